@@ -20,6 +20,8 @@ const buildOptions = {
 // Export global functions for Google Apps Script
 globalThis.doGet = Gas.doGet;
 globalThis.doPost = Gas.doPost;
+// Execution API (scripts.run) entry: function "api", parameters [{ op, ... }]
+globalThis.api = Gas.api;
 globalThis.authorizeOnce = Gas.authorizeOnce;
 // Dev test helpers (run from GAS editor)
 globalThis.testBooksFind = Gas.testBooksFind;
@@ -3,9 +3,10 @@
  * ルーター（index.ts）から呼ばれる純粋関数として実装。
  */
 import { CONFIG, isFindDebugEnabled } from "../config";
-import { ApiResponse, ok, ng, normalize, toNumberOrNull } from "../lib/common";
+import { ApiResponse, ok, ng, normalize, toNumberOrNull, parseFields, projectFields, wantsField } from "../lib/common";
 import { decidePrefix, nextIdForPrefix } from "../lib/id_rules";
-import { pickCol, parseMonthlyGoal } from "../lib/sheet_utils";
+import { pickCol, parseMonthlyGoal, openSpreadsheet } from "../lib/sheet_utils";
+import { deltaSince, fnv1a } from "../lib/delta";
 
 export type ChapterInfo = {
   idx: number | null;
@@ -27,7 +28,7 @@ export type BookDetails = {
 // 以降は index.ts から移植したロジック（必要箇所のみ）
 
 export function authorizeOnce(): void {
-  const ss = SpreadsheetApp.openById(CONFIG.BOOKS_FILE_ID);
+  const ss = openSpreadsheet(CONFIG.BOOKS_FILE_ID);
   const name = ss.getSheets()[0].getName();
   console.log("authorized OK, first sheet:", name);
 }
@@ -106,7 +107,7 @@ export function booksFind(req: Record<string, any>): ApiResponse {
 
   try {
     // --- シート読み込み ---
-    const sh = SpreadsheetApp.openById(file_id).getSheetByName(sheet);
+    const sh = openSpreadsheet(file_id).getSheetByName(sheet);
     if (!sh) return ng("books.find", "NOT_FOUND", `sheet '${sheet}' not found`);
 
     const values = sh.getDataRange().getValues();
@@ -243,6 +244,9 @@ export function booksGet(req: Record<string, any>): ApiResponse {
   const { book_id, book_ids, file_id = CONFIG.BOOKS_FILE_ID, sheet = CONFIG.BOOKS_SHEET } = req;
   const listParam: any = (Array.isArray(book_ids) ? book_ids : (Array.isArray(book_id) ? book_id : null));
   if (!book_id && !listParam) return ng("books.get", "BAD_REQUEST", "book_id または book_ids が必要です");
+  // fields 指定時は要求されたキーだけを返す（目次が不要なら章の行は組み立てない）
+  const fields = parseFields(req.fields);
+  const withChapters = wantsField(fields, "structure");
 
   const norm = (s: any): string => (s ?? "").toString().trim().toLowerCase().normalize("NFKC");
 
@@ -255,7 +259,7 @@ export function booksGet(req: Record<string, any>): ApiResponse {
   };
 
   try {
-    const sh = SpreadsheetApp.openById(file_id).getSheetByName(sheet);
+    const sh = openSpreadsheet(file_id).getSheetByName(sheet);
     if (!sh) return ng("books.get", "NOT_FOUND", `sheet '${sheet}' not found`);
 
     const values = sh.getDataRange().getValues();
@@ -313,7 +317,7 @@ export function booksGet(req: Record<string, any>): ApiResponse {
         const chEnd  = (IDX.chapEnd >= 0 ? toNumberOrNull(r[IDX.chapEnd]) : null);
         const chIdx  = (IDX.chapIdx >= 0 ? toNumberOrNull(r[IDX.chapIdx]) : null);
         const numSty = (IDX.numStyle >= 0 ? (r[IDX.numStyle] ?? "").toString().trim() : "");
-        if (chName || chBeg != null || chEnd != null) {
+        if (withChapters && (chName || chBeg != null || chEnd != null)) {
           booksMap[currentId].chapters.push({
             idx: chIdx ?? (booksMap[currentId].chapters.length + 1),
             title: chName || null,
@@ -336,7 +340,7 @@ export function booksGet(req: Record<string, any>): ApiResponse {
           structure: { chapters: b.chapters },
           assessment: { book_type: b.meta.book_type, quiz_type: b.meta.quiz_type, quiz_id: b.meta.quiz_id },
         };
-        return book;
+        return projectFields(book, fields);
       }).filter(Boolean);
 
       return ok("books.get", { books });
@@ -370,7 +374,7 @@ export function booksGet(req: Record<string, any>): ApiResponse {
       const chEnd  = (IDX.chapEnd >= 0 ? toNumberOrNull(r[IDX.chapEnd]) : null);
       const chIdx  = (IDX.chapIdx >= 0 ? toNumberOrNull(r[IDX.chapIdx]) : null);
       const numSty = (IDX.numStyle >= 0 ? (r[IDX.numStyle] ?? "").toString().trim() : "");
-      if (chName || chBeg != null || chEnd != null) {
+      if (withChapters && (chName || chBeg != null || chEnd != null)) {
         chapters.push({
           idx: chIdx ?? (chapters.length + 1),
           title: chName || null,
@@ -392,169 +396,154 @@ export function booksGet(req: Record<string, any>): ApiResponse {
       assessment: { book_type: meta.book_type, quiz_type: meta.quiz_type, quiz_id: meta.quiz_id },
     };
 
-    return ok("books.get", { book });
+    return ok("books.get", { book: projectFields(book, fields) });
   } catch (error: any) {
     return ng("books.get", "ERROR", error.message);
   }
 }
 
-/**
- * books.filter（書籍単位でグルーピングして返却）
- */
-export function booksFilter(req: Record<string, any>): ApiResponse {
-  // デフォルト挙動（2025-08-31 変更）:
-  // - limit未指定のときは常に上限なし（全件）とする（データ規模は数百冊想定）
-  // - 大量データでの利用時はクライアント側で limit 指定を推奨
-  const { where = {}, contains = {}, limit, file_id = CONFIG.BOOKS_FILE_ID, sheet = CONFIG.BOOKS_SHEET } = req;
-  try {
-    const sh = SpreadsheetApp.openById(file_id).getSheetByName(sheet);
-    if (!sh) return ng("books.filter", "NOT_FOUND", `sheet '${sheet}' not found`);
-
-    const values = sh.getDataRange().getValues();
-    if (!values.length) return ok("books.filter", { books: [], count: 0, limit });
+// books.filter / books.changed_since の列（見出しは空白・全半角・大小文字を無視して照合）
+const normHeader = (s: any): string => (s ?? "").toString().trim().toLowerCase().normalize("NFKC").replace(/\s+/g, "");
 
-    const headers = values.shift()!.map(h => String(h).trim());
-    const norm = (s: any): string => (s ?? "").toString().trim().toLowerCase().normalize("NFKC");
-    const pickCol = (headersArr: string[], candidates: string[]): number => {
-      const Hn = headersArr.map(h => norm(h).replace(/\s+/g, ""));
-      for (const c of candidates) {
-        const i = Hn.indexOf(norm(c).replace(/\s+/g, ""));
-        if (i >= 0) return i;
-      }
-      return -1;
-    };
+function pickBookCol(headers: string[], candidates: string[]): number {
+  const Hn = headers.map(normHeader);
+  for (const c of candidates) {
+    const i = Hn.indexOf(normHeader(c));
+    if (i >= 0) return i;
+  }
+  return -1;
+}
 
-    const IDX = {
-      id      : pickCol(headers, ["参考書ID", "ID", "id"]),
-      title   : pickCol(headers, ["参考書名", "タイトル", "書名", "title"]),
-      subject : pickCol(headers, ["教科", "科目", "subject"]),
-      goal    : pickCol(headers, ["月間目標", "goal"]),
-      unit    : pickCol(headers, ["単位当たり処理量", "単位処理量", "unit_load"]),
-      chapIdx : pickCol(headers, ["章立て"]),
-      chapName: pickCol(headers, ["章の名前", "章名"]),
-      chapBeg : pickCol(headers, ["章のはじめ", "開始", "begin", "start"]),
-      chapEnd : pickCol(headers, ["章の終わり", "終了", "end"]),
-      numStyle: pickCol(headers, ["番号の数え方", "番号", "numbering"]),
-      btype   : pickCol(headers, ["参考書のタイプ", "book_type"]),
-      qtype   : pickCol(headers, ["確認テストのタイプ", "quiz_type"]),
-      qid     : pickCol(headers, ["確認テストID", "quiz_id"])
-    };
+function bookColumns(headers: string[]) {
+  return {
+    id      : pickBookCol(headers, ["参考書ID", "ID", "id"]),
+    title   : pickBookCol(headers, ["参考書名", "タイトル", "書名", "title"]),
+    subject : pickBookCol(headers, ["教科", "科目", "subject"]),
+    goal    : pickBookCol(headers, ["月間目標", "goal"]),
+    unit    : pickBookCol(headers, ["単位当たり処理量", "単位処理量", "unit_load"]),
+    chapIdx : pickBookCol(headers, ["章立て"]),
+    chapName: pickBookCol(headers, ["章の名前", "章名"]),
+    chapBeg : pickBookCol(headers, ["章のはじめ", "開始", "begin", "start"]),
+    chapEnd : pickBookCol(headers, ["章の終わり", "終了", "end"]),
+    numStyle: pickBookCol(headers, ["番号の数え方", "番号", "numbering"]),
+    btype   : pickBookCol(headers, ["参考書のタイプ", "book_type"]),
+    qtype   : pickBookCol(headers, ["確認テストのタイプ", "quiz_type"]),
+    qid     : pickBookCol(headers, ["確認テストID", "quiz_id"]),
+    alias   : pickBookCol(headers, ["別名", "別称", "aliases"]), // 任意（MCP 側ミラーの books.find 用）
+  };
+}
 
-    const wherePairs = Object.entries(where as Record<string, any>);
-    const containsPairs = Object.entries(contains as Record<string, any>);
-    const colIndexFor = (k: string) => pickCol(headers, [k]);
-    const needCols = new Set<number>();
-    const whereIdx: [number, string][] = wherePairs.map(([k, v]) => {
-      const i = colIndexFor(k);
-      needCols.add(i);
-      return [i, String(v)];
-    });
-    const containsIdx: [number, string][] = containsPairs.map(([k, v]) => {
-      const i = colIndexFor(k);
-      needCols.add(i);
-      return [i, String(v)];
-    });
-
-    type BookBucket = {
-      meta: null | {
-        id: string;
-        title: string;
-        subject: string;
-        monthly_goal_text: string;
-        unit_load: number | null;
-        book_type: string;
-        quiz_type: string;
-        quiz_id: string;
-      };
-      chapters: ChapterInfo[];
-      cols: Record<number, string[]>;
-    };
+type BookCols = ReturnType<typeof bookColumns>;
 
-    const booksMap: Record<string, BookBucket> = {};
-    let currentId: string | null = null;
+function parseAliases(val: any): string[] {
+  if (val == null || val === "") return [];
+  try {
+    const x = JSON.parse(String(val));
+    if (Array.isArray(x)) return x.map(v => String(v));
+  } catch (_) {}
+  return String(val).split(/[,\u3001]/).map(s => s.trim()).filter(Boolean);
+}
 
-    for (const r of values) {
-      const idCell = (IDX.id >= 0 ? (r[IDX.id] ?? "").toString().trim() : "");
-      if (idCell) currentId = idCell;
-      if (!currentId) continue;
+// 参考書 ID → その本の行（ID 列が空の行は直前の本の章。同じ ID が離れて出てきたら同じ本にまとめる）。挿入順 = シートの順
+function groupBookRows(IDX: BookCols, values: any[][]): Record<string, any[][]> {
+  const groups: Record<string, any[][]> = {};
+  let currentId: string | null = null;
+  for (const r of values) {
+    const idCell = (IDX.id >= 0 ? (r[IDX.id] ?? "").toString().trim() : "");
+    if (idCell) currentId = idCell;
+    if (!currentId) continue;
+    (groups[currentId] ||= []).push(r);
+  }
+  return groups;
+}
 
-      const bucket = booksMap[currentId] || (booksMap[currentId] = {
-        meta: null,
-        chapters: [],
-        cols: {},
+// 1 冊ぶんの行から books.filter の形を作る（メタ情報は先頭行 = ID のある行、章は全行から）
+function bookRecord(IDX: BookCols, rows: any[][]): any {
+  const m = rows[0];
+  const chapters: ChapterInfo[] = [];
+  for (const r of rows) {
+    const chName = (IDX.chapName >= 0 ? (r[IDX.chapName] ?? "").toString().trim() : "");
+    const chBeg  = (IDX.chapBeg >= 0 ? toNumberOrNull(r[IDX.chapBeg]) : null);
+    const chEnd  = (IDX.chapEnd >= 0 ? toNumberOrNull(r[IDX.chapEnd]) : null);
+    const chIdx  = (IDX.chapIdx >= 0 ? toNumberOrNull(r[IDX.chapIdx]) : null);
+    const numSty = (IDX.numStyle >= 0 ? (r[IDX.numStyle] ?? "").toString().trim() : "");
+    if (chName || chBeg != null || chEnd != null) {
+      chapters.push({
+        idx: chIdx ?? (chapters.length + 1),
+        title: chName || null,
+        range: (chBeg != null || chEnd != null) ? { start: chBeg, end: chEnd } : null,
+        numbering: numSty || null,
       });
-
-      if (bucket.meta === null && idCell) {
-        bucket.meta = {
-          id: currentId,
-          title: (IDX.title >= 0 ? (r[IDX.title] ?? "").toString() : ""),
-          subject: (IDX.subject >= 0 ? (r[IDX.subject] ?? "").toString() : ""),
-          monthly_goal_text: (IDX.goal >= 0 ? (r[IDX.goal] ?? "").toString() : ""),
-          unit_load: (IDX.unit >= 0 ? toNumberOrNull(r[IDX.unit]) : null),
-          book_type: (IDX.btype >= 0 ? (r[IDX.btype] ?? "").toString() : ""),
-          quiz_type: (IDX.qtype >= 0 ? (r[IDX.qtype] ?? "").toString() : ""),
-          quiz_id  : (IDX.qid >= 0 ? (r[IDX.qid] ?? "").toString() : ""),
-        };
-      }
-
-      const chName = (IDX.chapName >= 0 ? (r[IDX.chapName] ?? "").toString().trim() : "");
-      const chBeg  = (IDX.chapBeg >= 0 ? toNumberOrNull(r[IDX.chapBeg]) : null);
-      const chEnd  = (IDX.chapEnd >= 0 ? toNumberOrNull(r[IDX.chapEnd]) : null);
-      const chIdx  = (IDX.chapIdx >= 0 ? toNumberOrNull(r[IDX.chapIdx]) : null);
-      const numSty = (IDX.numStyle >= 0 ? (r[IDX.numStyle] ?? "").toString().trim() : "");
-      if (chName || chBeg != null || chEnd != null) {
-        bucket.chapters.push({
-          idx: chIdx ?? (bucket.chapters.length + 1),
-          title: chName || null,
-          range: (chBeg != null || chEnd != null) ? { start: chBeg, end: chEnd } : null,
-          numbering: numSty || null,
-        });
-      }
-
-      for (const ci of needCols) {
-        if (ci < 0) continue;
-        const raw = r[ci];
-        if (raw == null || raw === "") continue;
-        (bucket.cols[ci] ||= []).push(String(raw));
-      }
     }
+  }
+  return {
+    id: (m[IDX.id] ?? "").toString().trim(),
+    title: (IDX.title >= 0 ? (m[IDX.title] ?? "").toString() : ""),
+    subject: (IDX.subject >= 0 ? (m[IDX.subject] ?? "").toString() : ""),
+    monthly_goal: {
+      text: (IDX.goal >= 0 ? (m[IDX.goal] ?? "").toString() : ""),
+      per_day_minutes: null,
+      days: null,
+      total_minutes_est: null,
+    },
+    unit_load: (IDX.unit >= 0 ? toNumberOrNull(m[IDX.unit]) : null),
+    structure: { chapters },
+    assessment: {
+      book_type: (IDX.btype >= 0 ? (m[IDX.btype] ?? "").toString() : ""),
+      quiz_type: (IDX.qtype >= 0 ? (m[IDX.qtype] ?? "").toString() : ""),
+      quiz_id  : (IDX.qid >= 0 ? (m[IDX.qid] ?? "").toString() : ""),
+    },
+    aliases: (IDX.alias >= 0 ? parseAliases(m[IDX.alias]) : []),
+  };
+}
+
+function readBookRows(file_id: string, sheet: string): { headers: string[]; values: any[][] } | null {
+  const sh = openSpreadsheet(file_id).getSheetByName(sheet);
+  if (!sh) return null;
+  const values = sh.getDataRange().getValues();
+  const headers = values.length ? values.shift()!.map(h => String(h).trim()) : [];
+  return { headers, values };
+}
 
-    const matchesBook = (b: BookBucket): boolean => {
+/**
+ * books.filter（書籍単位でグルーピングして返却）
+ */
+export function booksFilter(req: Record<string, any>): ApiResponse {
+  // デフォルト挙動（2025-08-31 変更）:
+  // - limit未指定のときは常に上限なし（全件）とする（データ規模は数百冊想定）
+  // - 大量データでの利用時はクライアント側で limit 指定を推奨
+  const { where = {}, contains = {}, limit, file_id = CONFIG.BOOKS_FILE_ID, sheet = CONFIG.BOOKS_SHEET } = req;
+  try {
+    const sheetRows = readBookRows(file_id, sheet);
+    if (!sheetRows) return ng("books.filter", "NOT_FOUND", `sheet '${sheet}' not found`);
+    const { headers, values } = sheetRows;
+    if (!headers.length) return ok("books.filter", { books: [], count: 0, limit });
+
+    const IDX = bookColumns(headers);
+    const whereIdx: [number, string][] = Object.entries(where as Record<string, any>).map(([k, v]) => [pickBookCol(headers, [k]), String(v)]);
+    const containsIdx: [number, string][] = Object.entries(contains as Record<string, any>).map(([k, v]) => [pickBookCol(headers, [k]), String(v)]);
+
+    // 本のどれかの行の値が一致すればよい（章ごとの列も対象）
+    const someRow = (rows: any[][], ci: number, test: (x: string) => boolean): boolean =>
+      rows.some(r => r[ci] != null && r[ci] !== "" && test(normalize(String(r[ci]))));
+    const matchesBook = (rows: any[][]): boolean => {
       for (const [ci, v] of whereIdx) {
-        if (ci < 0) return false;
-        const vals = b.cols[ci] || [];
-        if (!vals.some(x => normalize(x) === normalize(v))) return false;
+        if (ci < 0 || !someRow(rows, ci, x => x === normalize(v))) return false;
       }
       for (const [ci, v] of containsIdx) {
-        if (ci < 0) return false;
-        const vals = b.cols[ci] || [];
-        if (!vals.some(x => normalize(x).includes(normalize(v)))) return false;
+        if (ci < 0 || !someRow(rows, ci, x => x.includes(normalize(v)))) return false;
       }
       return true;
     };
 
+    const groups = groupBookRows(IDX, values);
     const results: any[] = [];
     const max = (typeof limit === 'number' && isFinite(limit) && limit > 0)
       ? Number(limit)
       : Number.POSITIVE_INFINITY;
-    for (const id of Object.keys(booksMap)) {
-      const b = booksMap[id];
-      if (!b.meta) continue;
-      if (!matchesBook(b)) continue;
-      results.push({
-        id: b.meta.id,
-        title: b.meta.title,
-        subject: b.meta.subject,
-        monthly_goal: {
-          text: b.meta.monthly_goal_text,
-          per_day_minutes: null,
-          days: null,
-          total_minutes_est: null,
-        },
-        unit_load: b.meta.unit_load,
-        structure: { chapters: b.chapters },
-        assessment: { book_type: b.meta.book_type, quiz_type: b.meta.quiz_type, quiz_id: b.meta.quiz_id },
-      });
+    for (const id of Object.keys(groups)) {
+      if (!matchesBook(groups[id])) continue;
+      results.push(bookRecord(IDX, groups[id]));
       if (results.length >= max) break;
     }
 
@@ -564,6 +553,32 @@ export function booksFilter(req: Record<string, any>): ApiResponse {
   }
 }
 
+/**
+ * books.changed_since（差分同期）
+ * - 入力: { cursor? }（前回の応答の cursor。初回は省略 → reset で全件）
+ * - 出力: { cursor, reset, upserts: books.filter と同じ形の書籍[], keys, deletes: キー[], total, changed }
+ * - 本ごとの生の行（と見出し）をハッシュして比べ、書籍の形を作るのは変わった本だけ
+ */
+export function booksChangedSince(req: Record<string, any>): ApiResponse {
+  const { cursor, file_id = CONFIG.BOOKS_FILE_ID, sheet = CONFIG.BOOKS_SHEET } = req;
+  try {
+    const sheetRows = readBookRows(file_id, sheet);
+    if (!sheetRows) return ng("books.changed_since", "NOT_FOUND", `sheet '${sheet}' not found`);
+    const { headers, values } = sheetRows;
+    const IDX = bookColumns(headers);
+    const groups = groupBookRows(IDX, values);
+    const sig = fnv1a(JSON.stringify(headers));
+    const entries = Object.keys(groups).map((id) => ({
+      id,
+      hash: fnv1a(sig + JSON.stringify(groups[id])),
+      build: () => bookRecord(IDX, groups[id]),
+    }));
+    return deltaSince("books.changed_since", "books", entries, cursor);
+  } catch (error: any) {
+    return ng("books.changed_since", "ERROR", error.message);
+  }
+}
+
 /**
  * books.create（自動ID付与）
  */
@@ -571,7 +586,7 @@ export function booksCreate(req: Record<string, any>): ApiResponse {
   const { title, subject, unit_load = null, monthly_goal = "", chapters = [], id_prefix } = req;
   if (!title || !subject) return ng("books.create", "BAD_REQUEST", "title と subject が必要です");
   try {
-    const sh = SpreadsheetApp.openById(CONFIG.BOOKS_FILE_ID).getSheetByName(CONFIG.BOOKS_SHEET);
+    const sh = openSpreadsheet(CONFIG.BOOKS_FILE_ID).getSheetByName(CONFIG.BOOKS_SHEET);
     if (!sh) return ng("books.create", "NOT_FOUND", `sheet '${CONFIG.BOOKS_SHEET}' not found`);
     const values = sh.getDataRange().getValues();
     if (!values.length) return ng("books.create", "EMPTY", "シートが空です");
@@ -647,7 +662,7 @@ export function booksUpdate(req: Record<string, any>): ApiResponse {
   if (!book_id) return ng("books.update", "BAD_REQUEST", "book_id が必要です");
   if (!updates || (typeof updates !== 'object' && !confirm_token)) return ng("books.update", "BAD_REQUEST", "updates が必要です");
   try {
-    const sh = SpreadsheetApp.openById(CONFIG.BOOKS_FILE_ID).getSheetByName(CONFIG.BOOKS_SHEET);
+    const sh = openSpreadsheet(CONFIG.BOOKS_FILE_ID).getSheetByName(CONFIG.BOOKS_SHEET);
     if (!sh) return ng("books.update", "NOT_FOUND", `sheet '${CONFIG.BOOKS_SHEET}' not found`);
     const values = sh.getDataRange().getValues();
     if (!values.length) return ng("books.update", "EMPTY", "シートが空です");
@@ -796,7 +811,7 @@ export function booksDelete(req: Record<string, any>): ApiResponse {
   const { book_id, confirm_token } = req;
   if (!book_id) return ng("books.delete", "BAD_REQUEST", "book_id が必要です");
   try {
-    const sh = SpreadsheetApp.openById(CONFIG.BOOKS_FILE_ID).getSheetByName(CONFIG.BOOKS_SHEET);
+    const sh = openSpreadsheet(CONFIG.BOOKS_FILE_ID).getSheetByName(CONFIG.BOOKS_SHEET);
     if (!sh) return ng("books.delete", "NOT_FOUND", `sheet '${CONFIG.BOOKS_SHEET}' not found`);
     const values = sh.getDataRange().getValues();
     if (!values.length) return ng("books.delete", "EMPTY", "シートが空です");
@@ -4,8 +4,8 @@
  * - 業務ロジック（プレビュー/確定、上書き方針など）は MCP 側で実装
  */
 import { CONFIG } from "../config";
-import { ApiResponse, ok, ng, toNumberOrNull } from "../lib/common";
-import { pickCol, headerKey } from "../lib/sheet_utils";
+import { ApiResponse, ok, ng, toNumberOrNull, versioned } from "../lib/common";
+import { pickCol, headerKey, openSpreadsheet } from "../lib/sheet_utils";
 
 type RowMap = Record<string, any>;
 
@@ -23,6 +23,18 @@ const WEEK_COLS = [
 // D1/L1/T1/AB1/AJ1（週開始日）
 const WEEK_START_ADDR = ["D1", "L1", "T1", "AB1", "AJ1"] as const;
 
+// weeks（週番号 1..5 の配列またはカンマ区切り）→ 対象週の集合。未指定は null（= 全週）
+function parseWeeks(x: any): Set<number> | null {
+  if (x === null || x === undefined || x === "") return null;
+  const items: any[] = Array.isArray(x) ? x : String(x).split(",");
+  const out = new Set<number>();
+  for (const w of items) {
+    const n = Number(String(w).trim());
+    if (Number.isInteger(n) && n >= 1 && n <= 5) out.add(n);
+  }
+  return out.size ? out : null;
+}
+
 // A/B/C/D 列（4〜30行）を 2 次元配列で取得
 function readABCD(sh: GoogleAppsScript.Spreadsheet.Sheet): any[][] {
   return sh.getRange(4, 1, 27, 4).getDisplayValues(); // A4:D30
@@ -39,6 +51,9 @@ function parseBookCode(raw: string): { month_code: number | null; book_id: strin
   return { month_code: Number.isFinite(code) ? code : null, book_id: id };
 }
 
+// 同一実行内（batch）で同じ生徒を何度も引かないよう解決結果を保持
+const _RESOLVED: Record<string, string | null> = {};
+
 // 学生IDからプランナーの Spreadsheet ID を解決
 // - req.spreadsheet_id があれば優先
 // - なければ Students Master から「スプレッドシート」URL もしくは「スピードプランナーID」を探す
@@ -46,8 +61,14 @@ function resolveSpreadsheetIdByStudent(req: RowMap): string | null {
   if (req.spreadsheet_id) return String(req.spreadsheet_id);
   const student_id = String(req.student_id || "").trim();
   if (!student_id) return null;
+  const key = `${req.students_file_id || ""}|${req.students_sheet || ""}|${student_id}`;
+  if (key in _RESOLVED) return _RESOLVED[key];
+  return (_RESOLVED[key] = resolveUncached(req, student_id));
+}
+
+function resolveUncached(req: RowMap, student_id: string): string | null {
   try {
-    const ssStu = SpreadsheetApp.openById(req.students_file_id || CONFIG.STUDENTS_FILE_ID);
+    const ssStu = openSpreadsheet(req.students_file_id || CONFIG.STUDENTS_FILE_ID);
     const shStu = ssStu.getSheetByName(req.students_sheet || CONFIG.STUDENTS_SHEET) || ssStu.getSheets()[0];
     if (!shStu) return null;
     const values = shStu.getDataRange().getValues();
@@ -93,7 +114,7 @@ function resolveSpreadsheetIdByStudent(req: RowMap): string | null {
 function openPlannerSheet(req: RowMap): GoogleAppsScript.Spreadsheet.Sheet | null {
   const fid = req.spreadsheet_id || resolveSpreadsheetIdByStudent(req);
   if (!fid) return null;
-  const ss = SpreadsheetApp.openById(fid);
+  const ss = openSpreadsheet(fid);
   // 1) 既定名で取得
   const named = ss.getSheetByName(SHEET_NAME);
   if (named) return named;
@@ -164,14 +185,16 @@ export function plannerDatesSet(req: RowMap): ApiResponse {
   }
 }
 
-// === metrics_get: 各週の E/F/G（行4〜30）を取得 ===
+// === metrics_get: 各週の E/F/G（行4〜30）を取得（if_none_match が現在の版なら not_modified） ===
 export function plannerMetricsGet(req: RowMap): ApiResponse {
   const sh = openPlannerSheet(req);
   if (!sh) return ng("planner.metrics.get", "NOT_FOUND", "planner sheet not found");
   const rows = sh.getMaxRows();
   const lastRow = Math.min(Math.max(rows, 30), 30); // 4..30 固定
+  const want = parseWeeks(req.weeks);
   const outWeeks: any[] = [];
   for (let wi = 0; wi < 5; wi++) {
+    if (want && !want.has(wi + 1)) continue; // 指定外の週は読まない
     const m = WEEK_COLS[wi];
     const range = sh.getRange(`${m.time}4:${m.guide}${lastRow}`);
     const vals = range.getDisplayValues();
@@ -186,21 +209,23 @@ export function plannerMetricsGet(req: RowMap): ApiResponse {
     });
     outWeeks.push({ week_index: wi + 1, column_time: m.time, column_unit: m.unit, column_guide: m.guide, items });
   }
-  return ok("planner.metrics.get", { weeks: outWeeks });
+  return versioned("planner.metrics.get", req, { weeks: outWeeks });
 }
 
-// === plan_get: 計画セル（H/P/X/AF/AN, 行4〜30） ===
+// === plan_get: 計画セル（H/P/X/AF/AN, 行4〜30）（if_none_match が現在の版なら not_modified） ===
 export function plannerPlanGet(req: RowMap): ApiResponse {
   const sh = openPlannerSheet(req);
   if (!sh) return ng("planner.plan.get", "NOT_FOUND", "planner sheet not found");
+  const want = parseWeeks(req.weeks);
   const outWeeks: any[] = [];
   for (let wi = 0; wi < 5; wi++) {
+    if (want && !want.has(wi + 1)) continue; // 指定外の週は読まない
     const m = WEEK_COLS[wi];
     const vals = sh.getRange(`${m.plan}4:${m.plan}30`).getDisplayValues();
     const items = vals.map((v, j) => ({ row: 4 + j, plan_text: String(v[0] || "") }));
     outWeeks.push({ week_index: wi + 1, column: m.plan, items });
   }
-  return ok("planner.plan.get", { weeks: outWeeks });
+  return versioned("planner.plan.get", req, { weeks: outWeeks });
 }
 
 // 文字数上限（仕様: 例の約1.3倍=52文字）
@@ -3,7 +3,7 @@
  * - 読み取り専用: 指定 (year, month) の行をフィルタして返す
  */
 import { ApiResponse, ok, ng, toNumberOrNull } from "../lib/common";
-import { pickCol, headerKey } from "../lib/sheet_utils";
+import { pickCol, headerKey, openSpreadsheet } from "../lib/sheet_utils";
 import { CONFIG } from "../config";
 
 type RowMap = Record<string, any>;
@@ -15,7 +15,7 @@ function resolveSpreadsheetIdByStudent(req: RowMap): string | null {
   const student_id = String(req.student_id || "").trim();
   if (!student_id) return null;
   try {
-    const ssStu = SpreadsheetApp.openById(req.students_file_id || CONFIG.STUDENTS_FILE_ID);
+    const ssStu = openSpreadsheet(req.students_file_id || CONFIG.STUDENTS_FILE_ID);
     const shStu = ssStu.getSheetByName(req.students_sheet || CONFIG.STUDENTS_SHEET) || ssStu.getSheets()[0];
     if (!shStu) return null;
     const values = shStu.getDataRange().getValues();
@@ -54,7 +54,7 @@ function resolveSpreadsheetIdByStudent(req: RowMap): string | null {
 function openMonthlySheet(req: RowMap): GoogleAppsScript.Spreadsheet.Sheet | null {
   const fid = req.spreadsheet_id || resolveSpreadsheetIdByStudent(req);
   if (!fid) return null;
-  const ss = SpreadsheetApp.openById(fid);
+  const ss = openSpreadsheet(fid);
   const sh = ss.getSheetByName(SHEET_NAME);
   return sh || null;
 }
@@ -3,15 +3,16 @@
  * - まずはスプレッドシート「生徒マスター」本体のみを対象（リンク先は扱わない）
  */
 import { CONFIG } from "../config";
-import { ApiResponse, ok, ng } from "../lib/common";
+import { ApiResponse, ok, ng, parseFields, projectFields } from "../lib/common";
 import { nextIdForPrefix } from "../lib/id_rules";
-import { pickCol, headerKey } from "../lib/sheet_utils";
+import { pickCol, headerKey, openSpreadsheet } from "../lib/sheet_utils";
+import { deltaSince, fnv1a } from "../lib/delta";
 
 type RowMap = Record<string, any>;
 
 function openStudentsSheet(file_id?: string, sheetName?: string): GoogleAppsScript.Spreadsheet.Sheet | null {
   const fid = file_id || CONFIG.STUDENTS_FILE_ID;
-  const ss = SpreadsheetApp.openById(fid);
+  const ss = openSpreadsheet(fid);
   if (sheetName && sheetName.trim()) return ss.getSheetByName(sheetName) as any;
   return ss.getSheets()[0];
 }
@@ -60,6 +61,25 @@ export function studentsList(req: RowMap): ApiResponse {
   return ok("students.list", { students: sliced, count: sliced.length });
 }
 
+// 差分同期: { cursor? } → { cursor, reset, upserts: students.list と同じ形の生徒[], keys, deletes: キー[], total, changed }
+// 生の行（と見出し）をハッシュして比べ、生徒の形を作るのは変わった行だけ
+export function studentsChangedSince(req: RowMap): ApiResponse {
+  const sh = openStudentsSheet(req.file_id, req.sheet);
+  if (!sh) return ng("students.changed_since", "NOT_FOUND", "students sheet not found");
+  const values = sh.getDataRange().getValues();
+  const headers = values.length ? values[0].map(String) : [];
+  const idxId = pickCol(headers, COLS.id);
+  const sig = fnv1a(JSON.stringify(headers));
+  const entries = values.slice(1)
+    .filter(r => r.join("") !== "")
+    .map(r => ({
+      id: String(idxId >= 0 ? (r[idxId] ?? "") : "").trim(),
+      hash: fnv1a(sig + JSON.stringify(r)),
+      build: () => rowToStudent(headers, r),
+    }));
+  return deltaSince("students.changed_since", "students", entries, req.cursor);
+}
+
 export function studentsFind(req: RowMap): ApiResponse {
   const { query, limit, file_id, sheet } = req;
   if (!query) return ng("students.find", "BAD_REQUEST", "query is required");
@@ -91,6 +111,7 @@ export function studentsFind(req: RowMap): ApiResponse {
 export function studentsGet(req: RowMap): ApiResponse {
   const { student_id, student_ids, file_id, sheet } = req;
   const list = Array.isArray(student_ids) ? student_ids : (Array.isArray(student_id) ? student_id : null);
+  const fields = parseFields(req.fields);
   const sh = openStudentsSheet(file_id, sheet);
   if (!sh) return ng("students.get", "NOT_FOUND", "students sheet not found");
   const values = sh.getDataRange().getValues();
@@ -101,7 +122,7 @@ export function studentsGet(req: RowMap): ApiResponse {
     const out: any[] = [];
     for (let r = 1; r < values.length; r++) {
       const id = String(idxId >= 0 ? values[r][idxId] : "").trim();
-      if (id && want.has(id)) out.push(rowToStudent(headers, values[r]));
+      if (id && want.has(id)) out.push(projectFields(rowToStudent(headers, values[r]), fields));
     }
     return ok("students.get", { students: out });
   }
@@ -109,7 +130,7 @@ export function studentsGet(req: RowMap): ApiResponse {
   if (!single) return ng("students.get", "BAD_REQUEST", "student_id or student_ids is required");
   for (let r = 1; r < values.length; r++) {
     const id = String(idxId >= 0 ? values[r][idxId] : "").trim();
-    if (id === single) return ok("students.get", { student: rowToStudent(headers, values[r]) });
+    if (id === single) return ok("students.get", { student: projectFields(rowToStudent(headers, values[r]), fields) });
   }
   return ng("students.get", "NOT_FOUND", `student '${single}' not found`);
 }
@@ -7,6 +7,7 @@
 // 設定と共通ユーティリティ
 import { CONFIG, isTableReadEnabled } from "./config";
 import { ApiResponse, ok, ng, createJsonResponse } from "./lib/common";
+import { withIdempotency } from "./lib/idempotency";
 // 書籍ハンドラ（実装本体）
 import {
   booksFind as booksFindHandler,
@@ -15,6 +16,7 @@ import {
   booksCreate as booksCreateHandler,
   booksUpdate as booksUpdateHandler,
   booksDelete as booksDeleteHandler,
+  booksChangedSince as booksChangedSinceHandler,
   authorizeOnce as handlersAuthorizeOnce,
 } from "./handlers/books";
 import {
@@ -25,6 +27,7 @@ import {
   studentsCreate as studentsCreateHandler,
   studentsUpdate as studentsUpdateHandler,
   studentsDelete as studentsDeleteHandler,
+  studentsChangedSince as studentsChangedSinceHandler,
 } from "./handlers/students";
 import {
   plannerIdsList as plannerIdsListHandler,
@@ -44,6 +47,77 @@ export function authorizeOnce(): void {
   handlersAuthorizeOnce();
 }
 
+/**
+ * op → ハンドラの振り分け（doGet/doPost/batch で共通）
+ * - 書き込み op に idempotency_key があれば、同じキーの再送は最初の応答を返す（lib/idempotency.ts）
+ */
+export function route(req: Record<string, any>): ApiResponse {
+  return withIdempotency(req, () => dispatch(req));
+}
+
+function dispatch(req: Record<string, any>): ApiResponse {
+  switch (req.op) {
+    case "books.find":   return booksFindHandler(req);
+    case "books.get":    return booksGetHandler(req);
+    case "books.filter": return booksFilterHandler(req);
+    case "books.create": return booksCreateHandler(req);
+    case "books.update": return booksUpdateHandler(req);
+    case "books.delete": return booksDeleteHandler(req);
+    case "books.changed_since": return booksChangedSinceHandler(req);
+    case "students.find":   return studentsFindHandler(req);
+    case "students.get":    return studentsGetHandler(req);
+    case "students.list":   return studentsListHandler(req);
+    case "students.filter": return studentsFilterHandler(req);
+    case "students.create": return studentsCreateHandler(req);
+    case "students.update": return studentsUpdateHandler(req);
+    case "students.delete": return studentsDeleteHandler(req);
+    case "students.changed_since": return studentsChangedSinceHandler(req);
+    // planner (weekly)
+    case "planner.ids_list":   return plannerIdsListHandler(req);
+    case "planner.dates.get":  return plannerDatesGetHandler(req);
+    case "planner.dates.set":  return plannerDatesSetHandler(req);
+    case "planner.metrics.get":return plannerMetricsGetHandler(req);
+    case "planner.plan.get":   return plannerPlanGetHandler(req);
+    case "planner.plan.set":   return plannerPlanSetHandler(req);
+    // planner (monthly)
+    case "planner.monthly.filter": return plannerMonthlyFilterHandler(req);
+    // 複数 op を 1 実行で
+    case "batch":           return batch(req);
+    case "table.read":      return (isTableReadEnabled() ? tableRead(req) : ng("table.read","DISABLED","table.read is disabled (set ENABLE_TABLE_READ=true in ScriptProperties)"));
+    case "ping":         return ok("ping", { status: "ok", timestamp: new Date().toISOString() });
+    default:              return ng(req.op || "unknown", "UNKNOWN_OP", "Unsupported op");
+  }
+}
+
+/**
+ * trace_id 付きのリクエスト（MCP サーバのトレース）を処理する
+ * - 応答の meta に trace_id と GAS 側の処理時間（elapsed_ms）を付け、実行ログにも 1 行残す
+ * - trace_id が無ければ route と同じ
+ */
+function traced(req: Record<string, any>): ApiResponse {
+  const traceId = typeof req.trace_id === "string" ? req.trace_id : "";
+  if (!traceId) return route(req);
+  const t0 = Date.now();
+  const res = route(req);
+  const elapsed = Date.now() - t0;
+  console.log(JSON.stringify({ trace_id: traceId, op: req.op, ok: res.ok, code: res.error?.code, elapsed_ms: elapsed }));
+  res.meta = { ...(res.meta || {}), trace_id: traceId, elapsed_ms: elapsed };
+  return res;
+}
+
+/**
+ * Execution API（scripts.run）入口
+ * - parameters: [{ op, ... }]（doPost の JSON ボディと同じ）→ 同じ形の応答を返す
+ * - WebApp と違い 302 のリダイレクトを挟まないので、MCP サーバは実測で速い方を選ぶ
+ */
+export function api(req: Record<string, any>): ApiResponse {
+  try {
+    return traced(req && typeof req === "object" ? req : {});
+  } catch (err: any) {
+    return ng((req && req.op) || "unknown", "UNCAUGHT", err.message, { stack: err.stack });
+  }
+}
+
 /**
  * HTTP GET 入口
  * - e.parameters を用いて `book_ids`（複数キー）を配列として解釈
@@ -62,36 +136,7 @@ export function doGet(e: GoogleAppsScript.Events.DoGet): GoogleAppsScript.Conten
   }
 
   if (p.op) {
-    const route = (req: Record<string, any>): ApiResponse => {
-      switch (req.op) {
-        case "books.find":   return booksFindHandler(req);
-        case "books.get":    return booksGetHandler(req);
-        case "books.filter": return booksFilterHandler(req);
-        case "books.create": return booksCreateHandler(req);
-        case "books.update": return booksUpdateHandler(req);
-        case "books.delete": return booksDeleteHandler(req);
-        case "students.find":   return studentsFindHandler(req);
-        case "students.get":    return studentsGetHandler(req);
-        case "students.list":   return studentsListHandler(req);
-        case "students.filter": return studentsFilterHandler(req);
-        case "students.create": return studentsCreateHandler(req);
-        case "students.update": return studentsUpdateHandler(req);
-        case "students.delete": return studentsDeleteHandler(req);
-        // planner (weekly)
-        case "planner.ids_list":   return plannerIdsListHandler(req);
-        case "planner.dates.get":  return plannerDatesGetHandler(req);
-        case "planner.dates.set":  return plannerDatesSetHandler(req);
-        case "planner.metrics.get":return plannerMetricsGetHandler(req);
-        case "planner.plan.get":   return plannerPlanGetHandler(req);
-        case "planner.plan.set":   return plannerPlanSetHandler(req);
-        // planner (monthly)
-        case "planner.monthly.filter": return plannerMonthlyFilterHandler(req);
-        case "table.read":      return (isTableReadEnabled() ? tableRead(req) : ng("table.read","DISABLED","table.read is disabled (set ENABLE_TABLE_READ=true in ScriptProperties)"));
-        case "ping":         return ok("ping", { status: "ok", timestamp: new Date().toISOString() });
-        default:              return ng(req.op || "unknown", "UNKNOWN_OP", "Unsupported op");
-      }
-    };
-    return createJsonResponse(route(p));
+    return createJsonResponse(traced(p));
   }
 
   return createJsonResponse(ok("ping", { params: p }));
@@ -104,37 +149,36 @@ export function doGet(e: GoogleAppsScript.Events.DoGet): GoogleAppsScript.Conten
 export function doPost(e: GoogleAppsScript.Events.DoPost): GoogleAppsScript.Content.TextOutput {
   try {
     const req = JSON.parse(e.postData?.contents || "{}");
-    switch (req.op) {
-      case "books.find":   return createJsonResponse(booksFindHandler(req));
-      case "books.get":    return createJsonResponse(booksGetHandler(req));
-      case "books.filter": return createJsonResponse(booksFilterHandler(req));
-      case "books.create": return createJsonResponse(booksCreateHandler(req));
-      case "books.update": return createJsonResponse(booksUpdateHandler(req));
-      case "books.delete": return createJsonResponse(booksDeleteHandler(req));
-      case "students.find":   return createJsonResponse(studentsFindHandler(req));
-      case "students.get":    return createJsonResponse(studentsGetHandler(req));
-      case "students.list":   return createJsonResponse(studentsListHandler(req));
-      case "students.filter": return createJsonResponse(studentsFilterHandler(req));
-      case "students.create": return createJsonResponse(studentsCreateHandler(req));
-      case "students.update": return createJsonResponse(studentsUpdateHandler(req));
-      case "students.delete": return createJsonResponse(studentsDeleteHandler(req));
-      // planner (weekly)
-      case "planner.ids_list":    return createJsonResponse(plannerIdsListHandler(req));
-      case "planner.dates.get":   return createJsonResponse(plannerDatesGetHandler(req));
-      case "planner.dates.set":   return createJsonResponse(plannerDatesSetHandler(req));
-      case "planner.metrics.get": return createJsonResponse(plannerMetricsGetHandler(req));
-      case "planner.plan.get":    return createJsonResponse(plannerPlanGetHandler(req));
-      case "planner.plan.set":    return createJsonResponse(plannerPlanSetHandler(req));
-      // planner (monthly)
-      case "planner.monthly.filter": return createJsonResponse(plannerMonthlyFilterHandler(req));
-      case "table.read":      return createJsonResponse(isTableReadEnabled() ? tableRead(req) : ng("table.read","DISABLED","table.read is disabled (set ENABLE_TABLE_READ=true in ScriptProperties)"));
-      default:               return createJsonResponse(ng(req.op || "unknown", "UNKNOWN_OP", "Unsupported op"));
-    }
+    return createJsonResponse(traced(req));
   } catch (err: any) {
     return createJsonResponse(ng("unknown", "UNCAUGHT", err.message, { stack: err.stack }));
   }
 }
 
+const BATCH_MAX = 50;
+
+/**
+ * batch（複数 op を 1 回の Apps Script 実行で処理）
+ * - 入力: { op:"batch", requests:[{op,...}, ...] }
+ * - 出力: data.results[i] が requests[i] の応答（順序を保持）。1 件の失敗は他に影響しない
+ * - 同一実行内なので openSpreadsheet のキャッシュにより同じファイルは 1 回だけ開く
+ */
+function batch(req: Record<string, any>): ApiResponse {
+  const list = req.requests;
+  if (!Array.isArray(list)) return ng("batch", "BAD_REQUEST", "requests[] is required");
+  if (list.length > BATCH_MAX) return ng("batch", "BAD_REQUEST", `too many requests (max ${BATCH_MAX})`);
+  const results = list.map((sub: any) => {
+    if (!sub || typeof sub !== "object") return ng("unknown", "BAD_REQUEST", "sub-request must be an object");
+    if (sub.op === "batch") return ng("batch", "BAD_REQUEST", "nested batch is not allowed");
+    try {
+      return route(sub);
+    } catch (err: any) {
+      return ng(sub.op || "unknown", "UNCAUGHT", err.message, { stack: err.stack });
+    }
+  });
+  return ok("batch", { results, count: results.length });
+}
+
 /**
  * テーブル読み取り（デバッグ用途）
  * - 注意: 本番運用では不要であれば無効化推奨
@@ -5,7 +5,7 @@
 export type ApiResponse = {
   ok: boolean;
   op?: string;
-  meta?: { ts: string };
+  meta?: { ts?: string; trace_id?: string; elapsed_ms?: number; idempotency_key?: string; replayed?: boolean };
   data?: any;
   error?: { code: string; message: string; details?: any };
 };
@@ -47,3 +47,47 @@ export function toNumberOrNull(x: any): number | null {
   return Number.isFinite(n) ? n : null;
 }
 
+
+// 射影（fields）: 配列またはカンマ区切り。未指定/空は null（= 全項目）
+export function parseFields(x: any): string[] | null {
+  if (x === null || x === undefined || x === "") return null;
+  const items: any[] = Array.isArray(x) ? x : String(x).split(",");
+  const out = Array.from(new Set(items.map((f) => String(f ?? "").trim()).filter((f) => f !== "")));
+  return out.length ? out : null;
+}
+
+// key（またはその配下 "key.sub"）が fields に含まれるか
+export function wantsField(fields: string[] | null, key: string): boolean {
+  return !fields || fields.some((f) => f === key || f.startsWith(key + "."));
+}
+
+// fields に挙がったキーだけを残す（"a.b" で 1 段下も指定可。keep は常に残す）
+export function projectFields(obj: any, fields: string[] | null, keep: string[] = ["id"]): any {
+  if (!fields || !obj || typeof obj !== "object" || Array.isArray(obj)) return obj;
+  const whole = new Set<string>(keep);
+  const nested: Record<string, string[]> = {};
+  for (const f of fields) {
+    const dot = f.indexOf(".");
+    if (dot < 0) whole.add(f);
+    else (nested[f.slice(0, dot)] = nested[f.slice(0, dot)] || []).push(f.slice(dot + 1));
+  }
+  const out: Record<string, any> = {};
+  for (const k of Object.keys(obj)) {
+    if (whole.has(k)) out[k] = obj[k];
+    else if (nested[k]) out[k] = projectFields(obj[k], nested[k], []);
+  }
+  return out;
+}
+
+// 内容の版トークン（ETag 相当）: 返す内容の JSON の MD5。手元の版と同じなら本文を返さずに済む
+export function contentVersion(x: any): string {
+  const digest = Utilities.computeDigest(Utilities.DigestAlgorithm.MD5, JSON.stringify(x), Utilities.Charset.UTF_8);
+  return digest.map((b) => ((b + 256) % 256).toString(16).padStart(2, "0")).join("");
+}
+
+// if_none_match が現在の版と一致すれば not_modified（本文なし）、違えば data に version を付けて返す
+export function versioned(op: string, req: Record<string, any>, data: Record<string, any>): ApiResponse {
+  const version = contentVersion(data);
+  if (req.if_none_match && String(req.if_none_match) === version) return ok(op, { not_modified: true, version });
+  return ok(op, { ...data, version });
+}
@@ -0,0 +1,100 @@
+/**
+ * マスター（参考書/生徒）の差分同期（changed_since）
+ * - レコードごとに内容ハッシュ（FNV-1a 32bit）を取り、カーソル発行時点の id→ハッシュ表と比べて
+ *   追加/変更（upserts）と削除（deletes）だけを返す
+ * - ハッシュは呼び出し側がシートの生の行（getValues）から取る。応答の形（books.filter / students.list と同じ）を
+ *   作るのは upserts に入るレコードだけ（変更がなければ 1 件も作らない）
+ * - id→ハッシュ表は ScriptCache に保存（6 時間。100KB/キーの上限に合わせて分割）。カーソルが不明・期限切れなら
+ *   reset=true で全件を返す（クライアントは手元の写しを置き換える）
+ * - 変更がなければ同じカーソルを返し、キャッシュへの書き込みもしない
+ * - 表のキーは recordKeys() の規則（ID が空の行・同じ ID の 2 行目以降も落とさない）。upserts と同じ並びの keys を返す
+ */
+import { ApiResponse, ok } from "./common";
+
+const STATE_TTL_SECONDS = 21600; // ScriptCache の上限（6 時間）
+const CHUNK_CHARS = 90000;
+
+// FNV-1a（32bit）。暗号用途ではなく変更検知用
+export function fnv1a(s: string): string {
+  let h = 0x811c9dc5;
+  for (let i = 0; i < s.length; i++) {
+    h ^= s.charCodeAt(i);
+    h = Math.imul(h, 0x01000193);
+  }
+  return (h >>> 0).toString(16).padStart(8, "0");
+}
+
+function saveState(cursor: string, state: Record<string, string>): void {
+  const text = Object.keys(state).map((id) => `${id}\t${state[id]}`).join("\n");
+  const parts: Record<string, string> = {};
+  let n = 0;
+  for (let i = 0; i < text.length || n === 0; i += CHUNK_CHARS) parts[`${cursor}:${n++}`] = text.slice(i, i + CHUNK_CHARS);
+  parts[`${cursor}:n`] = String(n);
+  CacheService.getScriptCache().putAll(parts, STATE_TTL_SECONDS);
+}
+
+function loadState(cursor: string): Record<string, string> | null {
+  const cache = CacheService.getScriptCache();
+  const n = Number(cache.get(`${cursor}:n`) || 0);
+  if (!n) return null;
+  const keys = Array.from({ length: n }, (_, i) => `${cursor}:${i}`);
+  const got = cache.getAll(keys);
+  if (keys.some((k) => got[k] == null)) return null;
+  const state: Record<string, string> = {};
+  for (const line of keys.map((k) => got[k]).join("").split("\n")) {
+    if (!line) continue;
+    const tab = line.indexOf("\t");
+    state[line.slice(0, tab)] = line.slice(tab + 1);
+  }
+  return state;
+}
+
+/**
+ * 写しのキー: ID（同じ ID の 2 件目以降は `ID#2`, `ID#3`…）。ID が空の行は `#内容ハッシュ`（同じ内容が続けば同じく `#2`…）
+ * - 行番号ではなく内容で決めるので、上に行が挿入されても他の行のキーは変わらない
+ */
+export function recordKeys(ids: string[], hashes: string[]): string[] {
+  const seen: Record<string, number> = {};
+  return ids.map((id, i) => {
+    const base = id || `#${hashes[i]}`;
+    const n = (seen[base] = (seen[base] || 0) + 1);
+    return n === 1 ? base : `${base}#${n}`;
+  });
+}
+
+/** 1 レコードぶん: ID（空可）、生の行のハッシュ、応答の形を作る関数（upserts に入るときだけ呼ぶ） */
+export type DeltaEntry = { id: string; hash: string; build: () => any };
+
+/**
+ * entries（シートの全件）とカーソルから差分応答を作る
+ * - kind: カーソルの名前空間（books / students）。別のマスターのカーソルは不明扱い
+ */
+export function deltaSince(op: string, kind: string, entries: DeltaEntry[], cursor: any): ApiResponse {
+  const keys = recordKeys(entries.map((e) => e.id), entries.map((e) => e.hash));
+  const state: Record<string, string> = {};
+  const byKey: Record<string, DeltaEntry> = {};
+  keys.forEach((k, i) => {
+    state[k] = entries[i].hash;
+    byKey[k] = entries[i];
+  });
+  const prev = typeof cursor === "string" && cursor.startsWith(kind + ":") ? loadState(cursor) : null;
+  const reset = prev === null;
+  const upserts: any[] = [];
+  const upsertKeys: string[] = [];
+  const deletes: string[] = [];
+  for (const k of Object.keys(state)) {
+    if (reset || prev![k] !== state[k]) {
+      upserts.push(byKey[k].build());
+      upsertKeys.push(k);
+    }
+  }
+  if (!reset) {
+    for (const k of Object.keys(prev!)) if (!(k in state)) deletes.push(k);
+  }
+  let next = cursor;
+  if (reset || upserts.length || deletes.length) {
+    next = `${kind}:${Utilities.getUuid()}`;
+    saveState(next, state);
+  }
+  return ok(op, { cursor: next, reset, upserts, keys: upsertKeys, deletes, total: entries.length, changed: upserts.length + deletes.length });
+}
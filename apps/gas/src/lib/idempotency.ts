@@ -0,0 +1,65 @@
+/**
+ * 書き込み op の冪等キー（idempotency_key）
+ * - MCP サーバは書き込みごとにキーを付け、タイムアウト等で同じリクエストを送り直すことがある
+ * - 最初の実行の応答を ScriptCache に保存し（6 時間）、同じキーの再送には実行せずに保存済みの応答を返す
+ * - 実行中の再送（ヘッジ・早すぎる再試行）は IN_PROGRESS を返す（MCP 側は一時的な失敗として待って送り直す）
+ * - 応答の meta.idempotency_key でキーを受け付けたことを知らせる（旧デプロイでは付かない＝MCP は書き込みを再送しない）
+ */
+import { ApiResponse, ng } from "./common";
+
+const RESULT_TTL_SECONDS = 21600; // ScriptCache の上限（6 時間）
+const PENDING_TTL_SECONDS = 360;  // Apps Script の実行時間上限（6 分）を超えたら実行中の印は消える
+const LOCK_WAIT_MS = 10000;
+const KEY_MAX = 128;
+
+// キーを受け付ける書き込み op（プレビュー段階の update/delete も同じ扱いで問題ない）
+export const KEYED_WRITES: Record<string, boolean> = {
+  "books.create": true,
+  "books.update": true,
+  "books.delete": true,
+  "students.create": true,
+  "students.update": true,
+  "students.delete": true,
+  "planner.plan.set": true,
+  "planner.dates.set": true,
+};
+
+function withKey(res: ApiResponse, key: string, replayed: boolean): ApiResponse {
+  return { ...res, meta: { ...(res.meta || {}), idempotency_key: key, replayed } };
+}
+
+/**
+ * req.idempotency_key があれば重複を排除して run を実行する（キーなし・対象外の op はそのまま run）
+ */
+export function withIdempotency(req: Record<string, any>, run: () => ApiResponse): ApiResponse {
+  const op = String(req.op || "");
+  const key = typeof req.idempotency_key === "string" ? req.idempotency_key.trim().slice(0, KEY_MAX) : "";
+  if (!key || !KEYED_WRITES[op]) return run();
+
+  const cache = CacheService.getScriptCache();
+  const slot = `idem:${op}:${key}`;
+  const lock = LockService.getScriptLock();
+  if (!lock.tryLock(LOCK_WAIT_MS)) return ng(op, "IN_PROGRESS", "could not acquire the idempotency lock; retry later");
+  try {
+    const saved = cache.get(slot);
+    if (saved === "pending") return ng(op, "IN_PROGRESS", "a request with the same idempotency_key is still running");
+    if (saved) return withKey(JSON.parse(saved), key, true);
+    cache.put(slot, "pending", PENDING_TTL_SECONDS);
+  } finally {
+    lock.releaseLock();
+  }
+
+  let res: ApiResponse;
+  try {
+    res = run();
+  } catch (err) {
+    cache.remove(slot); // 例外は書き込み前に落ちた可能性が高いので、再送で実行し直せるようにする
+    throw err;
+  }
+  try {
+    cache.put(slot, JSON.stringify(res), RESULT_TTL_SECONDS);
+  } catch (_) {
+    cache.remove(slot); // 100KB を超える応答は保存できない（再送は実行し直しになる）
+  }
+  return withKey(res, key, false);
+}
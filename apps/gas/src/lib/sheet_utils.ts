@@ -39,3 +39,16 @@ export function parseMonthlyGoal(txt: any): { text: string; per_day_minutes: num
   return { text: s, per_day_minutes: perDay, days: null, total_minutes_est: null };
 }
 
+
+/**
+ * 同一実行内での Spreadsheet オブジェクトの使い回し
+ * - batch で複数のサブリクエストが同じファイルを開くとき openById を 1 回にする
+ * - GAS のグローバルは実行ごとに初期化されるため、実行をまたいで古い状態は残らない
+ */
+const _SS_CACHE: Record<string, GoogleAppsScript.Spreadsheet.Spreadsheet> = {};
+
+export function openSpreadsheet(id: string): GoogleAppsScript.Spreadsheet.Spreadsheet {
+  const key = String(id);
+  if (!_SS_CACHE[key]) _SS_CACHE[key] = SpreadsheetApp.openById(key);
+  return _SS_CACHE[key];
+}
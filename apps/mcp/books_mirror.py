@@ -0,0 +1,279 @@
+"""参考書マスターのプロセス内ミラー。
+
+books.filter（条件なし）で全冊のスナップショットを取り込み、books.find / books.get /
+books.filter と同じ結果をローカルで計算する（GAS の handlers/books.ts と同じ規則）。
+
+- TTL 経過後は次回アクセス時に再取得（BOOKS_MIRROR_TTL 秒、既定 300）
+- create/update/delete 確定時はサーバ側から invalidate() する
+"""
+import asyncio
+import math
+import re
+import time
+import unicodedata
+from typing import Any, Awaitable, Callable
+
+Loader = Callable[[], Awaitable[dict]]
+
+# --- 正規化（GAS の normalize / books.find 内 norm / tokenize と同じ規則） ---
+
+_WS = re.compile(r"\s+")
+_KANJI_HIRA_KANJI = re.compile(r"([一-龯])[ぁ-ん]{1,2}([一-龯])")
+_TOKEN_SPLIT = re.compile(r"[^A-Za-z0-9_一-龯ぁ-んァ-ン]+")
+_STOPWORDS = {"問題集", "入試", "演習", "講座", "ノート", "完全", "総合", "実戦", "実践"}
+_SUBJECT_KEYS = ["現代文", "古文", "漢文", "古文漢文", "英語", "数学", "化学", "化学基礎", "物理", "生物", "生物基礎", "日本史", "世界史", "地理", "地学"]
+
+
+def normalize(s: Any) -> str:
+    """trim → 小文字 → NFKC → 空白除去（common.ts normalize 相当）。"""
+    return _WS.sub("", unicodedata.normalize("NFKC", _js_str(s).strip().lower()))
+
+
+def tokenize(s: Any) -> list[str]:
+    n = unicodedata.normalize("NFKC", _js_str(s))
+    n = _KANJI_HIRA_KANJI.sub(r"\1 \2", n).lower()
+    return [t for t in (p.strip() for p in _TOKEN_SPLIT.split(n)) if len(t) >= 2 and t not in _STOPWORDS]
+
+
+def _js_str(x: Any) -> str:
+    """String(x) 相当（null/undefined は空文字、整数値の float は小数点なし）。"""
+    if x is None:
+        return ""
+    if isinstance(x, bool):
+        return "true" if x else "false"
+    if isinstance(x, float) and x.is_integer():
+        return str(int(x))
+    return str(x)
+
+
+def _parse_monthly_goal(text: str) -> dict:
+    m = re.search(r"(\d+(?:\.\d+)?)\s*時間", text or "")
+    return {
+        "text": text or "",
+        "per_day_minutes": round(float(m.group(1)) * 60) if m else None,
+        "days": None,
+        "total_minutes_est": None,
+    }
+
+
+# シート見出し（正規化済み）→ 書籍1冊ぶんの値リスト。books.filter の「書籍の全行に対して評価」を再現する。
+def _chapters(b: dict) -> list[dict]:
+    return ((b.get("structure") or {}).get("chapters")) or []
+
+
+_COLUMN_VALUES: dict[str, Callable[[dict], list[Any]]] = {}
+for _names, _fn in [
+    (("参考書ID", "ID", "id"), lambda b: [b.get("id")]),
+    (("参考書名", "タイトル", "書名", "title"), lambda b: [b.get("title")]),
+    (("教科", "科目", "subject"), lambda b: [b.get("subject")]),
+    (("月間目標", "goal"), lambda b: [(b.get("monthly_goal") or {}).get("text")]),
+    (("単位当たり処理量", "単位処理量", "unit_load"), lambda b: [b.get("unit_load")]),
+    (("章立て",), lambda b: [c.get("idx") for c in _chapters(b)]),
+    (("章の名前", "章名"), lambda b: [c.get("title") for c in _chapters(b)]),
+    (("章のはじめ", "開始", "begin", "start"), lambda b: [(c.get("range") or {}).get("start") for c in _chapters(b)]),
+    (("章の終わり", "終了", "end"), lambda b: [(c.get("range") or {}).get("end") for c in _chapters(b)]),
+    (("番号の数え方", "番号", "numbering"), lambda b: [c.get("numbering") for c in _chapters(b)]),
+    (("参考書のタイプ", "book_type"), lambda b: [(b.get("assessment") or {}).get("book_type")]),
+    (("確認テストのタイプ", "quiz_type"), lambda b: [(b.get("assessment") or {}).get("quiz_type")]),
+    (("確認テストID", "quiz_id"), lambda b: [(b.get("assessment") or {}).get("quiz_id")]),
+    (("別名", "別称", "aliases"), lambda b: list(b.get("aliases") or [])),
+]:
+    for _n in _names:
+        _COLUMN_VALUES[normalize(_n)] = _fn
+
+
+def has_column(key: str) -> bool:
+    """見出し key をミラーで扱えるか（books.filter の列）。"""
+    return normalize(key) in _COLUMN_VALUES
+
+
+def column_values(book: dict, key: str) -> list[str] | None:
+    """見出し key に対応する値（空を除く文字列）。ミラーで扱えない列は None。"""
+    fn = _COLUMN_VALUES.get(normalize(key))
+    if fn is None:
+        return None
+    return [_js_str(v) for v in fn(book) if v is not None and v != ""]
+
+
+# --- books.find / get / filter のローカル実装 ---
+
+def find(books: list[dict], query: str, limit: int | None = 20) -> dict:
+    q = normalize(query)
+    q_tokens = tokenize(query)
+    query_subject = next((k for k in _SUBJECT_KEYS if k.lower() in q_tokens), None)
+
+    df: dict[str, int] = {}
+    docs = []
+    for b in books:
+        aliases = [str(a) for a in (b.get("aliases") or [])]
+        docs.append((b, aliases))
+        for t in set(tokenize(" ".join([_js_str(b.get("title")), *aliases]))):
+            df[t] = df.get(t, 0) + 1
+    n_docs = len(docs) or 1
+
+    def idf(t: str) -> float:
+        d = df.get(t, 0)
+        return math.log(((n_docs - d + 0.5) / (d + 0.5)) + 1)
+
+    uniq_q = list(dict.fromkeys(q_tokens))
+    sum_idf_q = sum(idf(t) for t in uniq_q) or 1
+
+    candidates = []
+    for b, aliases in docs:
+        bid, title, subject = _js_str(b.get("id")), _js_str(b.get("title")), _js_str(b.get("subject"))
+        hay = [h for h in (normalize(x) for x in [bid, title, subject, *aliases]) if h and len(h) >= 2]
+        combined = " ".join([title, *aliases])
+        combined_norm = normalize(combined)
+        title_toks = list(dict.fromkeys(tokenize(combined)))
+        title_tok_set = set(title_toks)
+
+        cov_fwd = sum(idf(t) for t in uniq_q if t in title_tok_set) / sum_idf_q
+        sum_idf_t = sum(idf(t) for t in title_toks) or 1
+        cov_rev = sum(idf(t) for t in title_toks if t in uniq_q) / sum_idf_t
+
+        score, reason = 0.0, ""
+        if any(h == q for h in hay):
+            score, reason = 1.0, "exact"
+        elif q in combined_norm:
+            score, reason = 0.95, "phrase"
+        elif any(q in h for h in hay):
+            score, reason = 0.90, "partial_target"
+        elif cov_fwd > 0:
+            score, reason = 0.80, "coverage_q_in_title"
+        elif cov_rev >= 0.6:
+            score, reason = 0.78, "coverage_title_in_q"
+        else:
+            short = q[:3] if len(q) >= 3 else ""
+            if short and any(short in h for h in hay):
+                score, reason = 0.72, "fuzzy3"
+
+        bonus = 0.0
+        if cov_fwd > 0:
+            bonus += min(0.12, 0.12 * cov_fwd)
+        if normalize(title).startswith(q):
+            bonus += 0.02
+        if query_subject:
+            subj_n = normalize(subject)
+            if subj_n and normalize(query_subject) == subj_n:
+                bonus += 0.02
+
+        final = min(1.0, score + bonus)
+        if final > 0:
+            candidates.append({"book_id": bid, "title": title, "subject": subject, "score": final, "reason": reason})
+
+    candidates.sort(key=lambda c: -c["score"])
+    cut = len(candidates)
+    for i in range(len(candidates) - 1):
+        if candidates[i]["score"] - candidates[i + 1]["score"] >= 0.05:
+            cut = i + 1
+            break
+    sliced = candidates[: min(limit, cut) if isinstance(limit, int) else cut]
+    conf = 0.0
+    if sliced:
+        s1 = sliced[0]["score"]
+        s2 = sliced[1]["score"] if len(sliced) > 1 else 0
+        conf = max(0.0, min(1.0, s1 - 0.25 * s2))
+    return {"query": query, "candidates": sliced, "top": sliced[0] if sliced else None, "confidence": conf}
+
+
+def _as_get(b: dict) -> dict:
+    """books.filter 形 → books.get 形（monthly_goal をパース、別名は含めない）。"""
+    out = {k: v for k, v in b.items() if k != "aliases"}
+    out["monthly_goal"] = _parse_monthly_goal((b.get("monthly_goal") or {}).get("text") or "")
+    return out
+
+
+def get(books: list[dict], book_id: str | None = None, book_ids: list[str] | None = None) -> dict:
+    """books.get の ok/ng 応答（GAS と同形）を返す。"""
+    by_id = {_js_str(b.get("id")): b for b in books}
+    if book_ids:
+        want = list(dict.fromkeys(str(x).strip() for x in book_ids))
+        return {"ok": True, "op": "books.get", "data": {"books": [_as_get(by_id[i]) for i in want if i in by_id]}}
+    target = str(book_id or "").strip()
+    b = by_id.get(target)
+    if b is None:
+        return {"ok": False, "op": "books.get", "error": {"code": "NOT_FOUND", "message": f"book '{target}' not found", "details": {}}}
+    return {"ok": True, "op": "books.get", "data": {"book": _as_get(b)}}
+
+
+def filter_books(books: list[dict], where: dict | None, contains: dict | None, limit: int | None) -> dict | None:
+    """books.filter のデータ部。ミラーで扱えない列が条件にあれば None（上流へ委ねる）。"""
+    conds: list[tuple[str, str, str]] = []
+    for mode, pairs in (("eq", where or {}), ("in", contains or {})):
+        for k, v in pairs.items():
+            if normalize(k) not in _COLUMN_VALUES:
+                return None
+            conds.append((mode, k, normalize(v)))
+    max_n = limit if isinstance(limit, int) and limit > 0 else None
+    results = []
+    for b in books:
+        ok = True
+        for mode, k, v in conds:
+            vals = [normalize(x) for x in column_values(b, k) or []]
+            if not (any(x == v for x in vals) if mode == "eq" else any(v in x for x in vals)):
+                ok = False
+                break
+        if ok:
+            results.append(b)
+            if max_n is not None and len(results) >= max_n:
+                break
+    return {"books": results, "count": len(results), "limit": max_n}
+
+
+class BooksMirror:
+    """books.filter の全件スナップショットを TTL 付きで保持する。"""
+
+    def __init__(self, loader: Loader, ttl: float = 300.0) -> None:
+        self._loader = loader
+        self.ttl = ttl
+        self._books: list[dict] | None = None
+        self._loaded_at = 0.0
+        self._lock: asyncio.Lock | None = None
+        self._lock_loop: asyncio.AbstractEventLoop | None = None
+        self.loads = 0
+        self.hits = 0
+
+    def _get_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock, self._lock_loop = asyncio.Lock(), loop
+        return self._lock
+
+    def fresh(self) -> bool:
+        return self._books is not None and (time.monotonic() - self._loaded_at) < self.ttl
+
+    def age(self) -> float | None:
+        return None if self._books is None else time.monotonic() - self._loaded_at
+
+    def invalidate(self) -> None:
+        self._books = None
+
+    async def books(self) -> list[dict] | None:
+        """有効なスナップショット（期限切れなら再取得）。取得に失敗したら None。"""
+        if self.fresh():
+            self.hits += 1
+            return self._books
+        async with self._get_lock():
+            if self.fresh():  # 待っている間に他のタスクが読み込んだ
+                self.hits += 1
+                return self._books
+            return await self.refresh()
+
+    async def refresh(self) -> list[dict] | None:
+        res = await self._loader()
+        if not isinstance(res, dict) or not res.get("ok"):
+            return None
+        self._books = [b for b in ((res.get("data") or {}).get("books") or []) if isinstance(b, dict)]
+        self._loaded_at = time.monotonic()
+        self.loads += 1
+        return self._books
+
+    def stats(self) -> dict:
+        return {
+            "loaded": self._books is not None,
+            "count": len(self._books or []),
+            "age_seconds": self.age(),
+            "ttl_seconds": self.ttl,
+            "loads": self.loads,
+            "hits": self.hits,
+        }
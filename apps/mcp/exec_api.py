@@ -1,11 +1,45 @@
+"""Apps Script Execution API（scripts.run）の呼び出しとアクセストークンの管理。
+
+WebApp（/exec）は毎回 script.google.com → googleusercontent.com の 302 を 1 往復挟むが、
+Execution API は 1 リクエストで結果が返る。GAS 側は `api(req)`（index.ts）が WebApp と同じ route を通す。
+
+トークンの取得元（上から順に使う）:
+- GAS_SA_KEY_FILE / GAS_SA_KEY_JSON: サービスアカウント鍵の JWT bearer（RFC 7523）。Apps Script API は
+  サービスアカウント自身では実行できないので、ドメイン全体の委任で GAS_SA_SUBJECT のユーザーとして実行する。
+  署名に PyJWT[crypto] が必要（任意依存。入っていなければ鍵があっても Execution API は使わない）
+- GAS_OAUTH_CLIENT_ID / GAS_OAUTH_CLIENT_SECRET / GAS_OAUTH_REFRESH_TOKEN: OAuth クライアントのリフレッシュトークン
+- GAS_ACCESS_TOKEN: 固定のアクセストークン（従来どおり。失効したら差し替える）
+
+取得したトークンは expires_in の 60 秒前まで使い回し、401 が返ったら捨てて 1 回だけ取り直す。
+トークンが取れない・取り直しても 401/403 のときは routing.NotSent（GAS で実行されていない）を送出する。
+"""
+import asyncio
 import os
-import sys
+import time
 from typing import Any, Sequence
-import httpx
+try:
+    from .http_pool import get_client  # when running as a package
+    from . import fastjson, tracing
+    from .routing import NotSent
+except Exception:
+    from http_pool import get_client    # when running as a script
+    import fastjson
+    import tracing
+    from routing import NotSent
+
+TOKEN_URL = "https://oauth2.googleapis.com/token"
+API_BASE = "https://script.googleapis.com"
+# WebApp と同じ権限（スプレッドシートの読み書き）。GAS_SCOPES（空白区切り）で上書き
+DEFAULT_SCOPES = "https://www.googleapis.com/auth/spreadsheets"
+_EXPIRY_SKEW = 60.0
 
 
-def log(*a: Any) -> None:
-    print(*a, file=sys.stderr, flush=True)
+def _has_jwt() -> bool:
+    try:
+        import jwt  # noqa: F401  PyJWT[crypto]（任意）
+    except ImportError:
+        return False
+    return True
 
 
 def _script_id() -> str:
@@ -15,11 +49,147 @@ def _script_id() -> str:
     return sid
 
 
-def _access_token() -> str:
-    tok = os.environ.get("GAS_ACCESS_TOKEN")
-    if not tok:
-        raise RuntimeError("GAS_ACCESS_TOKEN is not set")
-    return tok
+class TokenSource:
+    """アクセストークンを期限まで保持し、切れたら取り直す（同時に切れても取得は 1 回）。"""
+
+    def __init__(self, kind: str = "none", *, static: str | None = None, sa_key: dict | None = None, subject: str | None = None,
+                 client_id: str | None = None, client_secret: str | None = None, refresh_token: str | None = None,
+                 scopes: str = DEFAULT_SCOPES, token_url: str = TOKEN_URL) -> None:
+        self.kind = kind
+        self._static = static
+        self._sa_key = sa_key or {}
+        self._subject = subject
+        self._client = (client_id, client_secret, refresh_token)
+        self.scopes = scopes
+        self.token_url = token_url
+        self._token: str | None = None
+        self._expires = 0.0
+        self._lock: asyncio.Lock | None = None
+        self._lock_loop: asyncio.AbstractEventLoop | None = None
+        self.refreshes = 0
+        self.hits = 0
+        self.invalidations = 0
+        self.error: str | None = None
+
+    @classmethod
+    def from_env(cls) -> "TokenSource":
+        env = lambda k: (os.environ.get(k) or "").strip()  # noqa: E731
+        common = {"scopes": env("GAS_SCOPES") or DEFAULT_SCOPES, "token_url": env("GAS_TOKEN_URL") or TOKEN_URL}
+        if env("GAS_SA_KEY_FILE") or env("GAS_SA_KEY_JSON"):
+            raw = env("GAS_SA_KEY_JSON")
+            try:
+                if not raw:
+                    with open(env("GAS_SA_KEY_FILE"), "rb") as f:
+                        raw = f.read()
+                key = fastjson.loads(raw)
+            except (OSError, ValueError) as e:
+                # 鍵が読めなければ Execution API は使わない（WebApp だけで動かす）
+                src = cls("none", **common)
+                src.error = f"service account key: {e}"
+                return src
+            return cls("service_account", sa_key=key, subject=env("GAS_SA_SUBJECT") or None, **common)
+        if env("GAS_OAUTH_REFRESH_TOKEN"):
+            return cls("refresh_token", client_id=env("GAS_OAUTH_CLIENT_ID"), client_secret=env("GAS_OAUTH_CLIENT_SECRET"),
+                       refresh_token=env("GAS_OAUTH_REFRESH_TOKEN"), **common)
+        if env("GAS_ACCESS_TOKEN"):
+            return cls("static", static=env("GAS_ACCESS_TOKEN"), **common)
+        return cls("none", **common)
+
+    def configured(self) -> bool:
+        if self.kind == "service_account" and not _has_jwt():
+            self.error = "service-account tokens need PyJWT with cryptography (pip install 'pyjwt[crypto]')"
+            return False
+        return self.kind != "none"
+
+    def _get_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock, self._lock_loop = asyncio.Lock(), loop
+        return self._lock
+
+    def _valid(self) -> bool:
+        return self._token is not None and time.monotonic() < self._expires
+
+    async def token(self) -> str:
+        if self._valid():
+            self.hits += 1
+            return self._token  # type: ignore[return-value]
+        async with self._get_lock():
+            if self._valid():  # 待っている間に他のタスクが取得した
+                self.hits += 1
+                return self._token  # type: ignore[return-value]
+            if self.kind == "none":
+                raise RuntimeError("Execution API credentials are not set (GAS_SA_KEY_FILE / GAS_OAUTH_REFRESH_TOKEN / GAS_ACCESS_TOKEN)")
+            if self.kind == "static":
+                self._token, self._expires = self._static, float("inf")
+                return self._token  # type: ignore[return-value]
+            r = await get_client().post(self.token_url, data=self._grant())
+            r.raise_for_status()
+            d = fastjson.loads(r.content)
+            self._token = str(d["access_token"])
+            self._expires = time.monotonic() + float(d.get("expires_in") or 3600) - _EXPIRY_SKEW
+            self.refreshes += 1
+            return self._token
+
+    def _grant(self) -> dict[str, str]:
+        if self.kind == "refresh_token":
+            cid, secret, rt = self._client
+            return {"grant_type": "refresh_token", "client_id": cid or "", "client_secret": secret or "", "refresh_token": rt or ""}
+        try:
+            import jwt  # PyJWT[crypto]（任意）
+        except ImportError as e:
+            raise RuntimeError("service-account tokens need PyJWT with cryptography (pip install 'pyjwt[crypto]')") from e
+        now = int(time.time())
+        claims = {"iss": self._sa_key.get("client_email"), "scope": self.scopes, "aud": self.token_url, "iat": now, "exp": now + 3600}
+        if self._subject:
+            claims["sub"] = self._subject
+        headers = {"kid": self._sa_key["private_key_id"]} if self._sa_key.get("private_key_id") else None
+        assertion = jwt.encode(claims, self._sa_key.get("private_key"), algorithm="RS256", headers=headers)
+        return {"grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer", "assertion": assertion}
+
+    def invalidate(self) -> None:
+        """401 を受けたとき（失効・取り消し）に手元のトークンを捨てる。固定トークンは取り直せないのでそのまま。"""
+        if self.kind != "static":
+            self._token, self._expires = None, 0.0
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        return {
+            "source": self.kind,
+            "valid": self._valid(),
+            "expires_in": None if not self._valid() or self._expires == float("inf") else round(self._expires - time.monotonic()),
+            "refreshes": self.refreshes,
+            "hits": self.hits,
+            "invalidations": self.invalidations,
+            "error": self.error,
+        }
+
+
+# --- プロセス共有のトークン（ENV から作る。テストでは set_tokens で差し替え） ---
+_TOKENS: TokenSource | None = None
+
+
+def get_tokens() -> TokenSource:
+    global _TOKENS
+    if _TOKENS is None:
+        _TOKENS = TokenSource.from_env()
+    return _TOKENS
+
+
+def set_tokens(src: TokenSource | None) -> None:
+    """共有のトークン元を差し替える（None なら次回 ENV から作り直す）。"""
+    global _TOKENS
+    _TOKENS = src
+
+
+def available() -> bool:
+    """Execution API を経路に使えるか（SCRIPT_ID と資格情報がそろっている）。"""
+    return bool(os.environ.get("SCRIPT_ID")) and get_tokens().configured()
+
+
+def dev_mode_default() -> bool:
+    """EXEC_DEV_MODE=1 で最新の保存版（HEAD）を実行する（スクリプトのオーナーのみ可）。既定はデプロイ版。"""
+    return os.environ.get("EXEC_DEV_MODE", "0").strip().lower() not in ("0", "false", "off", "no", "")
 
 
 async def scripts_run(
@@ -30,11 +200,12 @@ async def scripts_run(
 ) -> dict:
     """Call Apps Script Execution API: scripts.run
 
-    Expects an OAuth2 access token in env var GAS_ACCESS_TOKEN that is authorized
-    to run the target script. Returns the `response.result` payload on success.
+    Uses the shared token source (service account / refresh token / GAS_ACCESS_TOKEN)
+    and the pooled client. Returns the `response.result` payload on success.
     """
     sid = script_id or _script_id()
-    url = f"https://script.googleapis.com/v1/scripts/{sid}:run"
+    base = (os.environ.get("EXEC_API_BASE") or API_BASE).rstrip("/")
+    url = f"{base}/v1/scripts/{sid}:run"
     body = {
         "function": function,
         "devMode": bool(dev_mode),
@@ -42,17 +213,28 @@ async def scripts_run(
     if parameters is not None:
         body["parameters"] = list(parameters)
 
-    headers = {
-        "Authorization": f"Bearer {_access_token()}",
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }
-
-    log("EXECUTION_API POST", url, body)
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.post(url, headers=headers, json=body)
+    tokens = get_tokens()
+    inner = parameters[0] if function == "api" and parameters and isinstance(parameters[0], dict) else {}
+    tracing.log_request("EXECUTION_API POST", url, body, op=f"api:{inner.get('op')}" if inner else function)
+    for attempt in (0, 1):
+        try:
+            token = await tokens.token()
+        except Exception as e:
+            raise NotSent(f"Execution API token: {e}") from e
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+        r = await get_client().post(url, headers=headers, content=fastjson.dumps(body))
+        if r.status_code == 401 and attempt == 0 and tokens.kind != "static":
+            tokens.invalidate()
+            continue
+        if r.status_code in (401, 403):
+            raise NotSent(f"Execution API rejected the credentials: HTTP {r.status_code}")
         r.raise_for_status()
-        data = r.json()
+        break
+    data = fastjson.loads(r.content)
 
     # Execution API success shape: { response: { result: ... } }
     resp = data.get("response") if isinstance(data, dict) else None
@@ -62,3 +244,17 @@ async def scripts_run(
     # Error shape passthrough
     return data
 
+
+async def call(req: dict[str, Any], dev_mode: bool | None = None) -> dict:
+    """WebApp と同じリクエスト dict を GAS の api(req) に渡し、同じ形の応答を返す。
+
+    スクリプト側の例外（{done, error:{details:[{errorMessage}]}}）は EXEC_API_ERROR にまとめる。
+    """
+    op = str(req.get("op") or "")
+    res = await scripts_run("api", [req], dev_mode=dev_mode_default() if dev_mode is None else dev_mode)
+    if isinstance(res, dict) and "ok" in res:
+        return res
+    err = (res.get("error") if isinstance(res, dict) else None) or {}
+    detail = next(iter(err.get("details") or []), {}) if isinstance(err, dict) else {}
+    msg = (detail or {}).get("errorMessage") or (err.get("message") if isinstance(err, dict) else None) or "unexpected Execution API response"
+    return {"ok": False, "op": op, "error": {"code": "EXEC_API_ERROR", "message": str(msg)}}
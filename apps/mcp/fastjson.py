@@ -0,0 +1,39 @@
+"""JSON のエンコード/デコード（orjson があれば使う）。
+
+- 上流応答（books.filter の全件・students.list など大きな本文）のデコード、応答キャッシュの格納/復元、
+  ツール応答サイズの計測で使う
+- orjson は任意依存。未インストール、または JSON_FAST=0 のときは標準の json にフォールバックする
+- どちらの実装でも loads は bytes/str を受け、壊れた JSON には ValueError（のサブクラス）を送出する
+"""
+import json
+import os
+from typing import Any, Callable
+
+try:  # pragma: no cover - 任意依存
+    import orjson as _orjson
+except ImportError:  # pragma: no cover
+    _orjson = None
+
+
+def _enabled() -> bool:
+    return _orjson is not None and os.environ.get("JSON_FAST", "1").strip().lower() not in ("0", "false", "off", "no", "")
+
+
+def backend() -> str:
+    return "orjson" if _enabled() else "json"
+
+
+def loads(data: bytes | bytearray | memoryview | str) -> Any:
+    if _enabled():
+        return _orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any, default: Callable[[Any], Any] | None = None) -> bytes:
+    """UTF-8 の compact な JSON（非 ASCII はそのまま）。default は変換できない値に使う。"""
+    if _enabled():
+        try:
+            return _orjson.dumps(obj, default=default)
+        except TypeError:
+            pass  # 非 str キーなど orjson が扱えない値は標準実装に任せる
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=default).encode("utf-8")
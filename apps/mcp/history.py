@@ -0,0 +1,262 @@
+"""月間管理の実績（planner.monthly.filter）を複数月まとめて集計する（planner_monthly_history）。
+
+- MonthCache: (シート, 年, 月) → items。締まった月（今月より前）は変わらないので期限なし、
+  今月以降は HISTORY_OPEN_TTL 秒（既定 300）。件数の上限（HISTORY_CACHE_MAX, 既定 4096）を超えたら古い順に捨てる
+- pace_stats: 全月・全行の週の実績を列（書籍キー/月/週/範囲の量/開始/終わり）に展開してから、
+  列ごとの内包表記と 1 回のグループ集計で書籍ごとのペースを出す（numpy は依存にないので純 Python の列指向）
+  - units: 実績の範囲の量（"No.1601~1700" → 100。複数範囲は合計、範囲のない記入は数えない）
+  - advance: 進んだ量（前の週までの最終位置より先の分。同じ範囲の繰り返しは 0、番号が戻れば章の数え直しとして全量）
+  - units_per_week / advance_per_week（実績のある週あたり）、minutes_per_unit（月間時間 ÷ その月の advance）、
+    trend（月ごとの advance_per_week の最小二乗の傾き。平均の ±10% を超えれば up/down）
+- weekly_advance: 同じ列から書籍ごとの週の advance の並び（planner_plan_targets のペースの観測）
+"""
+import datetime as dt
+import os
+import re
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any
+
+_RANGE = re.compile(r"(\d+)\s*[~〜\-]\s*(\d+)")
+_MONTH = re.compile(r"^\s*(\d{2}|\d{4})\s*[-/年.]\s*(\d{1,2})\s*月?\s*$")
+TREND_FLAT = 0.1
+
+
+def parse_month(x: Any) -> tuple[int, int] | None:
+    """"2025-07" / "25/7" / "2025年7月" / (2025, 7) → (2025, 7)。"""
+    if isinstance(x, (list, tuple)) and len(x) == 2:
+        y, m = x
+    else:
+        mt = _MONTH.match(unicodedata.normalize("NFKC", str(x or "")))
+        if not mt:
+            return None
+        y, m = mt.groups()
+    try:
+        y, m = int(y), int(m)
+    except (TypeError, ValueError):
+        return None
+    y = y + 2000 if 0 <= y < 100 else y
+    return (y, m) if 1 <= m <= 12 and 2000 <= y <= 2099 else None
+
+
+def _ordinal(ym: tuple[int, int]) -> int:
+    return ym[0] * 12 + ym[1] - 1
+
+
+def month_range(start: tuple[int, int], end: tuple[int, int]) -> list[tuple[int, int]]:
+    a, b = sorted((_ordinal(start), _ordinal(end)))
+    return [(o // 12, o % 12 + 1) for o in range(a, b + 1)]
+
+
+def recent_months(n: int = 3, today: dt.date | None = None) -> list[tuple[int, int]]:
+    """今月までの直近 n か月（古い順）。"""
+    d = today or dt.date.today()
+    o = _ordinal((d.year, d.month))
+    return [(x // 12, x % 12 + 1) for x in range(o - n + 1, o + 1)]
+
+
+def label(ym: tuple[int, int]) -> str:
+    return f"{ym[0]}-{ym[1]:02d}"
+
+
+def closed(ym: tuple[int, int], today: dt.date | None = None) -> bool:
+    d = today or dt.date.today()
+    return _ordinal(ym) < _ordinal((d.year, d.month))
+
+
+class MonthCache:
+    """(シートのキー, 年, 月) → planner.monthly.filter の items。"""
+
+    def __init__(self, open_ttl: float = 300.0, max_entries: int = 4096) -> None:
+        self.open_ttl = open_ttl
+        self.max_entries = max_entries
+        self._items: OrderedDict[tuple[str, int, int], tuple[float | None, list[dict]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+    @classmethod
+    def from_env(cls) -> "MonthCache":
+        return cls(float(os.environ.get("HISTORY_OPEN_TTL", "300")), int(os.environ.get("HISTORY_CACHE_MAX", "4096")))
+
+    def get(self, sheet: str, ym: tuple[int, int]) -> list[dict] | None:
+        key = (sheet, *ym)
+        got = self._items.get(key)
+        if got is None or (got[0] is not None and time.monotonic() >= got[0]):
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return got[1]
+
+    def put(self, sheet: str, ym: tuple[int, int], items: list[dict]) -> None:
+        expires = None if closed(ym) else time.monotonic() + self.open_ttl
+        if expires is not None and self.open_ttl <= 0:
+            return
+        self._items[(sheet, *ym)] = (expires, items)
+        self._items.move_to_end((sheet, *ym))
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+            self.evicted += 1
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._items),
+            "closed_entries": sum(1 for exp, _ in self._items.values() if exp is None),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else None,
+            "evicted": self.evicted,
+            "open_ttl_seconds": self.open_ttl,
+        }
+
+
+def _ranges(text: str) -> list[tuple[int, int]]:
+    out = []
+    for m in _RANGE.finditer(unicodedata.normalize("NFKC", text)):
+        a, b = int(m.group(1)), int(m.group(2))
+        out.append((a, b) if a <= b else (b, a))
+    return out
+
+
+def _num(x: Any) -> float | None:
+    return float(x) if isinstance(x, (int, float)) and not isinstance(x, bool) else None
+
+
+def book_key(it: dict) -> str:
+    bid = str(it.get("book_id") or "").strip()
+    return bid or "title:" + str(it.get("title") or "").strip()
+
+
+def _slope(xs: list[float], ys: list[float]) -> float | None:
+    n = len(xs)
+    if n < 2:
+        return None
+    mx, my = sum(xs) / n, sum(ys) / n
+    sxx = sum((x - mx) ** 2 for x in xs)
+    return sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx if sxx else None
+
+
+def _round(x: float | None, nd: int = 2) -> float | None:
+    return None if x is None else round(x, nd)
+
+
+def _week_columns(months: list[tuple[tuple[int, int], list[dict]]]) -> dict[str, list]:
+    """週の実績の列（keys/ords/weeks/texts/units/advance）。"""
+    # 1) 週の実績を列に展開（1 行 = 1 書籍 × 1 月 × 1 週）
+    items = [(ym, it) for ym, its in months for it in its if isinstance(it, dict)]
+    week_rows = [(ym, it, w) for ym, it in items for w in (it.get("weeks") or []) if isinstance(w, dict)]
+    keys = [book_key(it) for _, it, _ in week_rows]
+    ords = [_ordinal(ym) for ym, _, _ in week_rows]
+    weeks = [int(w.get("index") or 0) for _, _, w in week_rows]
+    texts = [str(w.get("actual") or "").strip() for _, _, w in week_rows]
+    spans = [_ranges(t) for t in texts]
+    units = [sum(b - a + 1 for a, b in sp) if sp else None for sp in spans]
+    starts = [min(a for a, _ in sp) if sp else None for sp in spans]
+    ends = [max(b for _, b in sp) if sp else None for sp in spans]
+
+    # 2) 進んだ量: 書籍ごとに時系列（月 → 週）で前の週までの最終位置と比べる
+    advance: list[int | None] = [None] * len(week_rows)
+    last_end: dict[str, int] = {}
+    seen: dict[str, set[str]] = {}
+    for i in sorted(range(len(week_rows)), key=lambda i: (keys[i], ords[i], weeks[i])):
+        if units[i] is None:
+            continue
+        k, prev, norm = keys[i], last_end.get(keys[i]), "".join(texts[i].split())
+        if norm in seen.setdefault(k, set()):
+            advance[i] = 0  # 同じ範囲の繰り返し（復習）
+        elif prev is None or (ends[i] <= prev and starts[i] == 1):
+            advance[i] = units[i]  # 初回 / 番号が 1 に戻った（章ごとの数え直し）
+            last_end[k] = ends[i]
+        elif ends[i] > prev:
+            advance[i] = min(units[i], ends[i] - max(prev, starts[i] - 1))
+            last_end[k] = ends[i]
+        else:
+            advance[i] = 0  # 前に進んだ範囲より手前（やり直し）
+        seen[k].add(norm)
+    return {"items": items, "keys": keys, "ords": ords, "weeks": weeks, "texts": texts, "units": units, "advance": advance}
+
+
+def weekly_advance(months: list[tuple[tuple[int, int], list[dict]]]) -> dict[str, list[int]]:
+    """[(年月, items)] → 書籍キー → 実績のある週ごとの進んだ量（時系列順）。planner_plan_targets のペース用。"""
+    c = _week_columns(months)
+    keys, ords, weeks, advance = c["keys"], c["ords"], c["weeks"], c["advance"]
+    out: dict[str, list[int]] = {}
+    for i in sorted(range(len(keys)), key=lambda i: (ords[i], weeks[i])):
+        if advance[i] is not None:
+            out.setdefault(keys[i], []).append(advance[i])
+    return out
+
+
+def pace_stats(months: list[tuple[tuple[int, int], list[dict]]]) -> list[dict]:
+    """[(年月, items)] → 書籍ごとのペース（書籍キーの初出順）。"""
+    c = _week_columns(months)
+    items, keys, ords, weeks, texts, units, advance = (c[k] for k in ("items", "keys", "ords", "weeks", "texts", "units", "advance"))
+
+    # 3) グループ集計（書籍 / 書籍 × 月）。書籍の順は items の初出順
+    order = list(dict.fromkeys(book_key(it) for _, it in items))
+    agg = {k: {"weeks": 0, "units": 0, "advance": 0, "months": {}, "last": None} for k in order}
+    for i, k in enumerate(keys):
+        if units[i] is None:
+            continue
+        g = agg[k]
+        g["weeks"] += 1
+        g["units"] += units[i]
+        g["advance"] += advance[i] or 0
+        pm = g["months"].setdefault(ords[i], [0, 0])
+        pm[0] += 1
+        pm[1] += advance[i] or 0
+        if g["last"] is None or (ords[i], weeks[i]) >= g["last"][0]:
+            g["last"] = ((ords[i], weeks[i]), texts[i])
+    meta: dict[str, dict] = {}
+    seen_months: dict[str, set[int]] = {}
+    minutes: dict[str, dict[int, float]] = {}
+    for ym, it in items:
+        k, o = book_key(it), _ordinal(ym)
+        meta.setdefault(k, it)
+        seen_months.setdefault(k, set()).add(o)
+        m = _num(it.get("monthly_minutes"))
+        if m is not None:
+            mk = minutes.setdefault(k, {})
+            mk[o] = mk.get(o, 0.0) + m
+
+    out = []
+    for k in order:
+        g, it = agg[k], meta[k]
+        per_month = sorted(g["months"].items())
+        xs = [float(o) for o, _ in per_month]
+        ys = [adv / n for _, (n, adv) in per_month]
+        slope = _slope(xs, ys)
+        apw = g["advance"] / g["weeks"] if g["weeks"] else None
+        mins = minutes.get(k, {})
+        used = [o for o, (_, adv) in per_month if adv > 0 and o in mins]
+        adv_used = sum(g["months"][o][1] for o in used)
+        direction = None
+        if slope is not None and apw:
+            direction = "up" if slope > TREND_FLAT * apw else "down" if slope < -TREND_FLAT * apw else "flat"
+        out.append({
+            "book_id": str(it.get("book_id") or "").strip() or None,
+            "title": it.get("title"),
+            "subject": it.get("subject"),
+            "months": [label((o // 12, o % 12 + 1)) for o in sorted(seen_months[k])],
+            "weeks_observed": g["weeks"],
+            "units_total": g["units"],
+            "advance_total": g["advance"],
+            "units_per_week": _round(g["units"] / g["weeks"]) if g["weeks"] else None,
+            "advance_per_week": _round(apw),
+            "minutes_per_unit": _round(sum(mins[o] for o in used) / adv_used) if adv_used else None,
+            "unit_load": it.get("unit_load"),
+            "guideline_amount": it.get("guideline_amount"),
+            "trend": {
+                "slope_per_month": _round(slope),
+                "direction": direction,
+                "per_month": [{"month": label((o // 12, o % 12 + 1)), "weeks": n, "advance_per_week": _round(adv / n)} for o, (n, adv) in per_month],
+            },
+            "last_actual": g["last"][1] if g["last"] else None,
+        })
+    return out
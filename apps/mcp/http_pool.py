@@ -0,0 +1,108 @@
+import asyncio
+import os
+import sys
+from typing import Any
+
+import httpx
+
+
+def log(*a: Any) -> None:
+    print(*a, file=sys.stderr, flush=True)
+
+
+def _env_int(key: str, default: int) -> int:
+    try:
+        return int(os.environ.get(key, "") or default)
+    except ValueError:
+        return default
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(os.environ.get(key, "") or default)
+    except ValueError:
+        return default
+
+
+def _http2_available() -> bool:
+    """HTTP/2 は h2 パッケージがあるときだけ有効（httpx[http2]）。HTTP_HTTP2=0 で無効化。"""
+    if os.environ.get("HTTP_HTTP2", "1").strip().lower() in ("0", "false", "off", "no"):
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def limits_from_env() -> httpx.Limits:
+    """接続プールの上限（ENV で調整可能）。
+
+    - HTTP_MAX_CONNECTIONS: 同時接続の上限（既定 20）
+    - HTTP_MAX_KEEPALIVE: keep-alive で保持する接続数（既定 10）
+    - HTTP_KEEPALIVE_EXPIRY: アイドル接続を閉じるまでの秒数（既定 60）
+    """
+    return httpx.Limits(
+        max_connections=_env_int("HTTP_MAX_CONNECTIONS", 20),
+        max_keepalive_connections=_env_int("HTTP_MAX_KEEPALIVE", 10),
+        keepalive_expiry=_env_float("HTTP_KEEPALIVE_EXPIRY", 60.0),
+    )
+
+
+def accept_encoding() -> str:
+    """上流に求める圧縮（HTTP_GZIP=0 で無圧縮）。大きな JSON 本文（books.filter の全件など）の転送量を減らす。"""
+    if os.environ.get("HTTP_GZIP", "1").strip().lower() in ("0", "false", "off", "no"):
+        return "identity"
+    return "gzip"
+
+
+def build_client(**overrides: Any) -> httpx.AsyncClient:
+    kw: dict[str, Any] = {
+        "timeout": _env_float("HTTP_TIMEOUT", 30.0),
+        "follow_redirects": True,
+        "limits": limits_from_env(),
+        "http2": _http2_available(),
+        "headers": {"Accept-Encoding": accept_encoding()},
+    }
+    kw.update(overrides)
+    return httpx.AsyncClient(**kw)
+
+
+# --- プロセス共有クライアント（script.google.com / googleusercontent への接続を使い回す） ---
+_CLIENT: httpx.AsyncClient | None = None
+_CLIENT_LOOP: asyncio.AbstractEventLoop | None = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """共有 AsyncClient を返す（未作成なら作る）。
+
+    接続はイベントループに紐づくため、別ループ（asyncio.run を複数回呼ぶテスト等）
+    から呼ばれた場合は作り直す。
+    """
+    global _CLIENT, _CLIENT_LOOP
+    loop = asyncio.get_running_loop()
+    if _CLIENT is None or _CLIENT.is_closed or _CLIENT_LOOP is not loop:
+        _CLIENT = build_client()
+        _CLIENT_LOOP = loop
+    return _CLIENT
+
+
+def set_client(client: httpx.AsyncClient | None) -> None:
+    """共有クライアントを差し替える（テストで transport を注入する用途）。"""
+    global _CLIENT, _CLIENT_LOOP
+    _CLIENT = client
+    _CLIENT_LOOP = asyncio.get_running_loop() if client is not None else None
+
+
+async def open_client() -> httpx.AsyncClient:
+    client = get_client()
+    log("HTTP pool opened", f"http2={_http2_available()}", f"accept-encoding={accept_encoding()}", limits_from_env())
+    return client
+
+
+async def close_client() -> None:
+    global _CLIENT, _CLIENT_LOOP
+    client, _CLIENT, _CLIENT_LOOP = _CLIENT, None, None
+    if client is not None and not client.is_closed:
+        await client.aclose()
+        log("HTTP pool closed")
@@ -0,0 +1,302 @@
+"""参考書/生徒マスターの差分同期（books.changed_since / students.changed_since）。
+
+GAS はカーソル発行時点の「id → 内容ハッシュ」表と今のシートを比べ、追加/変更（upserts）と
+削除（deletes）だけを返す。ここではそれを手元の写し（メモリ or SQLite）に当てて全件を保つ。
+
+- 初回・カーソル不明/期限切れ（GAS 側 6 時間）は reset=true の全件応答で写しを置き換える
+- 変更がなければ応答は空（同じカーソル）で、写しはそのまま
+- 写しのキーは GAS が upserts と並べて返す keys（ID。ID が空の行は #内容ハッシュ、同じ ID の 2 件目以降は ID#2…）。
+  keys のない旧応答は ID をキーにする
+- 旧デプロイで changed_since が UNKNOWN_OP のときは全件取得（books.filter / students.list）に戻る
+- SQLite の写し（MASTER_SYNC_PATH）はプロセス再起動後もカーソルごと残るので、起動直後から差分で追いつける
+- PlannerSheets: 生徒の写しから「生徒 ID → 週間管理シート」の対応を作る（planner.* に spreadsheet_id を添える用）
+"""
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable
+
+Fetch = Callable[[dict], Awaitable[dict]]
+
+# kind → (差分 op, 全件 op, 全件応答の data キー)
+KINDS: dict[str, tuple[str, str, str]] = {
+    "books": ("books.changed_since", "books.filter", "books"),
+    "students": ("students.changed_since", "students.list", "students"),
+}
+
+
+def row_keys(rows: list[dict]) -> list[str]:
+    """全件取得に戻ったときの写しのキー（GAS lib/delta.ts の recordKeys と同じ規則。ハッシュは手元で取る）。"""
+    seen: dict[str, int] = {}
+    keys = []
+    for r in rows:
+        rid = str(r.get("id") or "").strip()
+        base = rid or "#" + hashlib.md5(json.dumps(r, ensure_ascii=False, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:8]
+        n = seen[base] = seen.get(base, 0) + 1
+        keys.append(base if n == 1 else f"{base}#{n}")
+    return keys
+
+
+def _keyed(upserts: list[dict], keys: list[str] | None) -> list[tuple[str, dict]]:
+    if keys is None or len(keys) != len(upserts):
+        keys = [str(r.get("id")) for r in upserts]
+    return [(str(k), r) for k, r in zip(keys, upserts)]
+
+
+class MemoryCopy:
+    """プロセス内の写し（キー → レコード。挿入順 = シートの行順）。"""
+
+    name = "memory"
+
+    def __init__(self, kind: str) -> None:
+        self.kind = kind
+        self.cursor: str | None = None
+        self.version = 0  # 中身が変わるたびに増える（索引の作り直しの判定に使う）
+        self._rows: dict[str, dict] = {}
+
+    def rows(self) -> list[dict]:
+        return list(self._rows.values())
+
+    def count(self) -> int:
+        return len(self._rows)
+
+    def apply(self, cursor: str | None, reset: bool, upserts: list[dict], deletes: list[str], keys: list[str] | None = None) -> None:
+        if reset:
+            self._rows = {}
+        for k, r in _keyed(upserts, keys):
+            self._rows[k] = r
+        for i in deletes:
+            self._rows.pop(str(i), None)
+        self.cursor = cursor
+        self.version += int(bool(reset or upserts or deletes))
+
+
+class SQLiteCopy(MemoryCopy):
+    """SQLite ファイルに書き通す写し（WAL）。読み取りはメモリ上の dict から。"""
+
+    name = "sqlite"
+
+    def __init__(self, kind: str, path: str) -> None:
+        super().__init__(kind)
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._local = threading.local()
+        c = self._conn()
+        c.execute("CREATE TABLE IF NOT EXISTS master_rows (kind TEXT NOT NULL, id TEXT NOT NULL, body TEXT NOT NULL, PRIMARY KEY (kind, id))")
+        c.execute("CREATE TABLE IF NOT EXISTS master_cursor (kind TEXT PRIMARY KEY, cursor TEXT, synced REAL NOT NULL)")
+        row = c.execute("SELECT cursor FROM master_cursor WHERE kind=?", (kind,)).fetchone()
+        self.cursor = row[0] if row else None
+        # rowid 順 = 最初に入った順（ON CONFLICT DO UPDATE は rowid を変えない）
+        self._rows = {i: json.loads(b) for i, b in c.execute("SELECT id, body FROM master_rows WHERE kind=? ORDER BY rowid", (kind,))}
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def apply(self, cursor: str | None, reset: bool, upserts: list[dict], deletes: list[str], keys: list[str] | None = None) -> None:
+        c = self._conn()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            if reset:
+                c.execute("DELETE FROM master_rows WHERE kind=?", (self.kind,))
+            c.executemany(
+                "INSERT INTO master_rows(kind, id, body) VALUES (?,?,?) ON CONFLICT(kind, id) DO UPDATE SET body=excluded.body",
+                [(self.kind, k, json.dumps(r, ensure_ascii=False, default=str)) for k, r in _keyed(upserts, keys)],
+            )
+            c.executemany("DELETE FROM master_rows WHERE kind=? AND id=?", [(self.kind, str(i)) for i in deletes])
+            c.execute("INSERT OR REPLACE INTO master_cursor(kind, cursor, synced) VALUES (?,?,?)", (self.kind, cursor, time.time()))
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        c.execute("COMMIT")
+        super().apply(cursor, reset, upserts, deletes, keys)
+
+
+def make_copy(kind: str, path: str | None = None) -> MemoryCopy:
+    """MASTER_SYNC_PATH（または path）があれば SQLite、なければメモリの写し。"""
+    path = path if path is not None else os.environ.get("MASTER_SYNC_PATH", "").strip()
+    return SQLiteCopy(kind, path) if path else MemoryCopy(kind)
+
+
+class MasterSync:
+    """1 マスターぶんの差分同期。fetch は GAS への POST（server._post）。"""
+
+    def __init__(self, kind: str, fetch: Fetch, copy: MemoryCopy | None = None) -> None:
+        self.kind = kind
+        self.op, self.full_op, self.key = KINDS[kind]
+        self._fetch = fetch
+        self.copy = copy if copy is not None else make_copy(kind)
+        self.delta_supported = True
+        self.syncs = 0
+        self.resets = 0
+        self.full_loads = 0
+        self.upserts = 0
+        self.deletes = 0
+        self.synced_at: float | None = None
+
+    def rows(self) -> list[dict]:
+        return self.copy.rows()
+
+    async def sync(self) -> dict:
+        """差分を取り込んで写しを最新にする。失敗時は GAS のエラー応答をそのまま返す（写しは変えない）。"""
+        if self.delta_supported:
+            res = await self._fetch({"op": self.op, "cursor": self.copy.cursor})
+            if isinstance(res, dict) and res.get("ok"):
+                d = res.get("data") or {}
+                raw, keys = d.get("upserts") or [], d.get("keys")
+                if not isinstance(keys, list) or len(keys) != len(raw):
+                    keys = None
+                picked = [(str(keys[i]) if keys else None, r) for i, r in enumerate(raw) if isinstance(r, dict)]
+                ups = [r for _, r in picked]
+                dels = [str(i) for i in (d.get("deletes") or [])]
+                reset = bool(d.get("reset"))
+                self.copy.apply(d.get("cursor"), reset, ups, dels, [k for k, _ in picked] if keys else None)
+                return self._done(reset, len(ups), len(dels))
+            if not (isinstance(res, dict) and (res.get("error") or {}).get("code") == "UNKNOWN_OP"):
+                return res
+            self.delta_supported = False
+        res = await self._fetch({"op": self.full_op})
+        if not (isinstance(res, dict) and res.get("ok")):
+            return res
+        rows = [r for r in ((res.get("data") or {}).get(self.key) or []) if isinstance(r, dict)]
+        self.copy.apply(None, True, rows, [], row_keys(rows))
+        self.full_loads += 1
+        return self._done(True, len(rows), 0)
+
+    def _done(self, reset: bool, ups: int, dels: int) -> dict:
+        self.syncs += 1
+        self.resets += int(reset)
+        self.upserts += ups
+        self.deletes += dels
+        self.synced_at = time.time()
+        return {"ok": True, "op": self.op, "data": {"kind": self.kind, "reset": reset, "upserts": ups, "deletes": dels, "count": self.copy.count()}}
+
+    def stats(self) -> dict:
+        return {
+            "store": self.copy.name,
+            "count": self.copy.count(),
+            "cursor": self.copy.cursor,
+            "delta_supported": self.delta_supported,
+            "syncs": self.syncs,
+            "resets": self.resets,
+            "full_loads": self.full_loads,
+            "upserts": self.upserts,
+            "deletes": self.deletes,
+            "synced_at": self.synced_at,
+        }
+
+
+class PlannerSheets:
+    """生徒 ID → 週間管理シート（planner_sheet_id）の対応。生徒マスターの写しから作る。
+
+    planner.* に spreadsheet_id を添えて送れば、GAS は生徒シート全体を読んで探す処理
+    （resolveSpreadsheetIdByStudent）を飛ばせる。ttl 秒ごとに写しを差分同期して作り直し、
+    生徒の作成/更新/削除の確定では forget() で該当生徒を捨てる（その生徒の次の解決で差分同期する）。
+    対応が分からない生徒（ID 列ではなくリンクだけの行など）は None を返し、従来どおり GAS に解決させる。
+    """
+
+    _RETRY_AFTER_FAILURE = 30.0
+
+    def __init__(self, load: Callable[[], Awaitable[list[dict] | None]], ttl: float = 600.0) -> None:
+        self._load = load
+        self.ttl = ttl
+        self._map: dict[str, str] = {}
+        self._stale: set[str] = set()
+        self._next_load = 0.0
+        self._retry_at = 0.0  # 読み込みに失敗したら、forget() された生徒もこの時刻までは読み直さない
+        self._lock: asyncio.Lock | None = None
+        self._lock_loop: asyncio.AbstractEventLoop | None = None
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.load_failures = 0
+        self.forgotten = 0
+
+    def _get_lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._lock is None or self._lock_loop is not loop:
+            self._lock, self._lock_loop = asyncio.Lock(), loop
+        return self._lock
+
+    def fresh(self) -> bool:
+        return time.monotonic() < self._next_load
+
+    def _due(self, sid: str) -> bool:
+        return not self.fresh() or (sid in self._stale and time.monotonic() >= self._retry_at)
+
+    async def resolve(self, student_id: Any) -> str | None:
+        sid = str(student_id or "").strip()
+        if not sid:
+            return None
+        if self._due(sid):
+            async with self._get_lock():
+                if self._due(sid):  # 待っている間に他のタスクが読み込んだ
+                    await self.refresh()
+        spid = self._map.get(sid)
+        if spid:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return spid
+
+    async def refresh(self) -> bool:
+        try:
+            rows = await self._load()
+        except Exception:
+            rows = None
+        if rows is None:
+            self.load_failures += 1
+            self._next_load = self._retry_at = time.monotonic() + min(self.ttl, self._RETRY_AFTER_FAILURE)
+            return False
+        self._map = {}
+        self._stale = set()
+        self.learn(rows)
+        self.loads += 1
+        self._next_load = time.monotonic() + self.ttl
+        return True
+
+    def expire(self) -> None:
+        """次の解決で対応表を作り直す（読み取り元の切り替え時など）。"""
+        self._next_load = 0.0
+
+    def learn(self, rows: list[dict]) -> None:
+        for s in rows:
+            if not isinstance(s, dict):
+                continue
+            sid, spid = str(s.get("id") or "").strip(), str(s.get("planner_sheet_id") or "").strip()
+            if sid and spid:
+                self._map[sid] = spid
+            elif sid:
+                self._map.pop(sid, None)
+
+    def forget(self, student_id: Any = None) -> None:
+        """生徒マスターの書き込み後: 該当生徒を捨て、その生徒の次の解決で写しを読み直す（ID 不明なら全体）。"""
+        sid = str(student_id or "").strip()
+        if sid:
+            self._map.pop(sid, None)
+            self._stale.add(sid)
+        else:
+            self._map = {}
+            self._next_load = 0.0
+        self.forgotten += 1
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._map),
+            "fresh": self.fresh(),
+            "stale": len(self._stale),
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "load_failures": self.load_failures,
+            "forgotten": self.forgotten,
+        }
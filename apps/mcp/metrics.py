@@ -0,0 +1,248 @@
+"""Prometheus 形式のメトリクス（外部ライブラリなしの最小実装）。
+
+- ツール単位: 処理時間・1 回あたりの上流リクエスト数・応答バイト数のヒストグラム、呼び出し数、error.code 別の失敗数、処理中の数
+  - 応答バイト数は応答をもう 1 回 JSON にして測るので、ツールごとに METRICS_BYTES_SAMPLE 回に 1 回（既定 20, 初回は必ず）だけ測る。
+    0 で測らない
+- 上流（GAS op）単位: 処理時間のヒストグラム、リクエスト数、失敗数、処理中の数
+- キャッシュ系（応答キャッシュ/参考書ミラー/single-flight）は出力時に collector で最新値を読む
+
+`/metrics` は server.py の custom_route から `render()` を返す。
+"""
+import bisect
+import contextlib
+import contextvars
+import os
+import threading
+import time
+from typing import Any, Awaitable, Callable, Iterator
+
+try:
+    from . import fastjson
+except ImportError:  # when running as a script
+    import fastjson
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 13, 21, 50, 100)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _escape(v: Any) -> str:
+    return str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple[Any, ...], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict[str, Any]) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, n: float = 1, **labels: Any) -> None:
+        k = self._key(labels)
+        with self._lock:
+            self._values[k] = self._values.get(k, 0) + n
+
+    def value(self, **labels: Any) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_labels(self.labels, k)} {_num(v)}" for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, v: float, **labels: Any) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = v
+
+    def dec(self, n: float = 1, **labels: Any) -> None:
+        self.inc(-n, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[tuple, list] = {}  # key → [bucket counts..., sum, count]
+
+    def observe(self, v: float, **labels: Any) -> None:
+        k = self._key(labels)
+        i = bisect.bisect_left(self.buckets, v)
+        with self._lock:
+            row = self._values.get(k)
+            if row is None:
+                row = self._values[k] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                row[i] += 1
+            row[-2] += v
+            row[-1] += 1
+
+    def count(self, **labels: Any) -> int:
+        row = self._values.get(self._key(labels))
+        return row[-1] if row else 0
+
+    def render(self) -> list[str]:
+        out = self.header()
+        with self._lock:
+            items = sorted((k, list(row)) for k, row in self._values.items())
+        for k, row in items:
+            acc = 0
+            for b, n in zip(self.buckets + (float("inf"),), row[:-2] + [row[-1] - sum(row[:-2])]):
+                acc += n
+                le = 'le="' + _num(b) + '"'
+                out.append(f"{self.name}_bucket{_labels(self.labels, k, le)} {acc}")
+            out.append(f"{self.name}_sum{_labels(self.labels, k)} {_num(row[-2])}")
+            out.append(f"{self.name}_count{_labels(self.labels, k)} {row[-1]}")
+        return out
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: list[_Metric] = []
+        self.collectors: list[Callable[[], None]] = []
+
+    def add(self, m: Any) -> Any:
+        self.metrics.append(m)
+        return m
+
+    def render(self) -> str:
+        for c in self.collectors:
+            c()
+        lines: list[str] = []
+        for m in self.metrics:
+            lines += m.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+TOOL_SECONDS = REGISTRY.add(Histogram("cram_tool_duration_seconds", "MCP tool latency", ("tool",)))
+TOOL_CALLS = REGISTRY.add(Counter("cram_tool_calls_total", "MCP tool invocations", ("tool",)))
+TOOL_ERRORS = REGISTRY.add(Counter("cram_tool_errors_total", "MCP tool failures by error.code", ("tool", "code")))
+TOOL_UPSTREAM = REGISTRY.add(Histogram("cram_tool_upstream_requests", "Upstream GAS requests per tool invocation", ("tool",), COUNT_BUCKETS))
+TOOL_BYTES = REGISTRY.add(Histogram("cram_tool_response_bytes", "Tool response payload size (JSON bytes, sampled every METRICS_BYTES_SAMPLE calls)", ("tool",), BYTES_BUCKETS))
+TOOL_IN_FLIGHT = REGISTRY.add(Gauge("cram_tool_in_flight", "MCP tool calls in progress", ("tool",)))
+UPSTREAM_SECONDS = REGISTRY.add(Histogram("cram_upstream_duration_seconds", "Upstream request latency per GAS op", ("target", "op")))
+UPSTREAM_REQUESTS = REGISTRY.add(Counter("cram_upstream_requests_total", "Upstream requests per GAS op (each retry counts)", ("target", "op", "tool")))
+UPSTREAM_ERRORS = REGISTRY.add(Counter("cram_upstream_errors_total", "Upstream failures per GAS op by error code", ("target", "op", "code")))
+UPSTREAM_IN_FLIGHT = REGISTRY.add(Gauge("cram_upstream_in_flight", "Upstream requests in progress", ("target",)))
+CACHE_HITS = REGISTRY.add(Gauge("cram_cache_hits", "Cache hits since start", ("cache",)))
+CACHE_MISSES = REGISTRY.add(Gauge("cram_cache_misses", "Cache misses (upstream loads) since start", ("cache",)))
+CACHE_HIT_RATIO = REGISTRY.add(Gauge("cram_cache_hit_ratio", "Cache hit ratio since start", ("cache",)))
+
+# 実行中のツール呼び出し（上流リクエストをツールに帰属させる）
+_CURRENT: contextvars.ContextVar[dict | None] = contextvars.ContextVar("cram_tool_call", default=None)
+
+
+def current_tool() -> str:
+    call = _CURRENT.get()
+    return call["tool"] if call else ""
+
+
+def _error_code(res: Any) -> str | None:
+    if isinstance(res, dict) and res.get("ok") is False:
+        return str((res.get("error") or {}).get("code") or "UNKNOWN")
+    return None
+
+
+async def observe_tool(tool: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+    """ツール 1 回ぶんを計測する（入れ子のツール呼び出しは外側に含める）。"""
+    if _CURRENT.get() is not None:
+        return await fn()
+    call = {"tool": tool, "upstream": 0}
+    token = _CURRENT.set(call)
+    TOOL_CALLS.inc(tool=tool)
+    TOOL_IN_FLIGHT.inc(tool=tool)
+    t0 = time.perf_counter()
+    try:
+        res = await fn()
+    except Exception:
+        TOOL_ERRORS.inc(tool=tool, code="EXCEPTION")
+        raise
+    finally:
+        TOOL_SECONDS.observe(time.perf_counter() - t0, tool=tool)
+        TOOL_UPSTREAM.observe(call["upstream"], tool=tool)
+        TOOL_IN_FLIGHT.dec(tool=tool)
+        _CURRENT.reset(token)
+    code = _error_code(res)
+    if code:
+        TOOL_ERRORS.inc(tool=tool, code=code)
+    if _sample_bytes(tool):
+        try:
+            TOOL_BYTES.observe(len(fastjson.dumps(res, default=str)), tool=tool)
+        except (TypeError, ValueError):
+            pass
+    return res
+
+
+def _sample_bytes(tool: str) -> bool:
+    try:
+        every = int(os.environ.get("METRICS_BYTES_SAMPLE", "20") or 20)
+    except ValueError:
+        every = 20
+    return every > 0 and (int(TOOL_CALLS.value(tool=tool)) - 1) % every == 0
+
+
+@contextlib.contextmanager
+def upstream(op: str, target: str = "webapp") -> Iterator[dict]:
+    """上流リクエスト 1 回を計測する。with 内で box["result"] に応答 dict を入れると error.code も数える。"""
+    call = _CURRENT.get()
+    if call is not None:
+        call["upstream"] += 1
+    UPSTREAM_REQUESTS.inc(target=target, op=op, tool=call["tool"] if call else "")
+    UPSTREAM_IN_FLIGHT.inc(target=target)
+    box: dict[str, Any] = {}
+    t0 = time.perf_counter()
+    try:
+        yield box
+    except Exception as e:
+        status = getattr(getattr(e, "response", None), "status_code", None)
+        UPSTREAM_ERRORS.inc(target=target, op=op, code=f"HTTP_{status}" if status else type(e).__name__)
+        raise
+    finally:
+        UPSTREAM_SECONDS.observe(time.perf_counter() - t0, target=target, op=op)
+        UPSTREAM_IN_FLIGHT.dec(target=target)
+    code = _error_code(box.get("result"))
+    if code:
+        UPSTREAM_ERRORS.inc(target=target, op=op, code=code)
+
+
+def set_cache(cache: str, hits: float, misses: float) -> None:
+    CACHE_HITS.set(hits, cache=cache)
+    CACHE_MISSES.set(misses, cache=cache)
+    if hits + misses:
+        CACHE_HIT_RATIO.set(round(hits / (hits + misses), 4), cache=cache)
@@ -0,0 +1,72 @@
+"""応答の射影（fields / weeks）。GAS 側（lib/common.ts の projectFields, planner.ts の parseWeeks）と同じ規則。
+
+- fields: 残すキーの配列またはカンマ区切り。"structure.chapters" のように 1 段下も指定できる。
+  識別用のキー（books/students は id, planner の items は row）は常に残す
+- weeks: 残す週番号（1..5）の配列またはカンマ区切り
+いずれも未指定（None/空）なら何も削らない。
+"""
+from typing import Any
+
+
+def parse_fields(x: Any) -> list[str] | None:
+    if x is None:
+        return None
+    items = x if isinstance(x, (list, tuple)) else str(x).split(",")
+    out = [str(f).strip() for f in items if str(f or "").strip()]
+    return list(dict.fromkeys(out)) or None
+
+
+def parse_weeks(x: Any) -> list[int] | None:
+    if x is None or x == "":
+        return None
+    items = x if isinstance(x, (list, tuple)) else str(x).split(",")
+    out: list[int] = []
+    for w in items:
+        try:
+            n = int(str(w).strip())
+        except ValueError:
+            continue
+        if 1 <= n <= 5 and n not in out:
+            out.append(n)
+    return sorted(out) or None
+
+
+def wants(fields: list[str] | None, key: str) -> bool:
+    """key（またはその配下）が fields に含まれるか。fields 未指定なら常に True。"""
+    return not fields or any(f == key or f.startswith(key + ".") for f in fields)
+
+
+def project(obj: Any, fields: list[str] | None, keep: tuple[str, ...] = ("id",)) -> Any:
+    if not fields or not isinstance(obj, dict):
+        return obj
+    whole: set[str] = set(keep)
+    nested: dict[str, list[str]] = {}
+    for f in fields:
+        head, _, rest = f.partition(".")
+        if rest:
+            nested.setdefault(head, []).append(rest)
+        else:
+            whole.add(head)
+    out: dict[str, Any] = {}
+    for k, v in obj.items():
+        if k in whole:
+            out[k] = v
+        elif k in nested:
+            out[k] = project(v, nested[k], keep=())
+    return out
+
+
+def project_weeks(weeks: list[dict], want: list[int] | None, fields: list[str] | None = None) -> list[dict]:
+    """planner の weeks[]: 週の絞り込みと items の fields 射影（row は常に残す）。"""
+    out = []
+    for w in weeks or []:
+        try:
+            wi = int(w.get("week_index") or 0)
+        except (TypeError, ValueError):
+            wi = 0
+        if want and wi not in want:
+            continue
+        if fields:
+            w = {**w, "items": [project(it, fields, keep=("row",)) for it in w.get("items") or []]}
+        out.append(w)
+    return out
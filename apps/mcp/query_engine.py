@@ -0,0 +1,205 @@
+"""参考書/生徒マスターの写しに対するローカルのクエリエンジン（books_filter / students_filter）。
+
+- where: 完全一致（値がリストなら in）。辞書なら演算子 {"in":[...]} / {"prefix":"..."} / {"contains":"..."} /
+  {"gte":1, "lt":3}（gt/gte/lt/lte は数値として読めるセルだけが一致）。contains: 部分一致（従来どおり）
+- 比較は GAS と同じ正規化（trim → 小文字 → NFKC → 空白除去）。複数値の列（参考書の章など）はどれか 1 つが一致すれば一致
+- 索引: よく絞り込む列（教科・参考書のタイプ / Status・学年）の「正規化した値 → 行番号」。eq / in / prefix は
+  索引の候補（小さい順に積集合）から始め、残りの条件だけを候補に当てる。索引のない列も正規化済みの列を使い回す
+- sort: ["教科", "-unit_load"] / "教科,-参考書名"（- で降順。全行が数値として読める列は数値順、空は常に最後）。
+  limit / offset は並べ替えの後（sort なしは行の順）
+"""
+import bisect
+import re
+from typing import Any, Callable, Iterable
+
+try:
+    from .books_mirror import normalize
+except ImportError:  # when running as a script
+    from books_mirror import normalize
+
+# row, 正規化した列キー → その行の値（文字列）。扱えない列は None
+Values = Callable[[dict, str], list[str] | None]
+
+INDEXED_OPS = ("eq", "in", "prefix")
+RANGE_OPS = {"gt": lambda a, b: a > b, "gte": lambda a, b: a >= b, "lt": lambda a, b: a < b, "lte": lambda a, b: a <= b}
+OPS = (*INDEXED_OPS, "contains", *RANGE_OPS)
+_NUM = re.compile(r"^[+-]?(\d+(\.\d*)?|\.\d+)$")
+
+
+class QueryError(ValueError):
+    """条件・並べ替えの指定が不正（呼び出し側は BAD_INPUT にする）。"""
+
+
+def _num(s: str) -> float | None:
+    t = s.replace(",", "")
+    return float(t) if _NUM.match(t) else None
+
+
+def parse_conditions(where: Any = None, contains: Any = None) -> list[tuple[str, str, Any]]:
+    """where / contains → [(列キー（正規化）, 演算子, 比較値（正規化済み・範囲は数値）)]。"""
+    conds: list[tuple[str, str, Any]] = []
+    for k, v in (where if isinstance(where, dict) else {}).items():
+        col = normalize(k)
+        ops = v if isinstance(v, dict) else {"in": v} if isinstance(v, (list, tuple)) else {"eq": v}
+        for op, x in ops.items():
+            if op not in OPS:
+                raise QueryError(f"unknown operator '{op}' for '{k}' (use one of {', '.join(OPS)})")
+            if op == "in":
+                xs = x if isinstance(x, (list, tuple)) else [x]
+                conds.append((col, op, {normalize(e) for e in xs}))
+            elif op in RANGE_OPS:
+                n = _num(normalize(x))
+                if n is None:
+                    raise QueryError(f"'{k}' {op} needs a number: {x!r}")
+                conds.append((col, op, n))
+            else:
+                conds.append((col, op, normalize(x)))
+    for k, v in (contains if isinstance(contains, dict) else {}).items():
+        conds.append((normalize(k), "contains", normalize(v)))
+    return conds
+
+
+def parse_sort(x: Any) -> list[tuple[str, bool]]:
+    """"教科,-参考書名" / ["教科", "-unit_load"] → [(列キー（正規化）, 降順か)]。"""
+    items = x if isinstance(x, (list, tuple)) else str(x or "").split(",")
+    out = []
+    for it in items:
+        t = str(it or "").strip()
+        if t:
+            out.append((normalize(t.lstrip("+-")), t.startswith("-")))
+    return out
+
+
+def _match(vals: list[str], op: str, x: Any) -> bool:
+    if op == "eq":
+        return x in vals
+    if op == "in":
+        return any(v in x for v in vals)
+    if op == "prefix":
+        return any(v.startswith(x) for v in vals)
+    if op == "contains":
+        return any(x in v for v in vals)
+    cmp = RANGE_OPS[op]
+    return any(n is not None and cmp(n, x) for n in map(_num, vals))
+
+
+class Table:
+    """1 マスターぶんの行と列の索引。load() で行を差し替え（版が同じなら作り直さない）、query() で絞り込む。"""
+
+    def __init__(self, values: Values, indexed: Iterable[str] = (), known: Callable[[str], bool] | None = None) -> None:
+        self._values = values
+        self._known = known
+        self.indexed = tuple(normalize(c) for c in indexed)
+        self._rows: list[dict] = []
+        self._version: Any = None
+        self._columns: dict[str, list[list[str]]] = {}
+        self._index: dict[str, dict[str, list[int]]] = {}
+        self._keys: dict[str, list[str]] = {}
+        self.builds = 0
+        self.queries = 0
+        self.index_queries = 0
+        self.rows_scanned = 0
+
+    def load(self, rows: list[dict], version: Any) -> None:
+        if version == self._version and self._version is not None:
+            return
+        self._rows = list(rows)
+        self._version = version
+        self._columns = {}
+        self._index = {}
+        self._keys = {}
+        for col in self.indexed:
+            postings: dict[str, list[int]] = {}
+            for i, vals in enumerate(self.column(col)):
+                for v in dict.fromkeys(vals):
+                    postings.setdefault(v, []).append(i)
+            self._index[col] = postings
+            self._keys[col] = sorted(postings)
+        self.builds += 1
+
+    def column(self, col: str) -> list[list[str]]:
+        """列の正規化済みの値（行番号順）。初回に作って使い回す。"""
+        got = self._columns.get(col)
+        if got is None:
+            got = self._columns[col] = [[normalize(v) for v in self._values(r, col) or []] for r in self._rows]
+        return got
+
+    def known(self, col: str) -> bool:
+        return self._known is None or self._known(col)
+
+    def _postings(self, col: str, op: str, x: Any) -> set[int]:
+        idx = self._index[col]
+        if op == "eq":
+            return set(idx.get(x, ()))
+        if op == "in":
+            return {i for v in x for i in idx.get(v, ())}
+        keys = self._keys[col]
+        out: set[int] = set()
+        for k in keys[bisect.bisect_left(keys, x):]:
+            if not k.startswith(x):
+                break
+            out.update(idx[k])
+        return out
+
+    def query(self, where: Any = None, contains: Any = None, sort: Any = None,
+              limit: int | None = None, offset: int | None = None) -> dict | None:
+        """{rows, total, plan}。扱えない列が条件/並べ替えにあれば None（呼び出し側は上流へ）。"""
+        conds = parse_conditions(where, contains)
+        order = parse_sort(sort)
+        if not all(self.known(c) for c, _, _ in conds) or not all(self.known(c) for c, _ in order):
+            return None
+        self.queries += 1
+        cands: set[int] | None = None
+        used: list[str] = []
+        rest: list[tuple[str, str, Any]] = []
+        by_size = []
+        for cond in conds:
+            col, op, x = cond
+            if op in INDEXED_OPS and col in self._index:
+                by_size.append(self._postings(col, op, x))
+                used.append(col)
+            else:
+                rest.append(cond)
+        for p in sorted(by_size, key=len):
+            cands = p if cands is None else cands & p
+            if not cands:
+                break
+        positions: Iterable[int] = sorted(cands) if cands is not None else range(len(self._rows))
+        scanned = 0
+        hits: list[int] = []
+        for i in positions:
+            scanned += 1
+            if all(_match(self.column(col)[i], op, x) for col, op, x in rest):
+                hits.append(i)
+        self.index_queries += int(bool(used))
+        self.rows_scanned += scanned
+        for col, desc in reversed(order):
+            hits = self._sorted(hits, col, desc)
+        start = offset if isinstance(offset, int) and offset > 0 else 0
+        end = start + limit if isinstance(limit, int) and limit > 0 else None
+        return {
+            "rows": [self._rows[i] for i in hits[start:end]],
+            "total": len(hits),
+            "plan": {"indexes": used, "candidates": len(cands) if cands is not None else len(self._rows), "scanned": scanned, "rows": len(self._rows)},
+        }
+
+    def _sorted(self, hits: list[int], col: str, desc: bool) -> list[int]:
+        vals = self.column(col)
+        firsts = {i: (vals[i][0] if vals[i] else "") for i in hits}
+        nums = {i: _num(v) for i, v in firsts.items() if v}
+        numeric = all(n is not None for n in nums.values())
+        present = [i for i in hits if firsts[i]]
+        empty = [i for i in hits if not firsts[i]]  # 空は昇順/降順どちらでも最後
+        present.sort(key=(lambda i: nums[i]) if numeric else (lambda i: firsts[i]), reverse=desc)
+        return present + empty
+
+    def stats(self) -> dict:
+        return {
+            "rows": len(self._rows),
+            "indexed": list(self.indexed),
+            "columns_cached": len(self._columns),
+            "builds": self.builds,
+            "queries": self.queries,
+            "index_queries": self.index_queries,
+            "rows_scanned": self.rows_scanned,
+        }
@@ -0,0 +1,254 @@
+"""上流（WebApp / Execution API）呼び出しの耐障害層。
+
+- 冪等な読み取り op を指数バックオフ＋ジッタ（full jitter）で再試行する。書き込みは冪等キー（idempotency_key）付きで
+  GAS がキーを受け付けると分かっているときだけ RETRY_WRITE_MAX 回まで再試行する（同じキーの再送は GAS が最初の応答を返す）
+- 一時的な失敗とみなすもの: 408/425/429/5xx、接続エラー/タイムアウト、WebApp が HTML を返した BAD_JSON、
+  同じキーの書き込みが GAS で実行中（IN_PROGRESS）
+- 宛先（webapp / exec_api）ごとのサーキットブレーカー: 連続失敗が CB_FAILURES 回に達したら
+  CB_RESET_SECONDS の間は上流へ投げずに CIRCUIT_OPEN を返す。経過後は 1 本だけ試し、成功で閉じる
+- ヘッジ（HEDGE=1 で有効, 既定オフ）: 読み取りが op ごとの p95 を過ぎても返らなければ 2 本目を投げ、早い方を採用する
+
+op ごとの上書き（OP は planner.plan.get → PLANNER_PLAN_GET）:
+- RETRY_<OP>=回数（読み取りと冪等キー付きの書き込みで有効。既定 RETRY_MAX=2 / 書き込みは RETRY_WRITE_MAX=4）
+- HEDGE_<OP>=0/1
+"""
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+import httpx
+
+Fetch = Callable[[], Awaitable[Any]]
+
+TRANSIENT_STATUS = {408, 425, 429, 500, 502, 503, 504}
+TRANSIENT_CODES = {"BAD_JSON", "IN_PROGRESS"}
+# 冪等キーを付けて送る書き込み op（GAS の lib/idempotency.ts と同じ集合）
+KEYED_WRITES = {
+    "books.create", "books.update", "books.delete",
+    "students.create", "students.update", "students.delete",
+    "planner.plan.set", "planner.dates.set",
+}
+
+_HEDGE_MIN_SAMPLES = 20  # p95 を信用するのに必要な計測数
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(os.environ.get(key, "") or default)
+    except ValueError:
+        return default
+
+
+def _env_on(key: str, default: str = "1") -> bool:
+    return os.environ.get(key, default).strip().lower() not in ("0", "false", "off", "no", "")
+
+
+def _op_env(prefix: str, op: str) -> str:
+    return prefix + op.upper().replace(".", "_")
+
+
+def transient_error(e: BaseException) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code in TRANSIENT_STATUS
+    return isinstance(e, httpx.TransportError)
+
+
+def transient_result(res: Any) -> bool:
+    if not isinstance(res, dict) or res.get("ok"):
+        return False
+    return str((res.get("error") or {}).get("code") or "") in TRANSIENT_CODES
+
+
+class Breaker:
+    """連続失敗で開き、reset 秒後に 1 本だけ試す（half-open）。"""
+
+    def __init__(self, threshold: int = 5, reset: float = 30.0) -> None:
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.trial = False
+        self.opens = 0
+
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if self.trial or self.retry_in() <= 0 else "open"
+
+    def retry_in(self) -> float:
+        return 0.0 if self.opened_at is None else max(0.0, self.opened_at + self.reset - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if not self.trial and self.retry_in() <= 0:
+            self.trial = True
+            return True
+        return False
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.trial or (self.opened_at is None and self.failures >= self.threshold):
+            self.opens += 1
+            self.opened_at = time.monotonic()
+        self.trial = False
+
+    def release(self) -> None:
+        """成否を判定しなかった試行（キャンセル・一時的でない例外）の後始末。"""
+        self.trial = False
+
+
+class Resilience:
+    def __init__(self, retries: int = 2, base_delay: float = 0.2, max_delay: float = 2.0,
+                 cb_failures: int = 5, cb_reset: float = 30.0, hedge_min: float = 0.2, seed: int | None = None,
+                 write_retries: int = 4) -> None:
+        self.retries = retries
+        self.write_retries = write_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.cb_failures = cb_failures
+        self.cb_reset = cb_reset
+        self.hedge_min = hedge_min
+        self._rnd = random.Random(seed)
+        self._breakers: dict[str, Breaker] = {}
+        self._latency: dict[str, deque] = {}
+        self.attempts: dict[str, int] = {}
+        self.retried: dict[str, int] = {}
+        self.gave_up: dict[str, int] = {}
+        self.rejected: dict[str, int] = {}
+        self.hedged: dict[str, int] = {}
+        self.hedge_wins: dict[str, int] = {}
+
+    @classmethod
+    def from_env(cls) -> "Resilience":
+        return cls(
+            retries=int(_env_float("RETRY_MAX", 2)),
+            base_delay=_env_float("RETRY_BASE_MS", 200) / 1000,
+            max_delay=_env_float("RETRY_MAX_MS", 2000) / 1000,
+            cb_failures=int(_env_float("CB_FAILURES", 5)),
+            cb_reset=_env_float("CB_RESET_SECONDS", 30),
+            hedge_min=_env_float("HEDGE_MIN_MS", 200) / 1000,
+            write_retries=int(_env_float("RETRY_WRITE_MAX", 4)),
+        )
+
+    # --- 方針 ---
+    def retries_for(self, op: str, idempotent: bool) -> int:
+        if not idempotent:
+            return 0
+        default = self.write_retries if op in KEYED_WRITES else self.retries
+        return max(0, int(_env_float(_op_env("RETRY_", op), default)))
+
+    def hedge_for(self, op: str, idempotent: bool) -> bool:
+        return idempotent and _env_on(_op_env("HEDGE_", op), os.environ.get("HEDGE", "0"))
+
+    def backoff(self, attempt: int) -> float:
+        return self._rnd.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+    def breaker(self, target: str) -> Breaker:
+        br = self._breakers.get(target)
+        if br is None:
+            br = self._breakers[target] = Breaker(self.cb_failures, self.cb_reset)
+        return br
+
+    def p95(self, op: str) -> float | None:
+        xs = self._latency.get(op)
+        if not xs or len(xs) < _HEDGE_MIN_SAMPLES:
+            return None
+        s = sorted(xs)
+        return s[min(len(s) - 1, int(round(0.95 * (len(s) - 1))))]
+
+    # --- 実行 ---
+    async def call(self, op: str, fn: Fetch, idempotent: bool, target: str = "webapp") -> Any:
+        """fn を方針どおりに実行する。ブレーカーが開いていれば上流へ投げずにエラー dict を返す。"""
+        if not _env_on("RESILIENCE"):
+            return await fn()
+        br = self.breaker(target)
+        retries = self.retries_for(op, idempotent)
+        hedge = self.hedge_for(op, idempotent)
+        attempt = 0
+        while True:
+            if not br.allow():
+                self.rejected[op] = self.rejected.get(op, 0) + 1
+                return {"ok": False, "op": op, "error": {"code": "CIRCUIT_OPEN", "message": f"{target} is failing ({br.failures} consecutive errors); retry in {br.retry_in():.0f}s"}}
+            self.attempts[op] = self.attempts.get(op, 0) + 1
+            err: BaseException | None = None
+            res: Any = None
+            try:
+                res = await (self._hedged(op, fn) if hedge else self._timed(op, fn))
+            except Exception as e:
+                if not transient_error(e):
+                    br.release()
+                    raise
+                err = e
+            except BaseException:
+                br.release()
+                raise
+            if err is None and not transient_result(res):
+                br.success()
+                return res
+            br.failure()
+            if attempt >= retries:
+                if attempt:
+                    self.gave_up[op] = self.gave_up.get(op, 0) + 1
+                if err is not None:
+                    raise err
+                return res
+            attempt += 1
+            self.retried[op] = self.retried.get(op, 0) + 1
+            await asyncio.sleep(self.backoff(attempt))
+
+    async def _timed(self, op: str, fn: Fetch) -> Any:
+        t0 = time.monotonic()
+        res = await fn()
+        if not transient_result(res):
+            self._latency.setdefault(op, deque(maxlen=200)).append(time.monotonic() - t0)
+        return res
+
+    async def _hedged(self, op: str, fn: Fetch) -> Any:
+        p95 = self.p95(op)
+        if p95 is None:
+            return await self._timed(op, fn)
+        first = asyncio.ensure_future(self._timed(op, fn))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=max(p95, self.hedge_min))
+            if done:
+                return first.result()
+            self.hedged[op] = self.hedged.get(op, 0) + 1
+            second = asyncio.ensure_future(self._timed(op, fn))
+            tasks.add(second)
+            last: asyncio.Future | None = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    last = t
+                    if t.exception() is None and not transient_result(t.result()):
+                        if t is second:
+                            self.hedge_wins[op] = self.hedge_wins.get(op, 0) + 1
+                        return t.result()
+            assert last is not None
+            return last.result()
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": _env_on("RESILIENCE"),
+            "breakers": {k: {"state": b.state(), "consecutive_failures": b.failures, "opens": b.opens, "retry_in_seconds": round(b.retry_in(), 1)} for k, b in self._breakers.items()},
+            "attempts": dict(self.attempts),
+            "retries": dict(self.retried),
+            "gave_up": dict(self.gave_up),
+            "rejected": dict(self.rejected),
+            "hedged": dict(self.hedged),
+            "hedge_wins": dict(self.hedge_wins),
+            "p95_ms": {op: round(v * 1000, 1) for op in sorted(self._latency) if (v := self.p95(op)) is not None},
+        }
@@ -0,0 +1,378 @@
+"""GAS 読み取り op のリードスルー応答キャッシュ。
+
+- キー: op と正規化済みパラメータ（キー順・空値・文字列前後空白を吸収）
+- op ごとの TTL（`CACHE_TTL_<OP>` で上書き。例: CACHE_TTL_PLANNER_PLAN_GET=30）
+- 応答は JSON バイト列で保持し、総バイト数 `CACHE_MAX_BYTES` を超えたら LRU で追い出す
+- 書き込み op の成功時は、対象のスプレッドシート/生徒に紐づくエントリを無効化する
+
+キャッシュから返す dict は毎回デコードし直すため、呼び出し側が書き換えても汚れない。
+"""
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+try:
+    from . import fastjson
+except ImportError:  # when running as a script
+    import fastjson
+
+Fetch = Callable[[], Awaitable[dict]]
+
+# 読み取り op → 既定 TTL（秒）
+DEFAULT_TTLS: dict[str, float] = {
+    "students.list": 120.0,
+    "students.find": 120.0,
+    "students.get": 120.0,
+    "students.filter": 120.0,
+    "planner.ids_list": 60.0,
+    "planner.dates.get": 60.0,
+    "planner.metrics.get": 60.0,
+    "planner.plan.get": 60.0,
+    "planner.monthly.filter": 300.0,
+}
+
+# 書き込み op（成功時に無効化）。students.update/delete はプレビュー段階では何も変わらない
+PLANNER_WRITES = {"planner.plan.set", "planner.dates.set"}
+STUDENT_WRITES = {"students.create", "students.update", "students.delete"}
+# 書き込みで内容が変わらない読み取り op（計画セルの書込みは週の開始日を変えない）
+WRITE_KEEPS: dict[str, set[str]] = {"planner.plan.set": {"planner.dates.get"}}
+
+_ALL_STUDENTS = "students:*"  # 生徒一覧系（list/find/filter）に付けるタグ
+_ALL_PLANNERS = "planner:*"   # planner.* 全エントリに付けるタグ
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(os.environ.get(key, "") or default)
+    except ValueError:
+        return default
+
+
+def as_dict(params: dict[str, Any] | list[tuple[str, Any]]) -> dict[str, Any]:
+    """GET の (key, value) リストも dict に寄せる（同じキーの繰り返しはリスト化）。"""
+    if isinstance(params, dict):
+        return params
+    out: dict[str, Any] = {}
+    for k, v in params:
+        if k in out:
+            out[k] = (out[k] if isinstance(out[k], list) else [out[k]]) + [v]
+        else:
+            out[k] = v
+    return out
+
+
+def _norm(v: Any) -> Any:
+    if isinstance(v, str):
+        return v.strip()
+    if isinstance(v, dict):
+        return {str(k): _norm(x) for k, x in v.items() if x is not None and x != ""}
+    if isinstance(v, (list, tuple)):
+        return [_norm(x) for x in v]
+    return v
+
+
+def cache_key(req: dict[str, Any]) -> str:
+    return json.dumps(_norm(req), ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+
+
+def _ok(res: Any) -> bool:
+    return isinstance(res, dict) and bool(res.get("ok"))
+
+
+class _Entry:
+    __slots__ = ("body", "expires", "tags")
+
+    def __init__(self, body: bytes, expires: float, tags: set[str]) -> None:
+        self.body = body
+        self.expires = expires
+        self.tags = tags
+
+
+class ResponseCache:
+    """op ごとの TTL と総バイト数上限を持つ LRU キャッシュ。"""
+
+    def __init__(self, ttls: dict[str, float] | None = None, max_bytes: int = 32 * 1024 * 1024) -> None:
+        self.ttls = dict(ttls if ttls is not None else DEFAULT_TTLS)
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._bytes = 0
+        # student_id ↔ spreadsheet_id の対応（応答・リクエストから学習）
+        self._sheet_of: dict[str, str] = {}
+        self._students_of: dict[str, set[str]] = {}
+        self.hits: dict[str, int] = {}
+        self.misses: dict[str, int] = {}
+        self.evictions = 0
+        self.invalidations = 0
+
+    @classmethod
+    def from_env(cls) -> "ResponseCache":
+        ttls = {op: _env_float("CACHE_TTL_" + op.upper().replace(".", "_"), ttl) for op, ttl in DEFAULT_TTLS.items()}
+        return cls(ttls=ttls, max_bytes=int(_env_float("CACHE_MAX_BYTES", 32 * 1024 * 1024)))
+
+    # --- 参照 ---
+    def ttl_of(self, op: str) -> float:
+        return self.ttls.get(op, 0.0)
+
+    def get(self, key: str) -> dict | None:
+        e = self._entries.get(key)
+        if e is None:
+            return None
+        if e.expires <= time.monotonic():
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return fastjson.loads(e.body)
+
+    def put(self, key: str, req: dict[str, Any], res: dict, ttl: float) -> None:
+        body = fastjson.dumps(res)
+        if len(body) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = _Entry(body, time.monotonic() + ttl, self._tags_for(req))
+        self._bytes += len(body)
+        while self._bytes > self.max_bytes and self._entries:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _drop(self, key: str) -> None:
+        e = self._entries.pop(key, None)
+        if e is not None:
+            self._bytes -= len(e.body)
+
+    def lookup(self, req: dict[str, Any] | list[tuple[str, Any]]) -> dict | None:
+        """キャッシュ対象の読み取り op ならヒット/ミスを数えて返す（対象外・ミスは None）。"""
+        req = as_dict(req)
+        op = str(req.get("op") or "")
+        if self.ttl_of(op) <= 0:
+            return None
+        cached = self.get(cache_key(req))
+        if cached is not None:
+            self.hits[op] = self.hits.get(op, 0) + 1
+        else:
+            self.misses[op] = self.misses.get(op, 0) + 1
+        return cached
+
+    def store(self, req: dict[str, Any] | list[tuple[str, Any]], res: Any) -> None:
+        """上流の応答を反映する（読み取りは保存、書き込みは関連エントリを無効化）。"""
+        req = as_dict(req)
+        ttl = self.ttl_of(str(req.get("op") or ""))
+        if ttl <= 0:
+            self.observe_write(req, res)
+        elif _ok(res):
+            self._learn(req, res)
+            self.put(cache_key(req), req, res, ttl)
+
+    async def through(self, req: dict[str, Any] | list[tuple[str, Any]], fetch: Fetch) -> dict:
+        """読み取り op はキャッシュ経由、書き込み op は成功後に関連エントリを無効化する。"""
+        cached = self.lookup(req)
+        if cached is not None:
+            return cached
+        res = await fetch()
+        self.store(req, res)
+        return res
+
+    # --- 無効化 ---
+    def _tags_for(self, req: dict[str, Any]) -> set[str]:
+        op = str(req.get("op") or "")
+        tags: set[str] = set()
+        sid = str(req.get("student_id") or "").strip()
+        spid = str(req.get("spreadsheet_id") or "").strip()
+        if sid:
+            tags.add("st:" + sid)
+        if spid:
+            tags.add("sp:" + spid)
+        if op.startswith("planner."):
+            tags.add(_ALL_PLANNERS)
+            tags.add("op:" + op)
+        elif op.startswith("students."):
+            ids = req.get("student_ids")
+            for x in (ids if isinstance(ids, list) else [ids] if ids else []):
+                tags.add("st:" + str(x).strip())
+            if op != "students.get":
+                tags.add(_ALL_STUDENTS)
+        return tags
+
+    def link(self, student_id: str, spreadsheet_id: str) -> None:
+        """生徒とスプレッドシートの対応を登録（どちらの指定で読んだエントリも書き込みで消せるように）。"""
+        sid, spid = str(student_id or "").strip(), str(spreadsheet_id or "").strip()
+        if not (sid and spid):
+            return
+        old = self._sheet_of.get(sid)
+        if old and old != spid:
+            self._students_of.get(old, set()).discard(sid)
+        self._sheet_of[sid] = spid
+        self._students_of.setdefault(spid, set()).add(sid)
+
+    def _learn(self, req: dict[str, Any], res: dict) -> None:
+        self.link(req.get("student_id"), req.get("spreadsheet_id"))
+        data = res.get("data") or {}
+        studs = data.get("students") or ([data["student"]] if isinstance(data.get("student"), dict) else [])
+        for s in studs:
+            if isinstance(s, dict):
+                self.link(s.get("id"), s.get("planner_sheet_id"))
+
+    def invalidate_tags(self, tags: set[str], keep_ops: set[str] | None = None) -> int:
+        keep = {"op:" + op for op in keep_ops or ()}
+        keys = [k for k, e in self._entries.items() if e.tags & tags and not e.tags & keep]
+        for k in keys:
+            self._drop(k)
+        self.invalidations += len(keys)
+        return len(keys)
+
+    def invalidate_sheet(self, student_id: Any = None, spreadsheet_id: Any = None, keep_ops: set[str] | None = None) -> int:
+        """planner 書き込み後: 対象シート（生徒経由で読んだ分も含む）のエントリを消す。
+
+        シートが分からない書き込みは planner.* を全て消す。生徒指定だけで読まれ、
+        シートとの対応が未学習のエントリも同じシートの可能性があるので一緒に消す。
+        keep_ops の op のエントリは残す（その書き込みで変わらない読み取り）。
+        """
+        sid, spid = str(student_id or "").strip(), str(spreadsheet_id or "").strip()
+        spid = spid or self._sheet_of.get(sid, "")
+        if not spid:
+            return self.invalidate_tags({_ALL_PLANNERS}, keep_ops)
+        tags = {"sp:" + spid} | {"st:" + s for s in self._students_of.get(spid, set())}
+        if sid:
+            tags.add("st:" + sid)
+        for e in self._entries.values():
+            if _ALL_PLANNERS in e.tags and not any(t.startswith("sp:") for t in e.tags):
+                tags |= {t for t in e.tags if t.startswith("st:") and t[3:] not in self._sheet_of}
+        return self.invalidate_tags(tags, keep_ops)
+
+    def invalidate_student(self, student_id: Any = None) -> int:
+        """生徒マスター書き込み後: 一覧系と当該生徒のエントリ（planner の生徒指定分も）を消す。"""
+        sid = str(student_id or "").strip()
+        tags = {_ALL_STUDENTS}
+        if sid:
+            tags.add("st:" + sid)
+            # planner_sheet_id が変わったかもしれないので対応は学習し直す
+            spid = self._sheet_of.pop(sid, None)
+            if spid:
+                tags.add("sp:" + spid)
+                self._students_of.get(spid, set()).discard(sid)
+        return self.invalidate_tags(tags)
+
+    def observe_write(self, req: dict[str, Any], res: Any) -> None:
+        op = str(req.get("op") or "")
+        if op not in PLANNER_WRITES and op not in STUDENT_WRITES:
+            return
+        if not _ok(res) or (res.get("data") or {}).get("requires_confirmation"):
+            return
+        if op in PLANNER_WRITES:
+            self.invalidate_sheet(req.get("student_id"), req.get("spreadsheet_id"), WRITE_KEEPS.get(op))
+        else:
+            self.invalidate_student(req.get("student_id"))
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self) -> dict:
+        ops = sorted(set(self.hits) | set(self.misses))
+        per_op = {}
+        for op in ops:
+            h, m = self.hits.get(op, 0), self.misses.get(op, 0)
+            per_op[op] = {"hits": h, "misses": m, "hit_ratio": round(h / (h + m), 4) if h + m else None}
+        h, m = sum(self.hits.values()), sum(self.misses.values())
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "hits": h,
+            "misses": m,
+            "hit_ratio": round(h / (h + m), 4) if h + m else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "ttl_seconds": dict(self.ttls),
+            "ops": per_op,
+        }
+
+
+# 版トークン（GAS が返す内容の MD5）に対応した読み取り op
+VERSIONED_OPS = {"planner.plan.get", "planner.metrics.get"}
+
+
+class VersionStore:
+    """条件付き読み取り（ETag 相当）用に、最後に受け取った応答とその版を覚えておく。
+
+    応答キャッシュの TTL 切れ・無効化の後も残し、次の読み取りで `if_none_match` として版を送る。
+    GAS は内容が同じなら `{not_modified: true}` だけを返すので、手元の応答を使い回す。
+    版は内容のハッシュなので、シートが変わっていれば必ず新しい本文が返る（古い内容は返さない）。
+    送った版をもう持っていない not_modified（送信中に並行の読み取りが新しい版を覚えた）は STALE_VERSION にし、
+    呼び出し側（server._fetch_versioned）が版なしで 1 回だけ取り直す。
+    件数上限（VERSION_MAX, 既定 500）を超えたら古いものから捨てる。
+    """
+
+    def __init__(self, max_entries: int = 500) -> None:
+        self.max_entries = max_entries
+        self._items: "OrderedDict[str, tuple[str, bytes]]" = OrderedDict()
+        self.not_modified: dict[str, int] = {}
+        self.full: dict[str, int] = {}
+        self.stale_refetches = 0
+
+    @classmethod
+    def from_env(cls) -> "VersionStore":
+        return cls(max_entries=int(_env_float("VERSION_MAX", 500)))
+
+    @staticmethod
+    def enabled() -> bool:
+        return os.environ.get("VERSIONED_READS", "1").strip().lower() not in ("0", "false", "off", "no", "")
+
+    def conditional(self, req: dict[str, Any] | list[tuple[str, Any]]) -> dict[str, Any] | list[tuple[str, Any]]:
+        """送信用のリクエスト（手元に版があれば if_none_match を付けた複製。元の req は変えない）。"""
+        d = as_dict(req)
+        if not self.enabled() or str(d.get("op") or "") not in VERSIONED_OPS:
+            return req
+        item = self._items.get(cache_key(d))
+        if item is None:
+            return req
+        if isinstance(req, dict):
+            return {**req, "if_none_match": item[0]}
+        return list(req) + [("if_none_match", item[0])]
+
+    def resolve(self, req: dict[str, Any] | list[tuple[str, Any]], res: Any) -> Any:
+        """not_modified なら手元の応答に差し替え、新しい本文なら版と一緒に覚える。"""
+        d = as_dict(req)
+        op = str(d.get("op") or "")
+        if op not in VERSIONED_OPS or not _ok(res):
+            return res
+        data = res.get("data") or {}
+        version = data.get("version")
+        if not version:
+            return res
+        key = cache_key(d)
+        if data.get("not_modified"):
+            item = self._items.get(key)
+            if item is not None and item[0] == version:
+                self._items.move_to_end(key)
+                self.not_modified[op] = self.not_modified.get(op, 0) + 1
+                return fastjson.loads(item[1])
+            return {"ok": False, "op": op, "error": {"code": "STALE_VERSION", "message": "not_modified for a version that is no longer held"}}
+        self.full[op] = self.full.get(op, 0) + 1
+        self._items[key] = (str(version), fastjson.dumps(res))
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+        return res
+
+    @staticmethod
+    def stale(res: Any) -> bool:
+        return isinstance(res, dict) and res.get("ok") is False and (res.get("error") or {}).get("code") == "STALE_VERSION"
+
+    def clear(self) -> None:
+        self._items.clear()
+
+    def stats(self) -> dict:
+        nm, full = sum(self.not_modified.values()), sum(self.full.values())
+        return {
+            "enabled": self.enabled(),
+            "entries": len(self._items),
+            "max_entries": self.max_entries,
+            "not_modified": nm,
+            "full": full,
+            "not_modified_ratio": round(nm / (nm + full), 4) if nm + full else None,
+            "not_modified_by_op": dict(self.not_modified),
+            "stale_refetches": self.stale_refetches,
+        }
@@ -0,0 +1,151 @@
+"""上流の経路選び（WebApp / Execution API）。
+
+op ごとに両経路の所要時間を指数移動平均（EWMA）で持ち、速い方へ送る。
+
+- EXEC_TRANSPORT=auto（既定）: Execution API が使える（SCRIPT_ID と資格情報がある）ときだけ比べる。
+  どちらかの計測が ROUTE_MIN_SAMPLES 回に満たなければその経路を先に試し、以降も ROUTE_EXPLORE_EVERY 回に
+  1 回は遅い方を試して推定を更新する
+- EXEC_TRANSPORT=webapp / exec_api: 経路を固定する
+- Execution API が EXEC_API_ERROR / CIRCUIT_OPEN / 例外で失敗したら EXEC_DISABLE_SECONDS の間は WebApp に固定する。
+  読み取りはその場で WebApp に投げ直し、書き込みは二重実行を避けて失敗をそのまま返す。
+  ただし送る前の失敗（NotSent: トークンの取得・認証の拒否、接続できない）は GAS で実行されていないので、
+  書き込みも WebApp に投げ直す
+"""
+import os
+import time
+from typing import Any, Awaitable, Callable
+
+import httpx
+
+Fetch = Callable[[], Awaitable[Any]]
+
+WEBAPP = "webapp"
+EXEC_API = "exec_api"
+FALLBACK_CODES = {"EXEC_API_ERROR", "CIRCUIT_OPEN"}
+
+
+class NotSent(RuntimeError):
+    """上流で実行される前に失敗した（トークンが取れない・認証で拒否された）。書き込みも別経路に投げ直してよい。"""
+
+
+def not_sent(e: BaseException) -> bool:
+    return isinstance(e, (NotSent, httpx.ConnectError, httpx.ConnectTimeout))
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(os.environ.get(key, "") or default)
+    except ValueError:
+        return default
+
+
+class _Latency:
+    __slots__ = ("n", "ewma")
+
+    def __init__(self) -> None:
+        self.n = 0
+        self.ewma = 0.0
+
+    def observe(self, ms: float, alpha: float) -> None:
+        self.ewma = ms if self.n == 0 else (1 - alpha) * self.ewma + alpha * ms
+        self.n += 1
+
+
+class Router:
+    def __init__(self, alpha: float = 0.2, min_samples: int = 3, explore_every: int = 50, disable_seconds: float = 600.0) -> None:
+        self.alpha = alpha
+        self.min_samples = min_samples
+        self.explore_every = explore_every
+        self.disable_seconds = disable_seconds
+        self._lat: dict[str, dict[str, _Latency]] = {}
+        self._decisions: dict[str, int] = {}
+        self.routed = {WEBAPP: 0, EXEC_API: 0}
+        self.fallbacks = 0
+        self.exec_failures = 0
+        self.disabled_until = 0.0
+
+    @classmethod
+    def from_env(cls) -> "Router":
+        return cls(
+            alpha=_env_float("ROUTE_EWMA_ALPHA", 0.2),
+            min_samples=int(_env_float("ROUTE_MIN_SAMPLES", 3)),
+            explore_every=int(_env_float("ROUTE_EXPLORE_EVERY", 50)),
+            disable_seconds=_env_float("EXEC_DISABLE_SECONDS", 600.0),
+        )
+
+    @staticmethod
+    def mode() -> str:
+        m = os.environ.get("EXEC_TRANSPORT", "auto").strip().lower()
+        return m if m in (WEBAPP, EXEC_API) else "auto"
+
+    def _pair(self, op: str) -> dict[str, _Latency]:
+        p = self._lat.get(op)
+        if p is None:
+            p = self._lat[op] = {WEBAPP: _Latency(), EXEC_API: _Latency()}
+        return p
+
+    def choose(self, op: str, exec_available: bool) -> str:
+        mode = self.mode()
+        if mode == WEBAPP or not exec_available or time.monotonic() < self.disabled_until:
+            return WEBAPP
+        if mode == EXEC_API:
+            return EXEC_API
+        p = self._pair(op)
+        w, e = p[WEBAPP], p[EXEC_API]
+        if e.n < self.min_samples:
+            return EXEC_API
+        if w.n < self.min_samples:
+            return WEBAPP
+        best, other = (EXEC_API, WEBAPP) if e.ewma <= w.ewma else (WEBAPP, EXEC_API)
+        n = self._decisions[op] = self._decisions.get(op, 0) + 1
+        return other if self.explore_every and n % self.explore_every == 0 else best
+
+    def observe(self, op: str, route: str, ms: float) -> None:
+        self._pair(op)[route].observe(ms, self.alpha)
+
+    def _exec_failed(self) -> None:
+        self.exec_failures += 1
+        self.disabled_until = time.monotonic() + self.disable_seconds
+
+    async def call(self, op: str, webapp: Fetch, exec_api: Fetch, idempotent: bool, exec_available: bool) -> Any:
+        """選んだ経路で送り、所要時間を記録する。Execution API の失敗は読み取りだけ WebApp に投げ直す。"""
+        route = self.choose(op, exec_available)
+        self.routed[route] += 1
+        if route == EXEC_API:
+            t0 = time.perf_counter()
+            try:
+                res = await exec_api()
+            except Exception as e:
+                self._exec_failed()
+                if not idempotent and not not_sent(e):
+                    raise
+            else:
+                if not (isinstance(res, dict) and str((res.get("error") or {}).get("code") or "") in FALLBACK_CODES):
+                    self.observe(op, EXEC_API, (time.perf_counter() - t0) * 1000)
+                    return res
+                self._exec_failed()
+                if not idempotent:
+                    return res
+            self.fallbacks += 1
+        t0 = time.perf_counter()
+        res = await webapp()
+        self.observe(op, WEBAPP, (time.perf_counter() - t0) * 1000)
+        return res
+
+    def reset(self) -> None:
+        self._lat.clear()
+        self._decisions.clear()
+        self.disabled_until = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode(),
+            "routed": dict(self.routed),
+            "fallbacks": self.fallbacks,
+            "exec_failures": self.exec_failures,
+            "exec_disabled_for": max(0.0, round(self.disabled_until - time.monotonic(), 1)),
+            "ops": {
+                op: {r: {"n": lat.n, "ewma_ms": round(lat.ewma, 1)} for r, lat in p.items()}
+                for op, p in sorted(self._lat.items())
+            },
+        }
@@ -1,16 +1,59 @@
-import os, sys, httpx
-from typing import Any, Iterable
+import asyncio, itertools, os, re, sys, time, uuid
+import datetime as dt
+from typing import Any, Callable, Iterable
 try:
     from .exec_api import scripts_run  # when running as a package
+    from . import exec_api
+    from .http_pool import get_client, open_client, close_client
+    from . import books_mirror, history, master_sync, snapshot, students_query
+    from .query_engine import QueryError, Table
+    from .response_cache import STUDENT_WRITES, ResponseCache, VersionStore, as_dict, cache_key
+    from .singleflight import SingleFlight, READ_OPS
+    from .token_store import TokenStore
+    from .resilience import Resilience, KEYED_WRITES
+    from .routing import Router
+    from . import fastjson, metrics, tracing
+    from .projection import parse_fields, parse_weeks, project, project_weeks, wants
+    from .suggest import PLAN_TEXT_MAX, build_index, suggest_targets
 except Exception:
     from exec_api import scripts_run    # when running as a script
+    import exec_api
+    from http_pool import get_client, open_client, close_client
+    import books_mirror
+    import history
+    import master_sync
+    import snapshot
+    import students_query
+    from query_engine import QueryError, Table
+    from response_cache import STUDENT_WRITES, ResponseCache, VersionStore, as_dict, cache_key
+    from singleflight import SingleFlight, READ_OPS
+    from token_store import TokenStore
+    from resilience import Resilience, KEYED_WRITES
+    from routing import Router
+    import fastjson
+    import metrics
+    import tracing
+    from projection import parse_fields, parse_weeks, project, project_weeks, wants
+    from suggest import PLAN_TEXT_MAX, build_index, suggest_targets
 try:
-    from mcp.server.fastmcp import FastMCP  # newer mcp package provides this helper
+    from mcp.server.fastmcp import Context, FastMCP  # newer mcp package provides this helper
 except Exception:
-    from fastmcp import FastMCP  # fallback to external fastmcp package
+    from fastmcp import Context, FastMCP  # fallback to external fastmcp package
 
 mcp = FastMCP("cram-books")
 
+def tool():
+    """@mcp.tool() の代わり。MCP 経由の呼び出しをトレース・計測する（関数を直接呼んだ場合は対象外）。"""
+    import functools
+
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(**kw: Any) -> Any:
+            return await tracing.trace_tool(fn.__name__, lambda: metrics.observe_tool(fn.__name__, lambda: fn(**kw)))
+        mcp.tool()(wrapper)
+        return fn
+    return deco
+
 def log(*a): print(*a, file=sys.stderr, flush=True)
 
 def _exec_url() -> str:
@@ -25,26 +68,294 @@ def _script_id() -> str:
         raise RuntimeError("SCRIPT_ID is not set")
     return sid
 
-async def _get(params: dict[str, Any] | list[tuple[str, Any]]) -> dict:
+def _record_io(sp: dict, r: Any, res: Any) -> None:
+    """upstream span に送受信バイト数・error.code・GAS 側の処理時間を書き込む。"""
+    if not sp:
+        return
+    first = r.history[0].request if r.history else r.request
+    sp["req_bytes"] = len(first.content) if first.method == "POST" else len(str(first.url))
+    sp["resp_bytes"] = len(r.content)
+    sp["wire_bytes"] = r.num_bytes_downloaded  # 圧縮後（gzip 応答なら resp_bytes より小さい）
+    if isinstance(res, dict):
+        if res.get("ok") is False:
+            sp["error_code"] = (res.get("error") or {}).get("code")
+        gas_ms = (res.get("meta") or {}).get("elapsed_ms")
+        if gas_ms is not None:
+            sp["gas_ms"] = gas_ms
+
+async def _send_get(params: dict[str, Any] | list[tuple[str, Any]]) -> dict:
     url = _exec_url()
-    log("HTTP GET", url, params)
-    async with httpx.AsyncClient(timeout=30, follow_redirects=True) as client:
-        r = await client.get(url, params=params)
+    op = str(as_dict(params).get("op") or "")
+    tid = tracing.current_trace_id()
+    if tid:
+        params = (list(params.items()) if isinstance(params, dict) else list(params)) + [("trace_id", tid)]
+    tracing.log_request("HTTP GET", url, params)
+    with metrics.upstream(op) as m, tracing.span(op, "upstream") as sp:
+        r = await get_client().get(url, params=params)
         r.raise_for_status()
-        return r.json()
+        try:
+            m["result"] = fastjson.loads(r.content)
+        except ValueError:
+            m["result"] = {"ok": False, "error": {"code": "BAD_JSON", "message": r.text[:500]}}
+        _record_io(sp, r, m["result"])
+    return m["result"]
 
-async def _post(json: dict[str, Any]) -> dict:
+async def _send_post(json: dict[str, Any]) -> dict:
     url = _exec_url()
-    log("HTTP POST", url, json)
-    async with httpx.AsyncClient(timeout=30, follow_redirects=True) as client:
-        r = await client.post(url, json=json)
+    op = str(json.get("op") or "")
+    tid = tracing.current_trace_id()
+    if tid:
+        json = {**json, "trace_id": tid}
+    tracing.log_request("HTTP POST", url, json)
+    with metrics.upstream(op) as m, tracing.span(op, "upstream") as sp:
+        if op == "batch" and sp:
+            sp["ops"] = [str((x or {}).get("op") or "") for x in json.get("requests") or []]
+        r = await get_client().post(url, json=json)
         r.raise_for_status()
         # Apps Script WebApp may return text/html content-type on redirect chain,
         # but body should be JSON string. Attempt to parse.
         try:
-            return r.json()
-        except Exception:
-            return {"ok": False, "error": {"code": "BAD_JSON", "message": r.text[:500]}}
+            m["result"] = fastjson.loads(r.content)
+        except ValueError:
+            m["result"] = {"ok": False, "error": {"code": "BAD_JSON", "message": r.text[:500]}}
+        _record_io(sp, r, m["result"])
+    return m["result"]
+
+def _env_on(key: str, default: str = "1") -> bool:
+    return os.environ.get(key, default).strip().lower() not in ("0", "false", "off", "no", "")
+
+# 一時的な失敗の再試行（読み取りのみ）・サーキットブレーカー・ヘッジ（RESILIENCE=0 で無効）
+_RESILIENCE = Resilience.from_env()
+
+# 書き込みの冪等キー（IDEMPOTENCY_KEYS=0 で付けない）。GAS が meta.idempotency_key を返したら受け付けると分かるので、
+# 以降はキー付きの書き込みも再試行・ヘッジ・経路の投げ直しの対象にする（旧デプロイには二重書込みの恐れがあるので送り直さない）
+_IDEMPOTENCY: dict[str, Any] = {"confirmed": False, "keyed": 0, "replayed": 0}
+
+def _one_idempotent(r: Any) -> bool:
+    if not isinstance(r, dict):
+        return False
+    op = str(r.get("op") or "")
+    return op in READ_OPS or (op in KEYED_WRITES and bool(r.get("idempotency_key")) and _IDEMPOTENCY["confirmed"])
+
+def _idempotent(req: dict[str, Any] | list[tuple[str, Any]]) -> bool:
+    d = as_dict(req)
+    if str(d.get("op") or "") == "batch":
+        return all(_one_idempotent(r) for r in d.get("requests") or [])
+    return _one_idempotent(d)
+
+def _with_key(payload: dict[str, Any], idempotency_key: Any = None, confirm_token: Any = None) -> dict[str, Any]:
+    """書き込みに冪等キーを付ける。呼び出し側の指定 > confirm_token 由来（同じ確定の再送は同じキー）> 未指定なら _post で採番。"""
+    key = _coerce_str(idempotency_key) or (f"confirm:{confirm_token}" if confirm_token else None)
+    if key:
+        payload["idempotency_key"] = key
+    return payload
+
+def _observe_key(res: Any) -> None:
+    meta = res.get("meta") if isinstance(res, dict) else None
+    if isinstance(meta, dict) and meta.get("idempotency_key"):
+        _IDEMPOTENCY["confirmed"] = True
+        _IDEMPOTENCY["replayed"] += int(bool(meta.get("replayed")))
+
+async def _send_exec(req: dict[str, Any]) -> dict:
+    """WebApp と同じリクエストを Execution API（GAS の api(req)）で送る。302 の往復がない。"""
+    op = str(req.get("op") or "")
+    if isinstance(req.get("book_ids"), str):  # GET の ?book_ids=... 1 件（doGet では配列になる）
+        req = {**req, "book_ids": [req["book_ids"]]}
+    tid = tracing.current_trace_id()
+    if tid:
+        req = {**req, "trace_id": tid}
+    with metrics.upstream(op, "exec_api") as m, tracing.span(op, "upstream") as sp:
+        m["result"] = await exec_api.call(req)
+        if sp:
+            sp["transport"] = "exec_api"
+            if m["result"].get("ok") is False:
+                sp["error_code"] = (m["result"].get("error") or {}).get("code")
+            if (m["result"].get("meta") or {}).get("elapsed_ms") is not None:
+                sp["gas_ms"] = m["result"]["meta"]["elapsed_ms"]
+    return m["result"]
+
+# 上流の経路（WebApp / Execution API）を op ごとの実測レイテンシで選ぶ（EXEC_TRANSPORT=webapp で WebApp 固定）
+_ROUTER = Router.from_env()
+
+async def _routed(req: dict[str, Any] | list[tuple[str, Any]], send_webapp) -> dict:
+    op = str(as_dict(req).get("op") or "")
+    idem = _idempotent(req)
+    return await _ROUTER.call(
+        op,
+        lambda: _RESILIENCE.call(op, send_webapp, idem),
+        lambda: _RESILIENCE.call(op, lambda: _send_exec(dict(as_dict(req))), idem, target="exec_api"),
+        idem,
+        exec_api.available(),
+    )
+
+# snapshot-read モード（SNAPSHOT_READ=<path> または snapshot_import）。上流の代わりにスナップショットから答える
+_SNAPSHOT: dict[str, Any] = {"reader": snapshot.open_from_env(), "fallbacks": 0}
+
+def _not_in_snapshot(res: Any) -> bool:
+    return isinstance(res, dict) and (res.get("error") or {}).get("code") == "NOT_IN_SNAPSHOT"
+
+async def _from_snapshot(req: dict[str, Any] | list[tuple[str, Any]], upstream) -> dict:
+    """スナップショットに答えがあればそれを返す。NOT_IN_SNAPSHOT は SNAPSHOT_FALLBACK=1 のときだけ上流へ。
+
+    batch はないものだけを 1 つの batch で上流に送り、元の順に差し込む。
+    """
+    reader = _SNAPSHOT["reader"]
+    if reader is None:
+        return await upstream()
+    req = dict(as_dict(req))
+    res = reader.answer(req)
+    if os.environ.get("SNAPSHOT_FALLBACK", "0") != "1":
+        return res
+    if _not_in_snapshot(res):
+        _SNAPSHOT["fallbacks"] += 1
+        return await upstream()
+    results = (res.get("data") or {}).get("results") if req.get("op") == "batch" and res.get("ok") else None
+    miss = [i for i, r in enumerate(results or []) if _not_in_snapshot(r)]
+    if miss:
+        _SNAPSHOT["fallbacks"] += len(miss)
+        sub = {**req, "requests": [req["requests"][i] for i in miss]}
+        live = await _routed(sub, lambda: _send_post(sub))
+        for i, r in zip(miss, (live.get("data") or {}).get("results") or [] if live.get("ok") else [live] * len(miss)):
+            results[i] = r
+    return res
+
+async def _http_get(params: dict[str, Any] | list[tuple[str, Any]]) -> dict:
+    return await _from_snapshot(params, lambda: _routed(params, lambda: _send_get(params)))
+
+async def _http_post(json: dict[str, Any]) -> dict:
+    return await _from_snapshot(json, lambda: _routed(json, lambda: _send_post(json)))
+
+# 読み取り op の応答キャッシュ（RESPONSE_CACHE=0 で無効）。書き込み op は成功時に関連エントリを無効化
+_CACHE = ResponseCache.from_env()
+# 同一の読み取りが同時に飛んだら上流呼び出しを 1 回にまとめる（SINGLEFLIGHT=0 で無効）
+_FLIGHT = SingleFlight()
+# planner.plan.get / metrics.get の版トークン（VERSIONED_READS=0 で無効）。同じ版なら GAS は本文を返さない
+_VERSIONS = VersionStore.from_env()
+
+async def _fetch_versioned(req: dict[str, Any] | list[tuple[str, Any]], send) -> dict:
+    """手元の版を if_none_match で送り、not_modified なら手元の応答を返す（対象外の op は素通し）。"""
+    res = _VERSIONS.resolve(req, await send(_VERSIONS.conditional(req)))
+    if _VERSIONS.stale(res):
+        # 送信中に並行の読み取り（別の batch の組み合わせなど）が新しい版を覚えた。版なしで 1 回だけ取り直す
+        _VERSIONS.stale_refetches += 1
+        res = _VERSIONS.resolve(req, await send(req))
+    return res
+
+async def _coalesced(req: dict[str, Any] | list[tuple[str, Any]], fetch) -> dict:
+    d = as_dict(req)
+    op = str(d.get("op") or "")
+    if op not in READ_OPS or not _env_on("SINGLEFLIGHT"):
+        return await fetch()
+    return await _FLIGHT.do(cache_key(d), op, fetch)
+
+async def _through(req: dict[str, Any] | list[tuple[str, Any]], fetch) -> dict:
+    """リクエスト層: 応答キャッシュ → single-flight → HTTP の順に通す。"""
+    upstream = lambda: _coalesced(req, fetch)
+    if not _env_on("RESPONSE_CACHE"):
+        return await upstream()
+    return await _CACHE.through(req, upstream)
+
+async def _get(params: dict[str, Any] | list[tuple[str, Any]]) -> dict:
+    return await _through(params, lambda: _fetch_versioned(params, _http_get))
+
+async def _with_sheet(req: dict[str, Any]) -> dict[str, Any]:
+    """planner.* の student_id 指定に手元の対応表から spreadsheet_id を添える（GAS が生徒シートを読まずに済む）。
+
+    PLANNER_SHEET_MAP=0 で無効。対応が分からない生徒・対応表の取得失敗は student_id だけで送る。
+    """
+    if (not str(req.get("op") or "").startswith("planner.") or req.get("spreadsheet_id")
+            or not req.get("student_id") or not _env_on("PLANNER_SHEET_MAP")):
+        return req
+    try:
+        spid = await _SHEETS.resolve(req["student_id"])
+    except Exception as e:
+        log("planner sheet resolve failed:", e)
+        return req
+    return {**req, "spreadsheet_id": spid} if spid else req
+
+async def _post(json: dict[str, Any]) -> dict:
+    json = await _with_sheet(json)
+    op = str(json.get("op") or "")
+    if op in KEYED_WRITES:
+        if not _env_on("IDEMPOTENCY_KEYS"):
+            json = {k: v for k, v in json.items() if k != "idempotency_key"}
+        elif not json.get("idempotency_key"):
+            json = {**json, "idempotency_key": uuid.uuid4().hex}
+        _IDEMPOTENCY["keyed"] += int("idempotency_key" in json)
+    res = await _through(json, lambda: _fetch_versioned(json, _http_post))
+    _observe_key(res)
+    if op in STUDENT_WRITES and _confirmed(res):
+        _SHEETS.forget(json.get("student_id"))
+        _STUDENTS_SYNC["at"] = 0.0
+    return res
+
+# --- batch（複数 op を 1 回の WebApp 呼び出しで）。GAS_BATCH=0 で無効 ---
+# 旧デプロイで batch が UNKNOWN_OP のときは単発呼び出しに戻し、一定時間後に再確認する
+_BATCH_RETRY_SECONDS = 600.0
+_BATCH_STATE: dict[str, float] = {"unsupported_until": 0.0, "batches": 0, "batched_ops": 0, "fallbacks": 0}
+
+def _batch_available() -> bool:
+    return _env_on("GAS_BATCH") and time.monotonic() >= _BATCH_STATE["unsupported_until"]
+
+async def _post_many(reqs: list[dict[str, Any]]) -> list[dict]:
+    """複数の POST を順序どおりに返す。キャッシュにない分だけを 1 つの batch にまとめて送る。
+
+    batch が使えない（GAS_BATCH=0 / 旧デプロイ / 通信失敗）ときは単発の _post を並行に投げる。
+    """
+    reqs = [await _with_sheet(r) for r in reqs]
+    with tracing.span("post_many", ops=[str(r.get("op") or "") for r in reqs]):
+        return await _post_many_traced(reqs)
+
+async def _post_many_traced(reqs: list[dict[str, Any]]) -> list[dict]:
+    results: list[dict | None] = [None] * len(reqs)
+    pending = list(range(len(reqs)))
+    if _env_on("RESPONSE_CACHE"):
+        pending = []
+        for i, r in enumerate(reqs):
+            results[i] = _CACHE.lookup(r)
+            if results[i] is None:
+                pending.append(i)
+    if len(pending) >= 2 and _batch_available():
+        subs = [_VERSIONS.conditional(reqs[i]) for i in pending]
+        payload = {"op": "batch", "requests": subs}
+        fetch = lambda: _http_post(payload)
+        try:
+            if all(str(r.get("op") or "") in READ_OPS for r in subs) and _env_on("SINGLEFLIGHT"):
+                res = await _FLIGHT.do(cache_key(payload), "batch", fetch)
+            else:
+                res = await fetch()
+        except Exception as e:
+            log("batch failed; falling back to single calls:", e)
+            res = None
+        outs = ((res or {}).get("data") or {}).get("results") if isinstance(res, dict) and res.get("ok") else None
+        if isinstance(outs, list) and len(outs) == len(subs):
+            _BATCH_STATE["batches"] += 1
+            _BATCH_STATE["batched_ops"] += len(subs)
+            stale = []
+            for i, out in zip(pending, outs):
+                out = _VERSIONS.resolve(reqs[i], out)
+                if _VERSIONS.stale(out):
+                    stale.append(i)  # 下の単発の経路で取り直す
+                    continue
+                if _env_on("RESPONSE_CACHE"):
+                    _CACHE.store(reqs[i], out)
+                results[i] = out
+            pending = stale
+        else:
+            _BATCH_STATE["fallbacks"] += 1
+            if isinstance(res, dict) and (res.get("error") or {}).get("code") == "UNKNOWN_OP":
+                _BATCH_STATE["unsupported_until"] = time.monotonic() + _BATCH_RETRY_SECONDS
+    if pending:
+        # キャッシュは引き済みなので、ここでは single-flight → HTTP だけを通して結果を反映する
+        async def _single(r: dict[str, Any]) -> dict:
+            out = await _coalesced(r, lambda: _fetch_versioned(r, _http_post))
+            if _env_on("RESPONSE_CACHE"):
+                _CACHE.store(r, out)
+            return out
+        outs = await asyncio.gather(*[_single(reqs[i]) for i in pending])
+        for i, out in zip(pending, outs):
+            results[i] = out
+    return results  # type: ignore[return-value]
 
 def _strip_quotes(s: str) -> str:
     s = s.strip()
@@ -74,19 +385,57 @@ def _pick_col(headers: list[str], candidates: Iterable[str]) -> int:
             continue
     return -1
 
-# --- Simple in-memory preview cache for propose→confirm ---
-_PREVIEW_CACHE: dict[str, dict] = {}
+# --- propose→confirm 用のプレビュートークン（TTL/件数上限付き。PREVIEW_STORE=sqlite でワーカー間共有） ---
+_PREVIEWS = TokenStore.from_env()
 def _preview_put(payload: dict) -> str:
-    import uuid
-    token = str(uuid.uuid4())
-    _PREVIEW_CACHE[token] = payload
-    return token
+    return _PREVIEWS.put(payload)
 def _preview_get(token: str) -> dict | None:
-    return _PREVIEW_CACHE.get(token)
+    return _PREVIEWS.get(token)
 def _preview_pop(token: str) -> dict | None:
-    return _PREVIEW_CACHE.pop(token, None)
+    return _PREVIEWS.pop(token)
+
+# --- 参考書/生徒マスターの差分同期（*.changed_since。MASTER_SYNC_PATH で SQLite に保存） ---
+_MASTERS = {kind: master_sync.MasterSync(kind, lambda req: _post(req)) for kind in master_sync.KINDS}
+
+async def _student_rows() -> list[dict] | None:
+    res = await _MASTERS["students"].sync()
+    return _MASTERS["students"].rows() if res.get("ok") else None
+
+# 生徒 ID → 週間管理シートの対応（生徒の写しから。PLANNER_SHEET_TTL 秒ごとに差分同期で作り直す）
+_SHEETS = master_sync.PlannerSheets(_student_rows, ttl=float(os.environ.get("PLANNER_SHEET_TTL", "600")))
 
-@mcp.tool()
+async def _load_books() -> dict:
+    """ミラーの取り込み。BOOKS_SYNC=1（既定）なら差分だけ取り、写しの全件を books.filter の形で返す。"""
+    if not _env_on("BOOKS_SYNC"):
+        return await _post({"op": "books.filter"})
+    res = await _MASTERS["books"].sync()
+    if not res.get("ok"):
+        return res
+    return {"ok": True, "op": "books.filter", "data": {"books": _MASTERS["books"].rows()}}
+
+# --- 参考書マスターのミラー（books_find/get/filter/list をローカルで応答） ---
+_BOOKS = books_mirror.BooksMirror(
+    loader=_load_books,
+    ttl=float(os.environ.get("BOOKS_MIRROR_TTL", "300")),
+)
+
+async def _mirror_books() -> list[dict] | None:
+    """ミラーのスナップショット（無効化中・取得失敗時は None → 呼び出し側は GAS へ）。"""
+    if not _env_on("BOOKS_MIRROR"):
+        return None
+    try:
+        return await _BOOKS.books()
+    except Exception as e:
+        log("books mirror load failed:", e)
+        return None
+
+def _mirror_ok(op: str, data: dict) -> dict:
+    return {"ok": True, "op": op, "meta": {"source": "mirror", "age_seconds": _BOOKS.age()}, "data": data}
+
+def _confirmed(res: Any) -> bool:
+    return isinstance(res, dict) and bool(res.get("ok")) and not (res.get("data") or {}).get("requires_confirmation")
+
+@tool()
 async def books_find(query: Any) -> dict:
     """参考書を曖昧検索します（GAS WebApp: books.find）。
 
@@ -115,19 +464,37 @@ async def books_find(query: Any) -> dict:
     q = _coerce_str(query, ("query","q","text"))
     if not q:
         return {"ok": False, "op":"books.find","error":{"code":"BAD_INPUT","message":"query is required"}}
+    books = await _mirror_books()
+    if books is not None:
+        return _mirror_ok("books.find", books_mirror.find(books, q))
     return await _get({"op":"books.find","query":q})
 
-@mcp.tool()
-async def books_get(book_id: Any = None, book_ids: Any = None) -> dict:
+def _project_data(res: Any, fields: list[str] | None, keys: tuple[str, ...]) -> Any:
+    """data.<key>（単体 dict / 配列）に fields 射影をかける。GAS 側でも同じ射影をしているが、旧デプロイやキャッシュ分も揃える。"""
+    if not fields or not isinstance(res, dict) or not res.get("ok"):
+        return res
+    data = dict(res.get("data") or {})
+    for k in keys:
+        v = data.get(k)
+        if isinstance(v, list):
+            data[k] = [project(x, fields) for x in v]
+        elif isinstance(v, dict):
+            data[k] = project(v, fields)
+    return {**res, "data": data}
+
+@tool()
+async def books_get(book_id: Any = None, book_ids: Any = None, fields: Any = None) -> dict:
     """参考書の詳細を取得します（GAS WebApp: books.get）。
 
     引数:
     - book_id: 単一ID（文字列）
     - book_ids: 複数ID（配列）。どちらか必須。
+    - fields: 返すキー（配列/カンマ区切り。例 ["title","subject"], "structure.chapters"）。id は常に含む。省略時は全項目
 
     使い方（例）:
     - 単一: books_get({"book_id":"gMB017"})
     - 複数: books_get({"book_ids":["gMB017","gMB018"]})
+    - 目次なし: books_get({"book_ids":[...], "fields":["title","subject"]})
 
     返り値（例）:
     - 単一: { ok:true, data: { book: { id, title, subject, monthly_goal, unit_load, structure:{chapters…} } } }
@@ -159,32 +526,54 @@ async def books_get(book_id: Any = None, book_ids: Any = None) -> dict:
     if not many:
         many = _as_list(book_id) if isinstance(book_id, (list, tuple)) else []
 
+    fl = parse_fields(fields)
+    if many or single:
+        books = await _mirror_books()
+        if books is not None:
+            res = _project_data(books_mirror.get(books, book_id=single, book_ids=many or None), fl, ("book", "books"))
+            if res.get("ok"):
+                res["meta"] = {"source": "mirror", "age_seconds": _BOOKS.age()}
+            return res
+
     if many:
         # GETのクエリに同名キーを複数並べる（GAS doGetで配列解釈）
         params: list[tuple[str, Any]] = [("op", "books.get")]
         for bid in many:
             params.append(("book_ids", bid))
-        return await _get(params)
+        if fl:
+            params.append(("fields", ",".join(fl)))
+        return _project_data(await _get(params), fl, ("book", "books"))
 
     if single:
-        return await _get({"op": "books.get", "book_id": single})
+        q: dict[str, Any] = {"op": "books.get", "book_id": single}
+        if fl:
+            q["fields"] = ",".join(fl)
+        return _project_data(await _get(q), fl, ("book", "books"))
 
     return {"ok": False, "op": "books.get", "error": {"code": "BAD_INPUT", "message": "book_id or book_ids is required"}}
 
 
-# --- Execution API based tools (experimental) ---
+# --- Execution API を明示的に使う内部関数（経路の比較・切り分け用。通常は _ROUTER が選ぶ） ---
+async def _scripts_run(op: str, **kw: Any) -> Any:
+    async def run() -> Any:
+        with metrics.upstream(op, "exec_api") as m:
+            m["result"] = await scripts_run(**kw)
+        return m["result"]
+    return await _RESILIENCE.call(op, run, op in READ_OPS, target="exec_api")
+
 async def books_find_exec(query: Any, dev_mode: bool = True) -> dict:
-    """[非公開/内部] Apps Script Execution API 経由の books.find（実験用）。
-    通常は使用しません。WebApp 版の books_find を利用してください。
-    必要時のみメンテナ向けに残しています。
+    """[非公開/内部] Apps Script Execution API 経由の books.find（GAS の api(req)）。
+    通常は books_find を使ってください（経路は EXEC_TRANSPORT と実測レイテンシで選ばれます）。
+    経路を固定して比較・切り分けしたいときのメンテナ向けです。
     """
     q = _coerce_str(query, ("query","q","text"))
     if not q:
         return {"ok": False, "op":"books.find","error":{"code":"BAD_INPUT","message":"query is required"}}
     try:
-        result = await scripts_run(
-            function="booksFind",
-            parameters=[{"query": q}],
+        result = await _scripts_run(
+            "books.find",
+            function="api",
+            parameters=[{"op": "books.find", "query": q}],
             dev_mode=dev_mode,
             script_id=_script_id(),
         )
@@ -194,9 +583,9 @@ async def books_find_exec(query: Any, dev_mode: bool = True) -> dict:
 
 
 async def books_get_exec(book_id: Any = None, book_ids: Any = None, dev_mode: bool = True) -> dict:
-    """[非公開/内部] Apps Script Execution API 経由の books.get（実験用）。
-    通常は使用しません。WebApp 版の books_get を利用してください。
-    必要時のみメンテナ向けに残しています。
+    """[非公開/内部] Apps Script Execution API 経由の books.get（GAS の api(req)）。
+    通常は books_get を使ってください（経路は EXEC_TRANSPORT と実測レイテンシで選ばれます）。
+    経路を固定して比較・切り分けしたいときのメンテナ向けです。
     """
     # Reuse normalization from GET tool
     def _as_list(x: Any) -> list[str]:
@@ -221,7 +610,7 @@ async def books_get_exec(book_id: Any = None, book_ids: Any = None, dev_mode: bo
         many = _as_list(book_id)
     single = _coerce_str(book_id, ("book_id","id")) if not many else None
 
-    req: dict[str, Any] = {}
+    req: dict[str, Any] = {"op": "books.get"}
     if many:
         req["book_ids"] = many
     elif single:
@@ -230,8 +619,9 @@ async def books_get_exec(book_id: Any = None, book_ids: Any = None, dev_mode: bo
         return {"ok": False, "op":"books.get","error":{"code":"BAD_INPUT","message":"book_id or book_ids is required"}}
 
     try:
-        result = await scripts_run(
-            function="booksGet",
+        result = await _scripts_run(
+            "books.get",
+            function="api",
             parameters=[req],
             dev_mode=dev_mode,
             script_id=_script_id(),
@@ -254,41 +644,87 @@ def _normalize_key_for_sheet(k: str) -> str:
     # そのまま返す（シート見出しが直接指定された場合）
     return k
 
-def _parse_where_like(x: Any) -> dict[str, Any] | None:
-    """'subject = "数学"' のような簡易式を {"教科":"数学"} に変換。辞書はそのまま通す。"""
+# 文字列式の演算子（長いものから試す）。"a >= 2" を "=" で切らないように
+_EXPR_OPS = [("^=", "prefix"), (">=", "gte"), ("<=", "lte"), (">", "gt"), ("<", "lt"), ("=", "eq"), (":", "eq")]
+_EXPR_IN = re.compile(r"^(.+?)\s+in\s*[(\[](.*)[)\]]$", re.IGNORECASE)
+_EXPR_AND = re.compile(r"\s+and\s+|\s*&&\s*", re.IGNORECASE)
+
+def _unquote(v: str) -> str:
+    v = v.strip()
+    if len(v) >= 2 and v[0] == v[-1] and v[0] in "\"'":
+        return v[1:-1]
+    return v
+
+def _parse_where_like(x: Any, norm: Callable[[str], str] = _normalize_key_for_sheet) -> dict[str, Any] | None:
+    """'subject = "数学"' のような簡易式を {"教科":"数学"} に変換。辞書はそのまま通す。
+
+    and / && で複数条件、`key in (a, b)`、`key >= 2` / `<` など（範囲）、`key ^= 青` （前方一致）も可。
+    """
     if isinstance(x, dict):
         # キー正規化（英語→日本語見出し）
-        return { _normalize_key_for_sheet(str(k)) : v for k, v in x.items() }
+        return { norm(str(k)) : v for k, v in x.items() }
     if isinstance(x, str):
-        s = x.strip()
-        # 演算子 = / : をサポート（前後空白/引用符を吸収）
-        for sep in ["=", ":"]:
-            if sep in s:
-                left, right = s.split(sep, 1)
-                key = _normalize_key_for_sheet(left.strip())
-                val = right.strip()
-                if (val.startswith("\"") and val.endswith("\"")) or (val.startswith("'") and val.endswith("'")):
-                    val = val[1:-1]
-                if key:
-                    return { key: val }
-        # 解析不能
-        return None
+        out: dict[str, Any] = {}
+        for part in _EXPR_AND.split(x.strip()):
+            m = _EXPR_IN.match(part.strip())
+            if m:
+                key = norm(m.group(1).strip())
+                out[key] = [_unquote(v) for v in m.group(2).split(",") if v.strip()]
+                continue
+            for sep, op in _EXPR_OPS:
+                if sep in part:
+                    left, right = part.split(sep, 1)
+                    key = norm(left.strip())
+                    if not key:
+                        return None
+                    val = _unquote(right)
+                    if op == "eq":
+                        out[key] = val
+                    else:
+                        prev = out.get(key)
+                        out[key] = {**(prev if isinstance(prev, dict) else {} if prev is None else {"eq": prev}), op: val}
+                    break
+            else:
+                # 解析不能
+                return None
+        return out or None
     return None
 
-@mcp.tool()
-async def books_filter(where: Any = None, contains: Any = None, limit: int | None = 50) -> dict:
+def _rich_query(*conds: Any, sort: Any = None, offset: Any = None) -> bool:
+    """GAS の books.filter / students.filter（完全一致・部分一致のみ）では答えられない指定か。"""
+    return bool(sort) or bool(offset) or any(isinstance(v, (dict, list, tuple)) for c in conds if isinstance(c, dict) for v in c.values())
+
+def _query_data(key: str, res: dict, limit: int | None, offset: int | None, rich: bool) -> dict:
+    data: dict[str, Any] = {key: res["rows"], "count": len(res["rows"])}
+    if key == "books":
+        data["limit"] = limit if isinstance(limit, int) and limit > 0 else None
+    if rich:
+        data["total"] = res["total"]
+        data["offset"] = offset if isinstance(offset, int) and offset > 0 else 0
+    return data
+
+# books_filter / students_filter のローカルのクエリエンジン（よく絞り込む列に索引）
+_BOOKS_TABLE = Table(books_mirror.column_values, indexed=("教科", "参考書のタイプ"), known=books_mirror.has_column)
+_STUDENTS_TABLE = Table(students_query.column_values, indexed=("Status", "学年"))
+
+@tool()
+async def books_filter(where: Any = None, contains: Any = None, limit: int | None = 50, sort: Any = None, offset: int | None = None) -> dict:
     """条件で参考書をフィルタします（GAS WebApp: books.filter）。
 
     引数:
     - where: 完全一致の条件（辞書 or 文字列式）。例: {"教科":"数学"} / "subject='数学'"
+      値をリストにすると in、辞書で演算子 {"in":[...]} / {"prefix":"青"} / {"gte":2,"lt":5}（数値の範囲）/ {"contains":"..."}。
+      文字列式は "subject in (数学, 英語) and unit_load >= 2" / "title ^= 青" も可
     - contains: 部分一致の条件（辞書 or 文字列式）。例: {"参考書名":"青チャート"}
-    - limit: 上限件数（既定 50）
+    - limit: 上限件数（既定 50）、offset: 先頭から飛ばす件数
+    - sort: 並べ替え（例 ["教科", "-unit_load"]。- で降順）
 
     キーの自動マッピング:
     - subject→教科, title→参考書名, id→参考書ID など、英語キーはシート見出しへ自動変換します。
 
     返り値（例）:
-    { ok:true, data:{ books:[ {id,title,subject,…} ], count, limit } }
+    { ok:true, data:{ books:[ {id,title,subject,…} ], count, limit, total?, offset? } }
+    （範囲・in・前方一致・sort・offset のときは total/offset 付き。手元の写しを索引で絞り込み、meta.plan に使った索引）
     """
     payload: dict[str, Any] = {"op": "books.filter"}
     w = _parse_where_like(where) if where is not None else None
@@ -299,6 +735,29 @@ async def books_filter(where: Any = None, contains: Any = None, limit: int | Non
         payload["contains"] = c
     if isinstance(limit, int) and limit > 0:
         payload["limit"] = limit
+    rich = _rich_query(w, sort=sort, offset=offset)
+    books = await _mirror_books()
+    version: Any = (id(books), _BOOKS.loads)
+    if books is None and rich:  # ミラー無効/取得失敗でも演算子は手元で評価する（全件を 1 回取る）
+        try:
+            full = await _post({"op": "books.filter"})
+        except Exception as e:
+            return {"ok": False, "op": "books.filter", "error": {"code": "HTTP_POST_ERROR", "message": str(e)}}
+        if not full.get("ok"):
+            return full
+        books, version = (full.get("data") or {}).get("books") or [], None
+    if books is not None:
+        _BOOKS_TABLE.load(books, version)
+        try:
+            res = _BOOKS_TABLE.query(payload.get("where"), payload.get("contains"), sort, payload.get("limit"), offset)
+        except QueryError as e:
+            return {"ok": False, "op": "books.filter", "error": {"code": "BAD_INPUT", "message": str(e)}}
+        if res is not None:
+            out = _mirror_ok("books.filter", _query_data("books", res, limit, offset, rich))
+            out["meta"]["plan"] = res["plan"]
+            return out
+        if rich:
+            return {"ok": False, "op": "books.filter", "error": {"code": "BAD_INPUT", "message": "operators/sort are supported only on the columns of books.filter (教科, 参考書名, 参考書のタイプ, 単位当たり処理量, 章の名前 …)"}}
     try:
         return await _post(payload)
     except Exception as e:
@@ -309,7 +768,11 @@ async def books_filter(where: Any = None, contains: Any = None, limit: int | Non
 
 def _normkey(k: str) -> str: return k.strip().lower()
 
-@mcp.tool()
+def _head(items: list, limit: int | None = None) -> Iterable:
+    """先頭 limit 件（スライスで中間のリストを作らず、一覧の整形と 1 パスで回す）。"""
+    return itertools.islice(items, limit) if isinstance(limit, int) and limit > 0 else items
+
+@tool()
 async def students_list(limit: int | None = None, include_all: bool | None = None) -> dict:
     """生徒一覧（親行のみ、id/name/grade/linksの簡易形）。
 
@@ -328,17 +791,16 @@ async def students_list(limit: int | None = None, include_all: bool | None = Non
             return {"ok": False, "op": "students.list", "error": {"code": "HTTP_GET_ERROR", "message": str(e)}}
     if not isinstance(data, dict) or not data.get("ok"):
         return {"ok": False, "op": "students.list", "error": {"code": "UPSTREAM_ERROR", "message": str(data)}}
-    items = ((data.get("data") or {}).get("students") or [])
     students = [{
         "id": s.get("id"),
         "name": s.get("name"),
         "grade": s.get("grade"),
         "planner_sheet_id": s.get("planner_sheet_id"),
         "meeting_doc_id": s.get("meeting_doc_id"),
-    } for s in items if isinstance(s, dict)]
+    } for s in _head((data.get("data") or {}).get("students") or [], limit) if isinstance(s, dict)]
     return {"ok": True, "op": "students.list", "data": {"students": students, "count": len(students)}}
 
-@mcp.tool()
+@tool()
 async def students_find(query: Any, limit: int | None = 10, include_all: bool | None = None) -> dict:
     q = _coerce_str(query, ("query","q","text"))
     if not q: return {"ok": False, "op": "students.find", "error": {"code": "BAD_INPUT", "message": "query is required"}}
@@ -354,8 +816,9 @@ async def students_find(query: Any, limit: int | None = 10, include_all: bool |
         except Exception as e:
             return {"ok": False, "op": "students.find", "error": {"code": "HTTP_GET_ERROR", "message": str(e)}}
 
-@mcp.tool()
-async def students_get(student_id: Any = None, student_ids: Any = None) -> dict:
+@tool()
+async def students_get(student_id: Any = None, student_ids: Any = None, fields: Any = None) -> dict:
+    """生徒の詳細（単一/複数）。fields で返すキーを絞れる（例 ["name","planner_sheet_id"]。id は常に含む。row は元の行全体）。"""
     # 単一/複数対応
     def _as_list(x: Any) -> list[str]:
         if x is None: return []
@@ -376,46 +839,84 @@ async def students_get(student_id: Any = None, student_ids: Any = None) -> dict:
     if many: params["student_ids"] = many
     elif single: params["student_id"] = single
     else: return {"ok": False, "op": "students.get", "error": {"code": "BAD_INPUT", "message": "student_id or student_ids is required"}}
+    fl = parse_fields(fields)
+    if fl: params["fields"] = fl
     try:
-        return await _post(params)
+        return _project_data(await _post(params), fl, ("student", "students"))
     except Exception as e:
         return {"ok": False, "op": "students.get", "error": {"code": "HTTP_POST_ERROR", "message": str(e)}}
 
-@mcp.tool()
-async def students_filter(where: Any = None, contains: Any = None, limit: int | None = None, include_all: bool | None = None) -> dict:
+# students_filter の写しの鮮度（STUDENTS_QUERY_TTL 秒ごとに差分同期。生徒の書き込みの確定で次回に同期）
+_STUDENTS_SYNC: dict[str, float] = {"at": 0.0}
+
+async def _students_copy() -> list[dict] | None:
+    if time.monotonic() - _STUDENTS_SYNC["at"] >= float(os.environ.get("STUDENTS_QUERY_TTL", "30")):
+        try:
+            res = await _MASTERS["students"].sync()
+        except Exception as e:
+            log("students sync failed:", e)
+            return None
+        if not res.get("ok"):
+            return None
+        _STUDENTS_SYNC["at"] = time.monotonic()
+    return _MASTERS["students"].rows()
+
+@tool()
+async def students_filter(where: Any = None, contains: Any = None, limit: int | None = None, include_all: bool | None = None,
+                          sort: Any = None, offset: int | None = None) -> dict:
+    """生徒を条件で絞り込み（既定は在塾のみ）。where/contains は見出し→値（英語キー name/grade/status なども可）。
+
+    where の値をリストにすると in、辞書で {"in":[...]} / {"prefix":"..."} / {"gte":..,"lt":..}。文字列式 "学年 in (高2, 高3)" も可。
+    sort（例 ["学年", "-名前"]）と offset も指定できる。生徒マスターの写し（差分同期）を索引で絞り込む（STUDENTS_QUERY=0 で GAS）。
+    """
     payload: dict[str, Any] = {"op": "students.filter"}
-    if isinstance(where, dict): payload["where"] = where
-    if isinstance(contains, dict): payload["contains"] = contains
+    w = _parse_where_like(where, str.strip) if where is not None else None
+    c = _parse_where_like(contains, str.strip) if contains is not None else None
+    if isinstance(w, dict): payload["where"] = w
+    if isinstance(c, dict): payload["contains"] = c
     if isinstance(limit, int) and limit>0: payload["limit"] = limit
     # 既定: 在塾のみ（呼び出し側で Status が指定されていなければ自動付与）
     if not include_all:
         w = payload.get("where") or {}
         # 明示的に Status が指定されていない場合のみ上書き
-        if not isinstance(w, dict) or ("Status" not in w and "status" not in w):
+        if not isinstance(w, dict) or not any(books_mirror.normalize(k) == "status" for k in w):
             payload["where"] = {**(w if isinstance(w, dict) else {}), "Status": "在塾"}
+    rich = _rich_query(payload.get("where"), sort=sort, offset=offset)
+    rows = await _students_copy() if _env_on("STUDENTS_QUERY") else None
+    if rows is not None:
+        _STUDENTS_TABLE.load(rows, (id(_MASTERS["students"].copy), _MASTERS["students"].copy.version))
+        try:
+            res = _STUDENTS_TABLE.query(payload.get("where"), payload.get("contains"), sort, payload.get("limit"), offset)
+        except QueryError as e:
+            return {"ok": False, "op": "students.filter", "error": {"code": "BAD_INPUT", "message": str(e)}}
+        if res is not None:
+            return {"ok": True, "op": "students.filter", "meta": {"source": "local", "plan": res["plan"]}, "data": _query_data("students", res, limit, offset, rich)}
+    if rich:
+        return {"ok": False, "op": "students.filter", "error": {"code": "UPSTREAM_ERROR", "message": "operators/sort need the local students copy (STUDENTS_QUERY=1 and a successful students sync)"}}
     try:
         return await _post(payload)
     except Exception as e:
         return {"ok": False, "op": "students.filter", "error": {"code": "HTTP_POST_ERROR", "message": str(e)}}
 
-@mcp.tool()
-async def students_create(record: dict[str, Any] | None = None, id_prefix: str | None = None) -> dict:
+@tool()
+async def students_create(record: dict[str, Any] | None = None, id_prefix: str | None = None, idempotency_key: str | None = None) -> dict:
     """生徒の新規作成。record にシート見出し→値で渡す（例: {"名前":"山田太郎","学年":"高1"}）。
     可能であれば `名前/学年` を含める。IDは s / id_prefix で自動採番。
+    idempotency_key: 応答が返らず作り直すときは前回と同じキーを渡す（作成済みなら最初の応答が返り、二重に作られない）。
     """
-    payload = {"op": "students.create", "record": record or {}}
+    payload = _with_key({"op": "students.create", "record": record or {}}, idempotency_key)
     if id_prefix: payload["id_prefix"] = id_prefix
     try:
         return await _post(payload)
     except Exception as e:
         return {"ok": False, "op": "students.create", "error": {"code": "HTTP_POST_ERROR", "message": str(e)}}
 
-@mcp.tool()
-async def students_update(student_id: Any, updates: dict[str, Any] | None = None, confirm_token: str | None = None) -> dict:
-    """生徒の更新（二段階）。updates は見出し→値のマップ。"""
+@tool()
+async def students_update(student_id: Any, updates: dict[str, Any] | None = None, confirm_token: str | None = None, idempotency_key: str | None = None) -> dict:
+    """生徒の更新（二段階）。updates は見出し→値のマップ。確定の再送は confirm_token 由来の冪等キーで最初の応答が返る。"""
     sid = _coerce_str(student_id, ("student_id","id"))
     if not sid: return {"ok": False, "op": "students.update", "error": {"code": "BAD_INPUT", "message": "student_id is required"}}
-    payload: dict[str, Any] = {"op": "students.update", "student_id": sid}
+    payload: dict[str, Any] = _with_key({"op": "students.update", "student_id": sid}, idempotency_key, confirm_token)
     if confirm_token: payload["confirm_token"] = confirm_token
     else:
         if isinstance(updates, dict): payload["updates"] = updates
@@ -425,11 +926,11 @@ async def students_update(student_id: Any, updates: dict[str, Any] | None = None
     except Exception as e:
         return {"ok": False, "op": "students.update", "error": {"code": "HTTP_POST_ERROR", "message": str(e)}}
 
-@mcp.tool()
-async def students_delete(student_id: Any, confirm_token: str | None = None) -> dict:
+@tool()
+async def students_delete(student_id: Any, confirm_token: str | None = None, idempotency_key: str | None = None) -> dict:
     sid = _coerce_str(student_id, ("student_id","id"))
     if not sid: return {"ok": False, "op": "students.delete", "error": {"code": "BAD_INPUT", "message": "student_id is required"}}
-    payload: dict[str, Any] = {"op": "students.delete", "student_id": sid}
+    payload: dict[str, Any] = _with_key({"op": "students.delete", "student_id": sid}, idempotency_key, confirm_token)
     if confirm_token: payload["confirm_token"] = confirm_token
     try:
         return await _post(payload)
@@ -437,8 +938,8 @@ async def students_delete(student_id: Any, confirm_token: str | None = None) ->
         return {"ok": False, "op": "students.delete", "error": {"code": "HTTP_POST_ERROR", "message": str(e)}}
 
 
-@mcp.tool()
-async def books_create(title: str, subject: str, unit_load: Any = None, monthly_goal: str | None = None, chapters: Any = None, id_prefix: str | None = None) -> dict:
+@tool()
+async def books_create(title: str, subject: str, unit_load: Any = None, monthly_goal: str | None = None, chapters: Any = None, id_prefix: str | None = None, idempotency_key: str | None = None) -> dict:
     """参考書を新規作成（GAS WebApp: books.create）。LLM向け・重要ルール:
 
     1) 章の配列は「最終形」を完全指定すること（追記ではない）。
@@ -450,6 +951,7 @@ async def books_create(title: str, subject: str, unit_load: Any = None, monthly_
        - 書籍が章をまたいで連番の場合のみ、次章の start=前章 end+1 に設定（例: 1章1-20 → 2章21-40）。
     4) 最初の章はシートの「親行」に入り、第2章以降は下行に追加される（GAS側仕様）。
     5) 数値は数値型で渡す（unit_load: 2 など）。id は自動採番（id_prefix で接頭辞指定可）。
+    6) 応答が返らず作り直すときは前回と同じ idempotency_key を渡す（作成済みなら最初の応答が返り、二重に作られない）。
 
     例（章ごとにリセット）:
     {"title":"語彙テスト","subject":"英語","unit_load":1,
@@ -465,7 +967,7 @@ async def books_create(title: str, subject: str, unit_load: Any = None, monthly_
        {"title":"第2章", "range":{"start":21, "end":40}, "numbering":"問"}
      ]}
     """
-    payload: dict[str, Any] = {"op": "books.create", "title": title, "subject": subject}
+    payload: dict[str, Any] = _with_key({"op": "books.create", "title": title, "subject": subject}, idempotency_key)
     if unit_load is not None:
         try:
             payload["unit_load"] = float(unit_load)
@@ -478,17 +980,20 @@ async def books_create(title: str, subject: str, unit_load: Any = None, monthly_
     if id_prefix:
         payload["id_prefix"] = id_prefix
     try:
-        return await _post(payload)
+        res = await _post(payload)
     except Exception as e:
         return {"ok": False, "op": "books.create", "error": {"code": "HTTP_POST_ERROR", "message": str(e)}}
+    if _confirmed(res):
+        _BOOKS.invalidate()
+    return res
 
 
-@mcp.tool()
-async def books_update(book_id: Any, updates: Any | None = None, confirm_token: str | None = None) -> dict:
+@tool()
+async def books_update(book_id: Any, updates: Any | None = None, confirm_token: str | None = None, idempotency_key: str | None = None) -> dict:
     """参考書の更新（GAS WebApp: books.update）。安全な2段階:
 
     1) プレビュー: {book_id, updates} → 差分と confirm_token
-    2) 確定: {book_id, confirm_token} → { updated }
+    2) 確定: {book_id, confirm_token} → { updated }（同じ確定の再送は confirm_token 由来の冪等キーで最初の応答が返る）
 
     入力の注意（LLM向け）:
     - updates.chapters は「完全置換」（追記ではない）。最終形の配列を渡す。
@@ -501,7 +1006,7 @@ async def books_update(book_id: Any, updates: Any | None = None, confirm_token:
     bid = _coerce_str(book_id, ("book_id","id"))
     if not bid:
         return {"ok": False, "op": "books.update", "error": {"code": "BAD_INPUT", "message": "book_id is required"}}
-    payload: dict[str, Any] = {"op": "books.update", "book_id": bid}
+    payload: dict[str, Any] = _with_key({"op": "books.update", "book_id": bid}, idempotency_key, confirm_token)
     if confirm_token:
         payload["confirm_token"] = confirm_token
     else:
@@ -510,13 +1015,16 @@ async def books_update(book_id: Any, updates: Any | None = None, confirm_token:
         else:
             return {"ok": False, "op": "books.update", "error": {"code": "BAD_INPUT", "message": "updates is required for preview"}}
     try:
-        return await _post(payload)
+        res = await _post(payload)
     except Exception as e:
         return {"ok": False, "op": "books.update", "error": {"code": "HTTP_POST_ERROR", "message": str(e)}}
+    if confirm_token and _confirmed(res):
+        _BOOKS.invalidate()
+    return res
 
 
-@mcp.tool()
-async def books_delete(book_id: Any, confirm_token: str | None = None) -> dict:
+@tool()
+async def books_delete(book_id: Any, confirm_token: str | None = None, idempotency_key: str | None = None) -> dict:
     """参考書の削除（2段階）を行います（GAS WebApp: books.delete）。
 
     ワークフロー:
@@ -526,43 +1034,181 @@ async def books_delete(book_id: Any, confirm_token: str | None = None) -> dict:
     bid = _coerce_str(book_id, ("book_id","id"))
     if not bid:
         return {"ok": False, "op": "books.delete", "error": {"code": "BAD_INPUT", "message": "book_id is required"}}
-    payload: dict[str, Any] = {"op": "books.delete", "book_id": bid}
+    payload: dict[str, Any] = _with_key({"op": "books.delete", "book_id": bid}, idempotency_key, confirm_token)
     if confirm_token:
         payload["confirm_token"] = confirm_token
     try:
-        return await _post(payload)
+        res = await _post(payload)
     except Exception as e:
         return {"ok": False, "op": "books.delete", "error": {"code": "HTTP_POST_ERROR", "message": str(e)}}
+    if confirm_token and _confirmed(res):
+        _BOOKS.invalidate()
+    return res
 
 
-@mcp.tool()
+@tool()
 async def books_list(limit: int | None = None) -> dict:
     """参考書を簡易一覧（id/subject/title のみ）。
 
     実装: books.filter（条件なし）で全件を取得し、必要最小項目に整形。
     - limit 指定時はその件数に切り詰め。
-    - 依存: WebAppの books.filter（POST）。table.read には依存しない。
+    - 依存: WebAppの books.filter（POST）。table.read には依存しない。ミラーが有効ならスナップショットから返す。
     """
-    payload: dict[str, Any] = {"op": "books.filter"}
-    if isinstance(limit, int) and limit > 0:
-        payload["limit"] = limit
-    try:
-        data = await _post(payload)
-    except Exception as e:
-        return {"ok": False, "op": "books.list", "error": {"code": "HTTP_POST_ERROR", "message": str(e)}}
+    items = await _mirror_books()
+    if items is None:
+        payload: dict[str, Any] = {"op": "books.filter"}
+        if isinstance(limit, int) and limit > 0:
+            payload["limit"] = limit
+        try:
+            data = await _post(payload)
+        except Exception as e:
+            return {"ok": False, "op": "books.list", "error": {"code": "HTTP_POST_ERROR", "message": str(e)}}
 
-    if not isinstance(data, dict) or not data.get("ok"):
-        return {"ok": False, "op": "books.list", "error": {"code": "UPSTREAM_ERROR", "message": str(data)}}
+        if not isinstance(data, dict) or not data.get("ok"):
+            return {"ok": False, "op": "books.list", "error": {"code": "UPSTREAM_ERROR", "message": str(data)}}
 
-    items = ((data.get("data") or {}).get("books") or [])
+        items = ((data.get("data") or {}).get("books") or [])
     books = [
         {"id": b.get("id"), "subject": b.get("subject"), "title": b.get("title")}
-        for b in items if isinstance(b, dict)
+        for b in _head(items, limit) if isinstance(b, dict)
     ]
     return {"ok": True, "op": "books.list", "data": {"books": books, "count": len(books)}}
 
 
-@mcp.tool()
+@tool()
+async def books_refresh() -> dict:
+    """参考書マスターのミラー（books_find/get/filter/list の応答元）を今すぐ再取得します。
+
+    通常は TTL（BOOKS_MIRROR_TTL 秒）で自動更新され、create/update/delete の確定時にも破棄されます。
+    シートを直接編集した直後など、すぐに反映したいときに使います。
+    """
+    try:
+        books = await _BOOKS.refresh()
+    except Exception as e:
+        return {"ok": False, "op": "books.refresh", "error": {"code": "HTTP_POST_ERROR", "message": str(e)}}
+    if books is None:
+        return {"ok": False, "op": "books.refresh", "error": {"code": "UPSTREAM_ERROR", "message": "books.filter failed"}}
+    return {"ok": True, "op": "books.refresh", "data": _BOOKS.stats()}
+
+
+@tool()
+async def masters_sync(kind: str | None = None) -> dict:
+    """参考書/生徒マスターの手元の写しを差分同期します（GAS: books.changed_since / students.changed_since）。
+
+    引数: kind = "books" | "students"（省略時は両方）。
+    追加/変更/削除された行だけを取り込みます。初回やカーソルの期限切れ（6 時間）は全件を取り直します（reset=true）。
+    参考書ミラーは次の読み取りで写しから作り直されます。
+    """
+    kinds = [str(kind).strip()] if kind else list(_MASTERS)
+    bad = [k for k in kinds if k not in _MASTERS]
+    if bad:
+        return {"ok": False, "op": "masters.sync", "error": {"code": "BAD_INPUT", "message": f"kind must be one of {sorted(_MASTERS)}"}}
+    out: dict[str, Any] = {}
+    for k in kinds:
+        try:
+            res = await _MASTERS[k].sync()
+        except Exception as e:
+            return {"ok": False, "op": "masters.sync", "error": {"code": "HTTP_POST_ERROR", "message": str(e)}}
+        if not res.get("ok"):
+            return res
+        out[k] = {**res["data"], "stats": _MASTERS[k].stats()}
+        if k == "books":
+            _BOOKS.invalidate()
+    return {"ok": True, "op": "masters.sync", "data": out}
+
+
+@tool()
+async def snapshot_export(
+    path: str | None = None,
+    student_ids: Any = None,
+    spreadsheet_ids: Any = None,
+    months: Any = None,
+) -> dict:
+    """参考書/生徒マスターと週間管理シートの読み取り結果を 1 つのスナップショット（SQLite）に書き出します。
+
+    引数:
+    - path: 出力先（省略時 SNAPSHOT_PATH、既定 /tmp/cram-books-snapshot.sqlite3）
+    - student_ids / spreadsheet_ids: 対象シート（省略時は在塾生全員の週間管理シート）
+    - months: 月間管理の年月（例 ["2025-07","2025-08"] / "2025-07,2025-08"。省略時は今月と前月）
+
+    シートごとに planner.ids_list / dates.get / metrics.get / plan.get と各月の monthly.filter を保存します。
+    取得に失敗したシートは errors[] に残し、残りは書き出します。
+    """
+    split = lambda x: [str(v).strip() for v in (x if isinstance(x, list) else str(x or "").split(",")) if str(v or "").strip()]  # noqa: E731
+    out = path or os.environ.get("SNAPSHOT_PATH") or "/tmp/cram-books-snapshot.sqlite3"
+    try:
+        return await snapshot.export(
+            out, _post,
+            student_ids=split(student_ids) or None,
+            spreadsheet_ids=split(spreadsheet_ids) or None,
+            months=snapshot.parse_months(months) if months else None,
+            concurrency=int(os.environ.get("SNAPSHOT_CONCURRENCY", "4")),
+        )
+    except Exception as e:
+        return {"ok": False, "op": "snapshot.export", "error": {"code": "EXPORT_FAILED", "message": str(e)}}
+
+
+@tool()
+async def snapshot_import(path: str | None = None, off: bool | None = None) -> dict:
+    """スナップショットを読み取り元にします（snapshot-read モード）。off=true で上流（GAS）に戻します。
+
+    読み取りツール（books_* / students_* / planner_*_get / planner_monthly_filter / planner_plan_targets）は
+    スナップショットから答え、書き込みは SNAPSHOT_READ_ONLY で拒否します。
+    切り替え時は応答キャッシュ・版・参考書ミラー・シート対応表を捨てます（マスターの写しは次の差分同期で全件を取り直す）。
+    """
+    if off:
+        reader = None
+    else:
+        src = path or os.environ.get("SNAPSHOT_PATH") or "/tmp/cram-books-snapshot.sqlite3"
+        try:
+            reader = snapshot.SnapshotReader(src)
+        except Exception as e:
+            return {"ok": False, "op": "snapshot.import", "error": {"code": "BAD_SNAPSHOT", "message": f"{src}: {e}"}}
+    _SNAPSHOT["reader"] = reader
+    _CACHE.clear()
+    _VERSIONS.clear()
+    _BOOKS.invalidate()
+    _SHEETS.expire()
+    _STUDENTS_SYNC["at"] = 0.0
+    _HISTORY.clear()
+    return {"ok": True, "op": "snapshot.import", "data": reader.stats() if reader else {"enabled": False}}
+
+
+def _snapshot_stats() -> dict:
+    reader = _SNAPSHOT["reader"]
+    return {**(reader.stats() if reader else {"enabled": False}), "fallbacks": _SNAPSHOT["fallbacks"]}
+
+
+@tool()
+async def cache_stats(clear: bool | None = None) -> dict:
+    """応答キャッシュ（students.* / planner.* の読み取り）と参考書ミラーのヒット率・サイズ、
+    同時実行の集約（single-flight）件数、プレビュートークンの未確定/失効/確定件数、
+    上流呼び出しの再試行/ブレーカー/ヘッジの状況、planner 読み取りの版一致（not_modified）件数、
+    マスター差分同期の状況、WebApp / Execution API の経路選択（op ごとの EWMA）とトークンの状態を返します。
+
+    引数: clear=true で応答キャッシュを空にする（統計は残る。版は内容のハッシュなので残しても古い内容は返らない）。
+    """
+    if clear:
+        _CACHE.clear()
+    return {"ok": True, "op": "cache.stats", "data": {"response_cache": _CACHE.stats(), "books_mirror": _BOOKS.stats(), "singleflight": _FLIGHT.stats(), "preview_tokens": _PREVIEWS.stats(), "resilience": _RESILIENCE.stats(), "versions": _VERSIONS.stats(), "masters": {k: m.stats() for k, m in _MASTERS.items()}, "planner_sheets": _SHEETS.stats(), "idempotency": dict(_IDEMPOTENCY), "snapshot": _snapshot_stats(), "query": {"books": _BOOKS_TABLE.stats(), "students": _STUDENTS_TABLE.stats()}, "history": _HISTORY.stats(), "routing": {**_ROUTER.stats(), "tokens": exec_api.get_tokens().stats()}}}
+
+
+@tool()
+async def trace_get(trace_id: str | None = None, tool_name: str | None = None, limit: int | None = 20) -> dict:
+    """直近のツール呼び出しのトレースを返します（デバッグ用）。
+
+    - trace_id 指定: その呼び出しの span 一覧（上流 op ごとの開始/所要時間・送受信バイト・GAS 側処理時間）
+    - 省略時: 新しい順の概要（tool_name で絞り込み, 最大 limit 件）
+    """
+    if trace_id:
+        tr = tracing.find(str(trace_id).strip())
+        if tr is None:
+            return {"ok": False, "op": "trace.get", "error": {"code": "NOT_FOUND", "message": f"trace '{trace_id}' is not in the buffer"}}
+        return {"ok": True, "op": "trace.get", "data": tr}
+    return {"ok": True, "op": "trace.get", "data": {"traces": tracing.recent(limit or 20, tool_name)}}
+
+
+@tool()
 async def tools_help() -> dict:
     """このMCPで公開中のツール一覧と使い方を返します（簡易ヘルプ）。
 
@@ -583,16 +1229,16 @@ async def tools_help() -> dict:
         {
             "name": "books_get",
             "desc": "参考書の詳細取得（単一/複数）",
-            "args": {"book_id": "string | optional", "book_ids": "string[] | optional"},
-            "example": {"book_ids": ["gMB017", "gMB018"]},
-            "returns": "{ book } または { books }",
+            "args": {"book_id": "string | optional", "book_ids": "string[] | optional", "fields": "string[] | optional（例 [\"title\",\"subject\"]。id は常に含む）"},
+            "example": {"book_ids": ["gMB017", "gMB018"], "fields": ["title", "structure.chapters"]},
+            "returns": "{ book } または { books }（fields 指定時はそのキーのみ）",
         },
         {
             "name": "books_filter",
             "desc": "条件で参考書を絞り込み（書籍単位）",
-            "args": {"where": "object|string", "contains": "object|string", "limit": "number"},
-            "example": {"where": {"教科": "数学"}, "limit": 10},
-            "notes": "文字列式 subject='数学' や英語キー（subject/title/id）も可",
+            "args": {"where": "object|string", "contains": "object|string", "limit": "number", "sort": "string[]?（例 [\"-unit_load\",\"title\"]）", "offset": "number?"},
+            "example": {"where": {"教科": ["数学", "英語"], "unit_load": {"gte": 2}}, "sort": ["-unit_load"], "limit": 10},
+            "notes": "文字列式 subject='数学' や英語キー（subject/title/id）も可。値のリスト=in、{prefix}/{gt,gte,lt,lte}、式 \"subject in (数学, 英語) and unit_load >= 2\" / \"title ^= 青\"。手元の写しを教科・参考書のタイプの索引で絞る（meta.plan）。students_filter も同じ演算子（Status・学年に索引）",
         },
         {
             "name": "books_list",
@@ -601,17 +1247,62 @@ async def tools_help() -> dict:
             "example": {"limit": 50},
             "returns": "{ books:[{id,subject,title}], count }",
         },
+        {
+            "name": "books_refresh",
+            "desc": "参考書ミラー（find/get/filter/list の応答元）を即時再取得",
+            "args": {},
+            "returns": "{ loaded, count, age_seconds, ttl_seconds, loads, hits }",
+            "notes": "通常は不要（TTLと create/update/delete 確定で自動更新）。シートを直接編集した直後に使用。",
+        },
+        {
+            "name": "masters_sync",
+            "desc": "参考書/生徒マスターの手元の写しを差分同期（追加・変更・削除された行だけを取得）",
+            "args": {"kind": "'books' | 'students' | optional（省略時は両方）"},
+            "example": {"kind": "books"},
+            "returns": "{ books?:{kind,reset,upserts,deletes,count,stats}, students?:{...} }",
+            "notes": "初回・カーソル期限切れ（6時間）は全件（reset=true）。参考書ミラーの取り込みも既定でこの差分同期（BOOKS_SYNC=0 で全件取得）。",
+        },
+        {
+            "name": "snapshot_export",
+            "desc": "マスターと週間管理シートの読み取り結果をローカルのスナップショット（SQLite）に書き出す",
+            "args": {"path": "string?（既定 SNAPSHOT_PATH）", "student_ids": "string[]?", "spreadsheet_ids": "string[]?", "months": "string[]?（例 [\"2025-07\"]。既定は今月と前月）"},
+            "example": {"student_ids": ["S001"], "months": ["2025-07", "2025-08"]},
+            "returns": "{ path, snapshot_id, created_at, books, students, sheets, grids, months[], bytes, errors[], elapsed_ms }",
+            "notes": "シート未指定なら在塾生全員。CLI: python -m apps.mcp.snapshot export <path>。",
+        },
+        {
+            "name": "snapshot_import",
+            "desc": "スナップショットを読み取り元にする（snapshot-read モード。GAS の障害・クォータ切れでも読み取りが動く）",
+            "args": {"path": "string?（既定 SNAPSHOT_PATH）", "off": "boolean?（true で上流に戻す）"},
+            "example": {"path": "/tmp/cram-books-snapshot.sqlite3"},
+            "returns": "{ enabled, path, snapshot_id, created_at, books, students, sheets, grids, answered{}, missing{} }",
+            "notes": "起動時は SNAPSHOT_READ=<path>。書き込みは SNAPSHOT_READ_ONLY、スナップショットにないシート/月は NOT_IN_SNAPSHOT（SNAPSHOT_FALLBACK=1 で上流へ）。",
+        },
+        {
+            "name": "cache_stats",
+            "desc": "応答キャッシュ/参考書ミラーの統計（ヒット率・バイト数・TTL）と同時リクエスト集約数、プレビュートークン件数、再試行/ブレーカー状況",
+            "args": {"clear": "boolean | optional（応答キャッシュを空にする）"},
+            "returns": "{ response_cache:{entries,bytes,hits,misses,hit_ratio,ops{}}, books_mirror:{...}, singleflight:{calls,upstream_executions,coalesced,coalesced_by_op,snapshots,in_flight}, preview_tokens:{backend,outstanding,issued,confirmed,expired,evicted}, resilience:{breakers,retries,gave_up,rejected,hedged,hedge_wins,p95_ms}, masters:{books,students}, planner_sheets:{entries,hits,misses,loads,forgotten}, idempotency:{confirmed,keyed,replayed}, snapshot:{enabled,path?,snapshot_id?,created_at?,answered?,missing?,fallbacks}, query:{books,students}, history:{entries,closed_entries,hits,misses,hit_ratio,evicted}, routing:{mode,routed,fallbacks,exec_failures,ops{op:{webapp,exec_api}},tokens} }",
+            "notes": "planner.plan.set/dates.set、students.create/update/delete の確定で該当シート/生徒の分は自動で破棄。",
+        },
+        {
+            "name": "trace_get",
+            "desc": "直近のツール呼び出しのトレース（trace_id ごとの上流 op・所要時間・バイト数）",
+            "args": {"trace_id": "string?", "tool_name": "string?", "limit": "number?（既定 20）"},
+            "returns": "{ traces:[{trace_id,tool,duration_ms,ok,error_code,upstream_requests,bytes_sent,bytes_received}] } または { ..., spans:[{id,parent,name,kind,start_ms,duration_ms,req_bytes,resp_bytes,gas_ms?,error_code?}] }",
+            "notes": "直近 TRACE_BUFFER 件（既定 200）のみ保持。GAS 側の実行ログにも同じ trace_id が出る。"
+        },
         {
             "name": "books_create",
             "desc": "参考書の新規作成（自動ID付与）",
-            "args": {"title":"string","subject":"string","unit_load":"number?","monthly_goal":"string?","chapters":"Chapter[]?","id_prefix":"string?"},
+            "args": {"title":"string","subject":"string","unit_load":"number?","monthly_goal":"string?","chapters":"Chapter[]?","id_prefix":"string?","idempotency_key":"string?（再送時は前回と同じキー）"},
             "example": {"title":"テスト本","subject":"数学","unit_load":2,"chapters":[{"title":"第1章","range":{"start":1,"end":20},"numbering":"問"}]},
             "notes": "chaptersは最終形（完全指定）。numberingは必ず埋める（問/No./講など）。原則は章ごとにstart=1、連番書籍のみcarry。第1章は親行、2章以降は下行。数値は数値型で。"
         },
         {
             "name": "books_update",
             "desc": "二段階更新（preview→confirm）",
-            "args": {"book_id":"string","updates":"object?","confirm_token":"string?"},
+            "args": {"book_id":"string","updates":"object?","confirm_token":"string?","idempotency_key":"string?"},
             "example_preview": {"book_id":"gMB017","updates":{"title":"（改）"}},
             "example_confirm": {"book_id":"gMB017","confirm_token":"…"},
             "notes": "updates.chaptersは完全置換。numberingは必ず埋める。章またぎは原則リセット（start=1）、連番書籍のみcarry。章1は親行、章2以降は下行。未変更項目は含めない。"
@@ -619,7 +1310,7 @@ async def tools_help() -> dict:
         {
             "name": "books_delete",
             "desc": "二段階削除（preview→confirm）",
-            "args": {"book_id":"string","confirm_token":"string?"},
+            "args": {"book_id":"string","confirm_token":"string?","idempotency_key":"string?"},
             "example_preview": {"book_id":"gMB017"},
             "example_confirm": {"book_id":"gMB017","confirm_token":"…"},
         },
@@ -652,22 +1343,30 @@ async def tools_help() -> dict:
         {
             "name": "planner_plan_get",
             "desc": "計画セル（H/P/X/AF/AN, 行4〜30）を取得（改行保持）",
-            "args": {"student_id": "string?", "spreadsheet_id": "string?"},
+            "args": {"student_id": "string?", "spreadsheet_id": "string?", "weeks": "number[]?（例 [2]）", "fields": "string[]?（items のキー。例 [\"plan_text\"]。row は常に含む）"},
         },
         {
             "name": "planner_plan_create",
             "desc": "計画セルの一括作成（高速・単発）。MUST: 実行前に planner_guidance を読むこと。",
-            "args": {"items": "{week_index,row|book_id,plan_text,overwrite?}[]", "student_id": "string?", "spreadsheet_id": "string?", "overwrite": "bool?"},
+            "args": {"items": "{week_index,row|book_id,plan_text,overwrite?}[]", "student_id": "string?", "spreadsheet_id": "string?", "overwrite": "bool?", "idempotency_key": "string?（再送時は前回と同じキー）"},
             "returns": "{ updated, results[], warnings[], guidance_digest }",
             "notes": "週混在OK。GAS側で列ごとに連続ブロックへバッチ書込み。前提/上限/overwrite規則は従来通り。"
         },
         {
             "name": "planner_plan_create",
             "desc": "計画セルの一括作成（高速・単発）。MUST: 実行前に planner_guidance を読むこと。",
-            "args": {"items": "{week_index,row|book_id,plan_text,overwrite?}[]", "student_id": "string?", "spreadsheet_id": "string?", "overwrite": "bool?"},
+            "args": {"items": "{week_index,row|book_id,plan_text,overwrite?}[]", "student_id": "string?", "spreadsheet_id": "string?", "overwrite": "bool?", "idempotency_key": "string?（再送時は前回と同じキー）"},
             "returns": "{ updated, results[], warnings[], guidance_digest }",
             "notes": "週混在OK。GAS側で列ごとに連続ブロックへバッチ書込み。前提/上限/overwrite規則は従来通り。"
         },
+        {
+            "name": "planner_monthly_history",
+            "desc": "月間管理の実績を複数月まとめて取得し、参考書ごとのペース（週あたりの量・1 単位あたりの時間・傾向）を集計",
+            "args": {"student_id": "string?", "spreadsheet_id": "string?", "from_month": "string?（例 2025-05）", "to_month": "string?", "months": "string[]?", "book_id": "string?", "include_items": "bool?"},
+            "example": {"student_id": "S001", "from_month": "2025-05", "to_month": "2025-07"},
+            "returns": "{ months:[{month,count,cached,closed}], books:[{book_id,units_per_week,advance_per_week,minutes_per_unit,trend:{slope_per_month,direction,per_month[]},last_actual}], errors[] }",
+            "notes": "既定は今月までの直近 3 か月。キャッシュにない月だけを 1 回の batch で取得し、締まった月は以後キャッシュから答える。",
+        },
         {
             "name": "planner_guidance",
             "desc": "LLM向け：週間管理の計画作成ガイド（書式/上限/前提/手順）",
@@ -676,9 +1375,23 @@ async def tools_help() -> dict:
         {
             "name": "planner_plan_targets",
             "desc": "書込み候補の自動抽出（A非空・週間時間非空・計画未入力）。TOCに基づく簡易サジェスト付き。",
-            "args": {"student_id": "string?", "spreadsheet_id": "string?"},
-            "returns": "{ week_count, targets:[{week_index,row,book_id,weekly_minutes,guideline_amount,prev_range_hint,numbering_symbol,suggested_plan_text,suggestion_confidence,end_of_book}] }",
-            "notes": "suggested_plan_text は prev_range_hint と guideline_amount/TOC をもとに推定。境界不確実な場合は confidence=low とする。"
+            "args": {"student_id": "string?", "spreadsheet_id": "string?", "pace": "boolean?（既定 PLAN_PACE=0）", "pace_months": "number?（既定 PLAN_PACE_MONTHS=3, 上限 24）"},
+            "returns": "{ week_count, targets:[{week_index,row,book_id,weekly_minutes,guideline_amount,prev_range_hint,numbering_symbol,suggested_plan_text,suggested_segments,suggested_amount,suggestion_confidence,end_of_book,pace?}], pace?:{months,books_observed,errors} }",
+            "notes": "suggested_plan_text は直前週の計画（記入済み or 前週の叩き台）の続きを suggested_amount ぶん、目次の章境界・章ごとの記号に沿って推定（reset 型は章名付き）。suggested_amount は既定で guideline_amount、pace=true なら月間管理の実績と記入済みの週の量を guideline_amount へ縮約した平均。suggestion_confidence は 0..1（位置の確かさ: 一意 0.9 / 章が推定 0.65 / 先頭からと仮定 0.6 / 目次なし 0.35 × 量の確かさ: 目安量のみ 0.85、ペースは観測週数 n の重み n/(n+2) で観測の揃い具合 1.0〜0.7 へ寄せる。1 週だけなら 0.85 のまま）。"
+        },
+        {
+            "name": "planner_plan_targets_bulk",
+            "desc": "在塾生全員（または指定生徒）の planner_plan_targets を同時実行数の上限付きで並行計算",
+            "args": {"student_ids": "string[]?", "concurrency": "number?（既定 PLAN_TARGETS_CONCURRENCY=4, 上限 30）", "summary_only": "boolean?", "pace": "boolean?", "pace_months": "number?"},
+            "returns": "{ count, ok_count, error_count, concurrency, elapsed_ms, results:[{student_id,name,ok,week_count,target_count,targets?,error?,elapsed_ms}] }",
+            "notes": "生徒ごとの失敗は results[].error に閉じ込める。1 人終わるごとに progress/log 通知を送る。"
+        },
+        {
+            "name": "planner_plan_create_bulk",
+            "desc": "複数生徒の計画セルを 1 コールで一括作成（シートごとにまとめ、シート間は並行）。MUST: 実行前に planner_guidance を読むこと。",
+            "args": {"items": "{student_id|spreadsheet_id,week_index,row|book_id,plan_text,overwrite?}[]", "overwrite": "bool?", "concurrency": "number?（既定 PLAN_WRITE_CONCURRENCY=4, 上限 30）", "idempotency_key": "string?"},
+            "returns": "{ count, ok_count, error_count, concurrency, elapsed_ms, guidance_digest, sheets:[{spreadsheet_id|student_id,ok,week_count,submitted,updated,rejected[],results[],error?,elapsed_ms}], rejected? }",
+            "notes": "週数はキャッシュ済みの planner_dates_get で確認し、範囲外の週・52文字超は送らずに rejected へ。同じシートへの書込みは items の順に直列。guidance は 1 回だけ読み込む。"
         },
     ]
     return {"ok": True, "op": "tools.help", "data": {"tools": tools}}
@@ -686,7 +1399,13 @@ async def tools_help() -> dict:
 
 # ===== Planner (weekly) tools =====
 
-@mcp.tool()
+def _sheet_payload(op: str, sid: str | None, spid: str | None) -> dict[str, Any]:
+    payload: dict[str, Any] = {"op": op}
+    if sid: payload["student_id"] = sid
+    if spid: payload["spreadsheet_id"] = spid
+    return payload
+
+@tool()
 async def planner_ids_list(student_id: Any = None, spreadsheet_id: Any = None) -> dict:
     """A4:D30 を読み取り、raw_code/月コード/book_id/教科/タイトル/進め方メモを返します。
 
@@ -701,7 +1420,7 @@ async def planner_ids_list(student_id: Any = None, spreadsheet_id: Any = None) -
     if spid: payload["spreadsheet_id"] = spid
     return await _post(payload)
 
-@mcp.tool()
+@tool()
 async def planner_dates_get(student_id: Any = None, spreadsheet_id: Any = None) -> dict:
     payload: dict[str, Any] = {"op": "planner.dates.get"}
     sid = _coerce_str(student_id, ("student_id","id"))
@@ -710,7 +1429,7 @@ async def planner_dates_get(student_id: Any = None, spreadsheet_id: Any = None)
     if spid: payload["spreadsheet_id"] = spid
     return await _post(payload)
 
-@mcp.tool()
+@tool()
 async def planner_dates_propose(start_date: str, student_id: Any = None, spreadsheet_id: Any = None) -> dict:
     """D1 を変更するプレビューを作成（差分だけを返し、確定は confirm で）。"""
     get = await planner_dates_get(student_id=student_id, spreadsheet_id=spreadsheet_id)
@@ -725,15 +1444,15 @@ async def planner_dates_propose(start_date: str, student_id: Any = None, spreads
     })
     return {"ok": True, "op": "planner.dates.propose", "data": {"confirm_token": token, "effects": [{"cell": "D1", "before": before[0] if isinstance(before, list) else None, "after": start_date}]}}
 
-@mcp.tool()
+@tool()
 async def planner_dates_confirm(confirm_token: str) -> dict:
     payload = _preview_pop(confirm_token)
     if not payload:
-        return {"ok": False, "op": "planner.dates.confirm", "error": {"code": "CONFIRM_EXPIRED", "message": "invalid token"}}
+        return {"ok": False, "op": "planner.dates.confirm", "error": {"code": "CONFIRM_EXPIRED", "message": "invalid or expired token"}}
     payload["op"] = "planner.dates.set"
-    return await _post(payload)
+    return await _post(_with_key(payload, confirm_token=confirm_token))
 
-@mcp.tool()
+@tool()
 async def planner_metrics_get(student_id: Any = None, spreadsheet_id: Any = None) -> dict:
     payload: dict[str, Any] = {"op": "planner.metrics.get"}
     sid = _coerce_str(student_id, ("student_id","id"))
@@ -742,21 +1461,32 @@ async def planner_metrics_get(student_id: Any = None, spreadsheet_id: Any = None
     if spid: payload["spreadsheet_id"] = spid
     return await _post(payload)
 
-@mcp.tool()
-async def planner_plan_get(student_id: Any = None, spreadsheet_id: Any = None) -> dict:
-    # 1) plans
-    payload: dict[str, Any] = {"op": "planner.plan.get"}
+@tool()
+async def planner_plan_get(student_id: Any = None, spreadsheet_id: Any = None, weeks: Any = None, fields: Any = None) -> dict:
+    """計画セルと週ごとの指標（weekly_minutes/unit_load/guideline_amount）を週×行で返します。
+
+    - weeks: 返す週番号（例 [2] / "1,2"）。省略時は全週。GAS 側も指定週の列だけを読む
+    - fields: items に残すキー（例 ["plan_text"]）。row は常に含む。指標を含まない指定なら metrics.get を呼ばない
+    """
+    # 1) plans と 2) metrics（同じ入力で取得）。互いに独立なので 1 回の batch で取得する
     sid = _coerce_str(student_id, ("student_id","id"))
     spid = _coerce_str(spreadsheet_id, ("spreadsheet_id","sheet_id","id"))
-    if sid: payload["student_id"] = sid
-    if spid: payload["spreadsheet_id"] = spid
-    plans = await _post(payload)
+    wk = parse_weeks(weeks)
+    fl = parse_fields(fields)
+    need_metrics = any(wants(fl, k) for k in ("weekly_minutes", "unit_load", "guideline_amount"))
+    reqs = [_sheet_payload("planner.plan.get", sid, spid)]
+    if need_metrics:
+        reqs.append(_sheet_payload("planner.metrics.get", sid, spid))
+    if wk:
+        for r in reqs:
+            r["weeks"] = wk
+    plans, mets = (await _post_many(reqs) + [None])[:2]
     if not plans.get("ok"):
         return plans
-    # 2) metrics（同じ入力で取得）
-    mets = await planner_metrics_get(student_id=sid, spreadsheet_id=spid)
-    if not mets.get("ok"):
+    if not mets or not mets.get("ok"):
         # metricsが落ちてもプランは返す（後方互換）
+        if wk or fl:
+            return {**plans, "data": {**(plans.get("data") or {}), "weeks": project_weeks((plans.get("data") or {}).get("weeks") or [], wk, fl)}}
         return plans
     # 3) 結合: week×row で weekly_minutes/unit_load/guideline_amount を付与
     def index_by_row(items: list[dict]):
@@ -782,13 +1512,13 @@ async def planner_plan_get(student_id: Any = None, spreadsheet_id: Any = None) -
                 it["weekly_minutes"] = m.get("weekly_minutes")
                 it["unit_load"] = m.get("unit_load")
                 it["guideline_amount"] = m.get("guideline_amount")
-    return {"ok": True, "op": "planner.plan.get", "data": {"weeks": weeks}}
+    return {"ok": True, "op": "planner.plan.get", "data": {"weeks": project_weeks(weeks, wk, fl)}}
 
 # propose/confirm are fully removed (create-only workflow)
 
 
-@mcp.tool()
-async def planner_plan_create(items: Any, student_id: Any = None, spreadsheet_id: Any = None, overwrite: bool | None = None) -> dict:
+@tool()
+async def planner_plan_create(items: Any, student_id: Any = None, spreadsheet_id: Any = None, overwrite: bool | None = None, idempotency_key: str | None = None) -> dict:
     """計画セルを一括作成（高速・単発）。
 
     MUST: 実行前に planner_guidance を読むこと。応答にも guidance_digest を同梱します。
@@ -797,6 +1527,7 @@ async def planner_plan_create(items: Any, student_id: Any = None, spreadsheet_id
     - items: [{week_index, row|book_id, plan_text, overwrite?}, …]
     - student_id | spreadsheet_id: いずれか（シート解決）
     - overwrite: 省略時は false（空欄のみ）。items側で個別上書き可。
+    - idempotency_key: 応答が返らず送り直すときは前回と同じキーを渡す（書込み済みなら最初の応答が返る）
 
     動作:
     - 週混在OK。GAS側で列ごとに連続ブロックへまとめて setValues（高速）。
@@ -807,7 +1538,7 @@ async def planner_plan_create(items: Any, student_id: Any = None, spreadsheet_id
         return {"ok": False, "op": "planner.plan.create", "error": {"code": "BAD_INPUT", "message": "items[] is required"}}
     sid = _coerce_str(student_id, ("student_id","id"))
     spid = _coerce_str(spreadsheet_id, ("spreadsheet_id","sheet_id","id"))
-    payload: dict[str, Any] = {"op": "planner.plan.set", "items": []}
+    payload: dict[str, Any] = _with_key({"op": "planner.plan.set", "items": []}, idempotency_key)
     if sid: payload["student_id"] = sid
     if spid: payload["spreadsheet_id"] = spid
 
@@ -859,7 +1590,7 @@ async def planner_plan_create(items: Any, student_id: Any = None, spreadsheet_id
         out["error"] = res.get("error")
     return out
 
-@mcp.tool()
+@tool()
 async def planner_monthly_filter(year: int | str, month: int | str, student_id: Any = None, spreadsheet_id: Any = None) -> dict:
     """月間管理から指定年月(B=年下2桁, C=月)の実績を取得（読み取り専用）。
 
@@ -879,6 +1610,102 @@ async def planner_monthly_filter(year: int | str, month: int | str, student_id:
         return {"ok": False, "op": "planner.monthly.filter", "error": {"code": "HTTP_POST_ERROR", "message": str(e)}}
 
 
+# 月間管理の実績の (シート, 年月) ごとのキャッシュ（締まった月は期限なし）
+_HISTORY = history.MonthCache.from_env()
+_HISTORY_MAX_MONTHS = 24
+
+async def _monthly_items(sid: str | None, spid: str | None, months: list[tuple[int, int]]) -> tuple[dict[tuple[int, int], list[dict]], set[tuple[int, int]], list[dict]]:
+    """(年月 → items, キャッシュから答えた年月, 失敗)。キャッシュにない月だけを 1 回の batch（使えなければ並行）で取る。"""
+    if not spid and sid and _env_on("PLANNER_SHEET_MAP"):
+        try:
+            spid = await _SHEETS.resolve(sid)
+        except Exception as e:
+            log("planner sheet resolve failed:", e)
+    sheet = spid or f"st:{sid}"
+    got: dict[tuple[int, int], list[dict]] = {}
+    missing = []
+    for ym in months:
+        items = _HISTORY.get(sheet, ym)
+        if items is None:
+            missing.append(ym)
+        else:
+            got[ym] = items
+    errors: list[dict] = []
+    base = {"spreadsheet_id": spid} if spid else {"student_id": sid}
+    reqs = [{"op": "planner.monthly.filter", "year": y, "month": m, **base} for y, m in missing]
+    for ym, res in zip(missing, await _post_many(reqs) if reqs else []):
+        if isinstance(res, dict) and res.get("ok"):
+            items = [it for it in (res.get("data") or {}).get("items") or [] if isinstance(it, dict)]
+            _HISTORY.put(sheet, ym, items)
+            got[ym] = items
+        else:
+            errors.append({"month": history.label(ym), "error": (res.get("error") if isinstance(res, dict) else None) or {"code": "UPSTREAM_ERROR", "message": str(res)}})
+    return got, set(got) - set(missing), errors
+
+@tool()
+async def planner_monthly_history(
+    student_id: Any = None,
+    spreadsheet_id: Any = None,
+    from_month: Any = None,
+    to_month: Any = None,
+    months: Any = None,
+    book_id: Any = None,
+    include_items: bool | None = None,
+) -> dict:
+    """月間管理の実績を複数月まとめて取り、参考書ごとのペースを集計します（読み取り専用）。
+
+    引数:
+    - student_id または spreadsheet_id
+    - from_month / to_month: 期間（例 "2025-05" / "2025-07"。2 桁の年・"2025/7" も可）。省略時は今月までの直近 3 か月
+    - months: 年月のリスト（期間の代わりに飛び飛びで指定）。最大 24 か月
+    - book_id: その参考書だけ（省略時は全行）
+    - include_items: true で月ごとの items も返す
+
+    返り値: { months:[{month,count,cached}], books:[{book_id,title,subject,months,weeks_observed,units_total,advance_total,
+    units_per_week,advance_per_week,minutes_per_unit,unit_load,guideline_amount,trend:{slope_per_month,direction,per_month[]},last_actual}], errors[] }
+    units は記入された範囲の量、advance は前の週までより先に進んだ量（同じ範囲の復習は 0）。締まった月は以後キャッシュから答える。
+    """
+    sid = _coerce_str(student_id, ("student_id", "id"))
+    spid = _coerce_str(spreadsheet_id, ("spreadsheet_id", "sheet_id", "id"))
+    if not sid and not spid:
+        return {"ok": False, "op": "planner.monthly.history", "error": {"code": "BAD_INPUT", "message": "student_id or spreadsheet_id is required"}}
+    if months:
+        raw = months if isinstance(months, list) else str(months).split(",")
+        yms = [history.parse_month(x) for x in raw]
+        if None in yms:
+            return {"ok": False, "op": "planner.monthly.history", "error": {"code": "BAD_INPUT", "message": f"months must look like 2025-07: {months}"}}
+        yms = sorted(set(yms), key=lambda ym: ym[0] * 12 + ym[1])
+    elif from_month or to_month:
+        a, b = history.parse_month(from_month or to_month), history.parse_month(to_month or from_month)
+        if a is None or b is None:
+            return {"ok": False, "op": "planner.monthly.history", "error": {"code": "BAD_INPUT", "message": "from_month/to_month must look like 2025-07"}}
+        yms = history.month_range(a, b)
+    else:
+        yms = history.recent_months(3)
+    if len(yms) > _HISTORY_MAX_MONTHS:
+        return {"ok": False, "op": "planner.monthly.history", "error": {"code": "BAD_INPUT", "message": f"at most {_HISTORY_MAX_MONTHS} months"}}
+    t0 = time.perf_counter()
+    try:
+        got, cached, errors = await _monthly_items(sid, spid, yms)
+    except Exception as e:
+        return {"ok": False, "op": "planner.monthly.history", "error": {"code": "HTTP_POST_ERROR", "message": str(e)}}
+    if errors and not got:
+        return {"ok": False, "op": "planner.monthly.history", "error": errors[0]["error"], "data": {"errors": errors}}
+    bid = _coerce_str(book_id, ("book_id", "id"))
+    per_month = [(ym, [it for it in got[ym] if not bid or str(it.get("book_id") or "").strip() == bid]) for ym in yms if ym in got]
+    data: dict[str, Any] = {
+        "student_id": sid,
+        "spreadsheet_id": spid,
+        "months": [{"month": history.label(ym), "count": len(items), "cached": ym in cached, "closed": history.closed(ym)} for ym, items in per_month],
+        "books": history.pace_stats(per_month),
+        "errors": errors,
+        "elapsed_ms": round((time.perf_counter() - t0) * 1000, 1),
+    }
+    if include_items:
+        data["items"] = {history.label(ym): items for ym, items in per_month}
+    return {"ok": True, "op": "planner.monthly.history", "data": data}
+
+
 # ===== Weekly Planner: targets（自動抽出） =====
 
 def _week_count_from_dates(dget: dict) -> int:
@@ -898,93 +1725,93 @@ def _index_by_row(items: list[dict], key: str = "row") -> dict[int, dict]:
             continue
     return out
 
-@mcp.tool()
-async def planner_plan_targets(student_id: Any = None, spreadsheet_id: Any = None) -> dict:
+def _planner_month(dates: dict) -> dt.date | None:
+    """週間管理の最初の週の開始日（"2025/08/04" など）。読めなければ None（今日を基準にする）。"""
+    for x in ((dates.get("data") or {}).get("week_starts") or []):
+        m = re.match(r"^\s*(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})", str(x or ""))
+        if m:
+            try:
+                return dt.date(int(m.group(1)), int(m.group(2)), int(m.group(3)))
+            except ValueError:
+                return None
+    return None
+
+def _pace_months(pace: Any, pace_months: Any) -> int:
+    """ペースに使う月数（0 = ペースなし）。引数がなければ PLAN_PACE / PLAN_PACE_MONTHS（既定 3）。"""
+    on = _env_on("PLAN_PACE", "0") if pace is None else bool(pace)
+    if not on:
+        return 0
+    try:
+        n = int(pace_months) if pace_months not in (None, "") else int(os.environ.get("PLAN_PACE_MONTHS", "3") or 3)
+    except (TypeError, ValueError):
+        n = 3
+    return max(1, min(_HISTORY_MAX_MONTHS, n))
+
+@tool()
+async def planner_plan_targets(student_id: Any = None, spreadsheet_id: Any = None, pace: bool | None = None, pace_months: int | None = None) -> dict:
     """書込み候補セル（A非空・週間時間非空・計画未入力）を週×行で自動抽出します。
 
-    返却: { week_count, targets:[{week_index,row,book_id,weekly_minutes,guideline_amount,prev_range_hint?}] }
+    返却: { week_count, targets:[{week_index,row,book_id,weekly_minutes,guideline_amount,prev_range_hint?,suggested_plan_text?,
+            suggested_amount?,suggestion_confidence(0..1),pace?,...}], pace? }
+    叩き台（suggested_*）は suggest.py が目次の章区間に沿って作る。
+    pace=true（既定 PLAN_PACE=0）: シートの月までの直近 pace_months か月（既定 PLAN_PACE_MONTHS=3）の月間管理の実績と
+    記入済みの週から週の量を推定する（月間管理は planner_monthly_history と同じキャッシュを使い、目次と並行で取る）。
     """
     sid = _coerce_str(student_id, ("student_id","id"))
     spid = _coerce_str(spreadsheet_id, ("spreadsheet_id","sheet_id","id"))
-    # 1) 基本情報
-    ids = await planner_ids_list(student_id=sid, spreadsheet_id=spid)
+    if not (sid or spid):
+        return {"ok": False, "op": "planner.ids_list", "error": {"code": "BAD_INPUT", "message": "student_id or spreadsheet_id is required"}}
+    n_months = _pace_months(pace, pace_months)
+
+    # 1) 基本情報: ids/dates/metrics/plans は互いに独立なので 1 回の batch で取得（各 op は 1 回だけ）。
+    #    目次(books.get)は ids の book_id が分かってから（通常は参考書ミラーでローカル応答）。
+    #    ペースの月間管理はシートの月が分かってから、目次と並行で取る。
+    ids, dates, mets, plans = await _post_many([
+        _sheet_payload("planner.ids_list", sid, spid),
+        _sheet_payload("planner.dates.get", sid, spid),
+        _sheet_payload("planner.metrics.get", sid, spid),
+        _sheet_payload("planner.plan.get", sid, spid),
+    ])
+    book_ids = [it.get("book_id") for it in ((ids.get("data") or {}).get("items") or []) if it.get("book_id")] if ids.get("ok") else []
+
+    async def _books() -> Any:
+        if not book_ids:
+            return None
+        try:
+            return await books_get(book_ids=list(dict.fromkeys(book_ids)), fields=["structure.chapters"])
+        except Exception:
+            return None
+
+    async def _history() -> tuple[dict, list[dict]]:
+        try:
+            got, _, errs = await _monthly_items(sid, spid, months)
+        except Exception as e:
+            return {}, [{"error": {"code": "HTTP_POST_ERROR", "message": str(e)}}]
+        return got, errs
+
+    months = history.recent_months(n_months, _planner_month(dates)) if n_months and ids.get("ok") and dates.get("ok") else []
+    if months:
+        bres, (hist, hist_errors) = await asyncio.gather(_books(), _history())
+    else:
+        bres, hist, hist_errors = await _books(), {}, []
     if not ids.get("ok"):
         return {"ok": False, "op": "planner.plan.targets", "error": {"code": "UPSTREAM_IDS", "message": str(ids)}}
-    dates = await planner_dates_get(student_id=sid, spreadsheet_id=spid)
     if not dates.get("ok"):
         return {"ok": False, "op": "planner.plan.targets", "error": {"code": "UPSTREAM_DATES", "message": str(dates)}}
     week_count = _week_count_from_dates(dates)
-    mets = await planner_metrics_get(student_id=sid, spreadsheet_id=spid)
     if not mets.get("ok"):
         return {"ok": False, "op": "planner.plan.targets", "error": {"code": "UPSTREAM_METRICS", "message": str(mets)}}
-    plans = await planner_plan_get(student_id=sid, spreadsheet_id=spid)
     if not plans.get("ok"):
         return {"ok": False, "op": "planner.plan.targets", "error": {"code": "UPSTREAM_PLANS", "message": str(plans)}}
 
     id_items = (ids.get("data") or {}).get("items") or []
-    rows_with_book = set(int(it.get("row")) for it in id_items if it.get("row"))
     row_to_book = {int(it["row"]): it.get("book_id") for it in id_items if it.get("row")}
 
-    # 目次/numbering 情報を書籍ごとに収集（簡易）
-    unique_book_ids = [it.get("book_id") for it in id_items if it.get("book_id")]
-    book_meta: dict[str, dict] = {}
-    if unique_book_ids:
-        try:
-            bres = await books_get(book_ids=list(dict.fromkeys(unique_book_ids)))
-            if isinstance(bres, dict) and bres.get("ok"):
-                for b in ((bres.get("data") or {}).get("books") or []):
-                    bid = b.get("id")
-                    chapters = (((b.get("structure") or {}).get("chapters")) or [])
-                    sym = None
-                    max_end = None
-                    starts: list[int] = []
-                    ends: list[int] = []
-                    for ch in chapters:
-                        rng = ch.get("range") or {}
-                        s = rng.get("start")
-                        e = rng.get("end")
-                        try:
-                            if s is not None: starts.append(int(s))
-                            if e is not None: ends.append(int(e))
-                        except Exception:
-                            pass
-                        if not sym:
-                            sym = (ch.get("numbering") or "").strip() or None
-                    max_end = max(ends) if ends else None
-                    # numbering モード推定: リセット か キャリー
-                    mode = None
-                    if len(starts) >= 2 and len(ends) >= 1:
-                        try:
-                            if starts[1] == 1:
-                                mode = "reset"
-                            elif starts[1] == (ends[0] + 1):
-                                mode = "carry"
-                        except Exception:
-                            pass
-                    book_meta[str(bid)] = {"symbol": sym or "問", "max_end": max_end, "mode": mode}
-        except Exception:
-            pass
-
-    def _parse_prev_end(text: str) -> tuple[int | None, str | None]:
-        if not text:
-            return (None, None)
-        s = str(text)
-        # 優先: 範囲表記 X~Y
-        import re
-        m = re.findall(r"(\d+)\s*~\s*(\d+)", s)
-        if m:
-            try:
-                return (int(m[-1][1]), None)
-            except Exception:
-                return (None, None)
-        # 次: 数字の最後を採用
-        m2 = re.findall(r"(\d+)", s)
-        if m2:
-            try:
-                return (int(m2[-1]), None)
-            except Exception:
-                return (None, None)
-        return (None, None)
+    # 書籍ごとの章の区間インデックス（目次がない/取れない書籍は None → 目次なしの簡易サジェスト）
+    indexes: dict[str, Any] = {}
+    if isinstance(bres, dict) and bres.get("ok"):
+        for b in ((bres.get("data") or {}).get("books") or []):
+            indexes[str(b.get("id"))] = build_index(((b.get("structure") or {}).get("chapters")) or [])
 
     # 週ごとの maps
     wk_metrics: dict[int, dict[int, dict]] = {}
@@ -996,64 +1823,250 @@ async def planner_plan_targets(student_id: Any = None, spreadsheet_id: Any = Non
         wi = int(wk.get("week_index"))
         wk_plans[wi] = _index_by_row(wk.get("items") or [])
 
-    targets: list[dict] = []
-    for wi in range(1, week_count + 1):
-        metrics_rows = wk_metrics.get(wi, {})
-        plans_rows = wk_plans.get(wi, {})
-        for r in sorted(rows_with_book):
-            m = metrics_rows.get(r) or {}
-            p = plans_rows.get(r) or {}
-            weekly_minutes = m.get("weekly_minutes")
-            plan_text = (p.get("plan_text") or "").strip()
-            if weekly_minutes is None or str(weekly_minutes) == "":
-                continue  # 週間時間が空 → 対象外
-            if plan_text != "":
-                continue  # 既に埋まっている
-            # 直前週のヒント（prev_range_hint）
-            prev_hint = ""
-            for wj in range(wi-1, 0, -1):
-                pj = wk_plans.get(wj, {}).get(r)
-                if pj and str(pj.get("plan_text") or "").strip():
-                    prev_hint = str(pj.get("plan_text"))
-                    break
-            bid = row_to_book.get(r)
-            ga = (metrics_rows.get(r) or {}).get("guideline_amount")
-            # 簡易サジェスト（prev_range_hint と TOC から計算）
-            prev_end, _ = _parse_prev_end(prev_hint)
-            meta = book_meta.get(str(bid) if bid else "", {})
-            sym = meta.get("symbol") or "問"
-            max_end = meta.get("max_end")
-            start = (int(prev_end) + 1) if isinstance(prev_end, int) else 1
-            suggested_text = None
-            end_of_book = False
-            if isinstance(ga, (int, float)) and ga:
-                try:
-                    e = start + int(ga) - 1
-                    if isinstance(max_end, int) and e > max_end:
-                        e = max_end
-                        end_of_book = True
-                    suggested_text = f"{sym}{start}~{e}" + (" ★完了！" if end_of_book else "")
-                except Exception:
-                    suggested_text = None
-
-            targets.append({
-                "week_index": wi,
-                "row": r,
-                "book_id": bid,
-                "weekly_minutes": weekly_minutes,
-                "guideline_amount": ga,
-                "prev_range_hint": prev_hint,
-                "numbering_symbol": sym,
-                "suggested_plan_text": suggested_text,
-                "suggestion_confidence": "medium" if meta.get("mode") in ("reset","carry") else "low",
-                "end_of_book": end_of_book,
-            })
-
-    return {"ok": True, "op": "planner.plan.targets", "data": {"week_count": week_count, "targets": targets}}
-
-
-
-@mcp.tool()
+    # 行ごとに週を順になめ、空欄の週には直前週（記入 or 叩き台）の続きを目次に沿って出す
+    observed = history.weekly_advance([(ym, hist[ym]) for ym in months if ym in hist]) if months else None
+    targets = suggest_targets(week_count, row_to_book, wk_plans, wk_metrics, indexes, observed)
+
+    data: dict[str, Any] = {"week_count": week_count, "targets": targets}
+    if months:
+        data["pace"] = {
+            "months": [history.label(ym) for ym in months if ym in hist],
+            "books_observed": len(observed or {}),
+            "errors": hist_errors,
+        }
+    return {"ok": True, "op": "planner.plan.targets", "data": data}
+
+
+# --- 在塾生全員ぶんの targets を一括計算 ---
+_BULK_MAX_CONCURRENCY = 30  # Apps Script の同時実行上限（ユーザーあたり 30）
+
+def _bulk_concurrency(value: Any, env: str = "PLAN_TARGETS_CONCURRENCY") -> int:
+    try:
+        n = int(value) if value not in (None, "") else int(os.environ.get(env, "4") or 4)
+    except (TypeError, ValueError):
+        n = 4
+    return max(1, min(_BULK_MAX_CONCURRENCY, n))
+
+async def _notify(ctx: Context | None, done: int, total: int, message: str) -> None:
+    """進捗通知とログ（MCP リクエスト外で直接呼ばれた場合は何もしない）。"""
+    if ctx is None:
+        return
+    try:
+        await ctx.report_progress(done, total, message)
+        await ctx.info(message)
+    except Exception:
+        pass
+
+@tool()
+async def planner_plan_targets_bulk(student_ids: Any = None, concurrency: int | None = None, summary_only: bool | None = None,
+                                    pace: bool | None = None, pace_months: int | None = None, ctx: Context = None) -> dict:
+    """在塾生全員（students_list と同じ「在塾」条件）の planner_plan_targets を並行で計算します。
+
+    - 同時に処理する生徒数は concurrency（既定 PLAN_TARGETS_CONCURRENCY=4, 上限 30）で制限
+    - 1 人の失敗は他に波及しない（results[].ok=false と error を返す）
+    - 1 人終わるごとに進捗通知（progress/log）を送る
+    引数: student_ids（指定時はその生徒だけ。在塾以外も可）, summary_only=true で targets 本体を省き件数のみ,
+    pace / pace_months は planner_plan_targets と同じ（生徒ごとに渡す）。
+    返却: { count, ok_count, error_count, concurrency, elapsed_ms, results:[{student_id,name,ok,week_count?,target_count?,targets?,error?,elapsed_ms}] }
+    """
+    op = "planner.plan.targets_bulk"
+    ids = [str(x).strip() for x in (student_ids if isinstance(student_ids, list) else str(student_ids or "").split(",")) if str(x or "").strip()]
+    roster = await students_list(include_all=True if ids else None)
+    if not roster.get("ok"):
+        return {"ok": False, "op": op, "error": roster.get("error") or {"code": "UPSTREAM_ERROR", "message": str(roster)}}
+    students = (roster.get("data") or {}).get("students") or []
+    if ids:
+        by_id = {str(s.get("id")): s for s in students}
+        students = [by_id.get(i) or {"id": i} for i in dict.fromkeys(ids)]
+    n = _bulk_concurrency(concurrency)
+    sem = asyncio.Semaphore(n)
+    results: list[dict | None] = [None] * len(students)
+    done = 0
+    t_start = time.monotonic()
+
+    async def one(i: int, st: dict) -> None:
+        nonlocal done
+        t0 = time.monotonic()
+        async with sem:
+            try:
+                res = await planner_plan_targets(student_id=st.get("id"), spreadsheet_id=st.get("planner_sheet_id") or None,
+                                                 pace=pace, pace_months=pace_months)
+            except Exception as e:
+                res = {"ok": False, "op": "planner.plan.targets", "error": {"code": "EXCEPTION", "message": str(e)}}
+        entry: dict[str, Any] = {"student_id": st.get("id"), "name": st.get("name"), "ok": bool(isinstance(res, dict) and res.get("ok"))}
+        if entry["ok"]:
+            data = res.get("data") or {}
+            entry["week_count"] = data.get("week_count")
+            entry["target_count"] = len(data.get("targets") or [])
+            if not summary_only:
+                entry["targets"] = data.get("targets") or []
+        else:
+            entry["error"] = (res.get("error") if isinstance(res, dict) else None) or {"code": "UPSTREAM_ERROR", "message": str(res)}
+        entry["elapsed_ms"] = round((time.monotonic() - t0) * 1000, 1)
+        results[i] = entry
+        done += 1
+        status = f"targets={entry['target_count']}" if entry["ok"] else f"error={entry['error'].get('code')}"
+        await _notify(ctx, done, len(students), f"{entry['student_id']} {status}")
+
+    await asyncio.gather(*(one(i, st) for i, st in enumerate(students)))
+    ok_count = sum(1 for r in results if r and r["ok"])
+    return {"ok": True, "op": op, "data": {
+        "count": len(results),
+        "ok_count": ok_count,
+        "error_count": len(results) - ok_count,
+        "concurrency": n,
+        "elapsed_ms": round((time.monotonic() - t_start) * 1000, 1),
+        "results": results,
+    }}
+
+
+# --- 複数生徒の計画を一括書込み（シートごとにまとめ、シート間は並行） ---
+
+class _BulkSheetError(Exception):
+    """1 シートぶんの処理を打ち切る（GAS のエラー dict をそのまま持つ）。"""
+
+    def __init__(self, error: dict) -> None:
+        super().__init__(str(error.get("message") or error.get("code")))
+        self.error = error
+
+def _plan_item(it: dict, overwrite: bool | None) -> dict[str, Any]:
+    out: dict[str, Any] = {"week_index": int(it.get("week_index")), "plan_text": str(it.get("plan_text") or "")}
+    if it.get("overwrite") is not None:
+        out["overwrite"] = bool(it.get("overwrite"))
+    elif overwrite is not None:
+        out["overwrite"] = bool(overwrite)
+    if it.get("row") is not None:
+        out["row"] = it.get("row")
+    if it.get("book_id") is not None:
+        out["book_id"] = it.get("book_id")
+    return out
+
+def _plan_waves(items: list[tuple[int, dict]]) -> list[list[tuple[int, dict]]]:
+    """同じセル（週×行/book_id）が再び出たら次の planner.plan.set に回す。
+
+    GAS の一括書込みは overwrite 判定を書込み前のセルで行い、列ごとに行順へ並べ替えて書くので、
+    1 回の呼び出しに同じセルが 2 度あると後勝ちにならない。波に分けて順に送れば items の順どおりに効く。
+    """
+    waves: list[list[tuple[int, dict]]] = []
+    seen: list[set] = []
+    for idx, it in items:
+        key = (it["week_index"], it.get("row") if it.get("row") is not None else f"b:{it.get('book_id')}")
+        i = next((k for k in range(len(waves) - 1, -1, -1) if key in seen[k]), -1) + 1
+        if i == len(waves):
+            waves.append([])
+            seen.append(set())
+        waves[i].append((idx, it))
+        seen[i].add(key)
+    return waves
+
+@tool()
+async def planner_plan_create_bulk(items: Any, overwrite: bool | None = None, concurrency: int | None = None, idempotency_key: str | None = None, ctx: Context = None) -> dict:
+    """複数生徒の計画セルを 1 コールで書き込みます（全員ぶんの週次計画の配布用）。
+
+    MUST: 実行前に planner_guidance を読むこと（応答の guidance_digest は 1 回だけ読み込んで同梱）。
+
+    引数:
+    - items: [{student_id|spreadsheet_id, week_index, row|book_id, plan_text, overwrite?}, …]
+    - overwrite: 省略時は false（空欄のみ）。items 側で個別上書き可
+    - concurrency: 同時に書き込むシート数（既定 PLAN_WRITE_CONCURRENCY=4, 上限 30）
+    - idempotency_key: 送り直すときは前回と同じキー（シート・呼び出しごとのキーはここから作る。書込み済みの分は最初の応答が返る）
+
+    動作:
+    - items をシートごとにまとめる（生徒 ID は手元の対応表でシートに解決。不明なら GAS に解決させる）
+    - 各シートの週数は planner_dates_get（キャッシュ経由）で確かめ、範囲外の週・52 文字超の items は送らずに rejected へ
+    - 別のシートは並行、同じシートへの書込みは items の順に直列（同じセルが重なれば呼び出しを分ける）
+    - 1 シート終わるごとに進捗通知（progress/log）。1 シートの失敗は他に波及しない
+    返却: { count, ok_count, error_count, concurrency, elapsed_ms, guidance_digest,
+            sheets:[{spreadsheet_id|student_id, ok, week_count, submitted, updated, rejected[], results[], error?, elapsed_ms}] }
+    """
+    op = "planner.plan.create_bulk"
+    if not isinstance(items, list) or not items:
+        return {"ok": False, "op": op, "error": {"code": "BAD_INPUT", "message": "items[] is required"}}
+    groups: dict[tuple[str, str], list[tuple[int, dict]]] = {}
+    bad: list[dict] = []
+    for i, it in enumerate(items):
+        if not isinstance(it, dict):
+            bad.append({"index": i, "error": {"code": "BAD_INPUT", "message": f"bad item: {it}"}})
+            continue
+        spid = _coerce_str(it.get("spreadsheet_id"))
+        sid = _coerce_str(it.get("student_id"))
+        if not spid and sid:
+            spid = (await _with_sheet({"op": "planner.plan.set", "student_id": sid})).get("spreadsheet_id")
+        if not spid and not sid:
+            bad.append({"index": i, "error": {"code": "BAD_INPUT", "message": "student_id or spreadsheet_id is required"}})
+            continue
+        key = ("spreadsheet_id", spid) if spid else ("student_id", sid)
+        groups.setdefault(key, []).append((i, it))
+
+    n = _bulk_concurrency(concurrency, "PLAN_WRITE_CONCURRENCY")
+    sem = asyncio.Semaphore(n)
+    sheets: list[dict | None] = [None] * len(groups)
+    done = 0
+    t_start = time.monotonic()
+
+    async def one(k: int, key: tuple[str, str], members: list[tuple[int, dict]]) -> None:
+        nonlocal done
+        t0 = time.monotonic()
+        entry: dict[str, Any] = {key[0]: key[1], "ok": False, "submitted": 0, "updated": 0, "rejected": [], "results": []}
+        async with sem:
+            try:
+                d = await _post({"op": "planner.dates.get", key[0]: key[1]})
+                if not (isinstance(d, dict) and d.get("ok")):
+                    raise _BulkSheetError((d.get("error") if isinstance(d, dict) else None) or {"code": "UPSTREAM_ERROR", "message": str(d)})
+                week_count = _week_count_from_dates(d)
+                entry["week_count"] = week_count
+                send: list[tuple[int, dict]] = []
+                for idx, it in members:
+                    try:
+                        out_it = _plan_item(it, overwrite)
+                    except (TypeError, ValueError):
+                        entry["rejected"].append({"index": idx, "error": {"code": "BAD_INPUT", "message": "week_index must be a number"}})
+                        continue
+                    if not 1 <= out_it["week_index"] <= week_count:
+                        entry["rejected"].append({"index": idx, "error": {"code": "BAD_WEEK", "message": f"week_index out of range: {out_it['week_index']} (1..{week_count})"}})
+                    elif len(out_it["plan_text"]) > PLAN_TEXT_MAX:
+                        entry["rejected"].append({"index": idx, "error": {"code": "TOO_LONG", "message": f"plan_text too long ({len(out_it['plan_text'])} > {PLAN_TEXT_MAX})"}})
+                    else:
+                        send.append((idx, out_it))
+                entry["ok"] = True
+                for w, wave in enumerate(_plan_waves(send)):
+                    payload = {"op": "planner.plan.set", key[0]: key[1], "items": [x for _, x in wave]}
+                    res = await _post(_with_key(payload, f"{idempotency_key}:{key[1]}:{w}" if idempotency_key else None))
+                    entry["submitted"] += len(wave)
+                    if not (isinstance(res, dict) and res.get("ok")):
+                        raise _BulkSheetError((res.get("error") if isinstance(res, dict) else None) or {"code": "UPSTREAM_ERROR", "message": str(res)})
+                    for (idx, _), r in zip(wave, (res.get("data") or {}).get("results") or []):
+                        r = {"index": idx, **(r if isinstance(r, dict) else {})}
+                        entry["updated"] += int(bool(r.get("updated") or (r.get("ok") and r.get("cell"))))
+                        entry["results"].append(r)
+            except _BulkSheetError as e:
+                entry["ok"], entry["error"] = False, e.error
+            except Exception as e:
+                entry["ok"], entry["error"] = False, {"code": "EXCEPTION", "message": str(e)}
+        entry["elapsed_ms"] = round((time.monotonic() - t0) * 1000, 1)
+        sheets[k] = entry
+        done += 1
+        status = f"updated={entry['updated']}" if entry["ok"] else f"error={entry['error'].get('code')}"
+        await _notify(ctx, done, len(groups), f"{key[1]} {status}")
+
+    await asyncio.gather(*(one(k, key, members) for k, (key, members) in enumerate(groups.items())))
+    gd = await planner_guidance()
+    ok_count = sum(1 for e in sheets if e and e["ok"])
+    data: dict[str, Any] = {
+        "count": len(sheets),
+        "ok_count": ok_count,
+        "error_count": len(sheets) - ok_count,
+        "concurrency": n,
+        "elapsed_ms": round((time.monotonic() - t_start) * 1000, 1),
+        "guidance_digest": gd.get("data") or {},
+        "sheets": sheets,
+    }
+    if bad:
+        data["rejected"] = bad
+    return {"ok": True, "op": op, "data": data}
+
+
+@tool()
 async def planner_guidance() -> dict:
     """LLM向け：週間管理シートの計画作成ガイドを返します。
 
@@ -1116,7 +2129,7 @@ async def planner_guidance() -> dict:
                     "planner_ids_list で対象行(book_id/subject/title/guideline_note)を取得",
                     "planner_dates_get で週数と開始日を把握(week_count=4/5)",
                     "planner_plan_get で計画＋metrics(weekly_minutes/unit_load/guideline_amount)を取得",
-                    "過去2–3ヶ月の実績: planner_monthly_filter(year,month) を直近から複数回呼び、同書の過去実績を要約",
+                    "過去2–3ヶ月の実績: planner_monthly_history(student_id) で直近 3 か月（from_month/to_month で期間指定）をまとめて取得し、books[] の advance_per_week / minutes_per_unit / trend で同書のペースを把握",
                     "各書籍の目次・仕様: books_get(book_id) でTOC/numbering/単位を確認"
                 ],
                 "plan": [
@@ -1135,7 +2148,53 @@ async def planner_guidance() -> dict:
         }
     }
 
+def _collect_cache_metrics() -> None:
+    c, b, f = _CACHE.stats(), _BOOKS.stats(), _FLIGHT.stats()
+    metrics.set_cache("response", c["hits"], c["misses"])
+    metrics.set_cache("books_mirror", b["hits"], b["loads"])
+    metrics.set_cache("singleflight", f["coalesced"], f["upstream_executions"])
+    v = _VERSIONS.stats()
+    metrics.set_cache("versions", v["not_modified"], v["full"])
+
+metrics.REGISTRY.collectors.append(_collect_cache_metrics)
+
+@mcp.custom_route("/metrics", methods=["GET"])
+async def metrics_endpoint(request):
+    """Prometheus のスクレイプ先（text exposition format 0.0.4）。"""
+    from starlette.responses import Response
+    return Response(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@mcp.custom_route("/debug/traces", methods=["GET"])
+async def traces_endpoint(request):
+    """trace_get と同じ内容の HTTP 版（DEBUG_TRACES=1 のときだけ有効）。"""
+    from starlette.responses import JSONResponse
+    if not _env_on("DEBUG_TRACES", "0"):
+        return JSONResponse({"ok": False, "error": {"code": "DISABLED", "message": "set DEBUG_TRACES=1"}}, status_code=404)
+    q = request.query_params
+    try:
+        limit = int(q.get("limit") or 20)
+    except ValueError:
+        limit = 20
+    return JSONResponse(await trace_get(trace_id=q.get("trace_id"), tool_name=q.get("tool"), limit=limit))
+
+def build_app():
+    """uvicorn で配信する ASGI アプリ。共有 HTTP クライアントの生成/破棄を lifespan に載せる。"""
+    import contextlib
+    app = mcp.streamable_http_app()
+    inner = app.router.lifespan_context
+
+    @contextlib.asynccontextmanager
+    async def lifespan(a):
+        await open_client()
+        try:
+            async with inner(a) as state:
+                yield state
+        finally:
+            await close_client()
+
+    app.router.lifespan_context = lifespan
+    return app
+
 if __name__ == "__main__":
     import uvicorn
-    app = mcp.streamable_http_app()
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8080")))
+    uvicorn.run(build_app(), host="0.0.0.0", port=int(os.getenv("PORT", "8080")))
@@ -0,0 +1,72 @@
+"""同一リクエストの同時実行をまとめる（single-flight）。
+
+同じキーの呼び出しが実行中なら新たに上流へ投げず、先行呼び出しの結果を共有する。
+結果の dict は呼び出し側で書き換えられることがあるため、後続が待っていれば上流の応答が届いた時点で
+（先行呼び出し元が再開して書き換えるより前に）JSON の bytes を 1 回だけ作り、後続にはそれをデコードした複製を返す。
+後続がいなければ直列化はせず、先行呼び出し元には元の dict をそのまま返す。
+先行呼び出し元がキャンセルされても、待っている後続には結果が届く（上流呼び出しは shield する）。
+"""
+import asyncio
+from typing import Any, Awaitable, Callable
+
+try:
+    from . import fastjson
+except ImportError:  # when running as a script
+    import fastjson
+
+# 副作用のない op だけを束ねる（書き込みは必ず個別に送る）
+READ_OPS = {
+    "ping",
+    "books.find", "books.get", "books.filter", "books.changed_since",
+    "students.list", "students.find", "students.get", "students.filter", "students.changed_since",
+    "planner.ids_list", "planner.dates.get", "planner.metrics.get", "planner.plan.get", "planner.monthly.filter",
+    "table.read",
+}
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        # キー → (上流呼び出しのタスク, 待っている後続の数)。タスクの結果は (応答, 後続用の JSON bytes | None)
+        self._inflight: dict[str, tuple[asyncio.Future, list[int]]] = {}
+        self.calls = 0
+        self.executions = 0
+        self.coalesced: dict[str, int] = {}
+        self.snapshots = 0
+
+    async def do(self, key: str, op: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        self.calls += 1
+        got = self._inflight.get(key)
+        # 終わったタスク（done の後、片付けのコールバック前）には相乗りしない（後続用の bytes がないことがある）
+        if got is not None and not got[0].done() and got[0].get_loop() is asyncio.get_running_loop():
+            fut, joiners = got
+            joiners[0] += 1
+            self.coalesced[op] = self.coalesced.get(op, 0) + 1
+            return fastjson.loads((await asyncio.shield(fut))[1])
+        self.executions += 1
+        joiners = [0]
+
+        async def run() -> tuple[Any, bytes | None]:
+            res = await fn()
+            # タスクの完了と同じステップで作るので、先行呼び出し元の書き換えより前の内容になる
+            if not joiners[0]:
+                return res, None
+            self.snapshots += 1
+            return res, fastjson.dumps(res)
+
+        fut = asyncio.ensure_future(run())
+        self._inflight[key] = (fut, joiners)
+        fut.add_done_callback(lambda f: self._inflight.pop(key, None) if (self._inflight.get(key) or (None,))[0] is f else None)
+        return (await asyncio.shield(fut))[0]
+
+    def in_flight(self) -> int:
+        return len(self._inflight)
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "upstream_executions": self.executions,
+            "coalesced": sum(self.coalesced.values()),
+            "coalesced_by_op": dict(self.coalesced),
+            "snapshots": self.snapshots,
+            "in_flight": self.in_flight(),
+        }
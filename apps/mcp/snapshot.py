@@ -0,0 +1,366 @@
+"""オフラインのスナップショット（参考書/生徒マスターと週間管理シートを 1 つの SQLite ファイルに）。
+
+- export(): GAS から books.filter / students.list の全件と、選んだシートの planner.ids_list / dates.get /
+  metrics.get / plan.get / monthly.filter（指定月）を読み、zlib 圧縮した JSON で保存する（一時ファイル → rename）
+- SnapshotReader.answer(req): 読み取り op に GAS と同じ形の応答を返す。books.* は books_mirror、students.* は
+  students_query の規則で計算し、planner.* は保存した応答を weeks/fields で射影する。
+  スナップショットにないシート/月は NOT_IN_SNAPSHOT、書き込みは SNAPSHOT_READ_ONLY
+- changed_since はスナップショットごとのカーソルを返す（別のカーソルなら reset の全件）ので、差分同期の写しもそのまま動く
+
+サーバは SNAPSHOT_READ=<path> で起動する（または snapshot_import ツール）と上流の代わりにここから答える。
+Apps Script の障害・クォータ切れの間も読み取りは止まらず、起動直後から GAS を待たずに応答できる。
+
+CLI（EXEC_URL などはサーバと同じ ENV）:
+    uv run python -m apps.mcp.snapshot export snapshot.sqlite3 [--students S001,S002] [--sheets SP001] [--months 2025-07,2025-08]
+    uv run python -m apps.mcp.snapshot info snapshot.sqlite3
+"""
+import argparse
+import asyncio
+import contextlib
+import datetime as dt
+import os
+import sqlite3
+import sys
+import time
+import uuid
+import zlib
+from typing import Any, Awaitable, Callable
+
+try:
+    from . import books_mirror, fastjson, students_query
+    from .projection import parse_fields, parse_weeks, project, project_weeks
+except ImportError:  # when running as a script
+    import books_mirror
+    import fastjson
+    import students_query
+    from projection import parse_fields, parse_weeks, project, project_weeks
+
+Fetch = Callable[[dict], Awaitable[dict]]
+
+FORMAT_VERSION = 1
+# 保存するシート単位の読み取り op（monthly.filter は月ごとに part="YY-MM"）
+SHEET_OPS = ("planner.ids_list", "planner.dates.get", "planner.metrics.get", "planner.plan.get")
+MONTHLY_OP = "planner.monthly.filter"
+READ_OPS = {
+    "ping", "books.find", "books.get", "books.filter", "books.changed_since",
+    "students.list", "students.find", "students.get", "students.filter", "students.changed_since",
+    *SHEET_OPS, MONTHLY_OP,
+}
+
+
+def _pack(obj: Any) -> bytes:
+    return zlib.compress(fastjson.dumps(obj), 6)
+
+
+def _unpack(blob: bytes) -> Any:
+    return fastjson.loads(zlib.decompress(blob))
+
+
+def _ng(op: str, code: str, message: str) -> dict:
+    return {"ok": False, "op": op, "error": {"code": code, "message": message}}
+
+
+def _month_part(year: Any, month: Any) -> str | None:
+    """monthly.filter の year（2/4 桁）と month を "YY-MM" に（GAS と同じく 2000 年代の 2 桁）。"""
+    try:
+        yy, mm = int(str(year).strip()), int(str(month).strip())
+    except (TypeError, ValueError):
+        return None
+    yy = yy - 2000 if yy >= 2000 else yy
+    return f"{yy:02d}-{mm:02d}" if 0 <= yy <= 99 and 1 <= mm <= 12 else None
+
+
+def default_months(today: dt.date | None = None) -> list[tuple[int, int]]:
+    """既定の月: 今月と前月。"""
+    d = today or dt.date.today()
+    prev = (d.replace(day=1) - dt.timedelta(days=1))
+    return [(prev.year, prev.month), (d.year, d.month)]
+
+
+def parse_months(x: Any) -> list[tuple[int, int]]:
+    """"2025-07,2025-08" / ["2025-07"] / [[2025, 7]] → [(2025, 7), ...]。"""
+    items = x if isinstance(x, (list, tuple)) else str(x or "").split(",")
+    out: list[tuple[int, int]] = []
+    for it in items:
+        try:
+            y, m = (it if isinstance(it, (list, tuple)) else str(it).strip().replace("/", "-").split("-"))[:2]
+            ym = (int(y), int(m))
+        except (TypeError, ValueError):
+            continue
+        if 1 <= ym[1] <= 12 and ym not in out:
+            out.append(ym)
+    return out
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, timeout=5.0, isolation_level=None)
+    conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    conn.execute("CREATE TABLE IF NOT EXISTS masters (kind TEXT NOT NULL, pos INTEGER NOT NULL, id TEXT NOT NULL, body BLOB NOT NULL, PRIMARY KEY (kind, pos))")
+    conn.execute("CREATE TABLE IF NOT EXISTS sheets (spreadsheet_id TEXT NOT NULL, op TEXT NOT NULL, part TEXT NOT NULL, body BLOB NOT NULL, PRIMARY KEY (spreadsheet_id, op, part))")
+    return conn
+
+
+async def export(path: str, fetch: Fetch, student_ids: list[str] | None = None, spreadsheet_ids: list[str] | None = None,
+                 months: list[tuple[int, int]] | None = None, concurrency: int = 4) -> dict:
+    """GAS から読んでスナップショットを書く。シート未指定なら在塾生全員の週間管理シート。
+
+    マスターの取得に失敗したら書かずにそのエラー応答を返す。シートごとの失敗は errors[] に残して続ける。
+    """
+    t0 = time.monotonic()
+    books = await fetch({"op": "books.filter"})
+    if not (isinstance(books, dict) and books.get("ok")):
+        return books
+    students = await fetch({"op": "students.list"})
+    if not (isinstance(students, dict) and students.get("ok")):
+        return students
+    book_rows = [b for b in (books.get("data") or {}).get("books") or [] if isinstance(b, dict)]
+    student_rows = [s for s in (students.get("data") or {}).get("students") or [] if isinstance(s, dict)]
+
+    sheet_of = {str(s.get("id") or "").strip(): str(s.get("planner_sheet_id") or "").strip() for s in student_rows}
+    sheets = [str(x).strip() for x in spreadsheet_ids or [] if str(x or "").strip()]
+    if student_ids:
+        sheets += [sheet_of.get(str(i).strip(), "") for i in student_ids]
+    elif not sheets:
+        enrolled = students_query.filter_students(student_rows, {"Status": "在塾"})["data"]["students"]
+        sheets = [str(s.get("planner_sheet_id") or "").strip() for s in enrolled]
+    sheets = list(dict.fromkeys(s for s in sheets if s))
+    months = months if months is not None else default_months()
+
+    sem = asyncio.Semaphore(max(1, concurrency))
+    grids: list[tuple[str, str, str, Any]] = []
+    errors: list[dict] = []
+
+    async def one(spid: str, req: dict, part: str) -> None:
+        async with sem:
+            try:
+                res = await fetch({**req, "spreadsheet_id": spid})
+            except Exception as e:
+                res = _ng(req["op"], "EXCEPTION", str(e))
+        if isinstance(res, dict) and res.get("ok"):
+            data = {k: v for k, v in (res.get("data") or {}).items() if k not in ("version", "not_modified")}
+            grids.append((spid, req["op"], part, data))
+        else:
+            errors.append({"spreadsheet_id": spid, "op": req["op"], "part": part, "error": (res.get("error") if isinstance(res, dict) else None) or {"code": "UPSTREAM_ERROR", "message": str(res)}})
+
+    jobs = [one(spid, {"op": op}, "") for spid in sheets for op in SHEET_OPS]
+    jobs += [one(spid, {"op": MONTHLY_OP, "year": y, "month": m}, _month_part(y, m) or "") for spid in sheets for y, m in months]
+    await asyncio.gather(*jobs)
+
+    created = dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds")
+    snapshot_id = uuid.uuid4().hex[:12]
+    tmp = f"{path}.tmp-{snapshot_id}"
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    try:
+        conn = _connect(tmp)
+        try:
+            conn.execute("BEGIN")
+            meta = {"format": str(FORMAT_VERSION), "snapshot_id": snapshot_id, "created_at": created,
+                    "months": ",".join(f"{y}-{m:02d}" for y, m in months)}
+            conn.executemany("INSERT INTO meta(key, value) VALUES (?,?)", list(meta.items()))
+            conn.executemany("INSERT INTO masters(kind, pos, id, body) VALUES (?,?,?,?)",
+                             [("books", i, str(b.get("id") or ""), _pack(b)) for i, b in enumerate(book_rows)]
+                             + [("students", i, str(s.get("id") or ""), _pack(s)) for i, s in enumerate(student_rows)])
+            conn.executemany("INSERT OR REPLACE INTO sheets(spreadsheet_id, op, part, body) VALUES (?,?,?,?)",
+                             [(spid, op, part, _pack(data)) for spid, op, part, data in grids])
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        os.replace(tmp, path)
+    except BaseException:
+        # 書きかけの一時ファイル（とジャーナル）を残さない
+        for leftover in (tmp, tmp + "-journal"):
+            with contextlib.suppress(OSError):
+                os.remove(leftover)
+        raise
+    return {"ok": True, "op": "snapshot.export", "data": {
+        "path": os.path.abspath(path),
+        "snapshot_id": snapshot_id,
+        "created_at": created,
+        "books": len(book_rows),
+        "students": len(student_rows),
+        "sheets": len(sheets),
+        "grids": len(grids),
+        "months": [f"{y}-{m:02d}" for y, m in months],
+        "bytes": os.path.getsize(path),
+        "errors": errors,
+        "elapsed_ms": round((time.monotonic() - t0) * 1000, 1),
+    }}
+
+
+class SnapshotReader:
+    """スナップショットのファイルを読み、読み取り op に答える。マスターは開いたときに展開し、シートの応答は使うときに展開する。"""
+
+    def __init__(self, path: str) -> None:
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        self.path = os.path.abspath(path)
+        conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            self.meta = dict(conn.execute("SELECT key, value FROM meta"))
+            if int(self.meta.get("format") or 0) != FORMAT_VERSION:
+                raise ValueError(f"unsupported snapshot format: {self.meta.get('format')}")
+            masters: dict[str, list[dict]] = {"books": [], "students": []}
+            for kind, body in conn.execute("SELECT kind, body FROM masters ORDER BY kind, pos"):
+                masters.setdefault(kind, []).append(_unpack(body))
+            self._blobs = {(spid, op, part): body for spid, op, part, body in conn.execute("SELECT spreadsheet_id, op, part, body FROM sheets")}
+        finally:
+            conn.close()
+        self.books = masters["books"]
+        self.students = masters["students"]
+        self._sheet_of = {str(s.get("id") or "").strip(): str(s.get("planner_sheet_id") or "").strip() for s in self.students}
+        self._grids: dict[tuple[str, str, str], dict] = {}
+        self.cursor = f"snapshot:{self.meta.get('snapshot_id')}"
+        self.answered: dict[str, int] = {}
+        self.missing: dict[str, int] = {}
+
+    # --- 応答 ---
+    def answer(self, req: dict[str, Any]) -> dict:
+        op = str(req.get("op") or "")
+        if op == "batch":
+            subs = req.get("requests")
+            if not isinstance(subs, list):
+                return _ng("batch", "BAD_REQUEST", "requests[] is required")
+            results = [self.answer(s) if isinstance(s, dict) and s.get("op") != "batch" else _ng("batch", "BAD_REQUEST", "nested batch is not allowed") for s in subs]
+            return {"ok": True, "op": "batch", "meta": self._meta(), "data": {"results": results, "count": len(results)}}
+        if op not in READ_OPS:
+            return _ng(op or "unknown", "SNAPSHOT_READ_ONLY", f"snapshot-read mode answers reads only ({self.path})")
+        res = self._answer(op, req)
+        counter = self.missing if (res.get("error") or {}).get("code") == "NOT_IN_SNAPSHOT" else self.answered
+        counter[op] = counter.get(op, 0) + 1
+        if res.get("ok"):
+            res["meta"] = {**(res.get("meta") or {}), **self._meta()}
+        return res
+
+    def _meta(self) -> dict:
+        return {"source": "snapshot", "snapshot_id": self.meta.get("snapshot_id"), "snapshot_at": self.meta.get("created_at")}
+
+    def _answer(self, op: str, req: dict[str, Any]) -> dict:
+        if op == "ping":
+            return {"ok": True, "op": "ping", "data": {"status": "ok", "snapshot": True}}
+        if op == "books.find":
+            if not req.get("query"):
+                return _ng(op, "BAD_REQUEST", "query is required")
+            limit = req.get("limit", 20)
+            return {"ok": True, "op": op, "data": books_mirror.find(self.books, str(req["query"]), int(limit) if str(limit).isdigit() else 20)}
+        if op == "books.get":
+            ids = req.get("book_ids")
+            ids = ids if isinstance(ids, list) else [ids] if ids else None
+            res = books_mirror.get(self.books, book_id=req.get("book_id"), book_ids=ids)
+            fl = parse_fields(req.get("fields"))
+            if fl and res.get("ok"):
+                d = res["data"]
+                res["data"] = {"book": project(d["book"], fl)} if "book" in d else {"books": [project(b, fl) for b in d.get("books") or []]}
+            return res
+        if op == "books.filter":
+            data = books_mirror.filter_books(self.books, req.get("where") or {}, req.get("contains") or {}, req.get("limit") if isinstance(req.get("limit"), int) else None)
+            return {"ok": True, "op": op, "data": data} if data is not None else _ng(op, "NOT_IN_SNAPSHOT", "condition on a column the snapshot does not keep")
+        if op == "books.changed_since":
+            return self._changed(op, self.books, req.get("cursor"))
+        if op == "students.list":
+            return students_query.list_students(self.students, req.get("limit"))
+        if op == "students.find":
+            return students_query.find(self.students, req.get("query"), req.get("limit"))
+        if op == "students.get":
+            return students_query.get(self.students, req.get("student_id"), req.get("student_ids"), req.get("fields"))
+        if op == "students.filter":
+            return students_query.filter_students(self.students, req.get("where"), req.get("contains"), req.get("limit"))
+        if op == "students.changed_since":
+            return self._changed(op, self.students, req.get("cursor"))
+        return self._planner(op, req)
+
+    def _changed(self, op: str, rows: list[dict], cursor: Any) -> dict:
+        """スナップショットの中身は変わらないので、同じカーソルなら空、それ以外は reset の全件。"""
+        reset = cursor != self.cursor
+        return {"ok": True, "op": op, "data": {
+            "cursor": self.cursor, "reset": reset, "upserts": list(rows) if reset else [], "deletes": [], "total": len(rows), "changed": len(rows) if reset else 0,
+        }}
+
+    def _planner(self, op: str, req: dict[str, Any]) -> dict:
+        spid = str(req.get("spreadsheet_id") or "").strip() or self._sheet_of.get(str(req.get("student_id") or "").strip(), "")
+        if not spid:
+            return _ng(op, "NOT_FOUND", "planner sheet not found (resolve by student_id or spreadsheet_id)")
+        part = ""
+        if op == MONTHLY_OP:
+            part = _month_part(req.get("year"), req.get("month")) or ""
+            if not part:
+                return _ng(op, "BAD_REQUEST", "year(2桁/4桁) と month(1..12) を指定してください")
+        data = self._grid(spid, op, part)
+        if data is None:
+            what = f"{spid} {op}" + (f" {part}" if part else "")
+            return _ng(op, "NOT_IN_SNAPSHOT", f"not in snapshot: {what}")
+        if op in ("planner.metrics.get", "planner.plan.get"):
+            want, fl = parse_weeks(req.get("weeks")), parse_fields(req.get("fields"))
+            if want or fl:
+                data = {**data, "weeks": project_weeks(data.get("weeks") or [], want, fl)}
+        return {"ok": True, "op": op, "data": data}
+
+    def _grid(self, spid: str, op: str, part: str) -> dict | None:
+        key = (spid, op, part)
+        data = self._grids.get(key)
+        if data is None:
+            blob = self._blobs.get(key)
+            if blob is None:
+                return None
+            data = self._grids[key] = _unpack(blob)
+        return fastjson.loads(fastjson.dumps(data))  # 呼び出し側が書き換えても汚れない
+
+    def stats(self) -> dict:
+        return {
+            "enabled": True,
+            "path": self.path,
+            "snapshot_id": self.meta.get("snapshot_id"),
+            "created_at": self.meta.get("created_at"),
+            "months": [m for m in (self.meta.get("months") or "").split(",") if m],
+            "books": len(self.books),
+            "students": len(self.students),
+            "sheets": len({k[0] for k in self._blobs}),
+            "grids": len(self._blobs),
+            "answered": dict(self.answered),
+            "missing": dict(self.missing),
+        }
+
+
+def open_from_env() -> SnapshotReader | None:
+    """SNAPSHOT_READ=<path> ならスナップショットを開く（未設定なら None = 上流から読む）。"""
+    path = os.environ.get("SNAPSHOT_READ", "").strip()
+    return SnapshotReader(path) if path else None
+
+
+# --- CLI ---
+
+async def _cli_export(args: argparse.Namespace) -> int:
+    try:
+        from . import http_pool, server
+    except ImportError:
+        import http_pool
+        import server
+    split = lambda x: [s.strip() for s in (x or "").split(",") if s.strip()]  # noqa: E731
+    try:
+        res = await export(args.path, server._post, student_ids=split(args.students) or None, spreadsheet_ids=split(args.sheets) or None,
+                           months=parse_months(args.months) if args.months else None, concurrency=args.concurrency)
+    finally:
+        await http_pool.close_client()
+    print(fastjson.dumps(res).decode("utf-8"))
+    return 0 if res.get("ok") else 1
+
+
+def main(argv: list[str] | None = None) -> int:
+    p = argparse.ArgumentParser(prog="snapshot", description="cram-books snapshot export / info")
+    sub = p.add_subparsers(dest="cmd", required=True)
+    e = sub.add_parser("export", help="GAS から読んでスナップショットを書く")
+    e.add_argument("path")
+    e.add_argument("--students", help="生徒 ID（カンマ区切り）。未指定なら在塾生全員")
+    e.add_argument("--sheets", help="週間管理のスプレッドシート ID（カンマ区切り）")
+    e.add_argument("--months", help="月間管理の年月（例 2025-07,2025-08）。既定は今月と前月")
+    e.add_argument("--concurrency", type=int, default=4)
+    i = sub.add_parser("info", help="スナップショットの中身を表示")
+    i.add_argument("path")
+    args = p.parse_args(argv)
+    if args.cmd == "export":
+        return asyncio.run(_cli_export(args))
+    print(fastjson.dumps(SnapshotReader(args.path).stats()).decode("utf-8"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
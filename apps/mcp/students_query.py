@@ -0,0 +1,119 @@
+"""生徒マスターの読み取り op（students.list / find / get / filter）のローカル実装。
+
+GAS の handlers/students.ts と同じ規則で、students.list の全件（row に見出し→値を持つ形）から応答を作る。
+スナップショット（snapshot.py）からの応答に使う。
+"""
+import unicodedata
+from typing import Any
+
+try:
+    from .books_mirror import _js_str
+    from .projection import parse_fields, project
+except ImportError:  # when running as a script
+    from books_mirror import _js_str
+    from projection import parse_fields, project
+
+
+def header_key(s: Any) -> str:
+    """lib/sheet_utils.ts headerKey 相当（trim → 小文字 → NFKC → 空白除去）。"""
+    return "".join(unicodedata.normalize("NFKC", _js_str(s).strip().lower()).split())
+
+
+def _limit(items: list, limit: Any) -> list:
+    return items[:limit] if isinstance(limit, int) and not isinstance(limit, bool) and limit > 0 else items
+
+
+def _cell(s: dict, key_norm: str) -> str | None:
+    """見出し（正規化済み）に対応する元の行の値。列がなければ None。"""
+    for h, v in (s.get("row") or {}).items():
+        if header_key(h) == key_norm:
+            return _js_str(v)
+    return None
+
+
+# 英語キー → 見出しの候補（handlers/students.ts の COLS と同じ。見出しそのものが優先）
+_ALIASES = {
+    "id": ("生徒ID", "ID", "id"),
+    "student_id": ("生徒ID", "ID", "id"),
+    "name": ("氏名", "名前", "生徒名", "name"),
+    "grade": ("学年", "grade"),
+    "status": ("Status", "status"),
+    "planner_sheet_id": ("スピードプランナーID", "PlannerSheetId", "planner_sheet_id", "プランナーID"),
+    "meeting_doc_id": ("面談メモID", "MeetingDocId", "meeting_doc_id", "面談ドキュメントID"),
+    "tags": ("タグ", "tags"),
+}
+
+
+def column_values(s: dict, key: str) -> list[str] | None:
+    """クエリエンジン用: 見出し key の値（見出しがなければ英語キーの候補を順に）。列がなければ None。"""
+    k = header_key(key)
+    raw = _cell(s, k)
+    for cand in _ALIASES.get(k, ()):
+        if raw is not None:
+            break
+        raw = _cell(s, header_key(cand))
+    return None if raw is None else [raw]
+
+
+def list_students(rows: list[dict], limit: Any = None) -> dict:
+    out = _limit(list(rows), limit)
+    return {"ok": True, "op": "students.list", "data": {"students": out, "count": len(out)}}
+
+
+def find(rows: list[dict], query: Any, limit: Any = None) -> dict:
+    if not query:
+        return {"ok": False, "op": "students.find", "error": {"code": "BAD_REQUEST", "message": "query is required", "details": {}}}
+    q = unicodedata.normalize("NFKC", _js_str(query).lower()).strip()
+    cands = []
+    for s in rows:
+        sid, name = _js_str(s.get("id")).strip(), _js_str(s.get("name")).strip()
+        if not sid and not name:
+            continue
+        hay = [unicodedata.normalize("NFKC", x.lower()) for x in (sid, name)]
+        if any(h == q for h in hay):
+            cands.append({"student_id": sid, "name": name, "score": 1.0, "reason": "exact"})
+        elif any(q in h for h in hay):
+            cands.append({"student_id": sid, "name": name, "score": 0.9, "reason": "partial"})
+    cands.sort(key=lambda c: -c["score"])
+    sliced = _limit(cands, limit)
+    return {"ok": True, "op": "students.find", "data": {
+        "query": query, "candidates": sliced, "top": sliced[0] if sliced else None, "confidence": sliced[0]["score"] if sliced else 0,
+    }}
+
+
+def get(rows: list[dict], student_id: Any = None, student_ids: Any = None, fields: Any = None) -> dict:
+    fl = parse_fields(fields)
+    many = student_ids if isinstance(student_ids, list) else student_id if isinstance(student_id, list) else None
+    if many:
+        want = {str(x).strip() for x in many}
+        return {"ok": True, "op": "students.get", "data": {"students": [project(s, fl) for s in rows if _js_str(s.get("id")).strip() in want]}}
+    single = str(student_id or "").strip()
+    if not single:
+        return {"ok": False, "op": "students.get", "error": {"code": "BAD_REQUEST", "message": "student_id or student_ids is required", "details": {}}}
+    for s in rows:
+        if _js_str(s.get("id")).strip() == single:
+            return {"ok": True, "op": "students.get", "data": {"student": project(s, fl)}}
+    return {"ok": False, "op": "students.get", "error": {"code": "NOT_FOUND", "message": f"student '{single}' not found", "details": {}}}
+
+
+def filter_students(rows: list[dict], where: Any = None, contains: Any = None, limit: Any = None) -> dict:
+    eq = [(header_key(k), header_key(v)) for k, v in (where if isinstance(where, dict) else {}).items()]
+    inc = [(header_key(k), header_key(v)) for k, v in (contains if isinstance(contains, dict) else {}).items()]
+    out = []
+    for s in rows:
+        ok = True
+        for k, v in eq:
+            raw = _cell(s, k)
+            if raw is None or header_key(raw) != v:
+                ok = False
+                break
+        if ok:
+            for k, v in inc:
+                raw = _cell(s, k)
+                if raw is None or v not in header_key(raw):
+                    ok = False
+                    break
+        if ok:
+            out.append(s)
+    out = _limit(out, limit)
+    return {"ok": True, "op": "students.filter", "data": {"students": out, "count": len(out)}}
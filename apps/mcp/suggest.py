@@ -0,0 +1,413 @@
+"""週間計画の叩き台（suggested_plan_text）を目次（structure.chapters）に沿って作るエンジン。
+
+- 書籍ごとに章の区間インデックス（BookIndex）を 1 回だけ作る。章を学習順に並べた通し位置（ordinal）の
+  開始位置の配列を持ち、「前回どこまで進んだか」→「次の範囲」を bisect で O(log 章数) で引く
+- numbering の数え方を章の start から推定する
+  - carry: 章をまたいで番号が続く（例題 1~40, 41~90, …）。番号 → 章も bisect で引ける
+  - reset: 章ごとに 1 から数え直す（第1章 問1~60, 第2章 問1~45）。前回の文面の「第N章」や章ごとの記号で章を決め、
+    手がかりがなければ直前の位置より後ろで番号を含む最初の章とする
+- 章ごとの記号（例題/演習/No. など）を使い、章の終わりをまたぐ範囲は章ごとに区切って書く
+- suggest_targets は行ごとに週を順に 1 回なめ、空欄の週には直前週の計画（実際の記入 or 叩き台）の続きを出す
+- ペース（任意）: 書籍ごとの過去の週あたりの進み（月間管理の実績）とその行の記入済みの週の量を観測として、
+  guideline_amount を事前分布に見立てた縮約平均（観測 n 週、重み PACE_PRIOR_WEEKS 週ぶん）を週の量にする
+- suggestion_confidence は 0..1 の数値（位置の確かさ × 量の確かさ）。量の確かさは目安量だけなら AMOUNT_GUIDELINE、
+  ペースなら観測の多さとばらつき（変動係数）から
+
+正規表現はモジュール読み込み時に 1 回だけコンパイルする。
+"""
+import bisect
+import re
+import unicodedata
+from dataclasses import dataclass, field
+from typing import Any
+
+DEFAULT_SYMBOL = "問"
+# 位置の確かさ（一意に決まった / 推定 / 先頭からと仮定 / 目次なし）と量の確かさ（目安量だけ）
+POSITION_SURE, POSITION_GUESS, POSITION_START, POSITION_NO_TOC = 0.9, 0.65, 0.6, 0.35
+AMOUNT_GUIDELINE = 0.85
+PACE_PRIOR_WEEKS = 2.0
+DONE_MARK = " ★完了！"
+PLAN_TEXT_MAX = 52  # GAS の planner.plan.set と同じ上限
+
+_RANGE = re.compile(r"(\d+)\s*[~〜\-]\s*(\d+)")
+_NUM = re.compile(r"\d+")
+_CHAPTER = re.compile(r"第\s*(\d+)\s*章|(?:chapter|ch\.?)\s*(\d+)|(\d+)\s*章", re.IGNORECASE)
+_SYMBOL = re.compile(r"([^\d\s~〜\-、,/・]+)\s*$")
+_SEP = "、"
+
+
+def _norm(text: Any) -> str:
+    return unicodedata.normalize("NFKC", str(text or "")).strip()
+
+
+def _to_int(x: Any) -> int | None:
+    try:
+        return int(x) if x is not None and str(x).strip() != "" else None
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass(frozen=True)
+class Chapter:
+    idx: int
+    title: str | None
+    start: int
+    end: int
+    symbol: str
+    base: int  # 通し位置（0 起点）での開始位置
+
+    @property
+    def size(self) -> int:
+        return self.end - self.start + 1
+
+    def label(self) -> str:
+        t = (self.title or "").strip()
+        return t if t and len(t) <= 10 else f"第{self.idx}章"
+
+
+@dataclass(frozen=True)
+class PlanRef:
+    """計画セルの文面から読み取った「どこまで進んだか」。"""
+    end: int
+    chapter: int | None = None  # 「第N章」などの明示
+    symbol: str | None = None
+
+
+@dataclass
+class Segment:
+    chapter: Chapter
+    start: int
+    end: int
+
+    def to_dict(self) -> dict:
+        return {"chapter_idx": self.chapter.idx, "chapter": self.chapter.title, "symbol": self.chapter.symbol, "start": self.start, "end": self.end}
+
+
+@dataclass
+class Cursor:
+    """行ごとの進捗位置（通し位置。-1 は未着手）。sure=False は位置が推定であることを表す。"""
+    pos: int = -1
+    chapter: int = 0  # pos が属する章（chapters の添字）
+    sure: bool = False
+    known: bool = False  # 前回の位置が文面/叩き台から分かっているか
+
+
+@dataclass
+class BookIndex:
+    chapters: list[Chapter]
+    mode: str  # "carry" | "reset" | "single" | "mixed"
+    symbol: str
+    _bases: list[int] = field(default_factory=list)
+    _starts: list[int] = field(default_factory=list)
+
+    def __post_init__(self) -> None:
+        self._bases = [c.base for c in self.chapters]
+        self._starts = [c.start for c in self.chapters]
+
+    @property
+    def total(self) -> int:
+        last = self.chapters[-1]
+        return last.base + last.size
+
+    def chapter_at(self, pos: int) -> int:
+        """通し位置 → 章の添字（O(log 章数)）。"""
+        return max(0, bisect.bisect_right(self._bases, pos) - 1)
+
+    def _resolve_chapter(self, ref: PlanRef) -> int | None:
+        if ref.chapter is not None:
+            for i, c in enumerate(self.chapters):
+                if c.idx == ref.chapter:
+                    return i
+            for i, c in enumerate(self.chapters):
+                m = _CHAPTER.search(_norm(c.title))
+                if m and int(next(g for g in m.groups() if g)) == ref.chapter:
+                    return i
+        return None
+
+    def locate(self, ref: PlanRef, after: int = 0) -> tuple[int, int, bool] | None:
+        """文面の位置 → (通し位置, 章の添字, 一意に決まったか)。目次の範囲外なら None。"""
+        n = ref.end
+        i = self._resolve_chapter(ref)
+        if i is not None:
+            c = self.chapters[i]
+            n = min(max(n, c.start), c.end)
+            return c.base + (n - c.start), i, True
+        if self.mode in ("carry", "single"):
+            i = max(0, bisect.bisect_right(self._starts, n) - 1)
+            c = self.chapters[i]
+            if c.start <= n <= c.end:
+                return c.base + (n - c.start), i, True
+            return None
+        # reset / mixed: 番号を含む章が複数ありうる。記号が一致する章 → 直前の章以降 → 先頭から の順に探す
+        cands = [i for i, c in enumerate(self.chapters) if c.start <= n <= c.end]
+        if not cands:
+            return None
+        if ref.symbol:
+            by_sym = [i for i in cands if self.chapters[i].symbol == ref.symbol]
+            if len(by_sym) == 1:
+                i = by_sym[0]
+                return self.chapters[i].base + (n - self.chapters[i].start), i, True
+        later = [i for i in cands if i >= after]
+        i = (later or cands)[0]
+        return self.chapters[i].base + (n - self.chapters[i].start), i, len(cands) == 1
+
+    def next_range(self, pos: int, amount: int) -> tuple[list[Segment], int]:
+        """通し位置 pos の次から amount 単位ぶんを章ごとの区間に分けて返す（末尾で打ち切り）。"""
+        segs: list[Segment] = []
+        cur = pos + 1
+        left = amount
+        if cur >= self.total or left <= 0:
+            return segs, pos
+        i = self.chapter_at(cur)
+        while left > 0 and i < len(self.chapters):
+            c = self.chapters[i]
+            off = cur - c.base
+            take = min(left, c.size - off)
+            segs.append(Segment(c, c.start + off, c.start + off + take - 1))
+            left -= take
+            cur += take
+            i += 1
+        return segs, cur - 1
+
+    def format(self, segs: list[Segment], done: bool) -> str:
+        """区間 → 計画セルの文面。carry で記号が同じ続きの区間は 1 つにまとめ、reset は章名を付ける。"""
+        merged: list[Segment] = []
+        for s in segs:
+            prev = merged[-1] if merged else None
+            if prev and self.mode != "reset" and prev.chapter.symbol == s.chapter.symbol and prev.end + 1 == s.start:
+                merged[-1] = Segment(prev.chapter, prev.start, s.end)
+            else:
+                merged.append(s)
+        with_label = self.mode == "reset" and len(self.chapters) > 1
+
+        def render(short: bool) -> str:
+            parts = []
+            for s in merged:
+                label = (f"第{s.chapter.idx}章" if short else s.chapter.label()) + " " if with_label else ""
+                parts.append(f"{label}{s.chapter.symbol}{s.start}~{s.end}")
+            return _SEP.join(parts) + (DONE_MARK if done else "")
+
+        text = render(False)
+        return text if len(text) <= PLAN_TEXT_MAX or not with_label else render(True)
+
+
+def build_index(chapters: list[dict] | None, default_symbol: str | None = None) -> BookIndex | None:
+    """books.get の structure.chapters → BookIndex（範囲の分からない章は除く。使える章がなければ None）。"""
+    rows: list[tuple[int, str | None, int, int, str | None]] = []
+    for k, ch in enumerate(chapters or []):
+        if not isinstance(ch, dict):
+            continue
+        rng = ch.get("range") or {}
+        s, e = _to_int(rng.get("start")), _to_int(rng.get("end"))
+        if e is None:
+            continue
+        if s is None:
+            s = 1
+        if e < s:
+            continue
+        sym = _norm(ch.get("numbering")) or None
+        rows.append((_to_int(ch.get("idx")) or (k + 1), ch.get("title"), s, e, sym))
+    if not rows:
+        return None
+    book_sym = default_symbol or next((r[4] for r in rows if r[4]), None) or DEFAULT_SYMBOL
+    if len(rows) == 1:
+        mode = "single"
+    elif all(rows[j][2] == 1 for j in range(1, len(rows))):
+        mode = "reset"
+    elif all(rows[j][2] == rows[j - 1][3] + 1 for j in range(1, len(rows))):
+        mode = "carry"
+    else:
+        mode = "mixed"
+    out: list[Chapter] = []
+    base = 0
+    for idx, title, s, e, sym in rows:
+        out.append(Chapter(idx, title, s, e, sym or book_sym, base))
+        base += e - s + 1
+    return BookIndex(out, mode, book_sym)
+
+
+def parse_plan_text(text: Any) -> PlanRef | None:
+    """計画セルの文面 → 最後に書かれた範囲の終わり（と直前の「第N章」・記号）。数字がなければ None。"""
+    s = _norm(text)
+    if not s:
+        return None
+    ranges = list(_RANGE.finditer(s))
+    if ranges:
+        m = ranges[-1]
+        end, head_at = int(m.group(2)), m.start()
+    else:
+        nums = list(_NUM.finditer(s))
+        if not nums:
+            return None
+        m = nums[-1]
+        end, head_at = int(m.group(0)), m.start()
+    head = s[:head_at]
+    chapters = [c for c in _CHAPTER.finditer(head)]
+    chapter = int(next(g for g in chapters[-1].groups() if g)) if chapters else None
+    sym_m = _SYMBOL.search(head[chapters[-1].end():] if chapters else head)
+    return PlanRef(end=end, chapter=chapter, symbol=sym_m.group(1) if sym_m else None)
+
+
+def _amount(ga: Any) -> int | None:
+    if isinstance(ga, bool) or not isinstance(ga, (int, float)) or not ga:
+        return None
+    return max(1, int(ga))
+
+
+def plan_units(text: Any) -> int | None:
+    """計画/実績の文面の範囲の量（"例題18~27" → 10。複数範囲は合計、範囲がなければ None）。"""
+    spans = [(int(a), int(b)) for a, b in _RANGE.findall(_norm(text))]
+    return sum(abs(b - a) + 1 for a, b in spans) if spans else None
+
+
+@dataclass(frozen=True)
+class Pace:
+    """1 行ぶんのペースの推定。amount は週の量、confidence は量の確かさ（0..1）。"""
+    amount: int
+    confidence: float
+    observed_weeks: int
+    observed_mean: float | None
+    cv: float | None
+
+    def to_dict(self) -> dict:
+        return {"amount": self.amount, "observed_weeks": self.observed_weeks, "observed_mean": self.observed_mean, "cv": self.cv}
+
+
+def pace_model(guideline: Any, observed: list[float], prior_weeks: float = PACE_PRIOR_WEEKS) -> Pace | None:
+    """目安量（事前）と観測した週の量 → 縮約平均の週の量。どちらもなければ None。"""
+    ga = _amount(guideline)
+    obs = [float(x) for x in observed if isinstance(x, (int, float)) and x > 0]
+    n = len(obs)
+    if not n:
+        return Pace(ga, AMOUNT_GUIDELINE, 0, None, None) if ga else None
+    mean = sum(obs) / n
+    cv = (sum((x - mean) ** 2 for x in obs) / n) ** 0.5 / mean if n >= 2 else None
+    k = prior_weeks if ga else 0.0
+    amount = max(1, round((sum(obs) + k * (ga or 0)) / (n + k)))
+    # 観測の確かさ（揃っていれば 1.0、変動係数 1 以上で 0.7。1 週だけではばらつきが分からないので目安量と同じ）を
+    # 観測の重み n/(n+prior_weeks) で目安量の確かさから寄せる。揃った観測が増えて確かさが下がることはない
+    observed = AMOUNT_GUIDELINE if cv is None else 0.7 + 0.3 * (1 - min(1.0, cv))
+    weight = n / (n + prior_weeks)
+    conf = (1 - weight) * AMOUNT_GUIDELINE + weight * observed
+    return Pace(amount, round(conf, 4), n, round(mean, 2), None if cv is None else round(cv, 3))
+
+
+def _confidence(index: BookIndex | None, cur: Cursor, amount_conf: float = AMOUNT_GUIDELINE) -> float:
+    if index is None:
+        pos = POSITION_NO_TOC
+    elif cur.known:
+        pos = POSITION_SURE if cur.sure else POSITION_GUESS
+    else:
+        pos = POSITION_START  # 目次はあるが過去の記入がない（先頭からと仮定）
+    return round(pos * amount_conf, 2)
+
+
+def _cursor_from(index: BookIndex, ref: PlanRef | None, cur: Cursor) -> Cursor:
+    if ref is None:
+        return Cursor(cur.pos, cur.chapter, False, cur.known)
+    hit = index.locate(ref, after=cur.chapter)
+    if hit is None:
+        # 目次の範囲外（最終番号より先など）は読了扱い
+        if ref.end > max(c.end for c in index.chapters):
+            return Cursor(index.total - 1, len(index.chapters) - 1, True, True)
+        return Cursor(cur.pos, cur.chapter, False, cur.known)
+    pos, i, sure = hit
+    return Cursor(pos, i, sure, True)
+
+
+def suggest_row(index: BookIndex | None, weeks: list[dict], pace: Pace | None = None) -> list[dict]:
+    """1 行ぶん。weeks は週順の {week_index, plan_text, target, guideline_amount}。target の週だけ叩き台を返す。
+
+    pace を渡すと週の量は guideline_amount ではなく pace.amount（その週の目安量が空なら叩き台なしは従来どおり）。
+    """
+    out: list[dict] = []
+    cur = Cursor()
+    last_text = ""
+    legacy_end: int | None = None  # 目次がない書籍用（従来どおり前回の終わり +1 から）
+    for w in weeks:
+        text = str(w.get("plan_text") or "").strip()
+        if not w.get("target"):
+            if text:
+                last_text = text
+                ref = parse_plan_text(text)
+                legacy_end = ref.end if ref else None
+                if index is not None:
+                    cur = _cursor_from(index, ref, cur)
+            continue
+        amount = _amount(w.get("guideline_amount"))
+        if pace is not None and amount:
+            amount = pace.amount
+        res: dict[str, Any] = {
+            "week_index": w.get("week_index"),
+            "prev_range_hint": last_text,
+            "numbering_symbol": index.symbol if index else DEFAULT_SYMBOL,
+            "suggested_plan_text": None,
+            "suggested_segments": [],
+            "suggested_amount": amount,
+            "suggestion_confidence": _confidence(index, cur, pace.confidence if pace is not None else AMOUNT_GUIDELINE),
+            "end_of_book": False,
+        }
+        if index is None:
+            if amount:
+                start = (legacy_end or 0) + 1
+                res["suggested_plan_text"] = f"{DEFAULT_SYMBOL}{start}~{start + amount - 1}"
+                legacy_end = start + amount - 1
+            out.append(res)
+            continue
+        if cur.pos >= index.total - 1:
+            res["end_of_book"] = True
+            out.append(res)
+            continue
+        res["numbering_symbol"] = index.chapters[index.chapter_at(cur.pos + 1)].symbol
+        if amount:
+            segs, end = index.next_range(cur.pos, amount)
+            done = end >= index.total - 1
+            res["suggested_plan_text"] = index.format(segs, done)
+            res["suggested_segments"] = [s.to_dict() for s in segs]
+            res["end_of_book"] = done
+            cur = Cursor(end, index.chapter_at(end), cur.sure, True)
+        else:
+            cur = Cursor(cur.pos, cur.chapter, False, cur.known)  # この週の進み具合が分からない
+        out.append(res)
+    return out
+
+
+def suggest_targets(week_count: int, row_to_book: dict[int, Any], plans: dict[int, dict[int, dict]],
+                    metrics: dict[int, dict[int, dict]], indexes: dict[str, BookIndex | None],
+                    history: dict[str, list[float]] | None = None) -> list[dict]:
+    """planner_plan_targets の targets（週→行の順）を 1 回のパスで作る。
+
+    plans/metrics は week_index → row → item（planner.plan.get / metrics.get の items）。
+    対象は「週間時間あり・計画未入力」のセル。
+    history（book_id → 過去の週ごとの進んだ量）を渡すとペースを使う（その行の記入済みの週の量も観測に加える）。
+    """
+    by_cell: dict[tuple[int, int], dict] = {}
+    for r in sorted(row_to_book):
+        bid = row_to_book.get(r)
+        weeks = []
+        for wi in range(1, week_count + 1):
+            m = metrics.get(wi, {}).get(r) or {}
+            text = str((plans.get(wi, {}).get(r) or {}).get("plan_text") or "").strip()
+            wm = m.get("weekly_minutes")
+            target = not (wm is None or str(wm) == "") and text == ""
+            weeks.append({"week_index": wi, "plan_text": text, "target": target, "guideline_amount": m.get("guideline_amount"),
+                          "weekly_minutes": wm})
+        pace = None
+        if history is not None:
+            observed = [*(history.get(str(bid)) or [] if bid else []), *(plan_units(w["plan_text"]) for w in weeks if w["plan_text"])]
+            ga = next((w["guideline_amount"] for w in weeks if w["target"] and _amount(w["guideline_amount"])), None)
+            pace = pace_model(ga, [x for x in observed if x])
+        sugg = iter(suggest_row(indexes.get(str(bid)) if bid else None, weeks, pace))
+        for w in weeks:
+            if w["target"]:
+                by_cell[(w["week_index"], r)] = {
+                    "week_index": w["week_index"],
+                    "row": r,
+                    "book_id": bid,
+                    "weekly_minutes": w["weekly_minutes"],
+                    "guideline_amount": w["guideline_amount"],
+                    **{k: v for k, v in next(sugg).items() if k != "week_index"},
+                }
+                if pace is not None:
+                    by_cell[(w["week_index"], r)]["pace"] = pace.to_dict()
+    return [by_cell[k] for k in sorted(by_cell)]
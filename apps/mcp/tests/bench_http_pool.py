@@ -0,0 +1,67 @@
+"""共有 HTTP クライアント（keep-alive）と呼び出し毎クライアントのレイテンシ比較。
+
+ローカルのスタンドイン（tests/gas_standin.py）に対して同じ POST を N 回投げ、
+1 コールあたりの p50/p95/平均を比較する。
+
+    uv run python apps/mcp/tests/bench_http_pool.py [N]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../..")))
+
+from apps.mcp.tests.gas_standin import serve  # noqa: E402
+
+
+def summarize(label: str, xs: list[float]) -> None:
+    xs = sorted(xs)
+    p50 = xs[len(xs) // 2]
+    p95 = xs[min(len(xs) - 1, int(len(xs) * 0.95))]
+    print(f"{label:<22} n={len(xs)} p50={p50*1000:.2f}ms p95={p95*1000:.2f}ms mean={statistics.mean(xs)*1000:.2f}ms")
+
+
+async def per_call_client(url: str, n: int) -> list[float]:
+    # 変更前の _post と同じ: 呼び出し毎に AsyncClient を生成・破棄
+    out = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        async with httpx.AsyncClient(timeout=30, follow_redirects=True) as client:
+            r = await client.post(url, json={"op": "ping"})
+            r.raise_for_status()
+            r.json()
+        out.append(time.perf_counter() - t0)
+    return out
+
+
+async def pooled_client(n: int) -> list[float]:
+    from apps.mcp.server import _post
+    from apps.mcp.http_pool import close_client
+    out = []
+    try:
+        for _ in range(n):
+            t0 = time.perf_counter()
+            await _post({"op": "ping"})
+            out.append(time.perf_counter() - t0)
+    finally:
+        await close_client()
+    return out
+
+
+async def main(n: int) -> None:
+    with serve() as url:
+        os.environ["EXEC_URL"] = url
+        await per_call_client(url, 5)  # warm up
+        before = await per_call_client(url, n)
+        after = await pooled_client(n)
+    summarize("before (per-call)", before)
+    summarize("after (pooled)", after)
+    print(f"speedup(p50) x{sorted(before)[n//2] / sorted(after)[n//2]:.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200))
@@ -0,0 +1,103 @@
+"""大きな上流応答（books.filter 全件 5k 冊）のデコード・整形・転送量のマイクロベンチ。
+
+- decode: 変更前の `r.json()`（標準 json）と fastjson.loads（orjson があれば orjson）
+- trim: books_list の整形（変更前: スライスしてから dict 生成 → 変更後: islice で 1 パス）
+- size: ツール応答サイズの計測（metrics の cram_tool_response_bytes）
+- wire: スタンドイン経由の books_list（BOOKS_MIRROR=0）を HTTP_GZIP=0/1 で比較（転送バイトと p50）。
+  ローカルではスタンドインが同じマシンで Python の gzip をかけるぶん遅くなるので、転送量の比較として見る
+
+    uv run python apps/mcp/tests/bench_payload.py [N]
+"""
+import asyncio
+import gzip
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Any, Callable
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../..")))
+
+from apps.mcp.tests.gas_standin import Standin, scaled_fixtures, serve  # noqa: E402
+
+N_BOOKS = 5000
+
+
+def timeit(label: str, fn: Callable[[], Any], n: int) -> float:
+    fn()  # warm up
+    xs = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        fn()
+        xs.append(time.perf_counter() - t0)
+    p50 = statistics.median(xs)
+    print(f"{label:<34} n={n} p50={p50*1000:.2f}ms mean={statistics.mean(xs)*1000:.2f}ms")
+    return p50
+
+
+def trim_before(items: list, limit: int | None = None) -> list[dict]:
+    # 変更前の books_list と同じ
+    if isinstance(limit, int) and limit > 0:
+        items = items[:limit]
+    return [
+        {"id": b.get("id"), "subject": b.get("subject"), "title": b.get("title")}
+        for b in items if isinstance(b, dict)
+    ]
+
+
+def micro(n: int) -> None:
+    from apps.mcp import fastjson
+    from apps.mcp.server import _head
+
+    st = Standin(scaled_fixtures(n_books=N_BOOKS))
+    body = json.dumps(st.route({"op": "books.filter"}), ensure_ascii=False).encode("utf-8")
+    gz = gzip.compress(body)
+    print(f"payload: {N_BOOKS} books, {len(body)/1024:.0f} KiB (gzip {len(gz)/1024:.0f} KiB, x{len(body)/len(gz):.1f}); fastjson backend={fastjson.backend()}")
+
+    before = timeit("decode: json.loads (r.json)", lambda: json.loads(body.decode("utf-8")), n)
+    after = timeit(f"decode: fastjson.loads ({fastjson.backend()})", lambda: fastjson.loads(body), n)
+    timeit("decode: gunzip", lambda: gzip.decompress(gz), n)
+
+    items = fastjson.loads(body)["data"]["books"]
+    t_before = timeit("trim: before (slice + dict)", lambda: trim_before(items, N_BOOKS), n)
+    t_after = timeit("trim: islice (_head)", lambda: [
+        {"id": b.get("id"), "subject": b.get("subject"), "title": b.get("title")}
+        for b in _head(items, N_BOOKS) if isinstance(b, dict)
+    ], n)
+
+    res = {"ok": True, "op": "books.list", "data": {"books": trim_before(items), "count": len(items)}}
+    s_before = timeit("size: json.dumps", lambda: len(json.dumps(res, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")), n)
+    s_after = timeit(f"size: fastjson.dumps ({fastjson.backend()})", lambda: len(fastjson.dumps(res, default=str)), n)
+    total_before, total_after = before + t_before + s_before, after + t_after + s_after
+    print(f"decode+trim+size p50: {total_before*1000:.2f}ms → {total_after*1000:.2f}ms (x{total_before/total_after:.2f})")
+
+
+async def wire(n: int) -> None:
+    from apps.mcp import http_pool, server, tracing
+
+    os.environ["BOOKS_MIRROR"] = "0"
+    st = Standin(scaled_fixtures(n_books=N_BOOKS))
+    with serve(st) as url:
+        os.environ["EXEC_URL"] = url
+        for gz in ("0", "1"):
+            os.environ["HTTP_GZIP"] = gz
+            await http_pool.close_client()
+            xs, wire_bytes, resp_bytes = [], 0, 0
+            for _ in range(n):
+                tracing.clear()
+                t0 = time.perf_counter()
+                res = await server.mcp.call_tool("books_list", {})
+                xs.append(time.perf_counter() - t0)
+                tr = tracing.find(tracing.recent(1)[0]["trace_id"]) or {}
+                up = next(sp for sp in tr.get("spans", []) if sp["kind"] == "upstream")
+                wire_bytes, resp_bytes = up["wire_bytes"], up["resp_bytes"]
+            assert res
+            print(f"books_list HTTP_GZIP={gz}: p50={statistics.median(xs)*1000:.1f}ms wire={wire_bytes/1024:.0f} KiB body={resp_bytes/1024:.0f} KiB")
+        await http_pool.close_client()
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    micro(n)
+    asyncio.run(wire(max(3, n // 4)))
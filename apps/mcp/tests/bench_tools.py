@@ -0,0 +1,216 @@
+"""全 MCP ツールのレイテンシ/上流呼び出し数ベンチ（オフライン; EXEC_URL 不要）。
+
+tests/gas_standin.py のスタンドイン（scaled_fixtures + 固定 seed の遅延/揺らぎ）に対して
+各ツールを N 回ずつ呼び、p50/p95/p99 と 1 回あたりの上流 HTTP リクエスト数・op 数を記録する。
+
+- cold: 呼び出しごとに応答キャッシュ/参考書ミラーを空にする（上流コストそのもの）
+- warm: キャッシュを残したまま連続で呼ぶ（最初の 1 回は除外）
+- 生徒→週間管理シートの対応表はプロセスで持ち続けるものなので、各ツールの計測前に作り直す（計測外。
+  前のツールの生徒更新で捨てられた分を cold に数えない）
+
+保存済みベースライン（tests/bench_baseline.json）と比べ、上流リクエスト数が増えたか
+p95 が許容幅（--tolerance 割合 + --slack-ms）を超えて悪化したツールがあれば exit 1。
+
+    uv run python apps/mcp/tests/bench_tools.py                     # 計測して比較
+    uv run python apps/mcp/tests/bench_tools.py --update-baseline   # ベースラインを更新
+    uv run python apps/mcp/tests/bench_tools.py --only planner_plan_targets -n 20
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+from typing import Any, Awaitable, Callable
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../..")))
+
+from apps.mcp.tests.gas_standin import Standin, scaled_fixtures, serve  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "bench_baseline.json")
+
+Call = Callable[[], Awaitable[Any]]
+
+
+def scenarios(s: Any) -> dict[str, tuple[Call | None, Call]]:
+    """ツール名 → (計測外の準備, 計測する呼び出し)。二段階のツールはプレビュー→確定までを 1 回とする。"""
+    async def confirm(fn, **kw):
+        prev = await fn(**kw)
+        token = (prev.get("data") or {}).get("confirm_token")
+        return await fn(**{k: v for k, v in kw.items() if k != "updates"}, confirm_token=token)
+
+    state: dict[str, Any] = {}
+
+    async def new_book():
+        state["book"] = (await s.books_create(title="ベンチ削除用", subject="数学"))["data"]["id"]
+
+    async def new_student():
+        state["student"] = (await s.students_create(record={"名前": "ベンチ削除用", "学年": "高1"}))["data"]["id"]
+
+    async def dates_roundtrip():
+        prev = await s.planner_dates_propose(start_date="2025-08-04", spreadsheet_id="SP001")
+        return await s.planner_dates_confirm(prev["data"]["confirm_token"])
+
+    return {
+        "books_find": (None, lambda: s.books_find("青チャート")),
+        "books_get": (None, lambda: s.books_get(book_id="gMB017")),
+        "books_get(multi)": (None, lambda: s.books_get(book_ids=["gMB017", "gET007", "gEB001"])),
+        "books_filter": (None, lambda: s.books_filter(where={"教科": "英語"})),
+        "books_filter(rich)": (None, lambda: s.books_filter(where="subject in (数学, 英語) and unit_load >= 2", sort=["-unit_load", "title"], limit=10, offset=5)),
+        "books_list": (None, lambda: s.books_list()),
+        "books_refresh": (None, lambda: s.books_refresh()),
+        "books_create": (None, lambda: s.books_create(title="ベンチ本", subject="数学", chapters=[{"title": "第1章", "range": {"start": 1, "end": 10}, "numbering": "問"}])),
+        "books_update": (None, lambda: confirm(s.books_update, book_id="gEB001", updates={"unit_load": 1})),
+        "books_delete": (new_book, lambda: confirm(s.books_delete, book_id=state["book"])),
+        "students_list": (None, lambda: s.students_list()),
+        "students_list(all)": (None, lambda: s.students_list(include_all=True)),
+        "students_find": (None, lambda: s.students_find("テスト")),
+        "students_get": (None, lambda: s.students_get(student_id="S001")),
+        "students_filter": (None, lambda: s.students_filter(where={"学年": "高2"})),
+        "students_create": (None, lambda: s.students_create(record={"名前": "ベンチ生徒", "学年": "高1"})),
+        "students_update": (None, lambda: confirm(s.students_update, student_id="S001", updates={"学年": "高2"})),
+        "students_delete": (new_student, lambda: confirm(s.students_delete, student_id=state["student"])),
+        "planner_ids_list": (None, lambda: s.planner_ids_list(student_id="S001")),
+        "planner_dates_get": (None, lambda: s.planner_dates_get(student_id="S001")),
+        "planner_dates_propose+confirm": (None, dates_roundtrip),
+        "planner_metrics_get": (None, lambda: s.planner_metrics_get(student_id="S001")),
+        "planner_plan_get": (None, lambda: s.planner_plan_get(student_id="S001")),
+        "planner_plan_targets": (None, lambda: s.planner_plan_targets(student_id="S001")),
+        "planner_plan_targets(pace)": (None, lambda: s.planner_plan_targets(student_id="S001", pace=True, pace_months=4)),
+        "planner_plan_targets_bulk": (None, lambda: s.planner_plan_targets_bulk(student_ids=[f"S{i}" for i in range(101, 109)], summary_only=True)),
+        "planner_plan_create": (None, lambda: s.planner_plan_create(items=[{"week_index": 4, "row": 6, "plan_text": "問1~5"}], spreadsheet_id="SP001", overwrite=True)),
+        "planner_plan_create_bulk": (None, lambda: s.planner_plan_create_bulk(items=[{"student_id": f"S{i}", "week_index": 2, "row": 4, "plan_text": "問1~5"} for i in range(101, 109)], overwrite=True)),
+        "planner_monthly_filter": (None, lambda: s.planner_monthly_filter(2025, 7, student_id="S001")),
+        "planner_monthly_history": (None, lambda: s.planner_monthly_history(student_id="S001", from_month="2025-05", to_month="2025-08")),
+        "planner_guidance": (None, lambda: s.planner_guidance()),
+        "tools_help": (None, lambda: s.tools_help()),
+        "cache_stats": (None, lambda: s.cache_stats()),
+    }
+
+
+def pct(xs: list[float], p: float) -> float:
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(round(p * (len(xs) - 1))))]
+
+
+def reset_caches(s: Any) -> None:
+    s._CACHE.clear()
+    s._VERSIONS.clear()
+    s._BOOKS.invalidate()
+    s._STUDENTS_SYNC["at"] = 0.0
+    s._HISTORY.clear()
+
+
+async def run_one(st: Standin, s: Any, setup: Call | None, call: Call, n: int, warm: bool) -> dict:
+    lat: list[float] = []
+    reqs = 0
+    ops = 0
+    if warm:
+        reset_caches(s)
+        if setup:
+            await setup()
+        await call()  # 温め（計測外）
+    for _ in range(n):
+        if not warm:
+            reset_caches(s)
+        if setup:
+            await setup()
+        st.reset_calls()
+        t0 = time.perf_counter()
+        res = await call()
+        lat.append(time.perf_counter() - t0)
+        reqs += st.requests
+        ops += sum(v for k, v in st.calls.items() if k != "batch")
+        if isinstance(res, dict) and res.get("ok") is False:
+            raise SystemExit(f"tool failed during benchmark: {res}")
+    return {
+        "p50_ms": round(pct(lat, 0.50) * 1000, 2),
+        "p95_ms": round(pct(lat, 0.95) * 1000, 2),
+        "p99_ms": round(pct(lat, 0.99) * 1000, 2),
+        "mean_ms": round(statistics.mean(lat) * 1000, 2),
+        "requests_per_call": round(reqs / n, 2),
+        "ops_per_call": round(ops / n, 2),
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float, slack_ms: float) -> list[str]:
+    problems = []
+    for key, cur in results.items():
+        base = baseline.get(key)
+        if not base:
+            continue
+        if cur["requests_per_call"] > base["requests_per_call"] + 1e-9:
+            problems.append(f"{key}: upstream requests/call {base['requests_per_call']} → {cur['requests_per_call']}")
+        limit = base["p95_ms"] * (1 + tolerance) + slack_ms
+        if cur["p95_ms"] > limit:
+            problems.append(f"{key}: p95 {base['p95_ms']}ms → {cur['p95_ms']}ms (limit {limit:.1f}ms)")
+    return problems
+
+
+async def main(args: argparse.Namespace) -> int:
+    from apps.mcp import server as s
+    from apps.mcp.http_pool import close_client
+
+    for k in ("RESPONSE_CACHE", "BOOKS_MIRROR", "SINGLEFLIGHT", "GAS_BATCH"):
+        os.environ.pop(k, None)
+    st = Standin(scaled_fixtures(), seed=args.seed)
+    st.overhead, st.jitter = args.overhead_ms / 1000, args.jitter
+    results: dict[str, dict] = {}
+    with serve(st) as url:
+        os.environ["EXEC_URL"] = url
+        try:
+            for name, (setup, call) in scenarios(s).items():
+                if args.only and name not in args.only:
+                    continue
+                await s._SHEETS.refresh()
+                for mode in ("cold", "warm"):
+                    results[f"{name} [{mode}]"] = await run_one(st, s, setup, call, args.n, warm=(mode == "warm"))
+        finally:
+            await close_client()
+
+    print(f"{'tool':<42}{'p50':>9}{'p95':>9}{'p99':>9}{'req/call':>10}{'ops/call':>10}")
+    for key, r in results.items():
+        print(f"{key:<42}{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['requests_per_call']:>10}{r['ops_per_call']:>10}")
+
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(BASELINE_PATH) and args.only:
+            with open(BASELINE_PATH, encoding="utf-8") as f:
+                baseline = json.load(f).get("results", {})
+        baseline.update(results)
+        meta = {"iterations": args.n, "overhead_ms": args.overhead_ms, "jitter": args.jitter, "seed": args.seed}
+        with open(BASELINE_PATH, "w", encoding="utf-8") as f:
+            json.dump({"meta": meta, "results": baseline}, f, ensure_ascii=False, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"baseline updated: {BASELINE_PATH}")
+        return 0
+
+    if not os.path.exists(BASELINE_PATH):
+        print("no baseline yet (run with --update-baseline)")
+        return 0
+    with open(BASELINE_PATH, encoding="utf-8") as f:
+        baseline = json.load(f).get("results", {})
+    problems = compare(results, baseline, args.tolerance, args.slack_ms)
+    missing = sorted(set(baseline) - set(results)) if not args.only else []
+    for p in problems:
+        print("REGRESSION", p)
+    for m in missing:
+        print("MISSING", m)
+    if problems or missing:
+        return 1
+    print("BENCH OK ✔ (no regression vs baseline)")
+    return 0
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("-n", type=int, default=8, help="ツールごとの計測回数（既定 8）")
+    ap.add_argument("--overhead-ms", type=float, default=30.0, help="スタンドインの 1 リクエストあたり固定遅延（既定 30ms）")
+    ap.add_argument("--jitter", type=float, default=0.1, help="遅延の揺らぎ（割合, 既定 0.1）")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--tolerance", type=float, default=0.5, help="p95 の許容悪化率（既定 0.5 = +50%%）")
+    ap.add_argument("--slack-ms", type=float, default=15.0, help="p95 の許容悪化幅（絶対値, 既定 15ms）")
+    ap.add_argument("--only", nargs="*", help="計測するツール名（scenarios のキー）")
+    ap.add_argument("--update-baseline", action="store_true")
+    sys.exit(asyncio.run(main(ap.parse_args())))
@@ -0,0 +1,48 @@
+"""WebApp（302 の 2 ホップ）と Execution API（1 ホップ）の経路比較ベンチ。
+
+スタンドインに実行起動コスト（overhead）と 302 の 2 ホップ目の遅延（redirect_delay）を付け、
+books.get を EXEC_TRANSPORT=webapp / exec_api / auto（実測で選ぶ）で N 回ずつ送って p50 を比べる。
+
+    uv run python apps/mcp/tests/bench_transport.py [N] [REDIRECT_MS]
+"""
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../..")))
+
+from apps.mcp.tests.gas_standin import Standin, serve  # noqa: E402
+
+
+async def main(n: int, redirect_ms: float) -> None:
+    from apps.mcp import exec_api, http_pool, server
+
+    st = Standin()
+    st.overhead = 0.02
+    st.redirect_delay = redirect_ms / 1000
+    with serve(st) as url:
+        base = url.removesuffix("/exec")
+        os.environ.update({"EXEC_URL": url, "SCRIPT_ID": "standin", "EXEC_API_BASE": base, "GAS_TOKEN_URL": base + "/token", "GAS_OAUTH_REFRESH_TOKEN": "rt"})
+        exec_api.set_tokens(None)
+        req = {"op": "books.get", "book_id": "gMB017"}
+        for mode in ("webapp", "exec_api", "auto"):
+            os.environ["EXEC_TRANSPORT"] = mode
+            server._ROUTER.reset()
+            await server._http_post(req)  # 接続とトークンを温める
+            st.reset_calls()
+            xs = []
+            for _ in range(n):
+                t0 = time.perf_counter()
+                await server._http_post(req)
+                xs.append(time.perf_counter() - t0)
+            print(f"EXEC_TRANSPORT={mode:<8} n={n} p50={statistics.median(xs)*1000:.1f}ms mean={statistics.mean(xs)*1000:.1f}ms "
+                  f"http_requests={st.requests} via_exec_api={st.exec_api_requests}")
+        await http_pool.close_client()
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    redirect_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 30.0
+    asyncio.run(main(n, redirect_ms))
@@ -0,0 +1,750 @@
+"""ローカル用 GAS WebApp スタンドイン（オフライン計測・テスト用）。
+
+本物の WebApp と同じく `/exec` への GET/POST を受け付け、302 で `/echo` へ
+リダイレクトしてから JSON を返す（script.google.com → googleusercontent の 2 ホップを再現）。
+apps/gas/src/index.ts の op（books.* / students.* / planner.* / batch / ping / table.read）を
+フィクスチャ上で実装し、応答の形は各ハンドラに揃える。
+
+遅延モデル（Apps Script の実行コストを模す）:
+- overhead: HTTP リクエストごとの固定遅延（WebApp の実行起動）
+- latency[op]: op ごとの処理時間（batch ではサブリクエストぶんを合計）
+- jitter: 上記の合計に掛ける揺らぎの幅（0.2 なら ±20%）。seed 固定で再現可能
+- redirect_delay: WebApp の 302 の 2 ホップ目（/echo）の遅延。Execution API（/v1/scripts/{id}:run）にはかからない
+
+Execution API 相当として `/token`（アクセストークンの払い出し）と `/v1/scripts/{id}:run`（function="api"）も受ける。
+
+使い方:
+    with serve() as exec_url:
+        os.environ["EXEC_URL"] = exec_url
+        ...
+"""
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import random
+import socket
+import threading
+import time
+import unicodedata
+import uuid
+from collections import Counter
+from typing import Any, Callable, Iterator
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, RedirectResponse, Response
+from starlette.routing import Route
+
+from apps.mcp import books_mirror
+from apps.mcp.resilience import KEYED_WRITES
+from apps.mcp.projection import parse_fields, parse_weeks, project
+
+Handler = Callable[[dict[str, Any]], dict[str, Any]]
+
+
+def _ok(op: str, data: Any) -> dict:
+    return {"ok": True, "op": op, "meta": {"ts": "1970-01-01T00:00:00.000Z"}, "data": data}
+
+
+def _ng(op: str, code: str, message: str) -> dict:
+    return {"ok": False, "op": op, "error": {"code": code, "message": message, "details": {}}}
+
+
+def _versioned(op: str, req: dict, data: dict) -> dict:
+    """lib/common.ts の versioned(): 内容の MD5 が if_none_match と同じなら本文なしで返す。"""
+    version = hashlib.md5(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")).hexdigest()
+    if req.get("if_none_match") and str(req["if_none_match"]) == version:
+        return _ok(op, {"not_modified": True, "version": version})
+    return _ok(op, {**data, "version": version})
+
+
+def _hk(s: Any) -> str:
+    """lib/sheet_utils.ts headerKey 相当。"""
+    return "".join(unicodedata.normalize("NFKC", str(s if s is not None else "").strip().lower()).split())
+
+
+# --- フィクスチャ（参考書マスター/生徒/週間管理/月間管理） ---
+
+WEEK_COLS = [
+    {"time": "E", "unit": "F", "guide": "G", "plan": "H"},
+    {"time": "M", "unit": "N", "guide": "O", "plan": "P"},
+    {"time": "U", "unit": "V", "guide": "W", "plan": "X"},
+    {"time": "AC", "unit": "AD", "guide": "AE", "plan": "AF"},
+    {"time": "AK", "unit": "AL", "guide": "AM", "plan": "AN"},
+]
+PLANNER_ROWS = range(4, 31)
+
+
+def _book(bid: str, title: str, subject: str, unit_load: float | None, chapters: list[tuple[str, int, int, str]], aliases: list[str] | None = None) -> dict:
+    """books.filter の 1 冊ぶん（aliases 付き）。books.get の形は books_mirror.get で作る。"""
+    return {
+        "id": bid,
+        "title": title,
+        "subject": subject,
+        "monthly_goal": {"text": "", "per_day_minutes": None, "days": None, "total_minutes_est": None},
+        "unit_load": unit_load,
+        "structure": {"chapters": [
+            {"idx": i + 1, "title": t, "range": {"start": s, "end": e}, "numbering": n}
+            for i, (t, s, e, n) in enumerate(chapters)
+        ]},
+        "assessment": {"book_type": "", "quiz_type": "", "quiz_id": ""},
+        "aliases": list(aliases or []),
+    }
+
+
+def _student(sid: str, name: str, grade: str, planner: str, status: str = "在塾") -> dict:
+    return {
+        "id": sid, "name": name, "grade": grade, "planner_sheet_id": planner, "meeting_doc_id": "", "tags": "",
+        "row": {"生徒ID": sid, "名前": name, "学年": grade, "スピードプランナーID": planner, "Status": status},
+    }
+
+
+def _planner(rows: list[dict], plans: dict[tuple[int, int], str], week_starts: list[str], monthly: list[dict] | None = None) -> dict:
+    # gID の行は週 120 分・目安 10、それ以外（学校課題など）は時間だけ
+    metrics = {}
+    for r in rows:
+        is_book = r["raw_code"][3:].startswith("g")
+        metrics[r["row"]] = {"weekly_minutes": 120 if is_book else 60, "unit_load": 2 if is_book else None, "guideline_amount": 10 if is_book else None}
+    return {
+        "week_starts": list(week_starts),
+        "rows": rows,
+        "metrics": {wi: dict(metrics) for wi in range(1, 6)},
+        "plans": dict(plans),
+        "monthly": list(monthly or []),
+    }
+
+
+def _monthly_item(row: int, yy: int, mm: int, book_id: str, subject: str, title: str, weeks: list[str]) -> dict:
+    return {
+        "row": row, "raw_code": f"{yy}{mm}{book_id}", "month_code": yy * 10 + mm, "year": yy, "month": mm,
+        "book_id": book_id, "subject": subject, "title": title, "guideline_note": "",
+        "unit_load": 2, "monthly_minutes": 480, "guideline_amount": 40,
+        "weeks": [{"index": i + 1, "actual": (weeks[i] if i < len(weeks) else "")} for i in range(5)],
+    }
+
+
+def default_fixtures() -> dict[str, Any]:
+    books = [
+        _book("gMB017", "青チャート数学I+A", "数学", 2, [("数と式", 1, 40, "例題"), ("2次関数", 41, 90, "例題"), ("図形と計量", 91, 120, "例題")], ["青チャ"]),
+        _book("gET007", "ターゲット1900", "英語", 1, [("Part1", 1, 800, "No."), ("Part2", 801, 1500, "No."), ("Part3", 1501, 1900, "No.")], ["ターゲット"]),
+        _book("gEB001", "スクランブル英文法", "英語", 1, [("第1章", 1, 60, "問"), ("第2章", 1, 45, "問")]),
+    ]
+    rows = [
+        {"row": 4, "raw_code": "258gMB017", "subject": "数学", "title": "青チャート数学I+A", "guideline_note": ""},
+        {"row": 5, "raw_code": "258gET007", "subject": "英語", "title": "ターゲット1900", "guideline_note": ""},
+        {"row": 6, "raw_code": "258gEB001", "subject": "英語", "title": "スクランブル英文法", "guideline_note": ""},
+        {"row": 7, "raw_code": "258学校課題", "subject": "数学", "title": "学校課題", "guideline_note": "課題の範囲"},
+    ]
+    plans = {(1, 4): "例題1~10", (1, 5): "No.1~100", (2, 4): "例題11~20"}
+    monthly = [
+        _monthly_item(2, 25, 7, "gMB017", "数学", "青チャート数学I+A", ["例題1~8", "例題9~16", "例題17~24", "例題25~32"]),
+        _monthly_item(3, 25, 7, "gET007", "英語", "ターゲット1900", ["No.1~100", "No.101~200", "No.201~300", "No.301~400"]),
+        _monthly_item(4, 25, 6, "gMB017", "数学", "青チャート数学I+A", ["", "", "", ""]),
+    ]
+    return {
+        "books": books,
+        "students": [
+            _student("S001", "テスト太郎", "高2", "SP001"),
+            _student("S002", "テスト花子", "高3", "SP002", status="退塾"),
+        ],
+        "planners": {
+            "SP001": _planner(rows, plans, ["2025/08/04", "2025/08/11", "2025/08/18", "2025/08/25", ""], monthly),
+            "SP002": _planner(rows[:2], {}, ["2025/08/04", "2025/08/11", "2025/08/18", "2025/08/25", "2025/09/01"]),
+        },
+    }
+
+
+def scaled_fixtures(n_books: int = 200, n_students: int = 40, seed: int = 7) -> dict[str, Any]:
+    """default_fixtures に合成データを足した大きめのセット（ベンチ用）。乱数は seed 固定。"""
+    rnd = random.Random(seed)
+    fx = default_fixtures()
+    subjects = [("数学", "M", "例題"), ("英語", "E", "No."), ("物理", "P", "問"), ("化学", "C", "問"), ("古文", "K", "講")]
+    for i in range(n_books):
+        subj, code, num = subjects[i % len(subjects)]
+        chs, start = [], 1
+        for c in range(rnd.randint(1, 8)):
+            end = start + rnd.randint(10, 80)
+            chs.append((f"第{c + 1}章", start, end, num))
+            start = end + 1
+        fx["books"].append(_book(f"g{code}X{i:03d}", f"合成{subj}問題集{i}", subj, rnd.choice([1, 1.5, 2, 3]), chs))
+    for i in range(n_students):
+        sid, spid = f"S{i + 100:03d}", f"SP{i + 100:03d}"
+        fx["students"].append(_student(sid, f"合成生徒{i}", rnd.choice(["高1", "高2", "高3"]), spid, status="在塾" if i % 5 else "退塾"))
+        picks = rnd.sample(fx["books"], 6)
+        rows = [{"row": 4 + j, "raw_code": f"258{b['id']}", "subject": b["subject"], "title": b["title"], "guideline_note": ""} for j, b in enumerate(picks)]
+        plans = {(1, r["row"]): f"{b['structure']['chapters'][0]['numbering']}1~10" for r, b in zip(rows, picks) if rnd.random() < 0.5}
+        fx["planners"][spid] = _planner(rows, plans, ["2025/08/04", "2025/08/11", "2025/08/18", "2025/08/25", ""])
+    return fx
+
+
+class Standin:
+    """op → ハンドラのルーティングと呼び出し回数の記録。"""
+
+    def __init__(self, fixtures: dict[str, Any] | None = None, supports_batch: bool = True, seed: int = 0) -> None:
+        self.fx = fixtures or default_fixtures()
+        self.supports_batch = supports_batch
+        self.handlers: dict[str, Handler] = {
+            "ping": lambda req: _ok("ping", {"status": "ok", "timestamp": "1970-01-01T00:00:00.000Z"}),
+            "books.find": self.books_find,
+            "books.get": self.books_get,
+            "books.filter": self.books_filter,
+            "books.create": self.books_create,
+            "books.update": self.books_update,
+            "books.delete": self.books_delete,
+            "books.changed_since": lambda req: self._changed_since("books.changed_since", "books", self.books_filter({})["data"]["books"], req),
+            "students.list": self.students_list,
+            "students.find": self.students_find,
+            "students.get": self.students_get,
+            "students.filter": self.students_filter,
+            "students.create": self.students_create,
+            "students.update": self.students_update,
+            "students.delete": self.students_delete,
+            "students.changed_since": lambda req: self._changed_since("students.changed_since", "students", self.students_list({})["data"]["students"], req),
+            "planner.ids_list": self.planner_ids_list,
+            "planner.dates.get": self.planner_dates_get,
+            "planner.dates.set": self.planner_dates_set,
+            "planner.metrics.get": self.planner_metrics_get,
+            "planner.plan.get": self.planner_plan_get,
+            "planner.plan.set": self.planner_plan_set,
+            "planner.monthly.filter": self.planner_monthly_filter,
+            "table.read": lambda req: _ng("table.read", "DISABLED", "table.read is disabled (set ENABLE_TABLE_READ=true in ScriptProperties)"),
+        }
+        # changed_since のカーソル → id→ハッシュ表（GAS では ScriptCache）
+        self.delta_cursors: dict[str, dict[str, str]] = {}
+        # op → 処理時間（秒）。batch ではサブリクエストぶんを合計する
+        self.latency: dict[str, float] = {}
+        # HTTP リクエストごとの固定遅延（秒）。WebApp の実行起動コストに相当
+        self.overhead = 0.0
+        # 遅延の揺らぎ（割合）。0.2 なら各リクエストの遅延が ±20% の一様分布でぶれる
+        self.jitter = 0.0
+        # WebApp の 302 → googleusercontent の 2 ホップ目にかかる時間（秒）。Execution API にはない
+        self.redirect_delay = 0.0
+        self._rnd = random.Random(seed)
+        self.calls: Counter[str] = Counter()
+        self.requests = 0
+        # 処理中の HTTP リクエスト数とその最大値（同時実行数の上限の検証用）
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        # 次の HTTP リクエストから順に注入する障害: int = その HTTP ステータスで失敗（op は実行しない）,
+        # "html" = 200 で HTML を返す（BAD_JSON 相当）, float = その秒数だけ余計に遅らせてから通常処理,
+        # "lost" = op は実行するが応答が届かない（書き込み後のタイムアウト相当。504 を返す）
+        self.faults: list[int | str | float] = []
+        # 書き込みの冪等キー → 最初の応答（GAS の lib/idempotency.ts 相当。False なら旧デプロイとしてキーを無視）
+        self.supports_idempotency = True
+        self.idempotency: dict[str, dict | None] = {}
+        self.replays = 0
+        self._pending: dict[str, dict] = {}
+        # Execution API: /token で払い出したアクセストークン（scripts.run はこれだけ受け付ける）と有効秒数
+        self.access_tokens: set[str] = set()
+        self.token_grants: list[str] = []
+        self.token_ttl = 3600
+        self.exec_api_requests = 0
+        # planner.* を spreadsheet_id なし（student_id だけ）で受けて生徒シートから解決した回数
+        self.student_resolutions = 0
+        self._lock = threading.Lock()
+
+    # --- 二段階確定（CacheService 相当） ---
+    def _token_put(self, prefix: str, payload: dict) -> str:
+        token = uuid.uuid4().hex
+        with self._lock:
+            self._pending[f"{prefix}:{token}"] = payload
+        return token
+
+    def _token_pop(self, prefix: str, token: Any) -> dict | None:
+        with self._lock:
+            return self._pending.pop(f"{prefix}:{token}", None)
+
+    @staticmethod
+    def _limit(items: list, limit: Any) -> list:
+        limit = int(limit) if isinstance(limit, str) and limit.isdigit() else limit
+        return items[:limit] if isinstance(limit, int) and limit > 0 else items
+
+    # --- books ---
+    def _book_by_id(self, bid: Any) -> dict | None:
+        return next((b for b in self.fx["books"] if b["id"] == str(bid or "").strip()), None)
+
+    def books_find(self, req: dict) -> dict:
+        if not req.get("query"):
+            return _ng("books.find", "BAD_REQUEST", "query が必要です")
+        limit = req.get("limit", 20)
+        return _ok("books.find", books_mirror.find(self.fx["books"], str(req["query"]), int(limit) if str(limit).isdigit() else 20))
+
+    def books_get(self, req: dict) -> dict:
+        ids = req.get("book_ids")
+        if ids and not isinstance(ids, list):
+            ids = [ids]
+        res = books_mirror.get(self.fx["books"], req.get("book_id"), ids)
+        fl = parse_fields(req.get("fields"))
+        if fl and res.get("ok"):
+            d = res["data"]
+            res["data"] = {"books": [project(b, fl) for b in d["books"]]} if "books" in d else {"book": project(d["book"], fl)}
+        return res
+
+    def _changed_since(self, op: str, kind: str, records: list[dict], req: dict) -> dict:
+        """lib/delta.ts の deltaSince(): カーソル時点のキー→ハッシュ表との差分（不明なカーソルは reset で全件）。"""
+        hashes = [hashlib.md5(json.dumps(r, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest() for r in records]
+        keys, seen = [], {}
+        for r, h in zip(records, hashes):
+            base = str(r.get("id") or "").strip() or f"#{h}"
+            n = seen[base] = seen.get(base, 0) + 1
+            keys.append(base if n == 1 else f"{base}#{n}")
+        state, by_key = dict(zip(keys, hashes)), dict(zip(keys, records))
+        cursor = req.get("cursor")
+        prev = self.delta_cursors.get(cursor) if isinstance(cursor, str) and cursor.startswith(kind + ":") else None
+        reset = prev is None
+        changed = [k for k, h in state.items() if reset or prev.get(k) != h]
+        upserts = [by_key[k] for k in changed]
+        deletes = [] if reset else [i for i in prev if i not in state]
+        if reset or upserts or deletes:
+            cursor = f"{kind}:{uuid.uuid4()}"
+            self.delta_cursors[cursor] = state
+        return _ok(op, {"cursor": cursor, "reset": reset, "upserts": upserts, "keys": changed, "deletes": deletes, "total": len(records), "changed": len(upserts) + len(deletes)})
+
+    def books_filter(self, req: dict) -> dict:
+        limit = req.get("limit")
+        data = books_mirror.filter_books(self.fx["books"], req.get("where") or {}, req.get("contains") or {}, limit if isinstance(limit, int) else None)
+        if data is None:  # 未知の列は GAS と同じく一致なし
+            data = {"books": [], "count": 0, "limit": limit or None}
+        return _ok("books.filter", data)
+
+    def books_create(self, req: dict) -> dict:
+        if not req.get("title") or not req.get("subject"):
+            return _ng("books.create", "BAD_REQUEST", "title と subject が必要です")
+        prefix = req.get("id_prefix") or "gTMP"
+        n = sum(1 for b in self.fx["books"] if b["id"].startswith(prefix)) + 1
+        chs = [((c.get("title") or ""), (c.get("range") or {}).get("start"), (c.get("range") or {}).get("end"), c.get("numbering") or "")
+               for c in (req.get("chapters") or [])]
+        book = _book(f"{prefix}{n:03d}", req["title"], req["subject"], req.get("unit_load"), chs)
+        self.fx["books"].append(book)
+        return _ok("books.create", {"id": book["id"], "created_rows": max(1, len(chs))})
+
+    def books_update(self, req: dict) -> dict:
+        if not req.get("book_id"):
+            return _ng("books.update", "BAD_REQUEST", "book_id が必要です")
+        b = self._book_by_id(req.get("book_id"))
+        if not b:
+            return _ng("books.update", "NOT_FOUND", f"book_id '{req.get('book_id')}' が見つかりません")
+        if not req.get("confirm_token"):
+            u = req.get("updates") or {}
+            meta = {k: {"from": b.get(k), "to": v} for k, v in u.items() if k in ("title", "subject", "unit_load") and b.get(k) != v}
+            token = self._token_put("upd", {"book_id": b["id"], "updates": u})
+            return _ok("books.update", {"requires_confirmation": True, "preview": {"book_id": b["id"], "meta_changes": meta, "chapters": None}, "confirm_token": token, "expires_in_seconds": 300})
+        saved = self._token_pop("upd", req["confirm_token"])
+        if not saved:
+            return _ng("books.update", "CONFIRM_EXPIRED", "confirm_token が無効または期限切れです")
+        touched = 0
+        for k in ("title", "subject", "unit_load"):
+            if k in saved["updates"]:
+                b[k] = saved["updates"][k]
+                touched += 1
+        return _ok("books.update", {"book_id": b["id"], "updated": touched})
+
+    def books_delete(self, req: dict) -> dict:
+        b = self._book_by_id(req.get("book_id"))
+        if not b:
+            return _ng("books.delete", "NOT_FOUND", f"book_id '{req.get('book_id')}' が見つかりません")
+        rows = max(1, len(b["structure"]["chapters"]))
+        if not req.get("confirm_token"):
+            token = self._token_put("del", {"book_id": b["id"]})
+            return _ok("books.delete", {"requires_confirmation": True, "preview": {"book_id": b["id"], "rows": rows}, "confirm_token": token, "expires_in_seconds": 300})
+        if not self._token_pop("del", req["confirm_token"]):
+            return _ng("books.delete", "CONFIRM_EXPIRED", "confirm_token が無効または期限切れです")
+        self.fx["books"].remove(b)
+        return _ok("books.delete", {"deleted_rows": rows})
+
+    # --- students ---
+    def _student_by_id(self, sid: Any) -> dict | None:
+        return next((s for s in self.fx["students"] if s["id"] == str(sid or "").strip()), None)
+
+    def students_list(self, req: dict) -> dict:
+        out = self._limit(list(self.fx["students"]), req.get("limit"))
+        return _ok("students.list", {"students": out, "count": len(out)})
+
+    def students_find(self, req: dict) -> dict:
+        if not req.get("query"):
+            return _ng("students.find", "BAD_REQUEST", "query is required")
+        q = unicodedata.normalize("NFKC", str(req["query"]).lower()).strip()
+        cands = []
+        for s in self.fx["students"]:
+            hay = [unicodedata.normalize("NFKC", x.lower()) for x in (s["id"], s["name"])]
+            if any(h == q for h in hay):
+                cands.append({"student_id": s["id"], "name": s["name"], "score": 1.0, "reason": "exact"})
+            elif any(q in h for h in hay):
+                cands.append({"student_id": s["id"], "name": s["name"], "score": 0.9, "reason": "partial"})
+        cands.sort(key=lambda c: -c["score"])
+        out = self._limit(cands, req.get("limit"))
+        return _ok("students.find", {"query": req["query"], "candidates": out, "top": out[0] if out else None, "confidence": out[0]["score"] if out else 0})
+
+    def students_get(self, req: dict) -> dict:
+        ids = req.get("student_ids") or (req.get("student_id") if isinstance(req.get("student_id"), list) else None)
+        fl = parse_fields(req.get("fields"))
+        if ids:
+            want = {str(x).strip() for x in ids}
+            return _ok("students.get", {"students": [project(s, fl) for s in self.fx["students"] if s["id"] in want]})
+        single = str(req.get("student_id") or "").strip()
+        if not single:
+            return _ng("students.get", "BAD_REQUEST", "student_id or student_ids is required")
+        s = self._student_by_id(single)
+        if not s:
+            return _ng("students.get", "NOT_FOUND", f"student '{single}' not found")
+        return _ok("students.get", {"student": project(s, fl)})
+
+    def students_filter(self, req: dict) -> dict:
+        where = [(_hk(k), _hk(v)) for k, v in (req.get("where") or {}).items()]
+        contains = [(_hk(k), _hk(v)) for k, v in (req.get("contains") or {}).items()]
+        out = []
+        for s in self.fx["students"]:
+            row = {_hk(k): _hk(v) for k, v in s["row"].items()}
+            if all(k in row and row[k] == v for k, v in where) and all(k in row and v in row[k] for k, v in contains):
+                out.append(s)
+        out = self._limit(out, req.get("limit"))
+        return _ok("students.filter", {"students": out, "count": len(out)})
+
+    def students_create(self, req: dict) -> dict:
+        rec = req.get("record") or {}
+        prefix = (req.get("id_prefix") or "s").strip()
+        n = sum(1 for s in self.fx["students"] if s["id"].startswith(prefix)) + 1
+        sid = f"{prefix}{n:04d}"
+        self.fx["students"].append(_student(sid, str(rec.get("名前") or req.get("name") or ""), str(rec.get("学年") or req.get("grade") or ""), str(req.get("planner_sheet_id") or "")))
+        return _ok("students.create", {"id": sid, "created": True})
+
+    def students_update(self, req: dict) -> dict:
+        if not req.get("student_id"):
+            return _ng("students.update", "BAD_REQUEST", "student_id is required")
+        s = self._student_by_id(req.get("student_id"))
+        if not s:
+            return _ng("students.update", "NOT_FOUND", f"student '{req.get('student_id')}' not found")
+        if not req.get("confirm_token"):
+            u = req.get("updates") or {}
+            diffs = {k: {"from": s["row"].get(k), "to": v} for k, v in u.items() if str(s["row"].get(k)) != str(v)}
+            token = self._token_put("stu_upd", {"student_id": s["id"], "updates": u})
+            return _ok("students.update", {"requires_confirmation": True, "preview": {"diffs": diffs}, "confirm_token": token, "expires_in_seconds": 300})
+        saved = self._token_pop("stu_upd", req["confirm_token"])
+        if not saved:
+            return _ng("students.update", "CONFIRM_EXPIRED", "confirm_token is invalid or expired")
+        if saved["student_id"] != s["id"]:
+            return _ng("students.update", "CONFIRM_MISMATCH", "student_id mismatch")
+        s["row"].update(saved["updates"])
+        for k, v in saved["updates"].items():
+            if k in ("名前", "name"):
+                s["name"] = v
+            elif k in ("学年", "grade"):
+                s["grade"] = v
+            elif k in ("スピードプランナーID", "planner_sheet_id"):
+                s["planner_sheet_id"] = v
+        return _ok("students.update", {"updated": True})
+
+    def students_delete(self, req: dict) -> dict:
+        s = self._student_by_id(req.get("student_id"))
+        if not s:
+            return _ng("students.delete", "NOT_FOUND", f"student '{req.get('student_id')}' not found")
+        if not req.get("confirm_token"):
+            token = self._token_put("stu_del", {"student_id": s["id"]})
+            return _ok("students.delete", {"requires_confirmation": True, "preview": {"row": self.fx["students"].index(s) + 2}, "confirm_token": token, "expires_in_seconds": 300})
+        if not self._token_pop("stu_del", req["confirm_token"]):
+            return _ng("students.delete", "CONFIRM_EXPIRED", "confirm_token is invalid or expired")
+        self.fx["students"].remove(s)
+        return _ok("students.delete", {"deleted": True})
+
+    # --- planner ---
+    def _planner(self, req: dict) -> dict | None:
+        spid = req.get("spreadsheet_id")
+        if not spid and req.get("student_id"):
+            # GAS の resolveSpreadsheetIdByStudent（生徒シート全体を読む）に相当
+            with self._lock:
+                self.student_resolutions += 1
+            st = self._student_by_id(req["student_id"])
+            spid = st and st.get("planner_sheet_id")
+        return self.fx["planners"].get(spid) if spid else None
+
+    def planner_ids_list(self, req: dict) -> dict:
+        p = self._planner(req)
+        if not p:
+            return _ng("planner.ids_list", "NOT_FOUND", "planner sheet not found (resolve by student_id or spreadsheet_id)")
+        items = []
+        for r in p["rows"]:
+            code = r["raw_code"]
+            items.append({**r, "month_code": int(code[:3]), "book_id": code[3:]})
+        return _ok("planner.ids_list", {"count": len(items), "items": items})
+
+    def planner_dates_get(self, req: dict) -> dict:
+        p = self._planner(req)
+        if not p:
+            return _ng("planner.dates.get", "NOT_FOUND", "planner sheet not found")
+        return _ok("planner.dates.get", {"week_starts": list(p["week_starts"])})
+
+    def planner_dates_set(self, req: dict) -> dict:
+        p = self._planner(req)
+        if not p:
+            return _ng("planner.dates.set", "NOT_FOUND", "planner sheet not found")
+        if not req.get("start_date"):
+            return _ng("planner.dates.set", "BAD_REQUEST", "start_date is required (YYYY-MM-DD)")
+        try:
+            y, m, d = (int(x) for x in str(req["start_date"]).split("-"))
+        except ValueError:
+            return _ng("planner.dates.set", "BAD_DATE", "invalid start_date")
+        p["week_starts"][0] = f"{y}/{m:02d}/{d:02d}"
+        return _ok("planner.dates.set", {"updated": True})
+
+    def planner_metrics_get(self, req: dict) -> dict:
+        p = self._planner(req)
+        if not p:
+            return _ng("planner.metrics.get", "NOT_FOUND", "planner sheet not found")
+        want = parse_weeks(req.get("weeks"))
+        weeks = []
+        for wi, m in enumerate(WEEK_COLS, start=1):
+            if want and wi not in want:
+                continue
+            rows = p["metrics"].get(wi, {})
+            items = [{"row": r, **rows.get(r, {"weekly_minutes": None, "unit_load": None, "guideline_amount": None})} for r in PLANNER_ROWS]
+            weeks.append({"week_index": wi, "column_time": m["time"], "column_unit": m["unit"], "column_guide": m["guide"], "items": items})
+        return _versioned("planner.metrics.get", req, {"weeks": weeks})
+
+    def planner_plan_get(self, req: dict) -> dict:
+        p = self._planner(req)
+        if not p:
+            return _ng("planner.plan.get", "NOT_FOUND", "planner sheet not found")
+        want = parse_weeks(req.get("weeks"))
+        weeks = []
+        for wi, m in enumerate(WEEK_COLS, start=1):
+            if want and wi not in want:
+                continue
+            items = [{"row": r, "plan_text": p["plans"].get((wi, r), "")} for r in PLANNER_ROWS]
+            weeks.append({"week_index": wi, "column": m["plan"], "items": items})
+        return _versioned("planner.plan.get", req, {"weeks": weeks})
+
+    def planner_plan_set(self, req: dict) -> dict:
+        p = self._planner(req)
+        if not p:
+            return _ng("planner.plan.set", "NOT_FOUND", "planner sheet not found")
+        by_book = {r["raw_code"][3:]: r["row"] for r in p["rows"]}
+        results = []
+        for it in req.get("items") or [req]:
+            wi = int(it.get("week_index") or 0)
+            row = it.get("row") if it.get("row") is not None else by_book.get(str(it.get("book_id") or ""))
+            if not (1 <= wi <= len(WEEK_COLS)) or row is None:
+                results.append({"week_index": wi, "row": row, "error": {"code": "BAD_REQUEST"}})
+                continue
+            key = (wi, int(row))
+            text = str(it.get("plan_text") or "")
+            if len(text) > 52:
+                results.append({"week_index": wi, "row": key[1], "error": {"code": "TOO_LONG"}})
+                continue
+            if p["plans"].get(key) and not it.get("overwrite"):
+                results.append({"week_index": wi, "row": key[1], "error": {"code": "ALREADY_EXISTS"}})
+                continue
+            p["plans"][key] = text
+            results.append({"week_index": wi, "row": key[1], "updated": True})
+        return _ok("planner.plan.set", {"updated": any(r.get("updated") for r in results), "results": results})
+
+    def planner_monthly_filter(self, req: dict) -> dict:
+        try:
+            yy, mm = int(str(req.get("year")).strip()), int(str(req.get("month")).strip())
+        except ValueError:
+            yy, mm = -1, -1
+        yy = yy - 2000 if yy >= 2000 else yy
+        if not (0 <= yy <= 99) or not (1 <= mm <= 12):
+            return _ng("planner.monthly.filter", "BAD_REQUEST", "year(2桁/4桁) と month(1..12) を指定してください")
+        p = self._planner(req)
+        if not p:
+            return _ng("planner.monthly.filter", "NOT_FOUND", "monthly sheet not found (月間管理)")
+        items = [it for it in p["monthly"] if it["year"] == yy and it["month"] == mm]
+        return _ok("planner.monthly.filter", {"year": yy, "month": mm, "items": items, "count": len(items)})
+
+    # --- ルーター ---
+    def batch(self, req: dict) -> dict:
+        subs = req.get("requests")
+        if not isinstance(subs, list):
+            return _ng("batch", "BAD_REQUEST", "requests[] is required")
+        if len(subs) > 50:
+            return _ng("batch", "BAD_REQUEST", "too many requests (max 50)")
+        results = [_ng("batch", "BAD_REQUEST", "nested batch is not allowed") if (s or {}).get("op") == "batch" else self.route(s) for s in subs]
+        return _ok("batch", {"results": results, "count": len(results)})
+
+    def route(self, req: dict[str, Any]) -> dict:
+        op = str(req.get("op") or "")
+        with self._lock:
+            self.calls[op] += 1
+        if op == "batch" and self.supports_batch:
+            return self.batch(req)
+        h = self.handlers.get(op)
+        if h is None:
+            return _ng(op or "unknown", "UNKNOWN_OP", "Unsupported op")
+        key = str(req.get("idempotency_key") or "")
+        if not (key and op in KEYED_WRITES and self.supports_idempotency):
+            return h(req)
+        slot = f"{op}:{key}"
+        with self._lock:
+            if slot in self.idempotency:
+                saved = self.idempotency[slot]
+                if saved is None:
+                    return _ng(op, "IN_PROGRESS", "a request with the same idempotency_key is still running")
+                self.replays += 1
+                return {**saved, "meta": {**(saved.get("meta") or {}), "idempotency_key": key, "replayed": True}}
+            self.idempotency[slot] = None
+        try:
+            res = h(req)
+        except BaseException:
+            with self._lock:
+                self.idempotency.pop(slot, None)
+            raise
+        with self._lock:
+            self.idempotency[slot] = res
+        return {**res, "meta": {**(res.get("meta") or {}), "idempotency_key": key, "replayed": False}}
+
+    def reset_calls(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.requests = 0
+            self.exec_api_requests = 0
+            self.student_resolutions = 0
+            self.peak_in_flight = self.in_flight
+
+    def delay_for(self, req: dict) -> float:
+        if req.get("op") == "batch":
+            ops = [str(s.get("op") or "") for s in req.get("requests") or [] if isinstance(s, dict)]
+        else:
+            ops = [str(req.get("op") or "")]
+        delay = self.overhead + sum(self.latency.get(op, 0.0) for op in ops)
+        if delay and self.jitter:
+            with self._lock:
+                delay *= 1 + self._rnd.uniform(-self.jitter, self.jitter)
+        return max(0.0, delay)
+
+    def app(self) -> Starlette:
+        async def exec_(request: Request) -> Response:
+            if request.method == "POST":
+                try:
+                    req = json.loads((await request.body()) or b"{}")
+                except ValueError:
+                    return JSONResponse(_ng("unknown", "UNCAUGHT", "bad json"))
+            else:
+                req = {}
+                for k, v in request.query_params.multi_items():
+                    if k in req:
+                        req[k] = (req[k] if isinstance(req[k], list) else [req[k]]) + [v]
+                    else:
+                        req[k] = v
+            delay = self.delay_for(req)
+            with self._lock:
+                self.requests += 1
+                fault = self.faults.pop(0) if self.faults else None
+            if isinstance(fault, int):
+                return Response("<html>error</html>", status_code=fault, media_type="text/html")
+            if fault == "html":
+                return Response("<html>Google Apps Script error</html>", media_type="text/html")
+            if isinstance(fault, float):
+                delay += fault
+            res = await self._execute(req, delay)
+            if fault == "lost":
+                return Response("<html>Gateway Timeout</html>", status_code=504, media_type="text/html")
+            key = uuid.uuid4().hex
+            with self._lock:
+                self._pending[key] = res
+            return RedirectResponse(f"/echo?key={key}", status_code=302)
+
+        async def echo(request: Request) -> Response:
+            if self.redirect_delay:
+                await asyncio.sleep(self.redirect_delay)
+            with self._lock:
+                res = self._pending.pop(request.query_params.get("key", ""), None)
+            if res is None:
+                return Response("<html>expired</html>", media_type="text/html")
+            return Response(json.dumps(res, ensure_ascii=False), media_type="application/json")
+
+        async def token(request: Request) -> Response:
+            # oauth2.googleapis.com/token 相当（refresh_token / jwt-bearer のどちらも受ける）
+            form = await request.form()
+            grant = str(form.get("grant_type") or "")
+            if grant not in ("refresh_token", "urn:ietf:params:oauth:grant-type:jwt-bearer"):
+                return JSONResponse({"error": "unsupported_grant_type"}, status_code=400)
+            tok = f"at-{uuid.uuid4().hex}"
+            with self._lock:
+                self.token_grants.append(grant)
+                self.access_tokens.add(tok)
+            return JSONResponse({"access_token": tok, "expires_in": self.token_ttl, "token_type": "Bearer"})
+
+        async def scripts_run(request: Request) -> Response:
+            # script.googleapis.com/v1/scripts/{id}:run 相当。リダイレクトなしで結果を返す
+            auth = request.headers.get("authorization", "")
+            if auth.removeprefix("Bearer ") not in self.access_tokens:
+                return JSONResponse({"error": {"code": 401, "message": "Request had invalid authentication credentials.", "status": "UNAUTHENTICATED"}}, status_code=401)
+            body = json.loads((await request.body()) or b"{}")
+            if body.get("function") != "api":
+                return JSONResponse({"done": True, "error": {"code": 3, "message": "ScriptError", "details": [
+                    {"@type": "type.googleapis.com/google.apps.script.v1.ExecutionError", "errorMessage": f"Script function not found: {body.get('function')}", "errorType": "ScriptError"}]}})
+            req = (body.get("parameters") or [{}])[0]
+            with self._lock:
+                self.requests += 1
+                self.exec_api_requests += 1
+            res = await self._execute(req, self.delay_for(req))
+            return JSONResponse({"done": True, "response": {"@type": "type.googleapis.com/google.apps.script.v1.ExecutionResponse", "result": res}})
+
+        # googleusercontent と同じく Accept-Encoding: gzip なら大きな本文を圧縮して返す
+        return Starlette(routes=[
+            Route("/exec", exec_, methods=["GET", "POST"]),
+            Route("/echo", echo, methods=["GET"]),
+            Route("/token", token, methods=["POST"]),
+            Route("/v1/scripts/{script_id}:run", scripts_run, methods=["POST"]),
+        ], middleware=[Middleware(GZipMiddleware, minimum_size=1024)])
+
+    async def _execute(self, req: dict, delay: float) -> dict:
+        """op の実行（処理時間の待ちと処理中数の記録込み）。WebApp と Execution API で共通。"""
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            if delay:
+                await asyncio.sleep(delay)
+            res = self.route(req)
+            if isinstance(req.get("trace_id"), str) and req["trace_id"]:
+                # index.ts の traced() 相当
+                res = {**res, "meta": {**(res.get("meta") or {}), "trace_id": req["trace_id"], "elapsed_ms": round(delay * 1000)}}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        return res
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@contextlib.contextmanager
+def serve(standin: Standin | None = None) -> Iterator[str]:
+    """スタンドインを別スレッドの uvicorn で起動し、EXEC_URL 相当の URL を返す。"""
+    import uvicorn
+
+    st = standin or Standin()
+    port = _free_port()
+    server = uvicorn.Server(uvicorn.Config(st.app(), host="127.0.0.1", port=port, log_level="warning"))
+    th = threading.Thread(target=server.run, daemon=True)
+    th.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}/exec"
+    finally:
+        server.should_exit = True
+        th.join(timeout=5)
+
+
+if __name__ == "__main__":
+    # 手元の EXEC_URL として常駐させる: uv run python -m apps.mcp.tests.gas_standin [port]
+    # STANDIN_OVERHEAD（秒）/ STANDIN_JITTER（割合）で遅延を付ける
+    import sys
+
+    import uvicorn
+
+    st = Standin(scaled_fixtures())
+    st.overhead = float(os.environ.get("STANDIN_OVERHEAD", "0") or 0)
+    st.jitter = float(os.environ.get("STANDIN_JITTER", "0") or 0)
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8765
+    print(f"EXEC_URL=http://127.0.0.1:{port}/exec", file=sys.stderr)
+    uvicorn.run(st.app(), host="127.0.0.1", port=port, log_level="warning")
@@ -0,0 +1,1233 @@
+"""オフライン回帰テスト（EXEC_URL 不要）。
+
+tests/gas_standin.py のスタンドインを起動し、サーバ関数を直接呼んで
+上流呼び出し回数や並行性などの性質を検証する。
+
+    uv run python apps/mcp/tests/run_local_tests.py
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../..")))
+
+from apps.mcp.tests.gas_standin import Standin, scaled_fixtures, serve  # noqa: E402
+
+
+def _ops(st: Standin) -> dict[str, int]:
+    """batch の外枠を除いた op ごとの呼び出し回数。"""
+    return {k: v for k, v in st.calls.items() if k != "batch"}
+
+
+async def test_plan_targets_fanout(st: Standin) -> None:
+    from apps.mcp.server import _CACHE, _SHEETS, planner_plan_targets
+
+    os.environ["BOOKS_MIRROR"] = "0"  # books.get を上流で数える
+    await _SHEETS.refresh()  # 生徒→シートの対応表はプロセスで 1 回だけ読む（以降の呼び出し回数に含めない）
+    _CACHE.clear()
+    st.reset_calls()
+    res = await planner_plan_targets(student_id="S001")
+    assert res.get("ok"), f"planner_plan_targets failed: {res}"
+    calls = _ops(st)
+    for op in ("planner.ids_list", "planner.dates.get", "planner.metrics.get", "planner.plan.get", "books.get"):
+        assert calls.get(op) == 1, f"{op} should be fetched exactly once: {calls}"
+    assert sum(calls.values()) == 5, f"unexpected upstream calls: {calls}"
+    assert st.requests == 2, f"planner reads should share one batch request (+books.get): {st.requests}"
+    print("plan_targets upstream calls:", calls, "http requests:", st.requests)
+
+    # 1 リクエストあたり 200ms の実行コスト → 単発 5 本の直列なら ~1.0s、batch + books.get なら ~0.4s
+    st.overhead = 0.2
+    _CACHE.clear()
+    try:
+        t0 = time.perf_counter()
+        res = await planner_plan_targets(student_id="S001")
+        dt = time.perf_counter() - t0
+    finally:
+        st.overhead = 0.0
+        os.environ.pop("BOOKS_MIRROR", None)
+    assert res.get("ok"), f"planner_plan_targets failed: {res}"
+    assert dt < 0.7, f"plan_targets should batch upstream reads (took {dt:.2f}s)"
+    print(f"plan_targets wall-clock with 200ms per upstream request: {dt:.2f}s")
+
+
+async def test_batch_fallback(st: Standin) -> None:
+    from apps.mcp import server
+
+    server._CACHE.clear()
+    st.supports_batch = False
+    server._BATCH_STATE["unsupported_until"] = 0.0
+    try:
+        st.reset_calls()
+        res = await server.planner_plan_targets(student_id="S001")
+        assert res.get("ok"), res
+        assert st.calls["batch"] == 1 and all(v == 1 for v in _ops(st).values()), dict(st.calls)
+        # 旧デプロイと分かったら以後は batch を試さない
+        server._CACHE.clear()
+        st.reset_calls()
+        res = await server.planner_plan_get(spreadsheet_id="SP001")
+        assert res.get("ok") and "batch" not in st.calls, dict(st.calls)
+    finally:
+        st.supports_batch = True
+        server._BATCH_STATE["unsupported_until"] = 0.0
+    print("batch fallback upstream calls:", dict(st.calls))
+
+
+async def test_plan_get_fanout(st: Standin) -> None:
+    from apps.mcp.server import _CACHE, planner_plan_get
+
+    _CACHE.clear()
+    st.reset_calls()
+    res = await planner_plan_get(spreadsheet_id="SP001")
+    assert res.get("ok"), f"planner_plan_get failed: {res}"
+    assert _ops(st) == {"planner.plan.get": 1, "planner.metrics.get": 1} and st.requests == 1, dict(st.calls)
+    print("plan_get upstream calls:", dict(st.calls))
+
+
+async def test_books_mirror(st: Standin) -> None:
+    from apps.mcp import server
+
+    server._BOOKS.invalidate()
+    st.reset_calls()
+    f = await server.books_find("青チャート")
+    assert f.get("ok") and f["data"]["top"]["book_id"] == "gMB017", f
+    g = await server.books_get(book_ids=["gET007", "gMB017", "nope"])
+    assert [b["id"] for b in g["data"]["books"]] == ["gET007", "gMB017"], g
+    g1 = await server.books_get(book_id="nope")
+    assert not g1.get("ok") and g1["error"]["code"] == "NOT_FOUND", g1
+    flt = await server.books_filter(where="subject='英語'", contains={"章の名前": "Part"})
+    assert [b["id"] for b in flt["data"]["books"]] == ["gET007"], flt
+    lst = await server.books_list(limit=2)
+    assert lst["data"]["count"] == 2, lst
+    assert dict(st.calls) == {"books.changed_since": 1}, f"mirror should load once: {dict(st.calls)}"
+
+    created = await server.books_create(title="テスト本", subject="数学", chapters=[{"title": "第1章", "range": {"start": 1, "end": 5}, "numbering": "問"}])
+    assert created.get("ok"), created
+    g2 = await server.books_get(book_id=created["data"]["id"])
+    assert g2.get("ok"), f"created book should be visible after invalidation: {g2}"
+    assert st.calls["books.changed_since"] == 2, dict(st.calls)
+    print("books mirror upstream calls:", dict(st.calls))
+
+
+async def test_response_cache(st: Standin) -> None:
+    from apps.mcp import server
+
+    server._CACHE.clear()
+    st.reset_calls()
+    for _ in range(3):
+        res = await server.planner_plan_get(spreadsheet_id="SP001")
+        assert res.get("ok"), res
+    ids = await server.planner_ids_list(student_id="S001")
+    assert ids.get("ok"), ids
+    assert _ops(st) == {"planner.plan.get": 1, "planner.metrics.get": 1, "planner.ids_list": 1}, dict(st.calls)
+    # 呼び出し側が応答を書き換えてもキャッシュは汚れない
+    res["data"]["weeks"][0]["items"][0]["plan_text"] = "dirty"
+    again = await server.planner_plan_get(spreadsheet_id="SP001")
+    assert again["data"]["weeks"][0]["items"][0]["plan_text"] == "例題1~10", again
+
+    # plan.set（シート指定）→ 同じシートの plan/metrics と、シート未学習の生徒指定エントリが破棄される
+    w = await server.planner_plan_create(items=[{"week_index": 3, "row": 4, "plan_text": "例題21~30"}], spreadsheet_id="SP001")
+    assert w.get("ok"), w
+    st.reset_calls()
+    after = await server.planner_plan_get(spreadsheet_id="SP001")
+    assert after["data"]["weeks"][2]["items"][0]["plan_text"] == "例題21~30", after
+    await server.planner_ids_list(student_id="S001")
+    assert _ops(st) == {"planner.plan.get": 1, "planner.metrics.get": 1, "planner.ids_list": 1}, dict(st.calls)
+
+    # students.update はプレビューでは破棄せず、確定で当該生徒を破棄
+    st.reset_calls()
+    await server.students_get(student_id="S001")
+    prev = await server.students_update(student_id="S001", updates={"名前": "テスト次郎"})
+    await server.students_get(student_id="S001")
+    assert st.calls["students.get"] == 1, dict(st.calls)
+    await server.students_update(student_id="S001", confirm_token=prev["data"]["confirm_token"])
+    got = await server.students_get(student_id="S001")
+    assert st.calls["students.get"] == 2 and got["data"]["student"]["name"] == "テスト次郎", (dict(st.calls), got)
+
+    stats = server._CACHE.stats()
+    assert stats["hits"] >= 4 and stats["invalidations"] >= 3, stats
+    print("response cache:", {k: stats[k] for k in ("entries", "bytes", "hits", "misses", "hit_ratio", "invalidations")})
+
+
+async def test_singleflight(st: Standin) -> None:
+    from apps.mcp import server
+
+    os.environ["RESPONSE_CACHE"] = "0"  # キャッシュではなく in-flight の集約だけを見る
+    before = server._FLIGHT.stats()["coalesced"]
+    st.reset_calls()
+    st.latency["planner.metrics.get"] = 0.2
+    try:
+        res = await asyncio.gather(*[server.planner_metrics_get(spreadsheet_id="SP001") for _ in range(5)])
+    finally:
+        st.latency.clear()
+        os.environ.pop("RESPONSE_CACHE", None)
+    assert all(r.get("ok") for r in res), res
+    assert dict(st.calls) == {"planner.metrics.get": 1}, dict(st.calls)
+    assert server._FLIGHT.stats()["coalesced"] - before == 4, server._FLIGHT.stats()
+    assert server._FLIGHT.in_flight() == 0
+    # 結果は複製なので、ひとつを書き換えても他に波及しない
+    res[0]["data"]["weeks"].clear()
+    assert res[1]["data"]["weeks"], res[1]
+    # 先行呼び出し元が（後続の再開より前に）結果を書き換えても後続には見えない
+    from apps.mcp.singleflight import SingleFlight
+
+    sf, gate = SingleFlight(), asyncio.Event()
+
+    async def fetch() -> dict:
+        await gate.wait()
+        return {"items": [{"a": 1}]}
+
+    async def leader() -> dict:
+        r = await sf.do("k", "planner.plan.get", fetch)
+        r["items"][0]["mut"] = True
+        return r
+
+    lead = asyncio.ensure_future(leader())
+    await asyncio.sleep(0)
+    follow = asyncio.ensure_future(sf.do("k", "planner.plan.get", fetch))
+    await asyncio.sleep(0)
+    gate.set()
+    lr, fr = await asyncio.gather(lead, follow)
+    assert lr["items"][0].get("mut") and fr == {"items": [{"a": 1}]}, (lr, fr)
+    assert sf.stats()["upstream_executions"] == 1 and sf.stats()["coalesced"] == 1 and sf.stats()["snapshots"] == 1
+    # 相乗りがなければ直列化せず、元の dict をそのまま返す
+    body = {"items": [{"a": 2}]}
+
+    async def solo() -> dict:
+        return body
+
+    assert await sf.do("k2", "planner.plan.get", solo) is body and sf.stats()["snapshots"] == 1
+    # 書き込みは束ねない
+    st.reset_calls()
+    await asyncio.gather(*[server._post({"op": "planner.plan.set", "spreadsheet_id": "SP001", "items": [{"week_index": 4, "row": 6, "plan_text": "問1~5", "overwrite": True}]}) for _ in range(2)])
+    assert st.calls["planner.plan.set"] == 2, dict(st.calls)
+    print("singleflight:", server._FLIGHT.stats())
+
+
+async def test_token_store(st: Standin) -> None:
+    """プレビュートークン: TTL 失効・件数上限（LRU）・SQLite 共有・propose→confirm。"""
+    import tempfile
+    from apps.mcp import server
+    from apps.mcp.token_store import SQLiteBackend, TokenStore
+
+    store = TokenStore(ttl=0.05, max_entries=2)
+    a = store.put({"n": 1})
+    time.sleep(0.06)
+    assert store.pop(a) is None
+    b, c = store.put({"n": 2}), store.put({"n": 3})
+    assert store.get(b) == {"n": 2}  # b を使ったので次に追い出されるのは c
+    d = store.put({"n": 4})
+    assert store.get(c) is None and store.get(d) == {"n": 4}
+    assert store.pop(b) == {"n": 2} and store.pop(b) is None
+    stats = store.stats()
+    assert (stats["outstanding"], stats["expired"], stats["evicted"], stats["confirmed"]) == (1, 1, 1, 1), stats
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "preview.sqlite3")
+        w1, w2 = TokenStore(SQLiteBackend(path), max_entries=2), TokenStore(SQLiteBackend(path), max_entries=2)
+        t1 = w1.put({"op": "planner.dates.set", "start_date": "2025-08-04"})
+        assert w2.pop(t1) == {"op": "planner.dates.set", "start_date": "2025-08-04"}  # 別ワーカーで確定
+        assert w1.pop(t1) is None
+        for i in range(3):
+            w1.put({"n": i})
+        stats = w2.stats()
+        assert (stats["backend"], stats["outstanding"], stats["issued"], stats["confirmed"], stats["evicted"]) == ("sqlite", 2, 4, 1, 1), stats
+
+    prev = await server.planner_dates_propose(start_date="2025-08-04", spreadsheet_id="SP001")
+    token = prev["data"]["confirm_token"]
+    st.reset_calls()
+    res = await server.planner_dates_confirm(token)
+    assert res.get("ok") and st.calls["planner.dates.set"] == 1, res
+    again = await server.planner_dates_confirm(token)
+    assert again["error"]["code"] == "CONFIRM_EXPIRED", again
+    print("token_store:", server._PREVIEWS.stats())
+
+
+async def test_plan_targets_bulk() -> None:
+    """在塾生全員の targets: 同時実行数の上限を守り、1 人の失敗が他に波及しない。"""
+    from apps.mcp import server
+
+    fx = scaled_fixtures(n_students=20)
+    del fx["planners"]["SP101"]  # S101（在塾）のシートだけ壊す
+    st = Standin(fx)
+    st.overhead = 0.1
+    active = [s for s in fx["students"] if s["row"]["Status"] == "在塾"]
+    prev_url = os.environ.get("EXEC_URL")
+    server._CACHE.clear()
+    server._BOOKS.invalidate()
+    with serve(st) as url:
+        os.environ["EXEC_URL"] = url
+        try:
+            t0 = time.perf_counter()
+            res = await server.planner_plan_targets_bulk(concurrency=6, summary_only=True)
+            elapsed = time.perf_counter() - t0
+        finally:
+            if prev_url is not None:
+                os.environ["EXEC_URL"] = prev_url
+            server._CACHE.clear()
+            server._BOOKS.invalidate()
+    assert res["ok"], res
+    data = res["data"]
+    assert data["count"] == len(active) and data["concurrency"] == 6, data
+    failed = [r for r in data["results"] if not r["ok"]]
+    assert [r["student_id"] for r in failed] == ["S101"], failed
+    assert all("targets" not in r and r["target_count"] >= 0 for r in data["results"] if r["ok"])
+    assert st.peak_in_flight <= 6, st.peak_in_flight
+    # 直列なら 1 人 0.1s 以上かかる
+    assert elapsed < len(active) * 0.1 * 0.6, elapsed
+    print(f"plan_targets_bulk: {data['count']} students in {elapsed:.2f}s (peak in-flight {st.peak_in_flight})")
+
+
+async def test_resilience(st: Standin) -> None:
+    """一時的な失敗: 読み取りは再試行・書き込みは再試行しない・ブレーカー・ヘッジ。"""
+    import httpx
+    from apps.mcp import server
+    from apps.mcp.resilience import Resilience
+
+    prev = server._RESILIENCE
+    os.environ["RESPONSE_CACHE"] = "0"
+    os.environ["SINGLEFLIGHT"] = "0"
+    try:
+        server._RESILIENCE = Resilience(base_delay=0.01, max_delay=0.02, cb_failures=3, cb_reset=0.2, seed=1)
+        # 503 と HTML を挟んでも読み取りは成功する
+        st.reset_calls()
+        st.faults[:] = [503, "html"]
+        res = await server.planner_dates_get(spreadsheet_id="SP001")
+        assert res.get("ok") and st.requests == 3, (res, st.requests)
+        assert server._RESILIENCE.retried["planner.dates.get"] == 2
+        # GET の経路も HTML（BAD_JSON）を一時的な失敗として再試行する
+        st.reset_calls()
+        st.faults[:] = ["html"]
+        res = await server._get({"op": "books.find", "query": "青チャ"})
+        assert res.get("ok") and st.requests == 2 and server._RESILIENCE.retried["books.find"] == 1, (res, st.requests)
+        # 冪等キーを受け付けない（旧デプロイの）GAS への書き込みは 1 回だけ（失敗はそのまま返す）
+        st.reset_calls()
+        st.faults[:] = [503]
+        st.supports_idempotency, confirmed = False, server._IDEMPOTENCY["confirmed"]
+        server._IDEMPOTENCY["confirmed"] = False
+        try:
+            await server._post({"op": "planner.plan.set", "spreadsheet_id": "SP001", "items": [{"week_index": 4, "row": 6, "plan_text": "問1~5", "overwrite": True}]})
+            raise AssertionError("write should not be retried")
+        except httpx.HTTPStatusError:
+            pass
+        finally:
+            st.supports_idempotency, server._IDEMPOTENCY["confirmed"] = True, confirmed
+        assert st.requests == 1 and "planner.plan.set" not in server._RESILIENCE.retried
+        # 連続失敗でブレーカーが開き、上流に投げずに CIRCUIT_OPEN。reset 後の試行で閉じる
+        server._RESILIENCE = Resilience(base_delay=0.01, max_delay=0.02, cb_failures=3, cb_reset=0.2, seed=1)
+        st.reset_calls()
+        st.faults[:] = [502] * 3
+        try:
+            await server.planner_dates_get(spreadsheet_id="SP001")
+        except httpx.HTTPStatusError:
+            pass
+        res = await server.planner_dates_get(spreadsheet_id="SP001")
+        assert res["error"]["code"] == "CIRCUIT_OPEN" and st.requests == 3, (res, st.requests)
+        await asyncio.sleep(0.25)
+        res = await server.planner_dates_get(spreadsheet_id="SP001")
+        assert res.get("ok") and server._RESILIENCE.breaker("webapp").state() == "closed", res
+        # ヘッジ: p95 を過ぎても返らない読み取りは 2 本目が勝つ
+        os.environ["HEDGE"] = "1"
+        server._RESILIENCE = Resilience(hedge_min=0.05, seed=1)
+        for _ in range(20):
+            await server.planner_metrics_get(spreadsheet_id="SP001")
+        st.faults[:] = [1.0]
+        t0 = time.perf_counter()
+        res = await server.planner_metrics_get(spreadsheet_id="SP001")
+        elapsed = time.perf_counter() - t0
+        assert res.get("ok") and elapsed < 0.5, elapsed
+        assert server._RESILIENCE.hedge_wins["planner.metrics.get"] == 1, server._RESILIENCE.stats()
+        print("resilience:", server._RESILIENCE.stats())
+    finally:
+        server._RESILIENCE = prev
+        st.faults.clear()
+        for k in ("RESPONSE_CACHE", "SINGLEFLIGHT", "HEDGE"):
+            os.environ.pop(k, None)
+
+
+async def test_metrics(st: Standin) -> None:
+    """MCP 経由のツール呼び出しが /metrics に出る（処理時間・上流リクエスト数・エラーコード・キャッシュ）。"""
+    import httpx
+    from apps.mcp import metrics, server
+
+    server._CACHE.clear()
+    before = metrics.TOOL_SECONDS.count(tool="planner_plan_get")
+    await server.mcp.call_tool("planner_plan_get", {"student_id": "S001"})
+    await server.mcp.call_tool("planner_plan_get", {"student_id": "S001"})
+    await server.mcp.call_tool("students_get", {"student_id": "S999"})
+    assert metrics.TOOL_SECONDS.count(tool="planner_plan_get") == before + 2
+    assert metrics.UPSTREAM_REQUESTS.value(target="webapp", op="batch", tool="planner_plan_get") >= 1
+    assert metrics.TOOL_ERRORS.value(tool="students_get", code="NOT_FOUND") >= 1
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.build_app()), base_url="http://test") as c:
+        r = await c.get("/metrics")
+    assert r.status_code == 200 and r.headers["content-type"].startswith("text/plain"), r
+    body = r.text
+    for needle in (
+        'cram_tool_duration_seconds_bucket{tool="planner_plan_get",le="+Inf"}',
+        'cram_tool_upstream_requests_count{tool="planner_plan_get"}',
+        'cram_upstream_duration_seconds_count{target="webapp",op="batch"}',
+        'cram_tool_errors_total{tool="students_get",code="NOT_FOUND"}',
+        'cram_cache_hit_ratio{cache="response"}',
+        'cram_tool_in_flight{tool="planner_plan_get"} 0',
+    ):
+        assert needle in body, needle
+    # 応答バイト数は METRICS_BYTES_SAMPLE 回に 1 回だけ測る（0 で測らない）
+    os.environ["METRICS_BYTES_SAMPLE"] = "3"
+    try:
+        b0 = metrics.TOOL_BYTES.count(tool="students_list")
+        c0 = int(metrics.TOOL_CALLS.value(tool="students_list"))
+        for _ in range(6):
+            await server.mcp.call_tool("students_list", {})
+        assert metrics.TOOL_BYTES.count(tool="students_list") - b0 == sum(1 for i in range(c0, c0 + 6) if i % 3 == 0)
+        os.environ["METRICS_BYTES_SAMPLE"] = "0"
+        b0 = metrics.TOOL_BYTES.count(tool="students_list")
+        await server.mcp.call_tool("students_list", {})
+        assert metrics.TOOL_BYTES.count(tool="students_list") == b0
+    finally:
+        os.environ.pop("METRICS_BYTES_SAMPLE", None)
+    print("metrics:", len(body.splitlines()), "lines")
+
+
+async def test_tracing(st: Standin) -> None:
+    """MCP 経由の呼び出しに trace_id が付き、上流 op の span がリングバッファから引ける。"""
+    import httpx
+    from apps.mcp import server, tracing
+
+    server._CACHE.clear()
+    tracing.clear()
+    await server.mcp.call_tool("planner_plan_get", {"student_id": "S001"})
+    recent = (await server.trace_get())["data"]["traces"]
+    assert recent and recent[0]["tool"] == "planner_plan_get", recent
+    tr = (await server.trace_get(trace_id=recent[0]["trace_id"]))["data"]
+    ups = [sp for sp in tr["spans"] if sp["kind"] == "upstream"]
+    assert [sp["name"] for sp in ups] == ["batch"], tr
+    post_many = next(sp for sp in tr["spans"] if sp["name"] == "post_many")
+    assert ups[0]["parent"] == post_many["id"] and ups[0]["ops"] == ["planner.plan.get", "planner.metrics.get"], tr
+    assert ups[0]["req_bytes"] > 0 and ups[0]["resp_bytes"] > 0 and "gas_ms" in ups[0], ups
+    assert tr["bytes_received"] == ups[0]["resp_bytes"]
+    # 直接呼び出し（MCP 外）はトレースしない・trace_id も送らない
+    await server.planner_dates_get(spreadsheet_id="SP001")
+    assert len(tracing.recent(100)) == 1
+    # ペイロードは LOG_PAYLOADS=1 のときだけ切り詰めて出す
+    import contextlib
+    import io
+    buf = io.StringIO()
+    os.environ.update({"LOG_PAYLOADS": "1", "LOG_PAYLOAD_MAX": "40"})
+    try:
+        with contextlib.redirect_stderr(buf):
+            tracing.log_request("HTTP POST", "http://x", {"op": "planner.plan.set", "items": [{"plan_text": "x" * 100}]})
+    finally:
+        os.environ.pop("LOG_PAYLOADS")
+        os.environ.pop("LOG_PAYLOAD_MAX")
+    assert "op=planner.plan.set" in buf.getvalue() and "...(+" in buf.getvalue(), buf.getvalue()
+    # HTTP 版は DEBUG_TRACES=1 のときだけ
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.build_app()), base_url="http://test") as c:
+        assert (await c.get("/debug/traces")).status_code == 404
+        os.environ["DEBUG_TRACES"] = "1"
+        try:
+            r = await c.get("/debug/traces", params={"trace_id": tr["trace_id"]})
+        finally:
+            os.environ.pop("DEBUG_TRACES")
+    assert r.json()["data"]["trace_id"] == tr["trace_id"], r.text
+    print("tracing:", recent[0])
+
+
+async def test_projection(st: Standin) -> None:
+    """fields/weeks で応答が縮み、不要な上流 op（metrics.get）と週の読み取りを省く。"""
+    import json
+    from apps.mcp import server
+
+    os.environ["BOOKS_MIRROR"] = "0"
+    server._CACHE.clear()
+    full = await server.books_get(book_ids=["gMB017", "gET007"])
+    slim = await server.books_get(book_ids=["gMB017", "gET007"], fields="title,subject")
+    assert slim.get("ok") and [set(b) for b in slim["data"]["books"]] == [{"id", "title", "subject"}] * 2, slim
+    assert len(json.dumps(slim)) < len(json.dumps(full)) / 2, (len(json.dumps(slim)), len(json.dumps(full)))
+    one = await server.books_get(book_id="gMB017", fields=["structure.chapters"])
+    assert set(one["data"]["book"]) == {"id", "structure"} and set(one["data"]["book"]["structure"]) == {"chapters"}, one
+    os.environ.pop("BOOKS_MIRROR")
+
+    stu = await server.students_get(student_ids=["S001", "S002"], fields=["name"])
+    assert stu.get("ok") and all(set(x) == {"id", "name"} for x in stu["data"]["students"]), stu
+
+    server._CACHE.clear()
+    st.reset_calls()
+    res = await server.planner_plan_get(student_id="S001", weeks=[2], fields=["plan_text"])
+    assert res.get("ok") and [w["week_index"] for w in res["data"]["weeks"]] == [2], res
+    assert all(set(it) == {"row", "plan_text"} for it in res["data"]["weeks"][0]["items"]), res
+    assert "planner.metrics.get" not in _ops(st), st.calls
+    server._CACHE.clear()
+    res = await server.planner_plan_get(student_id="S001", weeks="1,3")
+    assert [w["week_index"] for w in res["data"]["weeks"]] == [1, 3], res
+    assert "weekly_minutes" in res["data"]["weeks"][0]["items"][0], res
+    print("projection: books", len(json.dumps(full)), "→", len(json.dumps(slim)), "bytes")
+
+
+async def test_payload() -> None:
+    """上流には gzip を求め（HTTP_GZIP=0 で無圧縮）、books_list の limit は 1 パスで切り詰める。"""
+    from apps.mcp import fastjson, http_pool, server, tracing
+
+    st = Standin(scaled_fixtures(n_books=300))
+    prev_url = os.environ.get("EXEC_URL")
+    os.environ["BOOKS_MIRROR"] = "0"
+    with serve(st) as url:
+        os.environ["EXEC_URL"] = url
+        try:
+            sizes = {}
+            for gz in ("1", "0"):
+                os.environ["HTTP_GZIP"] = gz
+                await http_pool.close_client()
+                tracing.clear()
+                res = await server.mcp.call_tool("books_list", {})
+                assert res, res
+                up = next(sp for sp in tracing.find(tracing.recent(1)[0]["trace_id"])["spans"] if sp["kind"] == "upstream")
+                sizes[gz] = (up["wire_bytes"], up["resp_bytes"])
+            assert sizes["1"][0] * 5 < sizes["1"][1], sizes  # gzip で転送量が数分の 1 に
+            assert sizes["0"][0] >= sizes["0"][1], sizes
+            lst = await server.books_list(limit=7)
+            assert lst["data"]["count"] == 7 and set(lst["data"]["books"][0]) == {"id", "subject", "title"}, lst
+        finally:
+            os.environ.pop("HTTP_GZIP")
+            os.environ.pop("BOOKS_MIRROR")
+            await http_pool.close_client()
+            if prev_url is not None:
+                os.environ["EXEC_URL"] = prev_url
+    obj = {"a": "日本語", "n": [1, 2.5, None, True]}
+    assert fastjson.loads(fastjson.dumps(obj)) == obj and fastjson.loads(fastjson.dumps(obj).decode("utf-8")) == obj
+    try:
+        fastjson.loads(b"<html>")
+        raise AssertionError("bad json must raise")
+    except ValueError:
+        pass
+    print("payload: wire/body bytes", sizes, "json backend:", fastjson.backend())
+
+
+async def test_versions(st: Standin) -> None:
+    """キャッシュ切れ後の planner 読み取りは版を送り、変わっていなければ本文なし（not_modified）で済ませる。"""
+    from apps.mcp import server, tracing
+
+    server._CACHE.clear()
+    server._VERSIONS.clear()
+    first = await server.planner_plan_get(student_id="S001")
+    assert first.get("ok"), first
+    server._CACHE.clear()  # TTL 切れ相当
+    nm0 = server._VERSIONS.stats()["not_modified"]
+    st.reset_calls()
+    tracing.clear()
+    await server.mcp.call_tool("planner_plan_get", {"student_id": "S001"})
+    again = await server.planner_plan_get(student_id="S001")  # キャッシュ済み
+    assert again == first, "not_modified は手元の応答と同じ内容を返す"
+    up = next(sp for sp in tracing.find(tracing.recent(1)[0]["trace_id"])["spans"] if sp["kind"] == "upstream")
+    assert up["resp_bytes"] < 1000, up  # 本文なし
+    assert server._VERSIONS.stats()["not_modified"] - nm0 == 2, server._VERSIONS.stats()  # plan.get + metrics.get
+    # シートが変われば版が変わり、新しい本文を受け取る
+    st.fx["planners"]["SP001"]["plans"][(1, 4)] = "例題1~99"
+    server._CACHE.clear()
+    fresh = await server.planner_plan_get(student_id="S001")
+    items = {it["row"]: it for it in fresh["data"]["weeks"][0]["items"]}
+    assert items[4]["plan_text"] == "例題1~99", items[4]
+    # 送信中に並行の読み取りが新しい版を覚えた後の not_modified は、版なしで 1 回だけ取り直す（STALE_VERSION にしない）
+    req = {"op": "planner.plan.get", "spreadsheet_id": "SP001"}
+    body = await server._http_post(req)
+    server._VERSIONS.resolve(req, body)
+    sent: list[bool] = []
+
+    async def send(r: dict) -> dict:
+        sent.append("if_none_match" in r)
+        if len(sent) == 1:
+            server._VERSIONS.resolve(req, {**body, "data": {**body["data"], "version": "newer"}})
+            return {"ok": True, "op": "planner.plan.get", "data": {"not_modified": True, "version": body["data"]["version"]}}
+        return await server._http_post(r)
+
+    stale0 = server._VERSIONS.stats()["stale_refetches"]
+    res = await server._fetch_versioned(req, send)
+    assert res.get("ok") and res["data"]["weeks"] and sent == [True, False], (res, sent)
+    assert server._VERSIONS.stats()["stale_refetches"] - stale0 == 1
+    # VERSIONED_READS=0 なら版を送らない
+    os.environ["VERSIONED_READS"] = "0"
+    try:
+        assert "if_none_match" not in server._VERSIONS.conditional({"op": "planner.plan.get", "student_id": "S001"})
+    finally:
+        os.environ.pop("VERSIONED_READS")
+    print("versions:", server._VERSIONS.stats())
+
+
+async def test_delta_sync(st: Standin) -> None:
+    """マスターの差分同期: 初回は全件（reset）、以降は追加/変更/削除の行だけ。SQLite の写しは再起動後も使える。"""
+    import tempfile
+
+    from apps.mcp import master_sync, server
+    from apps.mcp.singleflight import READ_OPS
+
+    fetch = lambda req: server._post(req)  # noqa: E731
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, "masters.sqlite3")
+        books = master_sync.MasterSync("books", fetch, master_sync.SQLiteCopy("books", path))
+        studs = master_sync.MasterSync("students", fetch, master_sync.MemoryCopy("students"))
+        r1 = await books.sync()
+        assert r1["ok"] and r1["data"]["reset"] and r1["data"]["count"] == len(st.fx["books"]), r1
+        r1 = await studs.sync()
+        assert r1["data"]["reset"] and r1["data"]["count"] == len(st.fx["students"]), r1
+        cursor = books.copy.cursor
+        assert (await books.sync())["data"] == {"kind": "books", "reset": False, "upserts": 0, "deletes": 0, "count": len(st.fx["books"])}
+        assert books.copy.cursor == cursor, "変更がなければカーソルは同じ"
+
+        # 追加・変更・削除
+        st.fx["books"].append({**st.fx["books"][0], "id": "gTMP900", "title": "差分テスト本"})
+        gmb = next(b for b in st.fx["books"] if b["id"] == "gMB017")
+        gmb_title = gmb["title"]
+        gmb["title"] = gmb_title + "（改訂）"
+        dropped = st.fx["books"].pop(next(i for i, b in enumerate(st.fx["books"]) if b["id"] == "gET007"))
+        st.fx["students"][0]["name"] += "（改）"
+        try:
+            st.reset_calls()
+            r2 = await books.sync()
+            assert (r2["data"]["reset"], r2["data"]["upserts"], r2["data"]["deletes"]) == (False, 2, 1), r2
+            assert dict(st.calls) == {"books.changed_since": 1}, dict(st.calls)
+            ids = [b["id"] for b in books.rows()]
+            assert "gTMP900" in ids and "gET007" not in ids and ids[-1] == "gTMP900", ids
+            assert next(b for b in books.rows() if b["id"] == "gMB017")["title"].endswith("（改訂）")
+            r2 = await studs.sync()
+            assert (r2["data"]["upserts"], r2["data"]["deletes"]) == (1, 0), r2
+            assert studs.rows()[0]["name"].endswith("（改）")
+
+            # SQLite の写しはカーソルごと復元され、続きから差分で追いつける
+            again = master_sync.SQLiteCopy("books", path)
+            assert again.cursor == books.copy.cursor and [b["id"] for b in again.rows()] == ids
+            assert (await master_sync.MasterSync("books", fetch, again).sync())["data"]["reset"] is False
+        finally:
+            st.fx["books"].pop()
+            gmb["title"] = gmb_title
+            st.fx["books"].append(dropped)
+            st.fx["students"][0]["name"] = st.fx["students"][0]["name"].removesuffix("（改）")
+
+        # 不明/期限切れのカーソル → 全件で置き換え
+        st.delta_cursors.clear()
+        r3 = await books.sync()
+        assert r3["data"]["reset"] and sorted(b["id"] for b in books.rows()) == sorted(b["id"] for b in st.fx["books"]), r3
+
+    # changed_since のない旧デプロイ → 全件取得に戻る
+    handler = st.handlers.pop("students.changed_since")
+    try:
+        old = master_sync.MasterSync("students", fetch, master_sync.MemoryCopy("students"))
+        r4 = await old.sync()
+        assert r4["ok"] and r4["data"]["count"] == len(st.fx["students"]) and not old.delta_supported, r4
+        assert old.stats()["full_loads"] == 1
+    finally:
+        st.handlers["students.changed_since"] = handler
+    assert "books.changed_since" in READ_OPS
+
+    res = await server.masters_sync(kind="nope")
+    assert not res["ok"] and res["error"]["code"] == "BAD_INPUT", res
+    res = await server.masters_sync()
+    assert res["ok"] and set(res["data"]) == {"books", "students"}, res
+    print("delta sync:", books.stats())
+
+
+async def test_exec_transport(st: Standin) -> None:
+    """Execution API 経路: トークンの使い回しと 401 での取り直し、実測で速い経路の選択、失敗時の WebApp 戻り（読み取りのみ）。"""
+    import httpx
+
+    from apps.mcp import exec_api, server
+
+    base = os.environ["EXEC_URL"].removesuffix("/exec")
+    env = {"SCRIPT_ID": "standin", "EXEC_API_BASE": base, "GAS_TOKEN_URL": base + "/token",
+           "GAS_OAUTH_CLIENT_ID": "cid", "GAS_OAUTH_CLIENT_SECRET": "secret", "GAS_OAUTH_REFRESH_TOKEN": "rt"}
+    prev = {k: os.environ.get(k) for k in [*env, "EXEC_TRANSPORT"]}
+    os.environ.update(env)
+    exec_api.set_tokens(None)
+    server._ROUTER.reset()
+    req = {"op": "books.get", "book_id": "gMB017"}
+    try:
+        assert exec_api.available() and exec_api.get_tokens().kind == "refresh_token"
+        # 計測が足りない経路を先に試す: Execution API から。トークンは 1 回だけ取得して使い回す
+        st.reset_calls()
+        st.token_grants.clear()
+        for _ in range(3):
+            res = await server._http_post(req)
+            assert res.get("ok") and res["data"]["book"]["id"] == "gMB017", res
+        assert st.exec_api_requests == 3 and st.token_grants == ["refresh_token"], (st.exec_api_requests, st.token_grants)
+        # 失効（401）→ 捨てて 1 回だけ取り直す
+        st.access_tokens.clear()
+        assert (await exec_api.call({"op": "ping"}))["ok"]
+        assert exec_api.get_tokens().stats()["invalidations"] == 1 and len(st.token_grants) == 2
+
+        # WebApp の 302 の 2 ホップ目が遅い → 計測後は Execution API を選ぶ
+        st.redirect_delay = 0.03
+        for _ in range(3):
+            await server._http_post(req)
+        lat = server._ROUTER.stats()["ops"]["books.get"]
+        assert lat["webapp"]["n"] == 3 and lat["exec_api"]["ewma_ms"] < lat["webapp"]["ewma_ms"], lat
+        st.reset_calls()
+        for _ in range(5):
+            await server._http_post(req)
+        assert st.exec_api_requests == 5 and st.requests == 5, (st.exec_api_requests, st.requests)
+        # 固定
+        os.environ["EXEC_TRANSPORT"] = "webapp"
+        st.reset_calls()
+        await server._http_post(req)
+        assert st.exec_api_requests == 0 and st.requests == 1
+        os.environ.pop("EXEC_TRANSPORT")
+
+        # Execution API の失敗: 読み取りは WebApp に投げ直し、しばらく WebApp に固定
+        os.environ["EXEC_API_BASE"] = base + "/gone"
+        fb0 = server._ROUTER.fallbacks
+        res = await server._http_post(req)
+        assert res.get("ok") and server._ROUTER.fallbacks == fb0 + 1, server._ROUTER.stats()
+        assert server._ROUTER.choose("books.get", True) == "webapp"
+        # 書き込みは投げ直さない（二重実行を避ける）
+        server._ROUTER.reset()
+        st.reset_calls()
+        try:
+            await server._http_post({"op": "books.delete", "book_id": "nope"})
+            raise AssertionError("write must not fall back to the WebApp")
+        except httpx.HTTPStatusError:
+            pass
+        assert "books.delete" not in st.calls, dict(st.calls)
+        # ただし送る前の失敗（トークンが取れない）は GAS で実行されていないので、書き込みも WebApp に投げ直す
+        os.environ["EXEC_API_BASE"] = base
+        os.environ["GAS_TOKEN_URL"] = base + "/gone"
+        exec_api.set_tokens(None)
+        server._ROUTER.reset()
+        st.reset_calls()
+        fb0 = server._ROUTER.fallbacks
+        res = await server._http_post({"op": "books.delete", "book_id": "nope"})
+        assert st.calls["books.delete"] == 1 and st.exec_api_requests == 0 and server._ROUTER.fallbacks == fb0 + 1, (res, dict(st.calls))
+        os.environ["GAS_TOKEN_URL"] = base + "/token"
+        exec_api.set_tokens(None)
+        server._ROUTER.reset()
+        # PyJWT がなければサービスアカウント鍵があっても Execution API は使わない
+        saved_jwt = sys.modules.get("jwt")
+        sys.modules["jwt"] = None  # type: ignore[assignment]  import jwt が ImportError になる
+        try:
+            sa = exec_api.TokenSource("service_account", sa_key={"client_email": "svc@example.iam.gserviceaccount.com"})
+            exec_api.set_tokens(sa)
+            assert not exec_api.available() and "PyJWT" in sa.stats()["error"], sa.stats()
+            assert server._ROUTER.choose("books.delete", exec_api.available()) == "webapp"
+        finally:
+            if saved_jwt is None:
+                sys.modules.pop("jwt", None)
+            else:
+                sys.modules["jwt"] = saved_jwt
+            exec_api.set_tokens(None)
+
+        # サービスアカウント鍵（JWT bearer）。署名には PyJWT[crypto] が要る
+        try:
+            import jwt  # noqa: F401
+            from cryptography.hazmat.primitives import serialization
+            from cryptography.hazmat.primitives.asymmetric import rsa
+        except ImportError:
+            print("exec transport: PyJWT[crypto] not installed; service-account grant not tested")
+        else:
+            pem = rsa.generate_private_key(public_exponent=65537, key_size=2048).private_bytes(
+                serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()).decode()
+            sa = exec_api.TokenSource("service_account", sa_key={"client_email": "svc@example.iam.gserviceaccount.com", "private_key": pem},
+                                      subject="owner@example.com", token_url=base + "/token")
+            assert (await sa.token()).startswith("at-") and st.token_grants[-1].endswith("jwt-bearer")
+            assert await sa.token() == await sa.token() and sa.stats()["refreshes"] == 1
+        print("exec transport:", {k: v for k, v in server._ROUTER.stats().items() if k != "ops"})
+    finally:
+        for k, v in prev.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        exec_api.set_tokens(None)
+        server._ROUTER.reset()
+        st.redirect_delay = 0.0
+
+
+async def test_planner_sheets(st: Standin) -> None:
+    """planner.* には対応表から spreadsheet_id を添え、GAS 側で生徒シートから探させない。生徒の更新で対応を捨てる。"""
+    from apps.mcp import server
+
+    server._SHEETS.forget()
+    server._CACHE.clear()
+    st.reset_calls()
+    res = await server.planner_ids_list(student_id="S001")
+    assert res.get("ok"), res
+    assert st.student_resolutions == 0, "spreadsheet_id を添えていれば GAS は生徒シートを読まない"
+    assert st.calls["students.changed_since"] == 1, dict(st.calls)
+    # 以降は対応表だけで済む（生徒マスターも読まない）
+    server._CACHE.clear()
+    st.reset_calls()
+    await server.planner_plan_get(student_id="S001")
+    await server.planner_dates_get(student_id="S001")
+    assert st.student_resolutions == 0 and "students.changed_since" not in st.calls, dict(st.calls)
+    # 対応の分からない生徒は student_id だけで送る（GAS が解決）
+    res = await server.planner_ids_list(student_id="S999")
+    assert not res.get("ok") and st.student_resolutions == 1, res
+
+    # 生徒の planner_sheet_id を変えたら捨てて読み直す
+    s1 = next(s for s in st.fx["students"] if s["id"] == "S001")
+    prev, prev_row = s1["planner_sheet_id"], dict(s1["row"])
+    st.fx["planners"]["SP900"] = st.fx["planners"][prev]
+    try:
+        prop = await server.students_update(student_id="S001", updates={"planner_sheet_id": "SP900"})
+        conf = await server.students_update(student_id="S001", confirm_token=prop["data"]["confirm_token"])
+        assert conf.get("ok"), conf
+        assert "S001" in server._SHEETS._stale
+        st.reset_calls()
+        await server.planner_ids_list(student_id="S001")
+        assert await server._SHEETS.resolve("S001") == "SP900" and st.student_resolutions == 0, dict(st.calls)
+    finally:
+        s1["planner_sheet_id"], s1["row"] = prev, prev_row
+        st.fx["planners"].pop("SP900")
+        server._SHEETS.forget()
+
+    # PLANNER_SHEET_MAP=0 なら従来どおり
+    os.environ["PLANNER_SHEET_MAP"] = "0"
+    try:
+        server._CACHE.clear()
+        st.reset_calls()
+        await server.planner_ids_list(student_id="S001")
+        assert st.student_resolutions == 1, st.student_resolutions
+    finally:
+        os.environ.pop("PLANNER_SHEET_MAP")
+
+    # 読み込みに失敗したら、forget() された生徒でも再試行までは読み直さない（GAS が落ちている間に毎回同期しない）
+    from apps.mcp import master_sync
+    loads = []
+
+    async def load() -> list[dict] | None:
+        loads.append(1)
+        return [{"id": "S001", "planner_sheet_id": "SP001"}] if len(loads) == 1 else None
+
+    sheets = master_sync.PlannerSheets(load, ttl=600.0)
+    assert await sheets.resolve("S001") == "SP001"
+    sheets.forget("S001")
+    for _ in range(5):
+        assert await sheets.resolve("S001") is None
+    assert len(loads) == 2 and sheets.stats()["load_failures"] == 1, sheets.stats()
+    sheets._retry_at = 0.0  # 再試行の時刻が来た
+    await sheets.resolve("S001")
+    assert len(loads) == 3 and sheets.stats()["load_failures"] == 2, sheets.stats()
+    print("planner sheets:", server._SHEETS.stats())
+
+
+async def test_plan_create_bulk(st: Standin) -> None:
+    """複数生徒の計画をシートごとにまとめて書く。週数は dates で確かめ、同じセルの重なりは順に効かせる。"""
+    from apps.mcp import server
+
+    saved = {k: dict(p["plans"]) for k, p in st.fx["planners"].items()}
+    server._CACHE.clear()
+    await server._SHEETS.refresh()
+    st.reset_calls()
+    try:
+        res = await server.planner_plan_create_bulk(items=[
+            {"student_id": "S001", "week_index": 3, "row": 5, "plan_text": "No.201~300"},
+            {"student_id": "S001", "week_index": 5, "row": 4, "plan_text": "範囲外"},          # SP001 は 4 週
+            {"spreadsheet_id": "SP001", "week_index": 3, "row": 5, "plan_text": "No.201~250", "overwrite": True},
+            {"student_id": "S002", "week_index": 5, "book_id": "gET007", "plan_text": "No.401~500"},
+            {"student_id": "S002", "week_index": 1, "row": 4, "plan_text": "あ" * 53},
+            {"spreadsheet_id": "SP404", "week_index": 1, "row": 4, "plan_text": "x"},
+            {"week_index": 1, "row": 4, "plan_text": "x"},
+        ], concurrency=2)
+        assert res.get("ok"), res
+        d = res["data"]
+        assert d["count"] == 3 and d["ok_count"] == 2 and d["error_count"] == 1, d
+        assert d["guidance_digest"] and [r["index"] for r in d["rejected"]] == [6], d
+        by = {e["spreadsheet_id"]: e for e in d["sheets"]}
+        sp1, sp2, bad = by["SP001"], by["SP002"], by["SP404"]
+        assert sp1["week_count"] == 4 and [r["index"] for r in sp1["rejected"]] == [1], sp1
+        assert sp1["submitted"] == 2 and sp1["updated"] == 2, sp1
+        # 同じセルは後の item が勝つ（呼び出しを分けて順に送る）
+        assert st.fx["planners"]["SP001"]["plans"][(3, 5)] == "No.201~250"
+        assert sp2["week_count"] == 5 and sp2["updated"] == 1 and sp2["rejected"][0]["error"]["code"] == "TOO_LONG", sp2
+        assert st.fx["planners"]["SP002"]["plans"][(5, 5)] == "No.401~500"
+        assert bad["error"]["code"] == "NOT_FOUND", bad
+        assert st.calls["planner.plan.set"] == 3 and st.student_resolutions == 0, dict(st.calls)
+        # 週数の確認はキャッシュ済みの dates を使う
+        st.reset_calls()
+        res = await server.planner_plan_create_bulk(items=[{"student_id": "S001", "week_index": 4, "row": 6, "plan_text": "問1~5"}])
+        assert res["data"]["ok_count"] == 1 and "planner.dates.get" not in st.calls, dict(st.calls)
+    finally:
+        for k, plans in saved.items():
+            st.fx["planners"][k]["plans"] = plans
+    print("plan create bulk:", {k: d[k] for k in ("count", "ok_count", "concurrency", "elapsed_ms")})
+
+
+async def test_idempotency(st: Standin) -> None:
+    """書き込みの冪等キー: 応答が失われた書き込みは同じキーで送り直し、GAS は実行せずに最初の応答を返す。"""
+    import httpx
+    from apps.mcp import server
+    from apps.mcp.resilience import Resilience
+
+    prev = server._RESILIENCE
+    server._RESILIENCE = Resilience(base_delay=0.02, max_delay=0.05, seed=1)
+    books, students = list(st.fx["books"]), list(st.fx["students"])
+    saved_plans = dict(st.fx["planners"]["SP001"]["plans"])
+    try:
+        # 旧デプロイ（キーを無視）と分かる前は、書き込みは送り直さない
+        server._IDEMPOTENCY["confirmed"] = False
+        st.supports_idempotency = False
+        st.reset_calls()
+        st.faults[:] = ["lost"]
+        try:
+            await server._post({"op": "planner.plan.set", "spreadsheet_id": "SP001", "items": [{"week_index": 4, "row": 6, "plan_text": "問1~5", "overwrite": True}]})
+            raise AssertionError("write to a deployment without idempotency should not be retried")
+        except httpx.HTTPStatusError:
+            pass
+        assert st.requests == 1 and not server._IDEMPOTENCY["confirmed"]
+        # 応答の meta.idempotency_key でキーを受け付けると分かる
+        st.supports_idempotency = True
+        res = await server.planner_plan_create(items=[{"week_index": 4, "row": 6, "plan_text": "問1~6"}], spreadsheet_id="SP001", overwrite=True)
+        assert res.get("ok") and server._IDEMPOTENCY["confirmed"], res
+
+        # 作成後に応答が失われても、送り直しは最初の応答を返し 1 冊だけ作られる
+        st.reset_calls()
+        st.faults[:] = ["lost"]
+        res = await server.books_create(title="冪等テスト", subject="数学", chapters=[{"title": "第1章", "range": {"start": 1, "end": 10}, "numbering": "問"}])
+        assert res.get("ok") and res["meta"]["replayed"] is True, res
+        assert st.calls["books.create"] == 2 and st.replays == 1, dict(st.calls)
+        assert sum(1 for b in st.fx["books"] if b["title"] == "冪等テスト") == 1
+
+        # 呼び出し側のキー: ツールを呼び直しても同じ生徒は 1 人だけ
+        a = await server.students_create(record={"名前": "冪等花子", "学年": "高1"}, idempotency_key="stu-create-1")
+        b = await server.students_create(record={"名前": "冪等花子", "学年": "高1"}, idempotency_key="stu-create-1")
+        assert a["data"]["id"] == b["data"]["id"] and b["meta"]["replayed"], (a, b)
+        assert sum(1 for x in st.fx["students"] if x["name"] == "冪等花子") == 1
+
+        # 確定の再送は confirm_token 由来のキーで同じ応答（トークンの使い切りで CONFIRM_EXPIRED にならない）
+        prop = await server.books_update(book_id=res["data"]["id"], updates={"unit_load": 3})
+        st.faults[:] = ["lost"]
+        conf = await server.books_update(book_id=res["data"]["id"], confirm_token=prop["data"]["confirm_token"])
+        assert conf.get("ok") and conf["meta"]["replayed"], conf
+
+        # 同じキーが実行中（ヘッジ・早すぎる再送）なら IN_PROGRESS を待って最初の応答を受け取る
+        slot = "planner.plan.set:plan-busy"
+        st.idempotency[slot] = None
+
+        async def finish() -> None:
+            await asyncio.sleep(0.05)
+            st.idempotency[slot] = {"ok": True, "op": "planner.plan.set", "data": {"updated": True, "results": []}}
+        task = asyncio.create_task(finish())
+        res = await server.planner_plan_create(items=[{"week_index": 4, "row": 6, "plan_text": "問1~7"}], spreadsheet_id="SP001", overwrite=True, idempotency_key="plan-busy")
+        await task
+        assert res.get("ok") and server._RESILIENCE.retried.get("planner.plan.set"), (res, server._RESILIENCE.stats())
+        assert st.fx["planners"]["SP001"]["plans"][(4, 6)] == "問1~6", "実行中の書き込みを二重に実行しない"
+
+        # IDEMPOTENCY_KEYS=0 ではキーを送らない
+        os.environ["IDEMPOTENCY_KEYS"] = "0"
+        try:
+            st.reset_calls()
+            await server.planner_plan_create(items=[{"week_index": 4, "row": 6, "plan_text": "問1~8"}], spreadsheet_id="SP001", overwrite=True, idempotency_key="ignored")
+            assert not any(k.endswith(":ignored") for k in st.idempotency), list(st.idempotency)
+        finally:
+            os.environ.pop("IDEMPOTENCY_KEYS")
+        print("idempotency:", server._IDEMPOTENCY, "replays:", st.replays)
+    finally:
+        server._RESILIENCE = prev
+        st.faults.clear()
+        st.supports_idempotency = True
+        st.fx["books"][:], st.fx["students"][:] = books, students
+        st.fx["planners"]["SP001"]["plans"] = saved_plans
+        server._BOOKS.invalidate()
+        server._SHEETS.forget()
+        server._CACHE.clear()
+
+
+async def test_snapshot(st: Standin) -> None:
+    """スナップショット: 書き出した後は読み取りツールが上流を呼ばずに同じ答えを返し、書き込みは拒否する。"""
+    import tempfile
+    from apps.mcp import server, snapshot
+
+    async def reads() -> dict:
+        return {
+            "books_find": await server.books_find("青チャート"),
+            "books_get": await server.books_get(book_ids=["gMB017", "gET007"], fields=["title"]),
+            "books_filter": await server.books_filter(where={"教科": "数学"}),
+            "students_list": await server.students_list(),
+            "students_get": await server.students_get(student_id="S001", fields=["name"]),
+            "students_filter": await server.students_filter(where={"学年": "高2"}),
+            "ids_list": await server.planner_ids_list(student_id="S001"),
+            "dates_get": await server.planner_dates_get(student_id="S001"),
+            "metrics_get": await server.planner_metrics_get(spreadsheet_id="SP001"),
+            "plan_get": await server.planner_plan_get(student_id="S001", weeks=[1, 2], fields=["plan_text"]),
+            "monthly": await server.planner_monthly_filter(year=2025, month=7, student_id="S001"),
+            "plan_targets": await server.planner_plan_targets(student_id="S001"),
+        }
+
+    def data(res: dict) -> dict:
+        assert res.get("ok"), res
+        return {k: v for k, v in res["data"].items() if k not in ("version", "not_modified")}
+
+    path = os.path.join(tempfile.mkdtemp(), "snap.sqlite3")
+    server._CACHE.clear()
+    live = await reads()
+    try:
+        res = await server.snapshot_export(path=path, months=["2025-07"])
+        assert res.get("ok") and not res["data"]["errors"], res
+        d = res["data"]
+        assert d["students"] == 2 and d["sheets"] == 1 and d["grids"] == 5, d  # 在塾生の SP001 のみ
+        assert (await server.snapshot_import(path=path))["data"]["enabled"]
+
+        st.reset_calls()
+        offline = await reads()
+        assert st.requests == 0, f"snapshot-read mode should not call upstream: {dict(st.calls)}"
+        for k in live:
+            assert data(offline[k]) == data(live[k]), (k, offline[k], live[k])
+
+        # 書き込みは拒否、スナップショットにないシート/月は NOT_IN_SNAPSHOT
+        res = await server.planner_plan_create(items=[{"week_index": 1, "row": 4, "plan_text": "x"}], spreadsheet_id="SP001")
+        assert res["error"]["code"] == "SNAPSHOT_READ_ONLY", res
+        res = await server.planner_plan_get(student_id="S002")
+        assert res["error"]["code"] == "NOT_IN_SNAPSHOT", res
+        res = await server.planner_monthly_filter(year=25, month=6, spreadsheet_id="SP001")
+        assert res["error"]["code"] == "NOT_IN_SNAPSHOT", res
+        assert st.requests == 0
+        # SNAPSHOT_FALLBACK=1 ならないものだけ上流へ
+        os.environ["SNAPSHOT_FALLBACK"] = "1"
+        try:
+            res = await server.planner_plan_get(student_id="S002")
+            assert res.get("ok") and st.calls["planner.plan.get"] == 1, (res, dict(st.calls))
+        finally:
+            os.environ.pop("SNAPSHOT_FALLBACK")
+        stats = (await server.cache_stats())["data"]["snapshot"]
+        assert stats["answered"]["planner.plan.get"] >= 1 and stats["fallbacks"] == 2, stats  # plan.get + metrics.get
+        info = snapshot.SnapshotReader(path).stats()
+        print("snapshot:", {k: info[k] for k in ("books", "students", "sheets", "grids")}, "bytes:", os.path.getsize(path))
+    finally:
+        await server.snapshot_import(off=True)
+
+    # 書き出しの途中で失敗したら一時ファイルを残さない（元のスナップショットもそのまま）
+    pack = snapshot._pack
+
+    def broken(obj: object) -> bytes:
+        raise ValueError("disk full")
+
+    snapshot._pack = broken
+    try:
+        await snapshot.export(path, server._post, spreadsheet_ids=["SP001"])
+        raise AssertionError("export should fail")
+    except ValueError:
+        pass
+    finally:
+        snapshot._pack = pack
+    assert os.listdir(os.path.dirname(path)) == ["snap.sqlite3"], os.listdir(os.path.dirname(path))
+
+
+async def test_query_engine(st: Standin) -> None:
+    """books_filter / students_filter のローカルのクエリエンジン: 索引の候補から絞り、in・範囲・前方一致・sort・offset に答える。"""
+    import json
+
+    from apps.mcp import books_mirror, master_sync, server
+    from apps.mcp.query_engine import Table
+
+    # 従来の完全一致/部分一致は books_mirror.filter_books（= GAS の規則）と同じ結果、索引の有無で結果は変わらない
+    fx = scaled_fixtures()
+    indexed = Table(books_mirror.column_values, indexed=("教科",), known=books_mirror.has_column)
+    plain = Table(books_mirror.column_values, known=books_mirror.has_column)
+    indexed.load(fx["books"], 1)
+    plain.load(fx["books"], 1)
+    for where, contains in [({"教科": "数学"}, None), ({"教科": "英語"}, {"章の名前": "第3章"}), (None, {"参考書名": "問題集1"}), ({"教科": "地学"}, None)]:
+        want = books_mirror.filter_books(fx["books"], where, contains, None)["books"]
+        got = indexed.query(where, contains)
+        assert got["rows"] == want and plain.query(where, contains)["rows"] == want, (where, contains)
+        if where:
+            n = sum(1 for b in fx["books"] if b["subject"] == where["教科"])
+            assert got["plan"]["indexes"] == ["教科"] and got["plan"]["scanned"] == n < len(fx["books"]), got["plan"]
+    res = indexed.query({"教科": ["数学", "物理"], "単位当たり処理量": {"gte": 2}}, sort=["-unit_load", "参考書名"], limit=5, offset=3)
+    want = [b for b in fx["books"] if b["subject"] in ("数学", "物理") and (b["unit_load"] or 0) >= 2]
+    want.sort(key=lambda b: books_mirror.normalize(b["title"]))
+    want.sort(key=lambda b: -b["unit_load"])
+    assert res["rows"] == want[3:8] and res["total"] == len(want), res["plan"]
+    assert indexed.query({"参考書名": {"prefix": "合成化学"}})["total"] == 40
+    assert indexed.query({"教科": "数学"}, sort="nope") is None  # 扱えない列は上流へ
+
+    # ツール: ミラー（差分同期の写し）から答える。文字列式の in / 範囲も同じ
+    server._BOOKS.invalidate()
+    os.environ["BOOKS_MIRROR"] = "1"
+    st.reset_calls()
+    res = await server.books_filter(where="subject in (数学, 英語) and unit_load >= 1", sort="-id", limit=1, offset=1)
+    assert res.get("ok") and res["meta"]["plan"]["indexes"] == ["教科"], res
+    both = sorted((b for b in st.fx["books"] if b["subject"] in ("数学", "英語") and (b["unit_load"] or 0) >= 1), key=lambda b: b["id"], reverse=True)
+    assert [b["id"] for b in res["data"]["books"]] == [both[1]["id"]] and res["data"]["total"] == len(both), res
+    bad = await server.books_filter(where={"教科": {"between": [1, 2]}})
+    assert bad["error"]["code"] == "BAD_INPUT", bad
+    bad = await server.books_filter(where={"出版社": ["A社"]})
+    assert bad["error"]["code"] == "BAD_INPUT", bad
+    assert dict(st.calls) == {"books.changed_since": 1}, dict(st.calls)
+
+    # 生徒: 写しは STUDENTS_QUERY_TTL の間は同期し直さない。書き込みの確定で次回に同期
+    server._STUDENTS_SYNC["at"] = 0.0
+    st.reset_calls()
+    res = await server.students_filter(where={"学年": ["高2", "高3"]}, include_all=True, sort="-学年")
+    assert [s["id"] for s in res["data"]["students"]] == ["S002", "S001"] and res["meta"]["source"] == "local", res
+    res = await server.students_filter(where="grade ^= 高")
+    assert [s["id"] for s in res["data"]["students"]] == ["S001"] and res["meta"]["plan"]["indexes"] == ["status"], res
+    assert st.calls["students.changed_since"] == 1 and "students.filter" not in st.calls, dict(st.calls)
+    students = list(st.fx["students"])
+    try:
+        await server.students_create(record={"名前": "索引次郎", "学年": "高2"})
+        res = await server.students_filter(where={"学年": "高2"}, contains={"名前": "索引"})
+        assert res["data"]["count"] == 1 and st.calls["students.changed_since"] == 2, (res, dict(st.calls))
+        # ID が空の行・同じ ID の 2 行目も写しに残り、GAS の students.filter と同じ行を返す（差分同期でも全件取得でも）
+        from apps.mcp.tests.gas_standin import _student
+        s0 = st.fx["students"][0]
+        st.fx["students"] += [_student("", "ID無し", "高2", ""), {**s0, "name": "重複ID", "row": {**s0["row"], "名前": "重複ID"}}]
+        server._STUDENTS_SYNC["at"] = 0.0
+        canon = lambda rows: sorted(json.dumps(s, ensure_ascii=False, sort_keys=True) for s in rows)  # noqa: E731
+        want = canon(st.students_filter({"where": {"Status": "在塾"}})["data"]["students"])
+        res = await server.students_filter(limit=1000)
+        assert res["meta"]["source"] == "local" and canon(res["data"]["students"]) == want, res["data"]["count"]
+        assert len(want) == len(st.fx["students"]) - sum(s["row"]["Status"] != "在塾" for s in st.fx["students"])
+        st.fx["students"][-2]["name"] = "ID無し（改）"
+        server._STUDENTS_SYNC["at"] = 0.0
+        res = await server.students_filter(where={"学年": "高2"}, limit=1000)
+        assert [s["name"] for s in res["data"]["students"]].count("ID無し（改）") == 1 and "ID無し" not in [s["name"] for s in res["data"]["students"]], res
+        full = master_sync.MemoryCopy("students")
+        full.apply(None, True, st.fx["students"], [], master_sync.row_keys(st.fx["students"]))
+        assert full.count() == len(st.fx["students"])
+        # STUDENTS_QUERY=0 は従来どおり GAS の students.filter
+        os.environ["STUDENTS_QUERY"] = "0"
+        try:
+            res = await server.students_filter(where={"学年": "高2"})
+            assert res.get("ok") and st.calls["students.filter"] == 1, dict(st.calls)
+        finally:
+            os.environ.pop("STUDENTS_QUERY")
+    finally:
+        st.fx["students"][:] = students
+        server._SHEETS.forget()
+        server._CACHE.clear()
+        server._STUDENTS_SYNC["at"] = 0.0
+    print("query engine:", server._BOOKS_TABLE.stats(), server._STUDENTS_TABLE.stats())
+
+
+async def test_monthly_history(st: Standin) -> None:
+    """複数月の実績: キャッシュにない月だけを 1 回の batch で取り、参考書ごとのペースを集計。締まった月は以後キャッシュから。"""
+    from apps.mcp import server
+    from apps.mcp.tests.gas_standin import _monthly_item
+
+    monthly = st.fx["planners"]["SP001"]["monthly"]
+    saved = list(monthly)
+    monthly.append(_monthly_item(2, 25, 8, "gMB017", "数学", "青チャート数学I+A", ["例題33~44", "例題33~44", "例題45~56", ""]))
+    server._HISTORY.clear()
+    server._CACHE.clear()
+    await server._SHEETS.refresh()
+    st.reset_calls()
+    try:
+        res = await server.planner_monthly_history(student_id="S001", from_month="2025-06", to_month="25/8")
+        assert res.get("ok"), res
+        d = res["data"]
+        assert [m["month"] for m in d["months"]] == ["2025-06", "2025-07", "2025-08"] and not d["errors"], d
+        assert st.calls["planner.monthly.filter"] == 3 and st.requests == 1, dict(st.calls)
+        by = {b["book_id"]: b for b in d["books"]}
+        blue = by["gMB017"]
+        # 7 月: 4 週で 32、8 月: 3 週で 24（同じ範囲の 2 回目は 0）
+        assert blue["weeks_observed"] == 7 and blue["units_total"] == 68 and blue["advance_total"] == 56, blue
+        assert [m["advance_per_week"] for m in blue["trend"]["per_month"]] == [8.0, 8.0] and blue["trend"]["direction"] == "flat", blue
+        assert blue["minutes_per_unit"] == round(960 / 56, 2) and blue["last_actual"] == "例題45~56", blue
+        assert by["gET007"]["advance_per_week"] == 100.0 and by["gET007"]["trend"]["slope_per_month"] is None
+
+        # 締まった月はキャッシュから（上流 0）。book_id で絞れる
+        st.reset_calls()
+        res = await server.planner_monthly_history(spreadsheet_id="SP001", months=["2025-07", "2025-08"], book_id="gMB017", include_items=True)
+        assert st.requests == 0 and all(m["cached"] for m in res["data"]["months"]), (dict(st.calls), res["data"]["months"])
+        assert [b["book_id"] for b in res["data"]["books"]] == ["gMB017"] and len(res["data"]["items"]["2025-08"]) == 1, res
+        assert server._HISTORY.stats()["closed_entries"] >= 3
+
+        bad = await server.planner_monthly_history(student_id="S001", months="2025-13")
+        assert bad["error"]["code"] == "BAD_INPUT", bad
+        bad = await server.planner_monthly_history(student_id="S001", from_month="2023-01", to_month="2025-01")
+        assert bad["error"]["code"] == "BAD_INPUT", bad
+        res = await server.planner_monthly_history(spreadsheet_id="SP404", months=["2025-07"])
+        assert not res.get("ok") and res["error"]["code"] == "NOT_FOUND", res
+    finally:
+        monthly[:] = saved
+        server._HISTORY.clear()
+    print("monthly history:", server._HISTORY.stats())
+
+
+async def test_plan_targets_pace(st: Standin) -> None:
+    """pace=true: シートの月（2025-08）までの月間管理の実績と記入済みの週から週の量を推定し、確かさを数値で返す。"""
+    from apps.mcp import server
+
+    plans = st.fx["planners"]["SP001"]["plans"]
+    saved = dict(plans)
+    plans.clear()
+    plans.update({(1, 4): "例題1~10", (1, 5): "No.1~100", (2, 4): "例題11~20"})  # 既定のフィクスチャの記入
+    server._HISTORY.clear()
+    server._CACHE.clear()
+    try:
+        await _plan_targets_pace(st)
+    finally:
+        plans.clear()
+        plans.update(saved)
+        server._HISTORY.clear()
+        server._CACHE.clear()
+
+
+async def _plan_targets_pace(st: Standin) -> None:
+    from apps.mcp import server
+
+    base = await server.planner_plan_targets(student_id="S001")
+    assert base.get("ok") and "pace" not in base["data"], base
+    server._CACHE.clear()
+    st.reset_calls()
+    res = await server.planner_plan_targets(student_id="S001", pace=True)
+    assert res.get("ok"), res
+    assert res["data"]["pace"] == {"months": ["2025-06", "2025-07", "2025-08"], "books_observed": 2, "errors": []}, res["data"]["pace"]
+    assert st.calls["planner.monthly.filter"] == 3 and st.calls["batch"] == 2, dict(st.calls)
+    by = {(t["week_index"], t["row"]): t for t in res["data"]["targets"]}
+    was = {(t["week_index"], t["row"]): t for t in base["data"]["targets"]}
+    # 青チャ: 7 月の実績（週 8）+ 記入済みの 2 週（10, 10）→ 目安量 10 へ縮約して 9
+    blue = by[(3, 4)]
+    assert blue["suggested_amount"] == 9 and blue["suggested_plan_text"] == "例題21~29", blue
+    assert blue["pace"]["observed_weeks"] == 6 and blue["suggestion_confidence"] > was[(3, 4)]["suggestion_confidence"], blue
+    # ターゲット: 実績は週 100 → 目安量 10 より大きく進める
+    assert by[(2, 5)]["suggested_amount"] > 10 and by[(2, 5)]["suggested_plan_text"].startswith("No.101~"), by[(2, 5)]
+    # 履歴のない書籍・目安量のない行は従来どおり
+    assert by[(1, 6)]["suggested_plan_text"] == was[(1, 6)]["suggested_plan_text"] and by[(1, 7)]["suggested_plan_text"] is None
+    assert all(isinstance(t["suggestion_confidence"], float) and 0 < t["suggestion_confidence"] <= 1 for t in by.values())
+
+    # 締まった月はキャッシュから（月間管理は上流 0）。bulk も pace を渡す
+    server._CACHE.clear()
+    st.reset_calls()
+    bulk = await server.planner_plan_targets_bulk(student_ids=["S001"], pace=True)
+    assert "planner.monthly.filter" not in st.calls, dict(st.calls)
+    got = bulk["data"]["results"][0]["targets"]
+    assert [t["suggested_plan_text"] for t in got] == [t["suggested_plan_text"] for t in res["data"]["targets"]], got
+    print("plan targets pace:", {k: (v["suggested_amount"], v["suggestion_confidence"]) for k, v in by.items() if v.get("pace")})
+
+
+async def main() -> None:
+    from apps.mcp.http_pool import close_client
+    from apps.mcp.tests import test_suggest
+
+    test_suggest.main()
+
+    st = Standin()
+    with serve(st) as url:
+        os.environ["EXEC_URL"] = url
+        try:
+            await test_plan_targets_fanout(st)
+            await test_plan_get_fanout(st)
+            await test_batch_fallback(st)
+            await test_books_mirror(st)
+            await test_response_cache(st)
+            await test_singleflight(st)
+            await test_token_store(st)
+            await test_plan_targets_bulk()
+            await test_resilience(st)
+            await test_metrics(st)
+            await test_tracing(st)
+            await test_projection(st)
+            await test_payload()
+            await test_versions(st)
+            await test_delta_sync(st)
+            await test_exec_transport(st)
+            await test_planner_sheets(st)
+            await test_plan_create_bulk(st)
+            await test_idempotency(st)
+            await test_snapshot(st)
+            await test_query_engine(st)
+            await test_monthly_history(st)
+            await test_plan_targets_pace(st)
+        finally:
+            await close_client()
+    print("ALL LOCAL TESTS PASSED ✔")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,169 @@
+"""suggest.py（目次に沿った計画の叩き台）の単体テスト。スタンドイン不要。
+
+    uv run python apps/mcp/tests/test_suggest.py
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../..")))
+
+from apps.mcp.suggest import build_index, pace_model, parse_plan_text, plan_units, suggest_row, suggest_targets  # noqa: E402
+
+
+def _ch(title, start, end, numbering, idx=None):
+    return {"idx": idx, "title": title, "range": {"start": start, "end": end}, "numbering": numbering}
+
+
+# 連番（章をまたいで番号が続く）: 青チャート型
+AOCHART = [_ch("数と式", 1, 40, "例題", 1), _ch("2次関数", 41, 90, "例題", 2), _ch("図形と計量", 91, 120, "例題", 3)]
+# 章ごとにリセット: 文法問題集型
+SCRAMBLE = [_ch("第1章", 1, 60, "問", 1), _ch("第2章", 1, 45, "問", 2), _ch("第3章", 1, 30, "問", 3)]
+# 章ごとに記号が違う（リセット）: 例題 → 演習
+MIXED_SYM = [_ch("基本例題", 1, 50, "例題", 1), _ch("演習問題", 1, 80, "演習", 2)]
+# 単語帳（1 章）
+TANGO = [_ch("全範囲", 1, 1900, "No.", 1)]
+
+
+def _weeks(*cells):
+    """(plan_text, guideline_amount) の並び → suggest_row 用の週。plan_text が None の週を対象にする。"""
+    return [{"week_index": i + 1, "plan_text": t or "", "target": t is None, "guideline_amount": ga} for i, (t, ga) in enumerate(cells)]
+
+
+def test_build_index_modes() -> None:
+    assert build_index(AOCHART).mode == "carry"
+    assert build_index(SCRAMBLE).mode == "reset"
+    assert build_index(TANGO).mode == "single"
+    assert build_index([_ch("a", 1, 10, "問"), _ch("b", 5, 20, "問")]).mode == "mixed"
+    assert build_index([]) is None and build_index([{"title": "x", "range": None}]) is None
+    idx = build_index(SCRAMBLE)
+    assert [c.base for c in idx.chapters] == [0, 60, 105] and idx.total == 135
+    assert [idx.chapter_at(p) for p in (0, 59, 60, 104, 105, 134)] == [0, 0, 1, 1, 2, 2]
+
+
+def test_parse_plan_text() -> None:
+    r = parse_plan_text("例題18~27")
+    assert (r.end, r.chapter, r.symbol) == (27, None, "例題")
+    r = parse_plan_text("第２章 問１〜１２")  # 全角は NFKC で揃える
+    assert (r.end, r.chapter, r.symbol) == (12, 2, "問")
+    r = parse_plan_text("例題18~20、第2章 例題1~7 ★完了！")
+    assert (r.end, r.chapter, r.symbol) == (7, 2, "例題")
+    assert parse_plan_text("No.1500まで").end == 1500
+    assert parse_plan_text("") is None and parse_plan_text("復習") is None
+
+
+def test_carry_crosses_chapter() -> None:
+    idx = build_index(AOCHART)
+    out = suggest_row(idx, _weeks(("例題31~40", 10), (None, 10), (None, 10)))
+    assert [o["suggested_plan_text"] for o in out] == ["例題41~50", "例題51~60"]
+    assert out[0]["suggestion_confidence"] == 0.77
+    # 章の境目をまたいでも記号が同じなら 1 区間
+    out = suggest_row(idx, _weeks(("例題1~35", 10), (None, 10)))
+    assert out[0]["suggested_plan_text"] == "例題36~45"
+    assert [(s["chapter_idx"], s["start"], s["end"]) for s in out[0]["suggested_segments"]] == [(1, 36, 40), (2, 41, 45)]
+
+
+def test_reset_uses_chapter_boundaries() -> None:
+    idx = build_index(SCRAMBLE)
+    # 第1章の終わりをまたぐ → 第2章は 1 から
+    out = suggest_row(idx, _weeks(("第1章 問41~55", 15), (None, 15), (None, 15)))
+    assert out[0]["suggested_plan_text"] == "第1章 問56~60、第2章 問1~10", out
+    assert out[1]["suggested_plan_text"] == "第2章 問11~25"
+    # 章の手がかりなし: 番号を含む最初の章とみなし、確度を下げる
+    out = suggest_row(idx, _weeks(("問20~30", 10), (None, 10)))
+    assert out[0]["suggested_plan_text"] == "第1章 問31~40" and out[0]["suggestion_confidence"] == 0.55
+    # 前週までの章の位置を引き継ぐ（第2章に入った後の「問5~8」は第2章）
+    out = suggest_row(idx, _weeks(("第2章 問1~4", 4), ("問5~8", 4), (None, 4)))
+    assert out[0]["suggested_plan_text"] == "第2章 問9~12", out
+
+
+def test_per_chapter_symbols() -> None:
+    idx = build_index(MIXED_SYM)
+    out = suggest_row(idx, _weeks(("例題41~48", 10), (None, 10)))
+    assert out[0]["suggested_plan_text"] == "基本例題 例題49~50、演習問題 演習1~8", out
+    assert out[0]["numbering_symbol"] == "例題"
+    # 記号で章が決まる（演習 → 第2章）
+    out = suggest_row(idx, _weeks(("演習10~20", 10), (None, 10)))
+    assert out[0]["suggested_plan_text"] == "演習問題 演習21~30" and out[0]["suggestion_confidence"] == 0.77
+    assert out[0]["numbering_symbol"] == "演習"
+
+
+def test_end_of_book() -> None:
+    idx = build_index(TANGO)
+    out = suggest_row(idx, _weeks(("No.1801~1880", 100), (None, 100), (None, 100)))
+    assert out[0]["suggested_plan_text"] == "No.1881~1900 ★完了！" and out[0]["end_of_book"]
+    assert out[1]["suggested_plan_text"] is None and out[1]["end_of_book"]
+
+
+def test_no_history_and_no_toc() -> None:
+    out = suggest_row(build_index(AOCHART), _weeks((None, 10), (None, 10)))
+    assert [o["suggested_plan_text"] for o in out] == ["例題1~10", "例題11~20"]
+    assert out[0]["suggestion_confidence"] == 0.51
+    # 目次なし: 前回の終わり +1 から（従来どおり）
+    out = suggest_row(None, _weeks(("12~20", 5), (None, 5)))
+    assert out[0]["suggested_plan_text"] == "問21~25" and out[0]["suggestion_confidence"] == 0.3
+    # 目安量がない週の後は位置が推定になる
+    out = suggest_row(build_index(AOCHART), _weeks(("例題1~10", 10), (None, None), (None, 10)))
+    assert out[0]["suggested_plan_text"] is None and out[1]["suggested_plan_text"] == "例題11~20"
+    assert out[1]["suggestion_confidence"] == 0.55
+
+
+def test_suggest_targets_batch() -> None:
+    idx = {"gMB017": build_index(AOCHART), "gEB001": build_index(SCRAMBLE)}
+    row_to_book = {4: "gMB017", 6: "gEB001", 7: None}
+    plans = {1: {4: {"plan_text": "例題1~10"}, 6: {"plan_text": "第1章 問1~55"}}}
+    mk = lambda ga: {"weekly_minutes": 120, "guideline_amount": ga}  # noqa: E731
+    metrics = {wi: {4: mk(10), 6: mk(10), 7: {"weekly_minutes": 60, "guideline_amount": None}} for wi in (1, 2, 3)}
+    out = suggest_targets(3, row_to_book, plans, metrics, idx)
+    assert [(t["week_index"], t["row"]) for t in out] == [(1, 7), (2, 4), (2, 6), (2, 7), (3, 4), (3, 6), (3, 7)]
+    by = {(t["week_index"], t["row"]): t for t in out}
+    assert by[(2, 4)]["suggested_plan_text"] == "例題11~20" and by[(3, 4)]["suggested_plan_text"] == "例題21~30"
+    assert by[(2, 6)]["suggested_plan_text"] == "第1章 問56~60、第2章 問1~5"
+    assert by[(3, 6)]["prev_range_hint"] == "第1章 問1~55" and by[(3, 6)]["suggested_plan_text"] == "第2章 問6~15"
+    assert by[(2, 7)]["suggested_plan_text"] is None and by[(2, 7)]["book_id"] is None
+
+
+def test_pace_model() -> None:
+    assert plan_units("例題18~27") == 10 and plan_units("第1章 問56~60、第2章 問1~5") == 10 and plan_units("復習") is None
+    # 観測なし: 目安量そのまま（量の確かさは目安量のみ）
+    p = pace_model(10, [])
+    assert (p.amount, p.confidence, p.observed_weeks) == (10, 0.85, 0)
+    # 安定した観測（週 8）は目安量 10 より観測寄りに縮約、確かさは目安量のみより高い
+    p = pace_model(10, [8, 8, 9, 7, 8])
+    assert p.amount == 9 and p.observed_weeks == 5 and p.observed_mean == 8.0 and p.confidence > 0.85
+    assert pace_model(10, [8] * 40).amount == 8
+    # ばらつきが大きい → 確かさは下がる。1 週だけ → ばらつきは分からないので目安量のみと同じ
+    assert pace_model(10, [2, 20]).confidence < 0.85
+    one = pace_model(10, [7])
+    assert one.confidence == 0.85 and one.cv is None
+    # 揃った観測が増えても確かさは下がらない
+    confs = [pace_model(10, [10] * n).confidence for n in range(8)]
+    assert all(a <= b for a, b in zip(confs, confs[1:])) and confs[-1] > confs[0], confs
+    # 目安量なし: 観測の平均
+    assert pace_model(None, [5, 7]).amount == 6 and pace_model(None, []) is None
+
+
+def test_suggest_targets_pace() -> None:
+    idx = {"gMB017": build_index(AOCHART)}
+    plans = {1: {4: {"plan_text": "例題1~6"}}, 2: {4: {"plan_text": "例題7~12"}}}
+    metrics = {wi: {4: {"weekly_minutes": 120, "guideline_amount": 10}} for wi in (1, 2, 3, 4)}
+    base = suggest_targets(4, {4: "gMB017"}, plans, metrics, idx)
+    assert base[0]["suggested_plan_text"] == "例題13~22" and base[0]["suggested_amount"] == 10 and "pace" not in base[0]
+    # 月間の実績（週 6）+ 記入済みの 2 週（6, 6）→ (6*6 + 2*10) / 8 = 7
+    out = suggest_targets(4, {4: "gMB017"}, plans, metrics, idx, {"gMB017": [6, 6, 6, 6]})
+    assert [t["suggested_plan_text"] for t in out] == ["例題13~19", "例題20~26"]
+    assert out[0]["suggested_amount"] == 7 and out[0]["pace"]["observed_weeks"] == 6 and out[0]["pace"]["cv"] == 0.0
+    assert out[0]["suggestion_confidence"] > base[0]["suggestion_confidence"]
+    # 履歴のない書籍でも記入済みの週は観測になる
+    out = suggest_targets(4, {4: "gMB017"}, plans, metrics, idx, {})
+    assert out[0]["pace"]["observed_weeks"] == 2 and out[0]["suggested_amount"] == 8
+
+
+def main() -> None:
+    for name, fn in sorted(globals().items()):
+        if name.startswith("test_") and callable(fn):
+            fn()
+    print("SUGGEST TESTS PASSED ✔")
+
+
+if __name__ == "__main__":
+    main()
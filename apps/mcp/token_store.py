@@ -0,0 +1,226 @@
+"""プレビュー→確定（propose/confirm）用のトークンストア。
+
+- TTL 経過で失効（PREVIEW_TTL 秒, 既定 300 = GAS 側の CacheService と同じ）
+- 件数上限（PREVIEW_MAX, 既定 1000）を超えたら最も古く使われたものから追い出す（LRU）
+- バックエンドは差し替え可能
+  - memory: プロセス内（既定）
+  - sqlite: ファイル共有（PREVIEW_STORE=sqlite, PREVIEW_STORE_PATH）。同じファイルを見る
+    ワーカー/インスタンス間で confirm できる
+- 未確定（outstanding）/ 失効（expired）/ 確定（confirmed）/ 追い出し（evicted）の件数を返す
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any
+
+
+def _env_float(key: str, default: float) -> float:
+    try:
+        return float(os.environ.get(key, "") or default)
+    except ValueError:
+        return default
+
+
+class MemoryBackend:
+    name = "memory"
+
+    def __init__(self) -> None:
+        self._items: "OrderedDict[str, tuple[str, float]]" = OrderedDict()
+        self._counters: dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def put(self, token: str, payload: str, expires: float) -> None:
+        with self._lock:
+            self._items[token] = (payload, expires)
+            self._items.move_to_end(token)
+
+    def get(self, token: str, now: float, remove: bool) -> tuple[str | None, bool]:
+        """(payload, 失効していたか)。remove=True なら取り出して消す。"""
+        with self._lock:
+            item = self._items.get(token)
+            if item is None:
+                return None, False
+            if item[1] <= now:
+                del self._items[token]
+                return None, True
+            if remove:
+                del self._items[token]
+            else:
+                self._items.move_to_end(token)
+            return item[0], False
+
+    def sweep(self, now: float) -> int:
+        with self._lock:
+            dead = [t for t, (_, exp) in self._items.items() if exp <= now]
+            for t in dead:
+                del self._items[t]
+            return len(dead)
+
+    def evict(self, max_entries: int) -> int:
+        with self._lock:
+            n = 0
+            while len(self._items) > max_entries:
+                self._items.popitem(last=False)
+                n += 1
+            return n
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+    def incr(self, name: str, n: int = 1) -> None:
+        if n:
+            with self._lock:
+                self._counters[name] = self._counters.get(name, 0) + n
+
+    def counters(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self._counters)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+
+class SQLiteBackend:
+    """SQLite ファイルで共有するバックエンド（WAL・短いトランザクション）。カウンタも共有する。"""
+
+    name = "sqlite"
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        d = os.path.dirname(os.path.abspath(path))
+        os.makedirs(d, exist_ok=True)
+        self._local = threading.local()
+        with self._tx() as c:
+            c.execute("CREATE TABLE IF NOT EXISTS preview_tokens (token TEXT PRIMARY KEY, payload TEXT NOT NULL, expires REAL NOT NULL, used REAL NOT NULL)")
+            c.execute("CREATE INDEX IF NOT EXISTS preview_tokens_used ON preview_tokens(used)")
+            c.execute("CREATE TABLE IF NOT EXISTS preview_counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    class _Tx:
+        def __init__(self, conn: sqlite3.Connection) -> None:
+            self.conn = conn
+
+        def __enter__(self) -> sqlite3.Connection:
+            self.conn.execute("BEGIN IMMEDIATE")
+            return self.conn
+
+        def __exit__(self, exc_type: Any, *_: Any) -> None:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+    def _tx(self) -> "_Tx":
+        return self._Tx(self._conn())
+
+    def put(self, token: str, payload: str, expires: float) -> None:
+        with self._tx() as c:
+            c.execute("INSERT OR REPLACE INTO preview_tokens(token, payload, expires, used) VALUES (?,?,?,?)", (token, payload, expires, time.time()))
+
+    def get(self, token: str, now: float, remove: bool) -> tuple[str | None, bool]:
+        with self._tx() as c:
+            row = c.execute("SELECT payload, expires FROM preview_tokens WHERE token=?", (token,)).fetchone()
+            if row is None:
+                return None, False
+            if row[1] <= now:
+                c.execute("DELETE FROM preview_tokens WHERE token=?", (token,))
+                return None, True
+            if remove:
+                c.execute("DELETE FROM preview_tokens WHERE token=?", (token,))
+            else:
+                c.execute("UPDATE preview_tokens SET used=? WHERE token=?", (time.time(), token))
+            return row[0], False
+
+    def sweep(self, now: float) -> int:
+        with self._tx() as c:
+            return c.execute("DELETE FROM preview_tokens WHERE expires<=?", (now,)).rowcount
+
+    def evict(self, max_entries: int) -> int:
+        with self._tx() as c:
+            return c.execute(
+                "DELETE FROM preview_tokens WHERE token IN (SELECT token FROM preview_tokens ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (max_entries,),
+            ).rowcount
+
+    def count(self) -> int:
+        return self._conn().execute("SELECT COUNT(*) FROM preview_tokens").fetchone()[0]
+
+    def incr(self, name: str, n: int = 1) -> None:
+        if n:
+            with self._tx() as c:
+                c.execute("INSERT INTO preview_counters(name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value=value+excluded.value", (name, n))
+
+    def counters(self) -> dict[str, int]:
+        return {k: v for k, v in self._conn().execute("SELECT name, value FROM preview_counters")}
+
+    def clear(self) -> None:
+        with self._tx() as c:
+            c.execute("DELETE FROM preview_tokens")
+
+
+class TokenStore:
+    def __init__(self, backend: Any = None, ttl: float = 300.0, max_entries: int = 1000) -> None:
+        self.backend = backend or MemoryBackend()
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+    @classmethod
+    def from_env(cls) -> "TokenStore":
+        kind = os.environ.get("PREVIEW_STORE", "memory").strip().lower()
+        if kind in ("sqlite", "file"):
+            backend: Any = SQLiteBackend(os.environ.get("PREVIEW_STORE_PATH") or "/tmp/cram-books-preview.sqlite3")
+        else:
+            backend = MemoryBackend()
+        return cls(backend, ttl=_env_float("PREVIEW_TTL", 300.0), max_entries=int(_env_float("PREVIEW_MAX", 1000)))
+
+    def put(self, payload: dict) -> str:
+        now = time.time()
+        self.backend.incr("expired", self.backend.sweep(now))
+        token = str(uuid.uuid4())
+        self.backend.put(token, json.dumps(payload, ensure_ascii=False), now + self.ttl)
+        self.backend.incr("issued")
+        self.backend.incr("evicted", self.backend.evict(self.max_entries))
+        return token
+
+    def _get(self, token: str, remove: bool) -> dict | None:
+        if not token:
+            return None
+        raw, expired = self.backend.get(str(token), time.time(), remove)
+        if expired:
+            self.backend.incr("expired")
+        return json.loads(raw) if raw is not None else None
+
+    def get(self, token: str) -> dict | None:
+        return self._get(token, remove=False)
+
+    def pop(self, token: str) -> dict | None:
+        """確定用に取り出す（1 回限り）。見つからない/失効していれば None。"""
+        payload = self._get(token, remove=True)
+        if payload is not None:
+            self.backend.incr("confirmed")
+        return payload
+
+    def stats(self) -> dict:
+        self.backend.incr("expired", self.backend.sweep(time.time()))
+        c = self.backend.counters()
+        return {
+            "backend": self.backend.name,
+            "outstanding": self.backend.count(),
+            "issued": c.get("issued", 0),
+            "confirmed": c.get("confirmed", 0),
+            "expired": c.get("expired", 0),
+            "evicted": c.get("evicted", 0),
+            "ttl_seconds": self.ttl,
+            "max_entries": self.max_entries,
+        }
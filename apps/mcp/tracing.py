@@ -0,0 +1,141 @@
+"""ツール呼び出し単位の軽量トレース。
+
+- MCP ツール呼び出しごとに trace_id を発行し、上流 op ごとの span（開始オフセット・所要時間・送受信バイト数・
+  error.code・GAS 側の処理時間）を親子つきで記録する
+- trace_id は GAS へのリクエストにも付ける（GAS 側は meta.trace_id/elapsed_ms を返し、実行ログにも残す）
+- 直近のトレースはリングバッファ（TRACE_BUFFER 件, 既定 200）に保持し、trace_get ツールと /debug/traces で参照する
+- ペイロードのログは LOG_PAYLOADS=1 のときだけ、LOG_PAYLOAD_MAX 文字（既定 500）に切り詰めて整形する
+"""
+import contextlib
+import contextvars
+import json
+import os
+import sys
+import time
+import uuid
+from collections import deque
+from typing import Any, Awaitable, Callable, Iterator
+
+
+def _env_int(key: str, default: int) -> int:
+    try:
+        return int(os.environ.get(key, "") or default)
+    except ValueError:
+        return default
+
+
+class Trace:
+    __slots__ = ("trace_id", "tool", "started", "t0", "duration_ms", "ok", "error_code", "spans", "_seq")
+
+    def __init__(self, tool: str) -> None:
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.tool = tool
+        self.started = time.time()
+        self.t0 = time.perf_counter()
+        self.duration_ms: float | None = None
+        self.ok: bool | None = None
+        self.error_code: str | None = None
+        self.spans: list[dict] = []
+        self._seq = 0
+
+    def offset_ms(self) -> float:
+        return round((time.perf_counter() - self.t0) * 1000, 2)
+
+    def summary(self) -> dict:
+        upstream = [s for s in self.spans if s.get("kind") == "upstream"]
+        return {
+            "trace_id": self.trace_id,
+            "tool": self.tool,
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "duration_ms": self.duration_ms,
+            "ok": self.ok,
+            "error_code": self.error_code,
+            "upstream_requests": len(upstream),
+            "bytes_sent": sum(s.get("req_bytes") or 0 for s in upstream),
+            "bytes_received": sum(s.get("resp_bytes") or 0 for s in upstream),
+        }
+
+    def to_dict(self) -> dict:
+        return {**self.summary(), "spans": list(self.spans)}
+
+
+_TRACE: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("cram_trace", default=None)
+_SPAN: contextvars.ContextVar[int | None] = contextvars.ContextVar("cram_span", default=None)
+_RECENT: deque = deque(maxlen=_env_int("TRACE_BUFFER", 200))
+
+
+def current_trace_id() -> str | None:
+    tr = _TRACE.get()
+    return tr.trace_id if tr else None
+
+
+async def trace_tool(tool: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+    """ツール 1 回ぶんのトレースを開始する（入れ子のツール呼び出しは外側のトレースに含める）。"""
+    if _TRACE.get() is not None:
+        return await fn()
+    tr = Trace(tool)
+    token = _TRACE.set(tr)
+    try:
+        res = await fn()
+    except Exception as e:
+        tr.ok, tr.error_code = False, type(e).__name__
+        raise
+    else:
+        tr.ok = not (isinstance(res, dict) and res.get("ok") is False)
+        if not tr.ok:
+            tr.error_code = str((res.get("error") or {}).get("code") or "UNKNOWN")
+        return res
+    finally:
+        tr.duration_ms = tr.offset_ms()
+        _TRACE.reset(token)
+        _RECENT.append(tr)
+
+
+@contextlib.contextmanager
+def span(name: str, kind: str = "internal", **attrs: Any) -> Iterator[dict]:
+    """トレース中なら span を 1 つ記録する（トレース外では記録せず、空の dict を返す）。"""
+    tr = _TRACE.get()
+    if tr is None:
+        yield {}
+        return
+    tr._seq += 1
+    sp: dict[str, Any] = {"id": tr._seq, "parent": _SPAN.get(), "name": name, "kind": kind, "start_ms": tr.offset_ms(), **attrs}
+    tr.spans.append(sp)
+    token = _SPAN.set(sp["id"])
+    t0 = time.perf_counter()
+    try:
+        yield sp
+    except Exception as e:
+        sp["error"] = type(e).__name__
+        raise
+    finally:
+        sp["duration_ms"] = round((time.perf_counter() - t0) * 1000, 2)
+        _SPAN.reset(token)
+
+
+def recent(limit: int = 20, tool: str | None = None) -> list[dict]:
+    out = [t.summary() for t in reversed(_RECENT) if not tool or t.tool == tool]
+    return out[:max(0, limit)]
+
+
+def find(trace_id: str) -> dict | None:
+    for t in reversed(_RECENT):
+        if t.trace_id == trace_id:
+            return t.to_dict()
+    return None
+
+
+def clear() -> None:
+    _RECENT.clear()
+
+
+def log_request(method: str, url: str, payload: Any, op: str | None = None) -> None:
+    """上流リクエストのログ。既定は op と trace_id の 1 行だけで、ペイロードは LOG_PAYLOADS=1 のときだけ整形する。"""
+    if op is None:
+        op = (payload if isinstance(payload, dict) else dict(payload or [])).get("op")
+    line = f"{method} op={op} trace={current_trace_id() or '-'}"
+    if os.environ.get("LOG_PAYLOADS", "0").strip().lower() in ("1", "true", "on", "yes"):
+        limit = _env_int("LOG_PAYLOAD_MAX", 500)
+        body = json.dumps(payload, ensure_ascii=False, default=str)
+        line += f" {url} " + (body if len(body) <= limit else body[:limit] + f"...(+{len(body) - limit} chars)")
+    print(line, file=sys.stderr, flush=True)